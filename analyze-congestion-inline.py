@@ -10,12 +10,36 @@ Usage in Visum Console:
 
 Usage via TCP/MCP:
     Send this entire script as Python code to execute
+
+If import-osm-network.py was exec'd in the same console, link and zone
+columns come from its session NetworkSnapshot (get_network_snapshot), so
+attributes already read by earlier steps are not fetched again over COM.
+Link columns are always re-read: assignment results change outside the
+snapshot (GUI runs, Procedures.Execute() in other scripts).
+Otherwise each collection is read with one GetMultipleAttributes call.
 """
 
 # Configuration
 ANALYSIS_PERIOD = "AP"
 TOP_N = 10
 
+
+def read_columns(collection_name, attrs, refresh=False):
+    """
+    {attr: list of values} for a Visum.Net collection, one COM read per collection.
+    refresh=True drops the collection from the session snapshot first.
+    """
+    snapshot_fn = globals().get("get_network_snapshot")
+    if snapshot_fn is not None:
+        if refresh:
+            invalidate_network_snapshot(collection_name)
+        columns = snapshot_fn(Visum).get(collection_name, attrs)
+        return {attr: values.tolist() for attr, values in columns.items()}
+    rows = getattr(Visum.Net, collection_name).GetMultipleAttributes(attrs)
+    values = list(zip(*rows)) if rows else [()] * len(attrs)
+    return {attr: list(col) for attr, col in zip(attrs, values)}
+
+
 try:
     # Find top congested links
     links = Visum.Net.Links
@@ -29,52 +53,34 @@ try:
     print(f"   • Total links in network: {total_links:,}")
     print(f"   • Retrieving attribute: {attr_vc}")
     
-    # Retrieve data - GetMultiAttValues returns tuple of (index, value) pairs
-    vc_data_raw = links.GetMultiAttValues(attr_vc)
+    # Retrieve all link columns in one read (fresh: assignment results)
+    link_attrs = [attr_vc, "FROMNODENO", "TONODENO", attr_vol, "LENGTH",
+                  "CAPPRT", "TYPENO", "NAME"]
+    try:
+        columns = read_columns("Links", link_attrs + ["V0PRT"], refresh=True)
+    except Exception:
+        columns = read_columns("Links", link_attrs, refresh=True)
+    
+    vc_ratios = columns[attr_vc]
     
-    print(f"   • VC data type: {type(vc_data_raw)}")
-    print(f"   • VC data length: {len(vc_data_raw)}")
-    print(f"   • First 3 items: {vc_data_raw[:3]}")
+    print(f"   • VC data length: {len(vc_ratios)}")
     
     # Check if we got data
-    if not isinstance(vc_data_raw, (tuple, list)) or len(vc_data_raw) == 0:
+    if len(vc_ratios) == 0:
         raise ValueError(f"No data returned for {attr_vc}. Assignment may not be executed.")
     
-    # Extract just the values (second element of each tuple)
-    vc_ratios = [item[1] if isinstance(item, tuple) else item for item in vc_data_raw]
-    
     print(f"   • Total values: {len(vc_ratios):,}")
     print(f"   • First 5 VC ratios: {vc_ratios[:5]}")
     print(f"   • Max VC ratio: {max(vc_ratios):.3f}")
     
-    # Get node IDs (FromNode and ToNode) - extract values from (index, value) tuples
-    from_nodes_raw = links.GetMultiAttValues("FROMNODENO")
-    from_nodes = [item[1] if isinstance(item, tuple) else item for item in from_nodes_raw]
-    
-    to_nodes_raw = links.GetMultiAttValues("TONODENO")
-    to_nodes = [item[1] if isinstance(item, tuple) else item for item in to_nodes_raw]
-    
-    # Get other attributes - extract values
-    volumes_raw = links.GetMultiAttValues(attr_vol)
-    volumes = [item[1] if isinstance(item, tuple) else item for item in volumes_raw]
-    
-    lengths_raw = links.GetMultiAttValues("LENGTH")
-    lengths = [item[1] if isinstance(item, tuple) else item for item in lengths_raw]
-    
-    capacities_raw = links.GetMultiAttValues("CAPPRT")
-    capacities = [item[1] if isinstance(item, tuple) else item for item in capacities_raw]
-    
-    type_nos_raw = links.GetMultiAttValues("TYPENO")
-    type_nos = [item[1] if isinstance(item, tuple) else item for item in type_nos_raw]
-    
-    names_raw = links.GetMultiAttValues("NAME")
-    names = [item[1] if isinstance(item, tuple) else item for item in names_raw]
-    
-    try:
-        v0_speeds_raw = links.GetMultiAttValues("V0PRT")
-        v0_speeds = [item[1] if isinstance(item, tuple) else item for item in v0_speeds_raw]
-    except:
-        v0_speeds = [None] * len(vc_ratios)
+    from_nodes = columns["FROMNODENO"]
+    to_nodes = columns["TONODENO"]
+    volumes = columns[attr_vol]
+    lengths = columns["LENGTH"]
+    capacities = columns["CAPPRT"]
+    type_nos = columns["TYPENO"]
+    names = columns["NAME"]
+    v0_speeds = columns.get("V0PRT", [None] * len(vc_ratios))
     
     # Build congested links list
     congested_links = []
@@ -376,9 +382,8 @@ try:
                                     print(f"         Matrix SUM = {matrix_sum:.2f}")
                                     print(f"         Zones = {zone_count}")
                                     
-                                    # Get all zone numbers using GetMultiAttValues
-                                    zone_numbers_raw = zones.GetMultiAttValues("NO")
-                                    zone_numbers = [item[1] if isinstance(item, tuple) else item for item in zone_numbers_raw]
+                                    # Get all zone numbers (one read, shared snapshot if available)
+                                    zone_numbers = read_columns("Zones", ["NO"])["NO"]
                                     
                                     print(f"         Zone numbers: {zone_numbers[:10]}... (showing first 10)")
                                     
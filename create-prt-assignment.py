@@ -197,6 +197,11 @@ def execute_procedures(visum):
     except Exception as e:
         print(f"\n❌ ERRORE durante l'esecuzione: {e}")
         raise
+    finally:
+        # Snapshot di rete di import-osm-network.py (se caricato nella stessa
+        # console): i risultati dell'assegnazione sono cambiati
+        if globals().get("invalidate_network_snapshot") is not None:
+            invalidate_network_snapshot()
 
 
 def main():
@@ -120,6 +120,11 @@ try:
         import traceback
         traceback.print_exc()
         raise
+    finally:
+        # Snapshot di rete di import-osm-network.py (se caricato in questa
+        # console): volumi e tempi letti prima dell'esecuzione non valgono piu'
+        if globals().get("invalidate_network_snapshot") is not None:
+            invalidate_network_snapshot()
     
     end_time = datetime.now()
     duration = (end_time - start_time).total_seconds()
@@ -7,6 +7,8 @@ Utilizza il metodo IIO.ImportOpenStreetMap della COM API
 
 import os
 import sys
+import functools
+import numpy as np
 import win32com.client
 from pathlib import Path
 import subprocess
@@ -67,6 +69,241 @@ DEFAULT_LINKTYPE_MAPPING = {
 }
 
 
+# ============================================================================
+# SCRITTURA ATTRIBUTI COM IN BLOCCO
+# ============================================================================
+
+# Oggetti per blocco nel fallback SetAttValue (avanzamento nel log)
+BULK_WRITE_CHUNK = 5000
+
+
+def _com_value(value):
+    """Scalari numpy -> tipi Python (COM non accetta np.int64/np.float64)."""
+    return value.item() if hasattr(value, "item") else value
+
+
+class BulkAttributeWriter:
+    """
+    Raccoglie aggiornamenti (indice oggetto, attributo, valore) su una
+    collezione COM Visum (Net.Links, Net.Nodes, ...) e li scrive con una
+    sola chiamata per attributo invece di un SetAttValue per oggetto
+    (ogni chiamata COM e' un round trip tra processi).
+
+    Gli indici sono 1-based nella collezione, come la prima colonna di
+    GetMultiAttValues. flush() prova per ogni attributo, nell'ordine:
+      1. SetMultiAttValues(attr, ((indice, valore), ...))
+      2. SetMultipleAttributes([attr], righe) sull'intera collezione
+         (valori correnti da GetMultipleAttributes + aggiornamenti)
+      3. SetAttValue oggetto per oggetto su GetAll, a blocchi di chunk_size
+    Il primo metodo in blocco riuscito viene provato per primo ai flush
+    successivi.
+
+    Della collezione servono solo questi metodi: per i test senza Visum
+    basta un oggetto finto che ne implementi un sottoinsieme.
+
+    Esempio:
+        >>> writer = BulkAttributeWriter(Visum.Net.Links)
+        >>> for idx, type_no in Visum.Net.Links.GetMultiAttValues("TypeNo"):
+        ...     writer.set(idx, "TypeNo", new_type(type_no))
+        >>> writer.flush()
+        {'TypeNo': 1234}
+    """
+
+    BULK_METHODS = ("SetMultiAttValues", "SetMultipleAttributes")
+
+    def __init__(self, collection, chunk_size=BULK_WRITE_CHUNK):
+        self.collection = collection
+        self.chunk_size = max(int(chunk_size), 1)
+        self.pending    = {}      # attributo -> {indice 1-based: valore}
+        self.method     = None    # ultimo metodo in blocco riuscito
+        self.stats      = {"bulk_calls": 0, "object_writes": 0}
+        self._objects   = None
+
+    def __len__(self):
+        return sum(len(updates) for updates in self.pending.values())
+
+    def set(self, index, attr, value):
+        """Registra un aggiornamento (a parita' di indice vince l'ultimo)."""
+        self.pending.setdefault(attr, {})[int(index)] = _com_value(value)
+
+    def flush(self):
+        """Scrive gli aggiornamenti in sospeso; ritorna {attributo: oggetti scritti}."""
+        written = {}
+        pending, self.pending = self.pending, {}
+        try:
+            for attr, updates in pending.items():
+                if updates:
+                    self._write(attr, sorted(updates.items()))
+                    written[attr] = len(updates)
+        finally:
+            # La collezione non e' nota per nome: colonna scartata da tutte
+            invalidate_network_snapshot(attrs=list(pending))
+        return written
+
+    def _write(self, attr, items):
+        methods = sorted(self.BULK_METHODS, key=lambda m: m != self.method)
+        errors = []
+        for method in methods:
+            try:
+                if method == "SetMultiAttValues":
+                    self.collection.SetMultiAttValues(attr, tuple(items))
+                else:
+                    self._set_multiple_attributes(attr, items)
+            except Exception as e:
+                errors.append("{}: {}".format(method, e))
+                continue
+            self.method = method
+            self.stats["bulk_calls"] += 1
+            return
+
+        print("  ⚠ Scrittura in blocco di {} non riuscita ({}); "
+              "SetAttValue su {} oggetti".format(attr, "; ".join(errors), len(items)))
+        self._write_objects(attr, items)
+
+    def _set_multiple_attributes(self, attr, items):
+        rows = [list(row) for row in self.collection.GetMultipleAttributes([attr])]
+        for index, value in items:
+            rows[index - 1][0] = value
+        self.collection.SetMultipleAttributes([attr], tuple(tuple(r) for r in rows))
+
+    def _write_objects(self, attr, items):
+        if self._objects is None:
+            self._objects = self.collection.GetAll
+        for start in range(0, len(items), self.chunk_size):
+            for index, value in items[start:start + self.chunk_size]:
+                self._objects[index - 1].SetAttValue(attr, value)
+            self.stats["object_writes"] += len(items[start:start + self.chunk_size])
+            if len(items) > self.chunk_size:
+                print("    {}: {}/{} oggetti".format(
+                    attr, min(start + self.chunk_size, len(items)), len(items)))
+
+
+# ============================================================================
+# SNAPSHOT RETE IN MEMORIA (NumPy)
+# ============================================================================
+
+# Snapshot della sessione console (vedi get_network_snapshot)
+_NETWORK_SNAPSHOT = None
+
+
+def _snapshot_column(values):
+    """Valori COM di un attributo -> array int64 / float64 / object."""
+    if len(values) and isinstance(values[0], str):
+        return np.asarray(values, dtype=object)
+    try:
+        arr = np.asarray(values, dtype=np.float64)
+    except (TypeError, ValueError):
+        return np.asarray(values, dtype=object)
+    if np.isfinite(arr).all() and (arr == np.round(arr)).all() and (np.abs(arr) < 2 ** 53).all():
+        return arr.astype(np.int64)
+    return arr
+
+
+class NetworkSnapshot:
+    """
+    Copia in memoria di colonne di attributi delle collezioni di visum.Net
+    (Links, Nodes, Zones, Connectors, ...) in array NumPy.
+
+    get() legge le colonne non ancora in cache con UNA chiamata
+    GetMultipleAttributes per collezione, invece di un GetMultiAttValues
+    per attributo da scompattare tupla per tupla. Le righe seguono
+    l'ordine della collezione: la riga i e' l'oggetto con indice 1-based
+    i + 1 (index(), da passare a BulkAttributeWriter).
+
+    Tipi: numeriche con soli valori interi -> int64, altre numeriche ->
+    float64 (valori vuoti = NaN), testo -> object.
+
+    La cache vale per la sessione finche':
+      - BulkAttributeWriter.flush() scrive un attributo (colonna scartata)
+      - execute_procedures() o le funzioni che modificano la rete
+        (@invalidates_network_snapshot) terminano (tutto scartato)
+      - cambia il numero di oggetti di una collezione (tabella scartata)
+      - si chiama invalidate_network_snapshot() (modifiche fatte fuori da
+        queste funzioni, es. da GUI o con SetAttValue diretti)
+
+    Esempio:
+        >>> snap = get_network_snapshot()
+        >>> cols = snap.get("Nodes", ["No", "XCoord", "YCoord"])
+        >>> cols["XCoord"].mean()
+    """
+
+    def __init__(self, visum):
+        self.visum  = visum
+        self.tables = {}     # collezione -> {"count": n, "columns": {ATTR: array}}
+        self.stats  = {"com_reads": 0, "cache_hits": 0}
+
+    def get(self, collection, attrs):
+        """{attributo: array} della collezione, nell'ordine degli oggetti."""
+        coll = getattr(self.visum.Net, collection)
+        count = int(coll.Count)
+        table = self.tables.get(collection)
+        if table is None or table["count"] != count:
+            table = self.tables[collection] = {"count": count, "columns": {}}
+        columns = table["columns"]
+
+        missing = [a for a in dict.fromkeys(attrs) if a.upper() not in columns]
+        if missing:
+            rows = coll.GetMultipleAttributes(missing) if count else ()
+            values = list(zip(*rows)) if rows else [()] * len(missing)
+            for attr, col in zip(missing, values):
+                columns[attr.upper()] = _snapshot_column(col)
+            self.stats["com_reads"] += 1
+        else:
+            self.stats["cache_hits"] += 1
+        return {a: columns[a.upper()] for a in attrs}
+
+    def index(self, collection):
+        """Indici 1-based degli oggetti (righe di get()) della collezione."""
+        return np.arange(1, int(getattr(self.visum.Net, collection).Count) + 1)
+
+    def invalidate(self, collection=None, attrs=None):
+        """Scarta le colonne attrs (tutte se None) della collezione (tutte se None)."""
+        for name in ([collection] if collection else list(self.tables)):
+            if name not in self.tables:
+                continue
+            if attrs is None:
+                del self.tables[name]
+            else:
+                for attr in attrs:
+                    self.tables[name]["columns"].pop(attr.upper(), None)
+
+
+def get_network_snapshot(visum=None):
+    """Snapshot della sessione per l'istanza Visum (creato al primo uso)."""
+    global _NETWORK_SNAPSHOT
+    if visum is None:
+        visum = Visum
+    if _NETWORK_SNAPSHOT is None or _NETWORK_SNAPSHOT.visum is not visum:
+        _NETWORK_SNAPSHOT = NetworkSnapshot(visum)
+    return _NETWORK_SNAPSHOT
+
+
+def invalidate_network_snapshot(collection=None, attrs=None):
+    """Scarta dallo snapshot di sessione le colonne indicate (tutto se senza argomenti)."""
+    if _NETWORK_SNAPSHOT is not None:
+        _NETWORK_SNAPSHOT.invalidate(collection, attrs)
+
+
+def invalidates_network_snapshot(func):
+    """Decoratore per le funzioni che modificano la rete: snapshot scartato all'uscita."""
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        finally:
+            invalidate_network_snapshot()
+    return wrapper
+
+
+def execute_procedures(visum):
+    """visum.Procedures.Execute() + invalidazione dello snapshot (volumi, TCur, ...)."""
+    try:
+        visum.Procedures.Execute()
+    finally:
+        invalidate_network_snapshot()
+
+
+@invalidates_network_snapshot
 def import_osm_network(osm_file_path, config_preset="Detailed urban network", 
                        save_net_file=True, clipping=0, 
                        coord_min=None, coord_max=None, visum_version="2025",
@@ -776,68 +1013,46 @@ def change_linktype_by_mapping(linktype_mapping=None, only_selected=True):
         if only_selected:
             print("Modifico solo i link attivi (OnlyActive=True)")
             # Usa GetMultiAttValues con OnlyActive=True per ottenere solo link attivi
-            active_data = visum.Net.Links.GetMultiAttValues("TypeNo", True)
-            total_links = len(active_data)
+            link_data = visum.Net.Links.GetMultiAttValues("TypeNo", True)
+            total_links = len(link_data)
             print("Link attivi trovati: {}".format(total_links))
             
             if total_links == 0:
                 result["message"] = "Nessun link attivo da modificare"
                 print(result["message"])
                 return result
-            
-            # Ottieni tutti i link per accedere per indice
-            all_links = visum.Net.Links.GetAll
-            
-            # Conta i cambiamenti per tipo
-            changes = {}
-            changed_count = 0
-            
-            # active_data è un array: [[link_index, TypeNo], ...]
-            # link_index è 1-based (indice nella lista GetAll)
-            for row in active_data:
-                link_index = int(row[0]) - 1  # Converti da 1-based a 0-based
-                current_type = int(row[1])
-                
-                if current_type in linktype_mapping:
-                    new_type = linktype_mapping[current_type]
-                    
-                    if current_type != new_type:
-                        # Ottieni il link dalla lista GetAll
-                        link = all_links[link_index]
-                        link.SetAttValue("TypeNo", new_type)
-                        changed_count += 1
-                        
-                        # Traccia i cambiamenti
-                        key = "{} -> {}".format(current_type, new_type)
-                        changes[key] = changes.get(key, 0) + 1
         else:
             print("Modifico tutti i link")
-            total_links = visum.Net.Links.Count
+            link_data = visum.Net.Links.GetMultiAttValues("TypeNo")
+            total_links = len(link_data)
             print("Link da processare: {}".format(total_links))
             
             if total_links == 0:
                 result["message"] = "Nessun link da modificare"
                 print(result["message"])
                 return result
+        
+        # Conta i cambiamenti per tipo
+        changes = {}
+        writer = BulkAttributeWriter(visum.Net.Links)
+        
+        # link_data è un array: [[link_index, TypeNo], ...]
+        # link_index è 1-based (indice nella lista GetAll)
+        for row in link_data:
+            current_type = int(row[1])
             
-            # Conta i cambiamenti per tipo
-            changes = {}
-            changed_count = 0
-            
-            # Processa ogni link
-            for link in visum.Net.Links:
-                current_type = link.AttValue("TypeNo")
+            if current_type in linktype_mapping:
+                new_type = linktype_mapping[current_type]
                 
-                if current_type in linktype_mapping:
-                    new_type = linktype_mapping[current_type]
+                if current_type != new_type:
+                    writer.set(row[0], "TypeNo", new_type)
                     
-                    if current_type != new_type:
-                        link.SetAttValue("TypeNo", new_type)
-                        changed_count += 1
-                        
-                        # Traccia i cambiamenti
-                        key = "{} -> {}".format(current_type, new_type)
-                        changes[key] = changes.get(key, 0) + 1
+                    # Traccia i cambiamenti
+                    key = "{} -> {}".format(current_type, new_type)
+                    changes[key] = changes.get(key, 0) + 1
+        
+        # Una sola scrittura COM per tutti i link modificati
+        changed_count = writer.flush().get("TypeNo", 0)
         
         result["status"] = "success"
         result["changed_count"] = changed_count
@@ -863,6 +1078,7 @@ if __name__ == "__main__":
     main()
 
 
+@invalidates_network_snapshot
 def apply_linktype_defaults():
     """
     STEP 4 OPZIONALE: Applica valori di default dai LinkTypes a tutti i link.
@@ -1575,7 +1791,10 @@ def create_speed_optimization_config(
         sample_od_pairs=None,
         random_seed=42,
         speed_delta_lower_pct=None,
-        speed_delta_upper_pct=None):
+        speed_delta_upper_pct=None,
+        skim_engine="csr",
+        n_workers=1,
+        resume_from=None):
     """
     Crea il file config.json per run_speed_optimization_subprocess().
 
@@ -1616,6 +1835,13 @@ def create_speed_optimization_config(
         speed_delta_upper_pct (float|None): [per_arc] % aumento max (es. 20.0 = +20%). Default: None
             Se entrambi None, usa speed_delta_arc_kmh (bounds assoluti).
             Se forniti, abilita anche il remapping 4-digit BBSC.
+        skim_engine (str): Motore shortest path: 'csr' (scipy su array CSR),
+            'cch' (gerarchia customizzabile, ordine di contrazione in cache su disco)
+            o 'networkx' (riferimento, per confronto su reti piccole). Default: 'csr'
+        n_workers (int): Processi per lo skim 'csr' (1 = seriale, 0 = tutti i core).
+            Risultati identici alla modalità seriale. Default: 1
+        resume_from (str|None): Checkpoint (optimization_checkpoint.npz o output_dir
+            di un run interrotto, es. per timeout) da cui riprendere. Default: None
 
     Returns:
         str: Path al file config.json temporaneo creato
@@ -1657,6 +1883,9 @@ def create_speed_optimization_config(
         "random_seed":           random_seed,
         "speed_delta_lower_pct": speed_delta_lower_pct,
         "speed_delta_upper_pct": speed_delta_upper_pct,
+        "skim_engine":           skim_engine,
+        "n_workers":             n_workers,
+        "resume_from":           str(resume_from) if resume_from else None,
     }
 
     temp_file = tempfile.NamedTemporaryFile(
@@ -1703,6 +1932,8 @@ def run_speed_optimization_subprocess(
             "links_remapped_csv": str,   # Path a links_remapped.csv (BBSC TYPENO)
             "linktype_stats_csv": str,   # Path a linktype_stats.csv
             "typeno_applied": dict,      # Risultato apply_typeno_remap_to_visum (solo se visum_instance fornito)
+            "trace": dict,               # Riepilogo fasi (tempi, picco RSS, contatori Dijkstra/solver)
+            "trace_file": str,           # Path a trace.json (dettaglio per fase e iterazione)
         }
 
     Esempio (senza aggiornamento automatico Visum):
@@ -1735,6 +1966,8 @@ def run_speed_optimization_subprocess(
         "links_remapped_csv": "",
         "linktype_stats_csv": "",
         "typeno_applied":    None,
+        "trace":             None,
+        "trace_file":        "",
     }
 
     try:
@@ -1866,6 +2099,11 @@ def run_speed_optimization_subprocess(
                 lf.write("\n" + "=" * 70 + "\n")
                 lf.write("ExitCode: {}\n".format(process.returncode))
 
+            # trace.json: scritto anche se l'ottimizzazione fallisce
+            trace_file = Path(output_dir) / "trace.json"
+            if trace_file.exists():
+                result["trace_file"] = str(trace_file)
+
             if process.returncode == 0:
                 flag_file  = Path(output_dir) / "optimization_complete.flag"
                 speeds_file = Path(output_dir) / "optimized_speeds.csv"
@@ -1879,6 +2117,7 @@ def run_speed_optimization_subprocess(
                     result["optimized_speeds"]  = flag_data.get("optimized_speeds", {})
                     result["links_remapped_csv"] = flag_data.get("links_remapped_csv", "")
                     result["linktype_stats_csv"] = flag_data.get("linktype_stats_csv", "")
+                    result["trace"]             = flag_data.get("trace")
                 else:
                     result["status"]  = "success"
                     result["message"] = "Subprocess completato (flag non trovato)"
@@ -1896,6 +2135,13 @@ def run_speed_optimization_subprocess(
                     except Exception:
                         pass
 
+                if result["trace"]:
+                    print("\nTempi per fase:")
+                    for stage, seconds in result["trace"].get("stages", {}).items():
+                        print("  {:24s} {:8.2f} s".format(stage, seconds))
+                    print("  Picco RSS: {} MB  |  trace: {}".format(
+                        result["trace"].get("peak_rss_mb"), result["trace_file"]))
+
                 print("\nLog completo: {}".format(log_path))
 
                 # ── Auto-importa TypeNo in Visum se handle fornito
@@ -1908,6 +2154,12 @@ def run_speed_optimization_subprocess(
             else:
                 result["message"] = "Subprocess terminato con errore (code: {}). Log: {}".format(
                     process.returncode, log_path)
+                if result["trace_file"]:
+                    try:
+                        with open(result["trace_file"], "r", encoding="utf-8") as f:
+                            result["trace"] = json.load(f)
+                    except (OSError, ValueError):
+                        pass
                 print("[ERRORE] {}".format(result["message"]))
 
         except subprocess.TimeoutExpired:
@@ -2127,8 +2379,8 @@ def apply_typeno_remap_to_visum(remap_csv_path, Visum=None):
 
     Legge il CSV prodotto da optimize_link_speeds.py (save_results), che contiene
     FROMNODENO, TONODENO, TYPENO_NEW (oppure TYPENO_OPT per il vecchio pipeline).
-    Usa GetMultiAttValues per bulk-leggere FromNodeNo/ToNodeNo, poi SetAttValue per
-    aggiornare solo gli archi che cambiano tipo.
+    Legge FromNodeNo/ToNodeNo/TypeNo dallo snapshot di rete (NetworkSnapshot), poi
+    BulkAttributeWriter per scrivere in blocco solo gli archi che cambiano tipo.
 
     Args:
         remap_csv_path (str): Path a links_remapped.csv
@@ -2207,13 +2459,10 @@ def apply_typeno_remap_to_visum(remap_csv_path, Visum=None):
 
     print("Archi con tipo cambiato nel CSV: {}".format(len(remap_dict)))
 
-    # ── Bulk-leggi attributi link da Visum
+    # ── Bulk-leggi attributi link da Visum (snapshot)
     try:
-        all_links       = Visum.Net.Links.GetAll
-        link_fromnodes  = Visum.Net.Links.GetMultiAttValues("FromNodeNo")
-        link_tonodes    = Visum.Net.Links.GetMultiAttValues("ToNodeNo")
-        link_typenums   = Visum.Net.Links.GetMultiAttValues("TypeNo")
-        n_total         = len(link_fromnodes)
+        links   = get_network_snapshot(Visum).get("Links", ["FromNodeNo", "ToNodeNo", "TypeNo"])
+        n_total = len(links["TypeNo"])
     except Exception as e:
         ret["message"] = "Errore lettura link da Visum: {}".format(e)
         print("✗ " + ret["message"])
@@ -2225,14 +2474,13 @@ def apply_typeno_remap_to_visum(remap_csv_path, Visum=None):
     # ── Applica aggiornamenti
     n_matched = 0
     n_changed = 0
+    writer = BulkAttributeWriter(Visum.Net.Links)
     try:
-        for i in range(n_total):
-            idx_1based   = int(link_fromnodes[i][0])
-            fn           = int(link_fromnodes[i][1])
-            tn           = int(link_tonodes[i][1])
-            current_type = int(link_typenums[i][1])
-
-            new_type = remap_dict.get((fn, tn))
+        link_rows = zip(links["FromNodeNo"].tolist(), links["ToNodeNo"].tolist(),
+                        links["TypeNo"].tolist())
+        for i, (fn, tn, current_type) in enumerate(link_rows):
+            idx_1based = i + 1
+            new_type = remap_dict.get((int(fn), int(tn)))
             if new_type is None:
                 continue
 
@@ -2240,10 +2488,11 @@ def apply_typeno_remap_to_visum(remap_csv_path, Visum=None):
             if new_type == current_type:
                 continue  # già corretto, nessuna scrittura COM necessaria
 
-            link = all_links[idx_1based - 1]  # GetAll è 0-based, indice 1-based → -1
-            link.SetAttValue("TypeNo", new_type)
+            writer.set(idx_1based, "TypeNo", new_type)
             n_changed += 1
 
+        writer.flush()
+
     except Exception as e:
         ret["message"] = "Errore durante aggiornamento link (dopo {} modifiche): {}".format(
             n_changed, e)
@@ -2265,6 +2514,7 @@ def apply_typeno_remap_to_visum(remap_csv_path, Visum=None):
     return ret
 
 
+@invalidates_network_snapshot
 def import_zones_shapefile_with_geometry(shapefile_path, visum_instance=None):
     """
     Importa zone da Shapefile in Visum usando visum.IO (CON geometrie complete)
@@ -2375,6 +2625,7 @@ def import_zones_shapefile_with_geometry(shapefile_path, visum_instance=None):
         return result
 
 
+@invalidates_network_snapshot
 def import_external_zones_from_shapefile(shapefile_path, start_id, name_field=None,
                                          conda_env=None, visum_instance=None):
     """
@@ -3011,6 +3262,7 @@ except Exception as e:
 
 
 
+@invalidates_network_snapshot
 def import_zones_from_geojson(geojson_file, zone_id_field="zone_id", 
                               output_crs="EPSG:4326", 
                               centroid_method="geometric",
@@ -3434,7 +3686,128 @@ def import_zones_from_geojson(geojson_file, zone_id_field="zone_id",
         return result
 
 
-def tag_nodes_with_zone(visum_instance=None):
+# Celle (punti x lati) per blocco nel test punto-in-poligono vettoriale
+POLYGON_TEST_BLOCK = 2000000
+
+
+def _wkt_polygon_rings(wkt):
+    """Anelli (array Nx2) di un POLYGON / MULTIPOLYGON WKT; [] se vuoto."""
+    import re
+    if not isinstance(wkt, str) or "POLYGON" not in wkt.upper():
+        return []
+    rings = []
+    for ring in re.findall(r"\(([^()]+)\)", wkt):
+        vertices = [v.split()[:2] for v in ring.split(",")]
+        arr = np.array([v for v in vertices if len(v) == 2], dtype=np.float64)
+        if len(arr) >= 3:
+            rings.append(arr)
+    return rings
+
+
+def _geojson_zone_rings(geojson_file, zone_id_field="zone_id"):
+    """{zona: [anelli Nx2]} dai Polygon / MultiPolygon di un GeoJSON di zonizzazione."""
+    with open(geojson_file, "r", encoding="utf-8") as f:
+        features = json.load(f).get("features", [])
+    zone_rings = {}
+    for feature in features:
+        geometry = feature.get("geometry") or {}
+        properties = feature.get("properties") or {}
+        if properties.get(zone_id_field) is None:
+            continue
+        if geometry.get("type") == "Polygon":
+            polygons = [geometry["coordinates"]]
+        elif geometry.get("type") == "MultiPolygon":
+            polygons = geometry["coordinates"]
+        else:
+            continue
+        rings = [np.asarray(ring, dtype=np.float64)[:, :2]
+                 for polygon in polygons for ring in polygon if len(ring) >= 3]
+        zone_rings.setdefault(int(properties[zone_id_field]), []).extend(rings)
+    return zone_rings
+
+
+def _points_in_rings(px, py, rings):
+    """
+    Maschera dei punti interni con la regola pari-dispari su tutti gli anelli
+    (buchi e parti di multipoligoni inclusi), vettoriale su punti x lati.
+    """
+    inside = np.zeros(len(px), dtype=bool)
+    for ring in rings:
+        x1, y1 = ring[:, 0], ring[:, 1]
+        x2, y2 = np.roll(x1, -1), np.roll(y1, -1)
+        step = max(1, POLYGON_TEST_BLOCK // len(ring))
+        for start in range(0, len(px), step):
+            X = px[start:start + step, None]
+            Y = py[start:start + step, None]
+            crosses = (y1 > Y) != (y2 > Y)
+            with np.errstate(divide="ignore", invalid="ignore"):
+                x_cross = x1 + (Y - y1) * (x2 - x1) / (y2 - y1)
+            n_cross = np.count_nonzero(crosses & (X < x_cross), axis=1)
+            inside[start:start + step] ^= (n_cross % 2).astype(bool)
+    return inside
+
+
+class _PointGrid:
+    """Griglia uniforme sui punti: righe dei punti che cadono in un rettangolo."""
+
+    def __init__(self, x, y, cell):
+        self.x, self.y = x, y
+        self.cell = float(cell) if cell > 0 else 1.0
+        self.x0, self.y0 = float(x.min()), float(y.min())
+        cx = ((x - self.x0) // self.cell).astype(np.int64)
+        cy = ((y - self.y0) // self.cell).astype(np.int64)
+        self.nx, self.ny = int(cx.max()) + 1, int(cy.max()) + 1
+        keys = cx * self.ny + cy
+        self.order = np.argsort(keys, kind="stable")
+        self.keys = keys[self.order]
+
+    def rows_in_bbox(self, xmin, ymin, xmax, ymax):
+        cx0 = max(int((xmin - self.x0) // self.cell), 0)
+        cx1 = min(int((xmax - self.x0) // self.cell), self.nx - 1)
+        cy0 = max(int((ymin - self.y0) // self.cell), 0)
+        cy1 = min(int((ymax - self.y0) // self.cell), self.ny - 1)
+        if cx0 > cx1 or cy0 > cy1:
+            return np.empty(0, dtype=np.int64)
+        parts = []
+        for cx in range(cx0, cx1 + 1):
+            lo = np.searchsorted(self.keys, cx * self.ny + cy0, side="left")
+            hi = np.searchsorted(self.keys, cx * self.ny + cy1, side="right")
+            parts.append(self.order[lo:hi])
+        rows = np.concatenate(parts)
+        in_box = ((self.x[rows] >= xmin) & (self.x[rows] <= xmax) &
+                  (self.y[rows] >= ymin) & (self.y[rows] <= ymax))
+        return rows[in_box]
+
+
+def _zones_from_polygons(px, py, zone_rings):
+    """
+    Zona di ogni punto dai poligoni ({zona: anelli}, nell'ordine delle zone),
+    0 = fuori da tutti. Punti in piu' zone (bordi, sovrapposizioni): vince
+    la prima. Indice a griglia uniforme sui punti (cella = dimensione
+    mediana delle zone): ogni zona testa solo i punti nel suo rettangolo,
+    quindi il costo cresce circa linearmente con i punti.
+    """
+    zone_of = np.zeros(len(px), dtype=np.int64)
+    boxes = []
+    for zone_no, rings in zone_rings.items():
+        if rings:
+            allv = np.vstack(rings)
+            boxes.append((zone_no, rings, allv.min(axis=0), allv.max(axis=0)))
+    if not boxes or len(px) == 0:
+        return zone_of
+
+    sizes = [max(hi[0] - lo[0], hi[1] - lo[1]) for _, _, lo, hi in boxes]
+    grid = _PointGrid(px, py, float(np.median(sizes)))
+    for zone_no, rings, lo, hi in boxes:
+        rows = grid.rows_in_bbox(lo[0], lo[1], hi[0], hi[1])
+        rows = rows[zone_of[rows] == 0]
+        if len(rows):
+            zone_of[rows[_points_in_rings(px[rows], py[rows], rings)]] = zone_no
+    return zone_of
+
+
+def tag_nodes_with_zone(visum_instance=None, method="polygon", zones_geojson=None,
+                        zone_id_field="zone_id", max_distance=5000):
     """
     Tagga ogni nodo con il numero della zona in cui si trova.
     
@@ -3442,17 +3815,33 @@ def tag_nodes_with_zone(visum_instance=None):
     Questo permette poi di forzare connectors solo verso nodi interni alla zona.
     
     METODO:
-    Per ogni nodo, verifica se le coordinate (X, Y) cadono dentro il poligono
-    della zona usando la geometria delle zone.
+    - "polygon" (default): punto-in-poligono vettoriale sui confini delle zone,
+      letti una volta dall'attributo WKTSurface delle zone Visum oppure dal
+      GeoJSON di zonizzazione (zones_geojson). Indice a griglia uniforme sui
+      nodi: ogni zona testa solo i nodi nel suo rettangolo di ingombro.
+      I nodi fuori da tutti i poligoni vanno al centroide più vicino
+      entro max_distance.
+    - "centroid": solo centroide più vicino entro max_distance (anche
+      fallback automatico se i confini delle zone non sono disponibili).
+    Le distanze dai centroidi sono Haversine in metri (coordinate WGS84,
+    come create_zone_connectors). AddVal2 scritto con una scrittura COM in blocco.
     
     Args:
         visum_instance: Istanza Visum (default: usa Visum da console)
+        method (str): "polygon" o "centroid" (default: "polygon")
+        zones_geojson (str|None): GeoJSON con i poligoni delle zone (default: None =
+            attributo WKTSurface delle zone Visum)
+        zone_id_field (str): Campo ID zona nel GeoJSON (default: "zone_id")
+        max_distance (float): Distanza massima nodo-centroide in metri (default: 5000)
     
     Returns:
         dict: {
             "status": str,
+            "method": str,
             "nodes_tagged": int,
             "nodes_in_zones": int,
+            "nodes_in_polygons": int,
+            "nodes_by_centroid": int,
             "nodes_outside": int,
             "zones_with_nodes": int
         }
@@ -3462,11 +3851,17 @@ def tag_nodes_with_zone(visum_instance=None):
         >>> result = tag_nodes_with_zone()
         >>> print(f"Nodi taggati: {result['nodes_in_zones']}")
         >>> print(f"Nodi fuori zone: {result['nodes_outside']}")
+        >>> 
+        >>> # Confini dal GeoJSON della zonizzazione
+        >>> result = tag_nodes_with_zone(zones_geojson=r"H:\\output\\zoning_0.geojson")
     """
     result = {
         "status": "failed",
+        "method": method,
         "nodes_tagged": 0,
         "nodes_in_zones": 0,
+        "nodes_in_polygons": 0,
+        "nodes_by_centroid": 0,
         "nodes_outside": 0,
         "zones_with_nodes": 0
     }
@@ -3484,97 +3879,89 @@ def tag_nodes_with_zone(visum_instance=None):
         # Reset AddVal2 su tutti i nodi
         print("Reset AddVal2 su tutti i nodi...")
         visum.Net.Nodes.SetAllAttValues("AddVal2", 0)
+        invalidate_network_snapshot("Nodes", ["AddVal2"])
         
-        # Ottieni coordinate nodi
+        # Ottieni coordinate nodi (snapshot: una lettura COM per collezione)
         print("\nCaricamento coordinate nodi...")
-        node_nos = visum.Net.Nodes.GetMultiAttValues("No")
-        node_xs = visum.Net.Nodes.GetMultiAttValues("XCoord")
-        node_ys = visum.Net.Nodes.GetMultiAttValues("YCoord")
+        snapshot = get_network_snapshot(visum)
+        nodes = snapshot.get("Nodes", ["XCoord", "YCoord"])
+        node_xs = nodes["XCoord"].astype(np.float64)
+        node_ys = nodes["YCoord"].astype(np.float64)
         
-        total_nodes = len(node_nos)
+        total_nodes = len(node_xs)
         print(f"Nodi totali: {total_nodes}")
         
         # Ottieni zone con coordinate
         print("Caricamento zone...")
-        zone_nos = visum.Net.Zones.GetMultiAttValues("No")
-        zone_xs = visum.Net.Zones.GetMultiAttValues("XCoord")
-        zone_ys = visum.Net.Zones.GetMultiAttValues("YCoord")
-        
-        # Per ogni zona, calcola coordinate
-        zones_data = {}
-        for i in range(len(zone_nos)):
-            zone_no = int(zone_nos[i][1])
-            zones_data[zone_no] = {
-                'x': float(zone_xs[i][1]),
-                'y': float(zone_ys[i][1])
-            }
+        zones = snapshot.get("Zones", ["No", "XCoord", "YCoord"])
+        zone_nos = zones["No"].astype(np.int64)
+        print(f"Zone totali: {len(zone_nos)}")
         
-        total_zones = len(zones_data)
-        print(f"Zone totali: {total_zones}")
-        
-        # Crea mappatura node_no -> index per accesso veloce
-        print("\nCreazione mappatura nodi...")
-        node_no_to_index = {}
-        for i, row in enumerate(node_nos):
-            node_no = int(row[1])
-            node_no_to_index[node_no] = i
-        
-        # Array diretto per SetAttValue veloce
-        all_nodes = visum.Net.Nodes.GetAll
-        
-        # Per ogni nodo, trova la zona più vicina
-        print("\nAssegnazione nodi a zone...")
-        zones_with_nodes = set()
-        nodes_in_zones = 0
-        max_zone_radius = 5000  # metri
-        
-        for i in range(total_nodes):
-            node_no = int(node_nos[i][1])
-            node_x = float(node_xs[i][1])
-            node_y = float(node_ys[i][1])
-            
-            # Trova zona più vicina al nodo
-            min_distance = float('inf')
-            closest_zone = None
-            
-            for zone_no, zone_coords in zones_data.items():
-                dx = node_x - zone_coords['x']
-                dy = node_y - zone_coords['y']
-                dist = (dx**2 + dy**2)**0.5
-                
-                if dist < min_distance:
-                    min_distance = dist
-                    closest_zone = zone_no
-            
-            # Se la zona più vicina è entro raggio, assegna
-            if closest_zone and min_distance <= max_zone_radius:
-                try:
-                    idx = node_no_to_index[node_no]
-                    all_nodes[idx].SetAttValue("AddVal2", closest_zone)
-                    nodes_in_zones += 1
-                    zones_with_nodes.add(closest_zone)
-                except:
-                    pass
-            
-            # Progress ogni 500 nodi
-            if (i + 1) % 500 == 0:
-                print(f"  Processati {i+1}/{total_nodes} nodi...")
+        zone_of = np.zeros(total_nodes, dtype=np.int64)
         
+        # Poligoni delle zone (una lettura)
+        if method == "polygon":
+            zone_rings = {}
+            try:
+                if zones_geojson:
+                    print("Confini zone da GeoJSON: {}".format(zones_geojson))
+                    zone_rings = _geojson_zone_rings(zones_geojson, zone_id_field)
+                else:
+                    print("Confini zone da WKTSurface...")
+                    wkt = snapshot.get("Zones", ["WKTSurface"])["WKTSurface"]
+                    zone_rings = {int(z): _wkt_polygon_rings(w)
+                                  for z, w in zip(zone_nos.tolist(), wkt.tolist())}
+            except Exception as e:
+                print(f"  ⚠ Confini zone non disponibili: {e}")
+            zone_rings = {z: r for z, r in zone_rings.items() if r}
+            
+            if zone_rings:
+                print(f"Zone con poligono: {len(zone_rings)}")
+                print("\nPunto-in-poligono...")
+                zone_of = _zones_from_polygons(node_xs, node_ys, zone_rings)
+                result["nodes_in_polygons"] = int(np.count_nonzero(zone_of))
+            else:
+                print("  ⚠ Nessun poligono di zona: uso il centroide più vicino")
+                result["method"] = "centroid"
+        
+        # Nodi senza zona -> centroide più vicino entro max_distance
+        outside = np.flatnonzero(zone_of == 0)
+        if len(outside) and len(zone_nos):
+            print("\nCentroide più vicino per {} nodi (max {} m)...".format(
+                len(outside), max_distance))
+            centroid_index = NodeSpatialIndex(zones["XCoord"], zones["YCoord"])
+            nearest, _ = centroid_index.nearest(node_xs[outside], node_ys[outside], max_distance)
+            found = nearest >= 0
+            zone_of[outside[found]] = zone_nos[nearest[found]]
+            result["nodes_by_centroid"] = int(np.count_nonzero(found))
+        
+        # Scrittura AddVal2 in blocco
+        print("Scrittura AddVal2...")
+        writer = BulkAttributeWriter(visum.Net.Nodes)
+        tagged = np.flatnonzero(zone_of)
+        for row, zone_no in zip(tagged.tolist(), zone_of[tagged].tolist()):
+            writer.set(row + 1, "AddVal2", zone_no)
+        writer.flush()
+        
+        nodes_in_zones = len(tagged)
         nodes_outside = total_nodes - nodes_in_zones
+        zones_with_nodes = len(np.unique(zone_of[tagged]))
         
         result["status"] = "success"
         result["nodes_tagged"] = total_nodes
         result["nodes_in_zones"] = nodes_in_zones
         result["nodes_outside"] = nodes_outside
-        result["zones_with_nodes"] = len(zones_with_nodes)
+        result["zones_with_nodes"] = zones_with_nodes
         
         print("\n" + "=" * 70)
         print("✓ TAGGING COMPLETATO")
         print("=" * 70)
         print(f"Nodi totali processati: {total_nodes}")
         print(f"Nodi assegnati a zone: {nodes_in_zones}")
+        print(f"  - dentro un poligono: {result['nodes_in_polygons']}")
+        print(f"  - centroide più vicino: {result['nodes_by_centroid']}")
         print(f"Nodi fuori zone: {nodes_outside}")
-        print(f"Zone con almeno 1 nodo: {len(zones_with_nodes)}")
+        print(f"Zone con almeno 1 nodo: {zones_with_nodes}")
         
         return result
         
@@ -3622,6 +4009,133 @@ def haversine_distance(lon1, lat1, lon2, lat2):
     return distance_m
 
 
+def haversine_distance_array(lon1, lat1, lon2, lat2):
+    """
+    Versione vettoriale (NumPy, con broadcasting) di haversine_distance:
+    stesse operazioni, distanze in METRI.
+    """
+    R = 6371000.0
+
+    lat1_rad = np.radians(lat1)
+    lat2_rad = np.radians(lat2)
+    delta_lat = np.radians(np.subtract(lat2, lat1))
+    delta_lon = np.radians(np.subtract(lon2, lon1))
+
+    a = np.sin(delta_lat/2)**2 + np.cos(lat1_rad) * np.cos(lat2_rad) * np.sin(delta_lon/2)**2
+    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1-a))
+
+    return R * c
+
+
+class NodeSpatialIndex:
+    """
+    Nodi entro un raggio in METRI da punti WGS84 (lon/lat).
+
+    Le coordinate sono proiettate in un piano metrico locale
+    (equirettangolare sulla latitudine media) e indicizzate con
+    scipy.spatial.cKDTree. Il raggio di ricerca nel piano e' allargato
+    del massimo errore di scala della proiezione sull'area (nodi e punti
+    interrogati), poi i candidati sono filtrati con la distanza Haversine
+    esatta: il risultato e' quello del confronto con tutti i nodi.
+    Senza scipy: Haversine vettoriale su tutti i nodi (stesso risultato).
+    nearest() da' il nodo piu' vicino (usato anche sui centroidi zona).
+
+    Esempio:
+        >>> index = NodeSpatialIndex(node_lon, node_lat)
+        >>> for rows, dist in index.within(zone_lon, zone_lat, 1000):
+        ...     ...   # righe dei nodi entro 1000 m e distanze Haversine
+    """
+
+    def __init__(self, lon, lat):
+        self.lon = np.asarray(lon, dtype=np.float64)
+        self.lat = np.asarray(lat, dtype=np.float64)
+        self.lat0 = float(np.radians(self.lat.mean())) if len(self.lat) else 0.0
+        self.tree = None
+        if len(self.lon) == 0:
+            return
+        try:
+            from scipy.spatial import cKDTree
+        except ImportError:
+            print("  ⚠ scipy non disponibile: ricerca nodi senza indice spaziale")
+            return
+        self.tree = cKDTree(self._project(self.lon, self.lat))
+
+    def _project(self, lon, lat):
+        """Piano locale in metri: x = R cos(lat0) lon, y = R lat (radianti)."""
+        R = 6371000.0
+        return np.column_stack([R * np.cos(self.lat0) * np.radians(lon),
+                                R * np.radians(lat)])
+
+    def _search_radius(self, max_distance, lat):
+        """Raggio nel piano che contiene tutti i punti entro max_distance (Haversine)."""
+        max_abs_lat = np.radians(np.abs(np.concatenate([self.lat, lat])).max())
+        scale = max(1.0, np.cos(self.lat0) / max(np.cos(max_abs_lat), 1e-12))
+        return max_distance * scale * 1.001 + 1.0
+
+    def within(self, lon, lat, max_distance):
+        """
+        Per ogni punto (lon[i], lat[i]): (righe dei nodi, distanze Haversine)
+        dei nodi con distanza <= max_distance, in ordine di riga.
+        """
+        lon = np.atleast_1d(np.asarray(lon, dtype=np.float64))
+        lat = np.atleast_1d(np.asarray(lat, dtype=np.float64))
+        if len(self.lon) == 0:
+            return [(np.empty(0, dtype=np.int64), np.empty(0))] * len(lon)
+
+        if self.tree is not None:
+            radius = self._search_radius(max_distance, lat)
+            candidates = self.tree.query_ball_point(self._project(lon, lat), radius)
+        else:
+            candidates = [None] * len(lon)
+
+        result = []
+        for i, cand in enumerate(candidates):
+            rows = (np.arange(len(self.lon)) if cand is None
+                    else np.sort(np.asarray(cand, dtype=np.int64)))
+            dist = haversine_distance_array(lon[i], lat[i], self.lon[rows], self.lat[rows])
+            inside = dist <= max_distance
+            result.append((rows[inside], dist[inside]))
+        return result
+
+    def nearest(self, lon, lat, max_distance=None, k=4):
+        """
+        Per ogni punto: (riga del nodo piu' vicino, distanza Haversine),
+        -1 / inf se nessun nodo entro max_distance. Con l'indice la scelta e'
+        tra i k piu' vicini nel piano locale.
+        """
+        lon = np.atleast_1d(np.asarray(lon, dtype=np.float64))
+        lat = np.atleast_1d(np.asarray(lat, dtype=np.float64))
+        rows = np.full(len(lon), -1, dtype=np.int64)
+        dist = np.full(len(lon), np.inf)
+        n = len(self.lon)
+        if n == 0 or len(lon) == 0:
+            return rows, dist
+
+        if self.tree is not None:
+            k = min(k, n)
+            _, cand = self.tree.query(self._project(lon, lat), k=k)
+            cand = np.asarray(cand, dtype=np.int64).reshape(len(lon), k)
+            step = len(lon)
+        else:
+            step = max(1, POLYGON_TEST_BLOCK // n)
+
+        for start in range(0, len(lon), step):
+            stop = min(start + step, len(lon))
+            c = cand[start:stop] if self.tree is not None else \
+                np.broadcast_to(np.arange(n), (stop - start, n))
+            d = haversine_distance_array(lon[start:stop, None], lat[start:stop, None],
+                                         self.lon[c], self.lat[c])
+            j = np.argmin(d, axis=1)
+            rows[start:stop] = c[np.arange(stop - start), j]
+            dist[start:stop] = d[np.arange(stop - start), j]
+
+        if max_distance is not None:
+            too_far = dist > max_distance
+            rows[too_far] = -1
+            dist[too_far] = np.inf
+        return rows, dist
+
+
 def activate_nodes_by_linktype(linktype_list=None, exclude_linktype_list=None, visum_instance=None):
     """
     Attiva nodi connessi a link di specifici tipi (per usare in connectors).
@@ -3675,83 +4189,54 @@ def activate_nodes_by_linktype(linktype_list=None, exclude_linktype_list=None, v
         
         # Reset AddVal1 su tutti i nodi (Active non esiste sui nodi!)
         visum.Net.Nodes.SetAllAttValues("AddVal1", 0)
+        invalidate_network_snapshot("Nodes", ["AddVal1"])
         
-        # Ottieni tutti gli attributi link in batch (VELOCE!)
+        # Ottieni tutti gli attributi link in batch (snapshot NumPy)
         print("\nCaricamento attributi link...")
-        link_typenums = visum.Net.Links.GetMultiAttValues("TypeNo")
-        link_fromnodes = visum.Net.Links.GetMultiAttValues("FromNodeNo")
-        link_tonodes = visum.Net.Links.GetMultiAttValues("ToNodeNo")
+        snapshot = get_network_snapshot(visum)
+        links = snapshot.get("Links", ["TypeNo", "FromNodeNo", "ToNodeNo"])
+        link_typenums = links["TypeNo"]
+        link_ends = np.concatenate([links["FromNodeNo"], links["ToNodeNo"]])
         
         total_links = len(link_typenums)
         print("Link totali: {}".format(total_links))
         
-        # Set di nodi da attivare e da escludere
-        nodes_to_activate = set()
-        nodes_to_exclude = set()
-        
-        # Filtra in Python (VELOCE - no chiamate COM!)
+        # Filtra con maschere NumPy (no chiamate COM!)
         print("Filtro link per tipo...")
         
         # Se linktype_list è None, include TUTTI i nodi
         if linktype_list is None:
             print("Includo TUTTI i nodi...")
-            for i in range(total_links):
-                from_node = int(link_fromnodes[i][1])
-                to_node = int(link_tonodes[i][1])
-                nodes_to_activate.add(from_node)
-                nodes_to_activate.add(to_node)
+            include = np.ones(total_links, dtype=bool)
         else:
             # Include solo nodi su link types specificati
-            for i in range(total_links):
-                link_typeno = int(link_typenums[i][1])  # [index, value]
-                
-                if link_typeno in linktype_list:
-                    from_node = int(link_fromnodes[i][1])
-                    to_node = int(link_tonodes[i][1])
-                    nodes_to_activate.add(from_node)
-                    nodes_to_activate.add(to_node)
+            include = np.isin(link_typenums, list(linktype_list))
+        nodes_to_activate = np.unique(link_ends[np.tile(include, 2)])
         
         # Se specificato, trova nodi da escludere
         if exclude_linktype_list:
             print("Filtro nodi da escludere...")
-            for i in range(total_links):
-                link_typeno = int(link_typenums[i][1])
-                
-                if link_typeno in exclude_linktype_list:
-                    from_node = int(link_fromnodes[i][1])
-                    to_node = int(link_tonodes[i][1])
-                    nodes_to_exclude.add(from_node)
-                    nodes_to_exclude.add(to_node)
+            exclude = np.isin(link_typenums, list(exclude_linktype_list))
+            nodes_to_exclude = np.unique(link_ends[np.tile(exclude, 2)])
             
             # Rimuovi nodi esclusi da quelli da attivare
-            nodes_to_activate -= nodes_to_exclude
+            nodes_to_activate = np.setdiff1d(nodes_to_activate, nodes_to_exclude)
             result["nodes_excluded"] = len(nodes_to_exclude)
             print("Nodi esclusi: {}".format(len(nodes_to_exclude)))
         
         print("Nodi finali da attivare: {}".format(len(nodes_to_activate)))
         
-        # Attiva i nodi trovati in batch (VELOCE - usa array diretto)
+        # Attiva i nodi trovati in batch (una scrittura COM in blocco)
         print("Attivazione nodi...")
         
-        # Ottieni array nodi e crea mappatura node_no -> index
-        node_nos_data = visum.Net.Nodes.GetMultiAttValues("No")
-        node_no_to_index = {}
-        for i, row in enumerate(node_nos_data):
-            node_no = int(row[1])
-            node_no_to_index[node_no] = i
+        # Righe dei nodi da attivare -> indice 1-based nella collezione
+        node_nos = snapshot.get("Nodes", ["No"])["No"]
+        node_idx = np.flatnonzero(np.isin(node_nos, nodes_to_activate)) + 1
         
-        # Accesso diretto all'array (evita ItemByKey!)
-        all_nodes = visum.Net.Nodes.GetAll
-        
-        activated_count = 0
-        for node_no in nodes_to_activate:
-            if node_no in node_no_to_index:
-                try:
-                    idx = node_no_to_index[node_no]
-                    all_nodes[idx].SetAttValue("AddVal1", 1)
-                    activated_count += 1
-                except:
-                    pass
+        writer = BulkAttributeWriter(visum.Net.Nodes)
+        for idx in node_idx.tolist():
+            writer.set(idx, "AddVal1", 1)
+        activated_count = writer.flush().get("AddVal1", 0)
         
         result["nodes_activated"] = activated_count
         result["status"] = "success"
@@ -3767,6 +4252,7 @@ def activate_nodes_by_linktype(linktype_list=None, exclude_linktype_list=None, v
         return result
 
 
+@invalidates_network_snapshot
 def create_zone_connectors(max_distance=1000, max_connectors_per_zone=5,
                           node_filter_active=False, bidirectional=True,
                           mode="add_all", distribute_by_quadrant=False,
@@ -3786,6 +4272,8 @@ def create_zone_connectors(max_distance=1000, max_connectors_per_zone=5,
     METODO:
     Itera su ogni zona, trova i nodi più vicini entro max_distance,
     e crea connectors usando visum.Net.AddConnector(zone_no, node_no).
+    I nodi entro max_distance vengono cercati con un indice spaziale
+    (NodeSpatialIndex: cKDTree + Haversine esatta sui candidati).
     
     Args:
         max_distance (float): Distanza massima zona-nodo in metri (default: 1000)
@@ -3918,73 +4406,49 @@ def create_zone_connectors(max_distance=1000, max_connectors_per_zone=5,
         # Ottieni coordinate nodi
         print("\nCaricamento coordinate nodi...")
         
-        # GetMultiAttValues richiede UNA stringa per volta
-        node_nos = visum.Net.Nodes.GetMultiAttValues("No")
-        node_xs = visum.Net.Nodes.GetMultiAttValues("XCoord")
-        node_ys = visum.Net.Nodes.GetMultiAttValues("YCoord")
-        
-        if node_filter_active:
-            node_addvals = visum.Net.Nodes.GetMultiAttValues("AddVal1")
+        # Snapshot: tutte le colonne nodi in una lettura COM
+        snapshot = get_network_snapshot(visum)
+        nodes = snapshot.get("Nodes", ["No", "XCoord", "YCoord", "AddVal1", "AddVal2"])
         
-        if only_in_own_zone:
-            node_zone_tags = visum.Net.Nodes.GetMultiAttValues("AddVal2")
+        # Se filtro attivo, solo nodi con AddVal1=1
+        keep = nodes["AddVal1"] == 1 if node_filter_active else np.ones(len(nodes["No"]), dtype=bool)
         
-        # Crea dizionario coordinate nodi (con zona di appartenenza se only_in_own_zone)
-        nodes_coords = {}
-        for i in range(len(node_nos)):
-            node_no = int(node_nos[i][1])  # [index, value]
-            x_coord = float(node_xs[i][1])
-            y_coord = float(node_ys[i][1])
-            
-            # Se filtro attivo, verifica AddVal1=1
-            if node_filter_active:
-                addval = int(node_addvals[i][1])
-                if addval != 1:
-                    continue  # Skip nodi non attivi
-            
-            # Salva coordinate e zona (se only_in_own_zone)
-            node_data = {'x': x_coord, 'y': y_coord}
-            if only_in_own_zone:
-                zone_tag = int(node_zone_tags[i][1])
-                node_data['zone'] = zone_tag
-            
-            nodes_coords[node_no] = node_data
+        # Array nodi disponibili (con zona di appartenenza per only_in_own_zone)
+        node_keys = nodes["No"][keep].astype(np.int64)
+        node_xs = nodes["XCoord"][keep].astype(np.float64)
+        node_ys = nodes["YCoord"][keep].astype(np.float64)
+        node_zone_tags = nodes["AddVal2"][keep]
         
-        print("Nodi disponibili: {}".format(len(nodes_coords)))
+        print("Nodi disponibili: {}".format(len(node_keys)))
         
         # Ottieni coordinate zone
         print("\nCaricamento coordinate zone...")
-        zone_nos = visum.Net.Zones.GetMultiAttValues("No")
-        zone_xs = visum.Net.Zones.GetMultiAttValues("XCoord")
-        zone_ys = visum.Net.Zones.GetMultiAttValues("YCoord")
-        
-        zones_coords = {}
-        for i in range(len(zone_nos)):
-            zone_no = int(zone_nos[i][1])  # [index, value]
-            zones_coords[zone_no] = {
-                'x': float(zone_xs[i][1]),
-                'y': float(zone_ys[i][1])
-            }
+        zones = snapshot.get("Zones", ["No", "XCoord", "YCoord"])
+        zone_list = [int(z) for z in zones["No"].tolist()]
+        zone_xs = zones["XCoord"].astype(np.float64)
+        zone_ys = zones["YCoord"].astype(np.float64)
         
-        print("Zone con coordinate: {}".format(len(zones_coords)))
+        print("Zone con coordinate: {}".format(len(zone_list)))
         
         # IMPORTANTE: Coordinate geografiche WGS84 (lon/lat in gradi)
         # Usa formula di Haversine per calcolare distanze in METRI
         print("Sistema coordinate: WGS84 (lon/lat) - Distanze calcolate con Haversine")
         print("Distanza massima: {} metri".format(max_distance))
         
+        # Nodi entro max_distance da ogni zona: cKDTree su piano metrico
+        # locale + Haversine esatta sui soli candidati (NodeSpatialIndex)
+        print("Indicizzazione spaziale nodi...")
+        node_index = NodeSpatialIndex(node_xs, node_ys)
+        zone_candidates = node_index.within(zone_xs, zone_ys, max_distance)
+        
         # MODE: ADD_MISSING - Filtra zone già connesse
-        zones_to_process = set(zones_coords.keys())
+        zones_to_process = set(zone_list)
         
         if mode == "add_missing":
             print("\nFiltro zone già connesse...")
             # Ottieni zone che hanno già connectors
             if visum.Net.Connectors.Count > 0:
-                connected_zones_data = visum.Net.Connectors.GetMultiAttValues("ZoneNo")
-                connected_zones = set()
-                for row in connected_zones_data:
-                    zone_no = int(row[1])
-                    connected_zones.add(zone_no)
+                connected_zones = set(snapshot.get("Connectors", ["ZoneNo"])["ZoneNo"].tolist())
                 
                 zones_to_skip = zones_to_process & connected_zones
                 zones_to_process -= connected_zones
@@ -4002,74 +4466,42 @@ def create_zone_connectors(max_distance=1000, max_connectors_per_zone=5,
         zones_connected = set()
         zones_not_connected = []
         
-        for zone_no, zone_coords in zones_coords.items():
+        for zone_pos, zone_no in enumerate(zone_list):
             # Skip zone se mode="add_missing" e zona già connessa
             if mode == "add_missing" and zone_no not in zones_to_process:
                 continue
             
-            zone_x = zone_coords['x']
-            zone_y = zone_coords['y']
+            # Nodi entro max_distance (righe degli array nodi) e distanze in METRI
+            rows, dists = zone_candidates[zone_pos]
             
-            # Calcola distanze e angoli a tutti i nodi
-            distances = []
-            for node_key, coords in nodes_coords.items():
-                # Se only_in_own_zone, salta nodi di altre zone
-                if only_in_own_zone:
-                    node_zone = coords.get('zone', 0)
-                    if node_zone != zone_no:
-                        continue  # Nodo appartiene a un'altra zona
-                
-                # Calcola distanza geografica con Haversine (in METRI)
-                # Coordinate: x=longitude, y=latitude
-                dist_m = haversine_distance(
-                    zone_coords['x'], zone_coords['y'],
-                    coords['x'], coords['y']
-                )
-                
-                if dist_m <= max_distance:
-                    # Calcola angolo approssimativo (OK per piccole distanze)
-                    dx = coords['x'] - zone_coords['x']
-                    dy = coords['y'] - zone_coords['y']
-                    import math
-                    angle = math.degrees(math.atan2(dy, dx))
-                    if angle < 0:
-                        angle += 360
-                    
-                    distances.append((dist_m, angle, node_key))
+            # Se only_in_own_zone, salta nodi di altre zone
+            if only_in_own_zone:
+                own = node_zone_tags[rows] == zone_no
+                rows, dists = rows[own], dists[own]
             
-            # Seleziona nodi in base alla strategia
-            closest_nodes = []
+            keys = node_keys[rows]
             
-            if distribute_by_quadrant and len(distances) > 0:
+            # Seleziona nodi in base alla strategia
+            if distribute_by_quadrant and len(rows) > 0:
                 # DISTRIBUZIONE PER QUADRANTE (0-90, 90-180, 180-270, 270-360)
-                quadrants = {
-                    0: [],   # 0-90°   (Nord-Est)
-                    1: [],   # 90-180° (Nord-Ovest)
-                    2: [],   # 180-270° (Sud-Ovest)
-                    3: []    # 270-360° (Sud-Est)
-                }
+                # Angolo approssimativo (OK per piccole distanze)
+                angles = np.degrees(np.arctan2(node_ys[rows] - zone_ys[zone_pos],
+                                               node_xs[rows] - zone_xs[zone_pos]))
+                angles[angles < 0] += 360
+                quadrants = (angles // 90).astype(np.int64)
+                quadrants[quadrants == 4] = 0  # 360° -> quadrante 0
                 
-                # Raggruppa nodi per quadrante
-                for dist, angle, node_key in distances:
-                    quadrant = int(angle // 90)
-                    if quadrant == 4:  # 360° -> quadrante 0
-                        quadrant = 0
-                    quadrants[quadrant].append((dist, angle, node_key))
-                
-                # Prendi il più vicino da ogni quadrante
+                # Prendi i più vicini di ogni quadrante (quadrante, distanza, angolo, nodo)
                 connectors_per_quadrant = max(1, max_connectors_per_zone // 4)
-                
-                for q in range(4):
-                    if quadrants[q]:
-                        # Ordina per distanza e prendi i primi N
-                        quadrants[q].sort()
-                        for item in quadrants[q][:connectors_per_quadrant]:
-                            closest_nodes.append((item[0], item[2]))  # (dist, node_key)
+                order = np.lexsort((keys, angles, dists, quadrants))
+                q_sorted = quadrants[order]
+                rank = np.arange(len(order)) - np.searchsorted(q_sorted, q_sorted)
+                selected = order[rank < connectors_per_quadrant]
             else:
                 # SELEZIONE PER DISTANZA (come prima)
-                distances_simple = [(dist, node_key) for dist, angle, node_key in distances]
-                distances_simple.sort()
-                closest_nodes = distances_simple[:max_connectors_per_zone]
+                selected = np.lexsort((keys, dists))[:max_connectors_per_zone]
+            
+            closest_nodes = list(zip(dists[selected].tolist(), keys[selected].tolist()))
             
             # Crea connectors
             connectors_for_zone = 0
@@ -4158,6 +4590,7 @@ def create_zone_connectors(max_distance=1000, max_connectors_per_zone=5,
 # 【7】 ZONE GENERATION FROM HEX GRID (WITH AUTO-ZONING TOOL)
 # ============================================================================
 
+@invalidates_network_snapshot
 def create_zones_from_hex_grid(hex_grid_file, num_zones=200, 
                                compact_zones=True, study_area_file=None,
                                geographical_distance_weight=10, output_crs="EPSG:4326",
@@ -4650,7 +5083,7 @@ def create_skim_matrices(matrix_no=1,
         print("(Esegue tutte le operazioni nella sequenza Procedures)")
         
         try:
-            visum.Procedures.Execute()
+            execute_procedures(visum)
             print("✓ Calcolo completato con successo")
         except Exception as e:
             result["message"] = "Errore esecuzione: {}".format(str(e))
@@ -5437,6 +5870,105 @@ def import_demand_matrices_from_csv(csv_path, separator=";", visum_instance=None
         return result
 
 
+def export_demand_matrices_to_csv(csv_path, separator=";", visum_instance=None):
+    """
+    Esporta le matrici di domanda dei demand segment in un CSV nel formato di
+    import_demand_matrices_from_csv (dseg;from_O;to_D;value, solo valori > 0).
+
+    Usato dalla calibrazione capacita' con assegnazione locale
+    (run_capacity_optimization con capacity_method="assignment"): il
+    subprocess legge la domanda da questo file (demand_csv).
+
+    Args:
+        csv_path (str)  : percorso del CSV da scrivere
+        separator (str) : separatore colonne (default ";")
+        visum_instance  : istanza Visum (default: usa variabile globale Visum)
+
+    Returns:
+        dict: {
+            "status"  : "success" | "failed",
+            "message" : str,
+            "csv_path": str,
+            "exported": { dseg_code: { "matrix_no": int, "od_pairs": int, "total": float } }
+        }
+    """
+    import csv as _csv
+
+    result = {
+        "status": "failed",
+        "message": "",
+        "csv_path": str(csv_path),
+        "exported": {}
+    }
+
+    try:
+        visum = visum_instance if visum_instance is not None else globals().get("Visum")
+        if visum is None:
+            raise RuntimeError("Nessuna istanza Visum disponibile: passa visum_instance oppure esegui dalla console Visum")
+
+        print("\n" + "=" * 70)
+        print("ESPORTAZIONE MATRICI DI DOMANDA IN CSV")
+        print("=" * 70)
+        print("File: {}".format(csv_path))
+
+        # Indice riga/colonna (1-based) -> numero zona, come nell'importazione
+        zone_nos = [int(z.AttValue("No")) for z in visum.Net.Zones.GetAll]
+        if not zone_nos:
+            result["message"] = "Nessuna zona nella rete Visum"
+            print("x {}".format(result["message"]))
+            return result
+
+        Path(csv_path).parent.mkdir(parents=True, exist_ok=True)
+        with open(csv_path, "w", encoding="utf-8", newline="") as f:
+            writer = _csv.writer(f, delimiter=separator)
+            writer.writerow(["dseg", "from_O", "to_D", "value"])
+            for matrix in visum.Net.Matrices.GetAll:
+                try:
+                    dseg_code = str(matrix.AttValue("DSegCode") or "").strip()
+                except Exception:
+                    continue
+                if not dseg_code or dseg_code in result["exported"]:
+                    continue
+                try:
+                    visum.Net.DemandSegments.ItemByKey(dseg_code)
+                except Exception:
+                    continue
+
+                n_pairs = 0
+                total = 0.0
+                for i, from_no in enumerate(zone_nos, start=1):
+                    row_vals = matrix.GetRow(i)
+                    for to_no, value in zip(zone_nos, row_vals):
+                        if value > 0:
+                            writer.writerow([dseg_code, from_no, to_no, value])
+                            n_pairs += 1
+                            total += value
+                result["exported"][dseg_code] = {
+                    "matrix_no": int(matrix.AttValue("No")),
+                    "od_pairs": n_pairs,
+                    "total": round(total, 2)
+                }
+                print("  DSeg {:10s} -> Matrice {:4d}  ({} coppie OD, {:.1f} viaggi)".format(
+                    dseg_code, int(matrix.AttValue("No")), n_pairs, total))
+
+        if not result["exported"]:
+            result["message"] = "Nessun demand segment con matrice di domanda"
+            print("x {}".format(result["message"]))
+            return result
+
+        result["status"] = "success"
+        result["message"] = "Esportati {} DSeg".format(len(result["exported"]))
+        print("=" * 70)
+        return result
+
+    except Exception as e:
+        result["message"] = "Errore: {}".format(str(e))
+        print("\nx {}".format(result["message"]))
+        import traceback
+        traceback.print_exc()
+        return result
+
+
 def import_procedure_settings(xml_path, read_functions=True, read_operations=False,
                                append_procedures=False, visum_instance=None):
     """
@@ -5633,6 +6165,7 @@ def add_prt_assignment_procedure(assignment_variant=2, execute=False, visum_inst
             executor = visum.Procedures.OperationExecutor
             executor.SetCurrentOperation(op)
             executor.ExecuteCurrentOperation()
+            invalidate_network_snapshot()
             print("Assegnazione completata")
 
         result["status"] = "success"
@@ -5886,7 +6419,10 @@ def run_prt_assignment_and_skim(assignment_variant=2, visum_instance=None):
         print("=" * 70)
         print("Avvio assegnazione + skim in corso...")
 
-        visum.Procedures.OperationExecutor.Execute()
+        try:
+            visum.Procedures.OperationExecutor.Execute()
+        finally:
+            invalidate_network_snapshot()
 
         print("✓ Esecuzione completata")
 
@@ -5923,6 +6459,8 @@ def optimize_capacity_from_observed_times(
         assignment_variant=2,
         vc_threshold_high=0.80,
         vc_threshold_low=0.40,
+        engine="visum",
+        conda_env=None,
         visum_instance=None):
     """
     Ottimizza le capacita' dei link type per minimizzare l'errore tra
@@ -5942,6 +6480,11 @@ def optimize_capacity_from_observed_times(
     Le varianti usano la codifica: TypeNo = base * 100 + V_index * 10 + C_index
     dove C_index: 0=-25%, 1=-20%, 2=-15%, 3=-10%, 4=-5%, 5=+0%, 6=+5%, 7=+10%, 8=+15%, 9=+20%
 
+    Con engine="local" le iterazioni non rieseguono l'assegnazione Visum:
+    delega a run_capacity_optimization(capacity_method="assignment"), che
+    valuta ogni candidato con un'assegnazione all'equilibrio locale (BPR)
+    sulla rete esportata e applica a Visum solo la scelta finale.
+
     Args:
         observed_times_csv (str): CSV con colonne [from_O, to_D, observed_time (minuti)]
         max_iterations (int): Numero massimo iterazioni (default: 10)
@@ -5953,6 +6496,9 @@ def optimize_capacity_from_observed_times(
         assignment_variant (int): Variante assegnazione PrT (default: 2 = Equilibrium)
         vc_threshold_high (float): Soglia v/c sopra cui aumentare capacita' (default: 0.80)
         vc_threshold_low (float): Soglia v/c sotto cui diminuire capacita' (default: 0.40)
+        engine (str): 'visum' (assegnazione Visum a ogni iterazione) o 'local'
+            (assegnazione locale, vedi sopra) (default: 'visum')
+        conda_env (str|None): Ambiente conda del subprocess con engine='local'
         visum_instance: Istanza Visum COM (default: usa console)
 
     Returns:
@@ -5979,6 +6525,24 @@ def optimize_capacity_from_observed_times(
     import csv as _csv
     import math
 
+    if engine == "local":
+        # Il risultato e' quello di run_capacity_optimization (fasi 1-5)
+        return run_capacity_optimization(
+            observed_times_csv,
+            conda_env=conda_env,
+            assignment_variant=assignment_variant,
+            n_iterations=max_iterations,
+            od_col_orig=od_col_orig,
+            od_col_dest=od_col_dest,
+            od_col_time=od_col_time,
+            capacity_method="assignment",
+            assignment_options={
+                "vc_threshold_high":     vc_threshold_high,
+                "vc_threshold_low":      vc_threshold_low,
+                "convergence_threshold": convergence_threshold,
+            },
+            visum_instance=visum_instance)
+
     CAP_PCT = {0: -25, 1: -20, 2: -15, 3: -10, 4: -5,
                5: 0, 6: 5, 7: 10, 8: 15, 9: 20}
 
@@ -6103,11 +6667,12 @@ def optimize_capacity_from_observed_times(
         # -- 4. Analisi link type iniziale --
         print("\n### ANALISI LINK TYPE ###")
 
-        all_links = list(visum.Net.Links.GetAll)
+        snapshot = get_network_snapshot(visum)
+        link_typenos = snapshot.get("Links", ["TypeNo"])["TypeNo"].tolist()
         link_type_info = {}
 
-        for link in all_links:
-            type_no = int(link.AttValue("TypeNo"))
+        for type_no in link_typenos:
+            type_no = int(type_no)
             if type_no >= 1000:
                 base = type_no // 100
                 v_idx = (type_no % 100) // 10
@@ -6133,8 +6698,8 @@ def optimize_capacity_from_observed_times(
         current_c_index = {}
         for bt in optimizable_types:
             c_indices = []
-            for link in all_links:
-                type_no = int(link.AttValue("TypeNo"))
+            for type_no in link_typenos:
+                type_no = int(type_no)
                 link_base = type_no // 100 if type_no >= 1000 else type_no
                 if link_base == bt:
                     c_indices.append(type_no % 10 if type_no >= 1000 else 5)
@@ -6182,10 +6747,11 @@ def optimize_capacity_from_observed_times(
             return values, "OK"
 
         # -- 6. Helper: applica C_index ai link --
-        def _apply_cap(all_lnks, c_idx_map):
-            changed = 0
-            for lnk in all_lnks:
-                type_no = int(lnk.AttValue("TypeNo"))
+        def _apply_cap(c_idx_map):
+            writer = BulkAttributeWriter(visum.Net.Links)
+            type_nos = snapshot.get("Links", ["TypeNo"])["TypeNo"].tolist()
+            for idx_1based, type_no in enumerate(type_nos, 1):
+                type_no = int(type_no)
                 if type_no >= 1000:
                     base = type_no // 100
                     v_idx = (type_no % 100) // 10
@@ -6201,12 +6767,8 @@ def optimize_capacity_from_observed_times(
                 new_c = c_idx_map[base]
                 new_type_no = base * 100 + v_idx * 10 + new_c
                 if new_type_no != type_no:
-                    try:
-                        lnk.SetAttValue("TypeNo", new_type_no)
-                        changed += 1
-                    except Exception:
-                        pass
-            return changed
+                    writer.set(idx_1based, "TypeNo", new_type_no)
+            return writer.flush().get("TypeNo", 0)
 
         # -- 7. LOOP OTTIMIZZAZIONE --
         print("\n" + "=" * 70)
@@ -6221,7 +6783,7 @@ def optimize_capacity_from_observed_times(
             print("-" * 50)
 
             print("  Esecuzione assegnazione + skim...")
-            visum.Procedures.Execute()
+            execute_procedures(visum)
             print("  Assegnazione completata")
 
             od_values, msg = _extract_tcur(visum, observed_od, zone_index)
@@ -6281,7 +6843,7 @@ def optimize_capacity_from_observed_times(
                             current_c_index[bt] = max(0, min(9,
                                 current_c_index[bt] - last_dir))
                             cap_history[bt]["history"].pop()
-                    _apply_cap(all_links, current_c_index)
+                    _apply_cap(current_c_index)
                     break
 
             if iteration == max_iterations:
@@ -6291,15 +6853,14 @@ def optimize_capacity_from_observed_times(
             # Calcola v/c per link type
             print("\n  Analisi v/c per link type:")
             type_vc = {}
-            for lnk in all_links:
-                type_no = int(lnk.AttValue("TypeNo"))
+            links = snapshot.get("Links", ["TypeNo", "VolVehPrT(AP)", "CapPrT"])
+            for type_no, vol, cap in zip(links["TypeNo"].tolist(),
+                                         links["VolVehPrT(AP)"].tolist(),
+                                         links["CapPrT"].tolist()):
+                type_no = int(type_no)
                 base = type_no // 100 if type_no >= 1000 else type_no
-                if base not in optimizable_types:
-                    continue
-                try:
-                    vol = float(lnk.AttValue("VolVehPrT(AP)"))
-                    cap = float(lnk.AttValue("CapPrT"))
-                except Exception:
+                # vol != vol: NaN = attributo vuoto
+                if base not in optimizable_types or vol != vol or cap != cap:
                     continue
                 if base not in type_vc:
                     type_vc[base] = {"vol": 0.0, "cap": 0.0, "n": 0}
@@ -6334,7 +6895,7 @@ def optimize_capacity_from_observed_times(
                 print("  Nessun cambio capacita' -> convergenza")
                 break
 
-            n_changed = _apply_cap(all_links, current_c_index)
+            n_changed = _apply_cap(current_c_index)
             print("\n  {} link aggiornati ({} tipi modificati)".format(n_changed, changes_made))
 
         # -- 8. Risultati finali --
@@ -6579,7 +7140,12 @@ def create_capacity_optimization_config(
         convergence_threshold=0.005,
         fix_connector_t0=True,
         sample_od_pairs=None,
-        random_seed=42):
+        random_seed=42,
+        skim_engine="csr",
+        n_workers=1,
+        capacity_method="bvls",
+        demand_csv=None,
+        assignment_options=None):
     """
     Crea il file config.json per optimize_capacity.py (subprocess esterno).
 
@@ -6591,6 +7157,14 @@ def create_capacity_optimization_config(
         vc_threshold (float): Soglia v/c per archi congestionati (default: 0.6)
         speed_delta_pct (float): Max variazione % velocita' congestionata (default: 25.0)
         n_iterations (int): Max iterazioni BVLS (default: 5)
+        skim_engine (str): 'csr' (scipy su array CSR), 'cch' (gerarchia
+            customizzabile) o 'networkx' (default: 'csr')
+        n_workers (int): Processi per lo skim 'csr', 0 = tutti i core (default: 1)
+        capacity_method (str): 'bvls' (TCur fisso) o 'assignment' (assegnazione
+            all'equilibrio locale per ogni candidato di capacita') (default: 'bvls')
+        demand_csv (str|None): CSV domanda per 'assignment' (da export_demand_matrices_to_csv)
+        assignment_options (dict|None): altre chiavi config per 'assignment'
+            (vdf_bpr, assignment_cap_factor, vc_threshold_high, ...)
 
     Returns:
         str: Path al file config.json creato
@@ -6625,7 +7199,12 @@ def create_capacity_optimization_config(
         "fix_connector_t0":      fix_connector_t0,
         "sample_od_pairs":       sample_od_pairs,
         "random_seed":           random_seed,
+        "skim_engine":           skim_engine,
+        "n_workers":             n_workers,
+        "capacity_method":       capacity_method,
+        "demand_csv":            str(demand_csv) if demand_csv else None,
     }
+    config.update(assignment_options or {})
 
     temp_file = tempfile.NamedTemporaryFile(
         mode="w", suffix="_capopt_config.json",
@@ -6896,15 +7475,15 @@ def apply_capacity_remap_to_visum(capacity_remap, visum_instance=None):
         for bt, ci in sorted(c_index_map.items()):
             print("  Base {:3d}: C_index={} (cap {:+d}%)".format(bt, ci, CAP_PCT.get(ci, 0)))
 
-        # Bulk-leggi TypeNo con GetMultiAttValues (molto piu' veloce)
-        all_links = visum.Net.Links.GetAll
-        link_types = visum.Net.Links.GetMultiAttValues("TypeNo")
+        # Bulk-leggi TypeNo dallo snapshot (molto piu' veloce)
+        link_types = get_network_snapshot(visum).get("Links", ["TypeNo"])["TypeNo"].tolist()
+        writer = BulkAttributeWriter(visum.Net.Links)
         n_total = len(link_types)
         result["n_links_total"] = n_total
         changed = 0
 
         for i in range(n_total):
-            type_no = int(link_types[i][1])
+            type_no = int(link_types[i])
             if type_no >= 1000:
                 base = type_no // 100
                 v_idx = (type_no % 100) // 10
@@ -6919,13 +7498,14 @@ def apply_capacity_remap_to_visum(capacity_remap, visum_instance=None):
             new_type_no = base * 100 + v_idx * 10 + new_c
 
             if new_type_no != type_no:
-                idx_1based = int(link_types[i][0])
-                all_links[idx_1based - 1].SetAttValue("TypeNo", new_type_no)
+                writer.set(i + 1, "TypeNo", new_type_no)
                 changed += 1
                 if base not in result["types_changed"]:
                     result["types_changed"][base] = {"count": 0, "c_index": new_c}
                 result["types_changed"][base]["count"] += 1
 
+        writer.flush()
+
         result["n_links_changed"] = changed
         result["status"] = "success"
         result["message"] = "{} link aggiornati".format(changed)
@@ -6955,15 +7535,23 @@ def run_capacity_optimization(
         od_col_orig="from_O",
         od_col_dest="to_D",
         od_col_time="observed_time",
+        capacity_method="bvls",
+        assignment_options=None,
         visum_instance=None):
     """
     Workflow completo ottimizzazione capacita':
       1. Esegui assegnazione PrT + skim TCur in Visum
       2. Esporta rete carica in shapefile (con TCur, Vol, Cap)
+         (+ matrici di domanda con capacity_method="assignment")
       3. Lancia ottimizzazione BVLS esterna (subprocess)
       4. Applica capacita' ottimali a Visum (cambio TypeNo)
       5. Riesegui assegnazione per verificare miglioramento
 
+    Con capacity_method="assignment" la fase 3 valuta i candidati di
+    capacita' con un'assegnazione all'equilibrio locale
+    (network-speed-optimization/traffic_assignment.py): Visum esegue solo
+    l'assegnazione iniziale e quella di conferma della fase 5.
+
     Args:
         observed_times_csv (str): CSV tempi osservati [from_O, to_D, observed_time (min)]
         network_export_dir (str|None): Cartella export shapefile (default: auto)
@@ -6973,6 +7561,9 @@ def run_capacity_optimization(
         vc_threshold (float): Soglia v/c per archi congestionati (default: 0.6)
         speed_delta_pct (float): Max variazione % (default: 25.0)
         n_iterations (int): Max iterazioni BVLS (default: 5)
+        capacity_method (str): 'bvls' o 'assignment' (default: 'bvls')
+        assignment_options (dict|None): chiavi config per 'assignment'
+            (vdf_bpr, assignment_cap_factor, vc_threshold_high, ...)
         visum_instance: Istanza Visum COM
 
     Returns:
@@ -6990,6 +7581,7 @@ def run_capacity_optimization(
         "message": "",
         "assignment": None,
         "export": None,
+        "demand": None,
         "optimization": None,
         "apply": None,
     }
@@ -7089,7 +7681,7 @@ def run_capacity_optimization(
 
         # Esegui tutta la sequenza
         print("\nEsecuzione: Init + Assegnazione + Skim...")
-        visum.Procedures.Execute()
+        execute_procedures(visum)
         print("OK Assegnazione completata")
 
         result["assignment"] = {
@@ -7111,9 +7703,21 @@ def run_capacity_optimization(
             print("x {}".format(result["message"]))
             return result
 
+        demand_csv = None
+        if capacity_method == "assignment":
+            demand_csv = str(Path(network_export_dir) / "demand.csv")
+            r_demand = export_demand_matrices_to_csv(demand_csv, visum_instance=visum)
+            result["demand"] = r_demand
+            if r_demand["status"] != "success":
+                result["message"] = "Errore esportazione domanda: {}".format(
+                    r_demand["message"])
+                print("x {}".format(result["message"]))
+                return result
+
         # FASE 3: Ottimizzazione esterna
         print("\n" + "=" * 70)
-        print("FASE 3: OTTIMIZZAZIONE BVLS (SUBPROCESS)")
+        print("FASE 3: OTTIMIZZAZIONE {} (SUBPROCESS)".format(
+            "CON ASSEGNAZIONE LOCALE" if capacity_method == "assignment" else "BVLS"))
         print("=" * 70)
         config_file = create_capacity_optimization_config(
             network_dir=network_export_dir,
@@ -7125,7 +7729,10 @@ def run_capacity_optimization(
             od_col_time=od_col_time,
             vc_threshold=vc_threshold,
             speed_delta_pct=speed_delta_pct,
-            n_iterations=n_iterations)
+            n_iterations=n_iterations,
+            capacity_method=capacity_method,
+            demand_csv=demand_csv,
+            assignment_options=assignment_options)
 
         r_opt = run_capacity_optimization_subprocess(
             config_file,
@@ -7159,7 +7766,7 @@ def run_capacity_optimization(
         print("FASE 5: VERIFICA - RIESECUZIONE ASSEGNAZIONE")
         print("=" * 70)
         print("Esecuzione assegnazione con capacita' aggiornate...")
-        visum.Procedures.Execute()
+        execute_procedures(visum)
         print("OK Assegnazione di verifica completata")
 
         result["status"] = "success"
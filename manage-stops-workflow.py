@@ -1399,7 +1399,13 @@ def execute_procedure_sequence():
         start_time = datetime.now()
         
         # Esegui tutta la sequenza
-        Visum.Procedures.Execute()
+        try:
+            Visum.Procedures.Execute()
+        finally:
+            # Snapshot di rete di import-osm-network.py (se caricato in questa
+            # console): volumi e tempi letti prima dell'esecuzione non valgono piu'
+            if globals().get("invalidate_network_snapshot") is not None:
+                invalidate_network_snapshot()
         
         print("\n" + "=" * 80)
         print("ESECUZIONE COMPLETATA CON SUCCESSO")
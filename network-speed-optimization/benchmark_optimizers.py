@@ -0,0 +1,634 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Benchmark optimizers
+====================
+Benchmark di optimize_link_speeds.py e optimize_capacity.py su reti
+sintetiche: niente shapefile riservati ne' licenza Visum.
+
+Per ogni dimensione (numero di link) genera:
+    - rete a griglia o grafo planare casuale (triangolazione di Delaunay)
+      con LinkType, LENGTH/V0PRT con unita' ("0.412km", "50km/h"), TCUR_PRT
+      in secondi, VOLVEHPRT/CAPPRT e colonne reverse R_* come nell'export Visum
+    - zone con connettori e CSV tempi osservati: tempi "veri" (velocita' per
+      tipo perturbate) con rumore log-normale controllato (--noise)
+e misura separatamente le fasi:
+    load (shapefile, solo se pyshp e' installato), load_cache, load_observed,
+    build_graph, compute_od_skims, build_composition_matrix(_per_arc),
+    lsq_linear(_per_arc), lsq_per_arc_global, remap, final_skims, final_skims_streamed, save
+
+Il JSON di output (commit git, ambiente, una voce per script x topologia x
+dimensione) e' confrontabile tra commit con --compare.
+
+UTILIZZO:
+    python benchmark_optimizers.py --links 1000 10000 100000 --output bench.json
+    python benchmark_optimizers.py --links 500000 --topology planar --script capacity
+    python benchmark_optimizers.py --links 1000 10000 --output new.json --compare old.json
+
+NOTA: ogni link e' esportato in entrambe le direzioni (una riga per verso,
+      con le colonne R_* del verso opposto): optimize_link_speeds.py legge solo
+      le righe, optimize_capacity.py anche le R_* (stessi valori).
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import optimize_capacity as cap_opt
+import optimize_link_speeds as speed_opt
+from csr_graph import get_edge_store
+from network_cache import NetworkCache
+from observed_times import load_observed_times
+from stage_timing import stage_timer, peak_rss_mb
+
+
+# Formato del JSON: cambiarlo se cambia il significato delle fasi
+BENCHMARK_VERSION = 1
+
+# LinkType sintetici: velocita' libera (km/h), corsie, capacita' per corsia, frequenza
+SYNTH_LINK_TYPES = {
+    10: (110.0, 3, 2000.0, 0.04),
+    20: (90.0,  2, 1800.0, 0.08),
+    30: (70.0,  2, 1500.0, 0.15),
+    40: (50.0,  1, 1200.0, 0.30),
+    60: (40.0,  1,  900.0, 0.28),
+    80: (30.0,  1,  700.0, 0.15),
+}
+
+# Lunghezza media dei link della griglia (km)
+GRID_SPACING_KM = 0.35
+
+# Connettori: lunghezza (km) e velocita' (km/h)
+CONNECTOR_LENGTH_KM = 0.2
+CONNECTOR_SPEED_KMH = 30.0
+
+# Origini per blocco della fase final_skims_streamed
+FINAL_SKIM_CHUNK_ORIGINS = 100
+
+
+# =============================================================================
+# RETE SINTETICA
+# =============================================================================
+
+def _grid_edges(n_edges_target, rng):
+    """Griglia nx x ny con ~n_edges_target lati non orientati."""
+    side = max(2, int(np.ceil(np.sqrt(n_edges_target / 2.0))))
+    ids = np.arange(side * side).reshape(side, side)
+    horiz = np.column_stack([ids[:, :-1].ravel(), ids[:, 1:].ravel()])
+    vert  = np.column_stack([ids[:-1, :].ravel(), ids[1:, :].ravel()])
+    edges = np.vstack([horiz, vert])
+    jitter = rng.uniform(-0.15, 0.15, size=(side * side, 2)) * GRID_SPACING_KM
+    xy = np.column_stack([np.tile(np.arange(side), side),
+                          np.repeat(np.arange(side), side)]) * GRID_SPACING_KM + jitter
+    return edges, xy
+
+
+def _planar_edges(n_edges_target, rng):
+    """Grafo planare casuale: lati della triangolazione di Delaunay (~3 per nodo)."""
+    from scipy.spatial import Delaunay
+
+    n_nodes = max(4, int(n_edges_target / 3.0))
+    extent = np.sqrt(n_nodes) * GRID_SPACING_KM
+    xy = rng.uniform(0.0, extent, size=(n_nodes, 2))
+    tri = Delaunay(xy).simplices
+    edges = np.vstack([tri[:, [0, 1]], tri[:, [1, 2]], tri[:, [2, 0]]])
+    edges = np.unique(np.sort(edges, axis=1), axis=0)
+    return edges, xy
+
+
+def make_network(n_links, topology="grid", n_zones=None, seed=42):
+    """
+    Genera una rete sintetica con ~n_links righe link (entrambi i versi).
+
+    Ritorna dict:
+        links, nodes, centroids, connectors : DataFrame con colonne Visum
+        xy                                  : coordinate nodi (km), per shapefile
+    """
+    rng = np.random.default_rng(seed)
+    make_edges = _planar_edges if topology == "planar" else _grid_edges
+    edges, xy = make_edges(max(1, n_links // 2), rng)
+    node_no = np.arange(1, len(xy) + 1)
+
+    types = np.array(list(SYNTH_LINK_TYPES))
+    speed, lanes, cap_lane, freq = (np.array(col) for col in zip(*SYNTH_LINK_TYPES.values()))
+    t_idx = rng.choice(len(types), size=len(edges), p=freq / freq.sum())
+
+    length_km = np.maximum(np.linalg.norm(xy[edges[:, 0]] - xy[edges[:, 1]], axis=1), 0.01)
+    capacity  = lanes[t_idx] * cap_lane[t_idx]
+    t0_s      = length_km / speed[t_idx] * 3600.0
+
+    # Un record per verso: volumi (e quindi TCur, BPR) diversi nei due versi
+    n = len(edges)
+    vol = rng.uniform(0.1, 1.1, size=(2, n)) * capacity
+    tcur = t0_s * (1.0 + 0.15 * (vol / capacity) ** 4)
+
+    def _direction(d):
+        src, dst = (edges[:, 0], edges[:, 1]) if d == 0 else (edges[:, 1], edges[:, 0])
+        r = 1 - d
+        return pd.DataFrame({
+            "FROMNODENO": node_no[src],
+            "TONODENO":   node_no[dst],
+            "TYPENO":     types[t_idx],
+            "NUMLANES":   lanes[t_idx],
+            "LENGTH":     ["{:.3f}km".format(x) for x in length_km],
+            "V0PRT":      ["{:.0f}km/h".format(x) for x in speed[t_idx]],
+            "CAPPRT":     capacity,
+            "VOLVEHPRT":  np.round(vol[d], 1),
+            "TCUR_PRT":   ["{:.1f}s".format(x) for x in tcur[d]],
+            "R_TYPENO":   types[t_idx],
+            "R_LENGTH":   ["{:.3f}km".format(x) for x in length_km],
+            "R_V0PRT":    ["{:.0f}km/h".format(x) for x in speed[t_idx]],
+            "R_CAPPRT":   capacity,
+            "R_VOLVEHPR": np.round(vol[r], 1),
+            "R_TCUR_PRT": ["{:.1f}s".format(x) for x in tcur[r]],
+        })
+
+    links = pd.concat([_direction(0), _direction(1)], ignore_index=True)
+
+    if n_zones is None:
+        n_zones = int(np.clip(np.sqrt(len(links)) * 2, 20, 400))
+    n_zones = min(n_zones, len(node_no))
+    zone_nodes = rng.choice(node_no, size=n_zones, replace=False)
+    zone_no = np.arange(1, n_zones + 1)
+
+    nodes = pd.DataFrame({"NO": node_no, "XCOORD": xy[:, 0], "YCOORD": xy[:, 1]})
+    centroids = pd.DataFrame({"NO": zone_no,
+                              "XCOORD": xy[zone_nodes - 1, 0],
+                              "YCOORD": xy[zone_nodes - 1, 1]})
+    connectors = pd.DataFrame({
+        "ZONENO": zone_no,
+        "NODENO": zone_nodes,
+        "LENGTH": ["{:.3f}km".format(CONNECTOR_LENGTH_KM)] * n_zones,
+        "V0PRT":  ["{:.0f}km/h".format(CONNECTOR_SPEED_KMH)] * n_zones,
+    })
+    return {"links": links, "nodes": nodes, "centroids": centroids,
+            "connectors": connectors, "xy": xy}
+
+
+def write_shapefiles(net, net_dir):
+    """
+    Scrive gli shapefile bench_*.shp con pyshp. Ritorna False se pyshp non
+    e' installato (la fase load viene saltata).
+    """
+    try:
+        import shapefile
+    except ImportError:
+        return False
+
+    net_dir = Path(net_dir)
+    net_dir.mkdir(parents=True, exist_ok=True)
+    xy = net["xy"]
+
+    def _write(name, df, shape_type, geometry):
+        with shapefile.Writer(str(net_dir / "bench_{}".format(name)), shapeType=shape_type) as w:
+            for col in df.columns:
+                kind = df[col].dtype.kind
+                if kind in "iu":
+                    w.field(col, "N", 18, 0)
+                elif kind == "f":
+                    w.field(col, "N", 18, 6)
+                else:
+                    w.field(col, "C", 32)
+            for geom, rec in zip(geometry, df.itertuples(index=False)):
+                if shape_type == shapefile.POINT:
+                    w.point(*geom)
+                else:
+                    w.line([geom])
+                w.record(*rec)
+
+    links = net["links"]
+    _write("link", links, shapefile.POLYLINE,
+           ([xy[a - 1].tolist(), xy[b - 1].tolist()]
+            for a, b in zip(links["FROMNODENO"], links["TONODENO"])))
+    _write("node", net["nodes"], shapefile.POINT, net["nodes"][["XCOORD", "YCOORD"]].values.tolist())
+    _write("zone_centroid", net["centroids"], shapefile.POINT,
+           net["centroids"][["XCOORD", "YCOORD"]].values.tolist())
+    conn = net["connectors"]
+    cent = net["centroids"].set_index("NO")
+    _write("connector", conn, shapefile.POLYLINE,
+           ([[cent.at[z, "XCOORD"], cent.at[z, "YCOORD"]], xy[n - 1].tolist()]
+            for z, n in zip(conn["ZONENO"], conn["NODENO"])))
+    return True
+
+
+def make_observed(module, net, config, weight, n_od, noise, seed, csv_path):
+    """
+    Tempi osservati sintetici: velocita' per tipo perturbate di +-20% (la
+    "verita'" che l'ottimizzatore deve ritrovare), shortest path sulle coppie
+    campionate e rumore log-normale sigma=noise. Scrive il CSV e ritorna il
+    numero di coppie.
+    """
+    rng = np.random.default_rng(seed + 1)
+    with contextlib.redirect_stdout(io.StringIO()):
+        G = module.build_graph(net["links"], net["connectors"], net["centroids"], config)
+        zones = module.get_centroid_ids(net["centroids"], net["connectors"])
+        factor = {lt: rng.uniform(0.8, 1.2) for lt in SYNTH_LINK_TYPES}
+        store = get_edge_store(G)
+        store.set(weight, np.arange(store.csr.n_arcs),
+                  store[weight] * store.by_type(factor, default=1.0))
+
+        n_all = len(zones) * (len(zones) - 1)
+        k = min(n_od, n_all)
+        flat = rng.choice(n_all, size=k, replace=False)
+        o_idx, d_idx = np.divmod(flat, len(zones) - 1)
+        d_idx = d_idx + (d_idx >= o_idx)
+        od_filter = {(zones[o], zones[d]) for o, d in zip(o_idx.tolist(), d_idx.tolist())}
+        od_times, _ = module.compute_od_skims(G, zones, weight=weight, verbose=False,
+                                              od_filter=od_filter)
+
+    keys = sorted(od_times)
+    t_true = np.array([od_times[k] for k in keys])
+    t_obs = t_true * np.exp(rng.normal(0.0, noise, size=len(keys)))
+    pd.DataFrame({"origin": [o for o, _ in keys], "destination": [d for _, d in keys],
+                  "time_m": np.round(t_obs, 4)}).to_csv(csv_path, index=False)
+    return len(keys)
+
+
+def load_observed(csv_path):
+    """Lettura tempi osservati come in main() degli script."""
+    config = {"od_col_orig": "origin", "od_col_dest": "destination", "od_col_time": "time_m"}
+    return load_observed_times(csv_path, config, speed_opt.OD_COL_ALIASES).as_dict()
+
+
+# =============================================================================
+# FASI
+# =============================================================================
+
+class BenchmarkRun:
+    """Raccoglie tempi e contatori delle fasi di un run (script x dimensione)."""
+
+    def __init__(self, script, topology, n_links_target, verbose=False):
+        self.verbose = verbose
+        self.result = {"script": script, "topology": topology,
+                       "n_links_target": n_links_target, "stages": {}}
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Fase cronometrata; l'output delle funzioni e' soppresso se non verbose."""
+        sink = contextlib.nullcontext() if self.verbose \
+            else contextlib.redirect_stdout(io.StringIO())
+        entry = {}
+        with stage_timer(name) as timing:
+            with sink:
+                yield entry
+        entry["seconds"] = round(timing["seconds"], 4)
+        entry["peak_rss_mb"] = timing["peak_rss_mb"]
+        if timing["counters"]:
+            entry["counters"] = timing["counters"]
+        self.result["stages"][name] = entry
+
+    def skip(self, name, reason):
+        self.result["stages"][name] = {"seconds": None, "skipped": reason}
+        print("  [i] {}: saltata ({})".format(name, reason))
+
+
+def _load_stages(run, module, net, work_dir, config, have_shp, kind):
+    """load (shapefile), load_cache (NetworkCache), load_observed."""
+    if have_shp:
+        with run.stage("load"):
+            frames = module.load_visum_network(config["network_dir"], file_prefix="bench",
+                                               config=config)
+    else:
+        run.skip("load", "pyshp non installato")
+        frames = (net["links"], net["nodes"], net["centroids"], net["connectors"])
+
+    cache = NetworkCache(Path(work_dir) / "network_cache", kind,
+                         {"link": Path(config["network_dir"]) / "bench_link.shp"},
+                         {"benchmark": BENCHMARK_VERSION})
+    with contextlib.redirect_stdout(io.StringIO()):
+        arrays = module.build_edge_arrays(frames[0], frames[3], config)
+        cache.save(list(frames), arrays,
+                   module.get_centroid_ids(frames[2], frames[3]))
+    with run.stage("load_cache"):
+        cache.load()
+
+    with run.stage("load_observed") as s:
+        T_obs_dict = load_observed(config["observed_times_csv"])
+        s["n_od"] = len(T_obs_dict)
+    return frames, T_obs_dict
+
+
+def bench_link_speeds(net, work_dir, args, have_shp):
+    """Fasi di optimize_link_speeds.py (per_type e per_arc)."""
+    config = dict(speed_opt.DEFAULT_CONFIG)
+    config.update({"network_dir": str(Path(work_dir) / "net"),
+                   "observed_times_csv": str(Path(work_dir) / "observed_speed.csv"),
+                   "output_dir": str(Path(work_dir) / "out_speed"),
+                   "skim_engine": args.engine, "n_workers": args.workers})
+    run = BenchmarkRun("link_speeds", args.topology, args.current_links, args.verbose)
+    make_observed(speed_opt, net, config, "t0", args.od_pairs, args.noise, args.seed,
+                  config["observed_times_csv"])
+
+    (links_df, _, centroids_df, connectors_df), T_obs_dict = _load_stages(
+        run, speed_opt, net, work_dir, config, have_shp, "link_speeds")
+
+    with run.stage("build_graph") as s:
+        G = speed_opt.build_graph(links_df, connectors_df, centroids_df, config)
+        s.update(n_nodes=G.number_of_nodes(), n_arcs=G.number_of_edges())
+    run.result.update(n_links=len(links_df), n_arcs=G.number_of_edges(),
+                      n_nodes=G.number_of_nodes())
+    centroid_ids = speed_opt.get_centroid_ids(centroids_df, connectors_df)
+    run.result["n_zones"] = len(centroid_ids)
+    linktype_list = sorted({d["linktype"] for _, _, d in G.edges(data=True)
+                            if d.get("linktype", -1) >= 0 and not d.get("is_connector", False)})
+    od_pairs = list(T_obs_dict)
+    radius = speed_opt.origin_time_radius(T_obs_dict, config.get("target_radius_slack", 1.5))
+
+    with run.stage("compute_od_skims") as s:
+        od_times, od_paths = speed_opt.compute_od_skims(
+            G, centroid_ids, verbose=True, od_filter=set(od_pairs),
+            engine=config["skim_engine"], n_workers=config["n_workers"],
+            target_radius=radius)
+        s["n_paths"] = len(od_paths)
+    valid = [od for od in od_pairs if od in od_paths]
+    paths = speed_opt.select_paths(od_paths, valid)
+
+    # per_type
+    with run.stage("build_composition_matrix") as s:
+        D, od_order = speed_opt.build_composition_matrix(G, paths, linktype_list)
+        s["shape"] = list(D.shape)
+    initial_speeds = speed_opt.get_initial_speeds_from_graph(G, linktype_list)
+    bounds = speed_opt.compute_speed_bounds(
+        linktype_list, initial_speeds, delta_v=config["speed_delta_kmh"],
+        v_min=config["speed_min_kmh"], v_max=config["speed_max_kmh"],
+        gap=config["speed_class_gap_kmh"])
+    with run.stage("lsq_linear") as s:
+        best_speeds, metrics = speed_opt.optimize_speeds_lsq(
+            D, np.array([T_obs_dict[od] for od in od_order]), linktype_list,
+            config["speed_min_kmh"], config["speed_max_kmh"],
+            initial_speeds=initial_speeds, speed_bounds=bounds)
+        s["rmse"] = round(metrics["rmse"], 4)
+
+    # per_arc
+    arc_initial_speeds = {(u, v): float(d["v0prt"]) for u, v, d in G.edges(data=True)
+                          if not d.get("is_connector", False) and d.get("linktype", -1) >= 0}
+    with run.stage("build_composition_matrix_per_arc") as s:
+        D_arc, arc_list, od_order_arc, _ = speed_opt.build_composition_matrix_per_arc(
+            G, paths, max_arcs=config["max_active_arcs"])
+        s.update(shape=list(D_arc.shape), nnz=int(D_arc.nnz))
+    with run.stage("lsq_linear_per_arc") as s:
+        _, metrics_arc = speed_opt.optimize_speeds_per_arc(
+            D_arc, np.array([T_obs_dict[od] for od in od_order_arc]), arc_list,
+            arc_initial_speeds, delta_v=config["speed_delta_arc_kmh"],
+            v_min=config["speed_min_kmh"], v_max=config["speed_max_kmh"],
+            delta_lower_pct=config["speed_delta_lower_pct"],
+            delta_upper_pct=config["speed_delta_upper_pct"])
+        s["rmse"] = round(metrics_arc["rmse"], 4)
+    with run.stage("build_composition_matrix_per_arc_global") as s:
+        D_glob, arc_glob, od_order_glob, _ = speed_opt.build_composition_matrix_per_arc(G, paths)
+        s.update(shape=list(D_glob.shape), nnz=int(D_glob.nnz))
+    with run.stage("lsq_per_arc_global") as s:
+        _, metrics_glob, _ = speed_opt.optimize_speeds_per_arc_global(
+            D_glob, np.array([T_obs_dict[od] for od in od_order_glob]), arc_glob,
+            arc_initial_speeds, delta_v=config["speed_delta_arc_kmh"],
+            v_min=config["speed_min_kmh"], v_max=config["speed_max_kmh"],
+            delta_lower_pct=config["speed_delta_lower_pct"],
+            delta_upper_pct=config["speed_delta_upper_pct"],
+            method=config["global_solver_method"], max_iter=config["global_max_iter"],
+            tol=config["global_tol"])
+        s.update(rmse=round(metrics_glob["rmse"], 4), solver_iterations=metrics_glob["solver_iterations"])
+
+    speed_opt.update_graph_t0(G, best_speeds, fix_connectors=config.get("fix_connector_t0", True))
+    with run.stage("remap") as s:
+        remap_df = speed_opt.remap_links_by_optimized_speed(
+            links_df, best_speeds, v0prt_field=config.get("v0prt_field", "V0PRT"),
+            linktype_field=config["linktype_field"], G=G)
+        s["n_rows"] = len(remap_df)
+
+    with run.stage("final_skims") as s:
+        skim_df = speed_opt.compute_final_skims(
+            G, centroid_ids, best_speeds, linktype_list,
+            engine=config["skim_engine"], n_workers=config["n_workers"])
+        s["n_rows"] = len(skim_df)
+    with run.stage("final_skims_streamed") as s:
+        stream_cfg = dict(config, output_dir=str(Path(work_dir) / "out_link_streamed"),
+                          final_skim_chunk_origins=FINAL_SKIM_CHUNK_ORIGINS)
+        observed_df = speed_opt.stream_final_skims(G, centroid_ids, linktype_list,
+                                                   T_obs_dict, stream_cfg)
+        s["n_observed_rows"] = 0 if observed_df is None else len(observed_df)
+
+    history = [{"iteration": 1, "n_od_used": len(valid), "max_rel_change_pct": 0.0,
+                "speeds": {str(lt): v for lt, v in best_speeds.items()},
+                "metrics": metrics}]
+    with run.stage("save"):
+        speed_opt.save_results(config["output_dir"], best_speeds, history, skim_df,
+                               T_obs_dict, config, G=G, initial_speeds=initial_speeds,
+                               linktype_list=linktype_list)
+        remap_df.to_csv(Path(config["output_dir"]) / "links_remapped.csv", index=False, sep=",")
+    return run.result
+
+
+def bench_capacity(net, work_dir, args, have_shp):
+    """Fasi di optimize_capacity.py."""
+    config = dict(cap_opt.DEFAULT_CONFIG)
+    config.update({"network_dir": str(Path(work_dir) / "net"),
+                   "observed_times_csv": str(Path(work_dir) / "observed_capacity.csv"),
+                   "output_dir": str(Path(work_dir) / "out_capacity"),
+                   "tcur_field": "TCUR_PRT",
+                   "skim_engine": args.engine, "n_workers": args.workers})
+    run = BenchmarkRun("capacity", args.topology, args.current_links, args.verbose)
+    make_observed(cap_opt, net, config, "tcur", args.od_pairs, args.noise, args.seed,
+                  config["observed_times_csv"])
+
+    (links_df, _, centroids_df, connectors_df), T_obs_dict = _load_stages(
+        run, cap_opt, net, work_dir, config, have_shp, "capacity")
+
+    with run.stage("build_graph") as s:
+        G = cap_opt.build_graph(links_df, connectors_df, centroids_df, config)
+        s.update(n_nodes=G.number_of_nodes(), n_arcs=G.number_of_edges())
+    run.result.update(n_links=len(links_df), n_arcs=G.number_of_edges(),
+                      n_nodes=G.number_of_nodes())
+    centroid_ids = cap_opt.get_centroid_ids(centroids_df, connectors_df)
+    run.result["n_zones"] = len(centroid_ids)
+    od_pairs = list(T_obs_dict)
+    radius = cap_opt.origin_time_radius(T_obs_dict, config.get("target_radius_slack", 1.5))
+
+    with run.stage("compute_od_skims") as s:
+        od_times, od_paths = cap_opt.compute_od_skims(
+            G, centroid_ids, weight="tcur", verbose=True, od_filter=set(od_pairs),
+            engine=config["skim_engine"], n_workers=config["n_workers"],
+            target_radius=radius)
+        s["n_paths"] = len(od_paths)
+    valid = [od for od in od_pairs if od in od_paths]
+    paths = cap_opt.select_paths(od_paths, valid)
+
+    active_types, linktype_list, _ = cap_opt.filter_congested_types(
+        G, list({d["linktype"] for _, _, d in G.edges(data=True) if d.get("linktype", -1) >= 0}),
+        vc_threshold=config.get("vc_threshold", 0.6))
+    initial_vcur = cap_opt.get_initial_vcur_from_graph(G, linktype_list)
+    bounds = cap_opt.compute_congested_speed_bounds(
+        linktype_list, initial_vcur, delta_pct=config.get("speed_delta_pct", 25.0))
+
+    with run.stage("build_composition_matrix") as s:
+        D, od_order = cap_opt.build_composition_matrix(G, paths, linktype_list)
+        s["shape"] = list(D.shape)
+    with run.stage("lsq_linear") as s:
+        optimal_vcur, metrics = cap_opt.optimize_congested_speeds(
+            D, np.array([T_obs_dict[od] for od in od_order]), linktype_list,
+            initial_vcur=initial_vcur, speed_bounds=bounds)
+        s["rmse"] = round(metrics["rmse"], 4)
+
+    cap_opt.update_graph_tcur(G, optimal_vcur, fix_connectors=config.get("fix_connector_t0", True))
+    with run.stage("remap") as s:
+        remap_df = cap_opt.remap_links_by_optimized_capacity(
+            links_df, optimal_vcur, initial_vcur, linktype_list, G=G)
+        s["n_rows"] = len(remap_df)
+
+    with run.stage("final_skims") as s:
+        skim_df = cap_opt.compute_final_skims(
+            G, centroid_ids, optimal_vcur, linktype_list,
+            engine=config["skim_engine"], n_workers=config["n_workers"])
+        s["n_rows"] = len(skim_df)
+    with run.stage("final_skims_streamed") as s:
+        stream_cfg = dict(config, output_dir=str(Path(work_dir) / "out_capacity_streamed"),
+                          final_skim_chunk_origins=FINAL_SKIM_CHUNK_ORIGINS)
+        observed_df = cap_opt.stream_final_skims(G, centroid_ids, linktype_list,
+                                                 T_obs_dict, stream_cfg)
+        s["n_observed_rows"] = 0 if observed_df is None else len(observed_df)
+
+    history = [{"iteration": 1, "n_od_used": len(valid), "max_rel_change_pct": 0.0,
+                "metrics": metrics,
+                "vcur": {str(lt): v for lt, v in optimal_vcur.items()}}]
+    capacity_remap, capacity_details = cap_opt.vcur_to_capacity_index(
+        linktype_list, initial_vcur, optimal_vcur)
+    with run.stage("save"):
+        out = Path(config["output_dir"])
+        out.mkdir(parents=True, exist_ok=True)
+        remap_df.to_csv(str(out / "links_remapped.csv"), index=False, sep=";")
+        cap_opt.save_results(config["output_dir"], optimal_vcur, initial_vcur, linktype_list,
+                             active_types, history, T_obs_dict, config,
+                             capacity_remap=capacity_remap, capacity_details=capacity_details,
+                             skim_df=skim_df, G=G)
+    return run.result
+
+
+# =============================================================================
+# REPORT
+# =============================================================================
+
+def _git_commit():
+    try:
+        out = subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                             cwd=str(Path(__file__).resolve().parent),
+                             capture_output=True, text=True, timeout=10)
+        return out.stdout.strip() or None
+    except Exception:
+        return None
+
+
+def environment_info():
+    import networkx
+    import scipy
+    return {"python": platform.python_version(), "platform": platform.platform(),
+            "cpu_count": os.cpu_count(), "numpy": np.__version__,
+            "scipy": scipy.__version__, "pandas": pd.__version__,
+            "networkx": networkx.__version__}
+
+
+def compare_reports(old, new):
+    """Stampa, per ogni run comune, secondi vecchio/nuovo e rapporto per fase."""
+    key = lambda r: (r["script"], r["topology"], r["n_links_target"])
+    old_runs = {key(r): r for r in old.get("runs", [])}
+    print("\nConfronto con {} (commit {}), x = vecchio/nuovo (>1 = piu' veloce):".format(
+        old.get("created", "?"), old.get("git_commit", "?")))
+    for run in new.get("runs", []):
+        base = old_runs.get(key(run))
+        if base is None:
+            continue
+        print("  {} {} {} link:".format(*key(run)))
+        for stage, entry in run["stages"].items():
+            t_new = entry.get("seconds")
+            t_old = base["stages"].get(stage, {}).get("seconds")
+            if t_new is None or t_old is None:
+                continue
+            print("    {:34s} {:9.3f} s -> {:9.3f} s   x{:.2f}".format(
+                stage, t_old, t_new, t_old / max(t_new, 1e-9)))
+
+
+# =============================================================================
+# MAIN
+# =============================================================================
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark di optimize_link_speeds / optimize_capacity su reti sintetiche")
+    parser.add_argument("--links", type=int, nargs="+", default=[1000, 10000],
+                        help="Dimensioni in numero di link (righe), es. 1000 10000 500000")
+    parser.add_argument("--topology", choices=["grid", "planar"], default="grid")
+    parser.add_argument("--script", choices=["speeds", "capacity", "both"], default="both")
+    parser.add_argument("--zones", type=int, default=None,
+                        help="Numero zone (default: 2*sqrt(link), tra 20 e 400)")
+    parser.add_argument("--od-pairs", type=int, default=20000,
+                        help="Coppie OD osservate (campione)")
+    parser.add_argument("--noise", type=float, default=0.05,
+                        help="Sigma del rumore log-normale sui tempi osservati")
+    parser.add_argument("--engine", default="csr", help="skim_engine (csr | cch | networkx)")
+    parser.add_argument("--workers", type=int, default=1, help="n_workers skim")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--compare", default=None, help="JSON di un run precedente")
+    parser.add_argument("--work-dir", default=None,
+                        help="Cartella dati generati (default: temporanea)")
+    parser.add_argument("--verbose", action="store_true", help="Mostra l'output delle funzioni")
+    args = parser.parse_args()
+
+    scripts = {"speeds": [bench_link_speeds], "capacity": [bench_capacity],
+               "both": [bench_link_speeds, bench_capacity]}[args.script]
+    work_root = Path(args.work_dir) if args.work_dir else Path(tempfile.mkdtemp(prefix="nso_bench_"))
+
+    report = {"benchmark_version": BENCHMARK_VERSION,
+              "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+              "git_commit": _git_commit(),
+              "environment": environment_info(),
+              "args": dict(vars(args)),
+              "runs": []}
+
+    print("=" * 70)
+    print("BENCHMARK OTTIMIZZATORI (rete sintetica {})".format(args.topology))
+    print("=" * 70)
+    print("  Cartella dati: {}".format(work_root))
+
+    for n_links in args.links:
+        args.current_links = n_links
+        work_dir = work_root / "{}_{}".format(args.topology, n_links)
+        work_dir.mkdir(parents=True, exist_ok=True)
+        t_start = time.perf_counter()
+        net = make_network(n_links, args.topology, n_zones=args.zones, seed=args.seed)
+        have_shp = write_shapefiles(net, work_dir / "net")
+        t_gen = time.perf_counter() - t_start
+        print("\n" + "-" * 60)
+        print("Rete {}: {} link, {} nodi, {} zone (generata in {:.1f} s)".format(
+            args.topology, len(net["links"]), len(net["nodes"]),
+            len(net["centroids"]), t_gen))
+        print("-" * 60)
+
+        for bench in scripts:
+            print("\n  {}:".format(bench.__name__))
+            result = bench(net, work_dir, args, have_shp)
+            result["generate_seconds"] = round(t_gen, 4)
+            result["peak_rss_mb"] = peak_rss_mb()
+            report["runs"].append(result)
+
+            # Salvataggio incrementale: un run lungo interrotto conserva le dimensioni fatte
+            with open(args.output, "w", encoding="utf-8") as f:
+                json.dump(report, f, indent=2, default=str)
+
+    print("\n  [OK] Risultati: {}".format(args.output))
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            compare_reports(json.load(f), report)
+
+
+if __name__ == "__main__":
+    main()
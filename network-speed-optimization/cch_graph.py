@@ -0,0 +1,494 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Customizable Contraction Hierarchy (CCH) per skim O/D ripetuti
+==============================================================
+Motore alternativo a csr_graph.py per i loop di calibrazione, dove la
+topologia resta fissa e cambiano solo i pesi (t0 / tcur) tra un'iterazione
+e l'altra.
+
+TRE FASI:
+    1. Preprocessing (indipendente dalla metrica, una volta per rete):
+       ordine di contrazione nested dissection sul grafo non orientato e
+       grafo cordale (archi originali + shortcut). Salvato su disco in
+       cch_<hash topologia>.npz e riletto alle esecuzioni successive.
+    2. Customizzazione (ad ogni cambio pesi): pesi salita/discesa di ogni
+       arco cordale con la "basic customization" sui triangoli inferiori,
+       vettorizzata per livello dell'albero di eliminazione.
+    3. Query molti-a-molti per le coppie di od_filter: ricerca in salita
+       dall'origine e in discesa (rovesciata) dalla destinazione, solo
+       sugli antenati nell'albero di eliminazione; il punto d'incontro
+       minimo da' il tempo, gli shortcut vengono espansi negli archi
+       originali (id arco CSR, come ArcPaths).
+
+UTILIZZO:
+    Nei due script: "skim_engine": "cch". Solo le chiamate con od_filter
+    usano la gerarchia; lo skim completo finale resta sul motore csr.
+
+NOTA: i tempi coincidono con csr_graph a meno dell'arrotondamento float
+      (somme in ordine diverso); a parita' di costo il percorso scelto
+      puo' differire.
+"""
+
+import hashlib
+import os
+import time
+
+import numpy as np
+
+from csr_graph import (get_csr_graph, edge_weights, _plan_origins, _collect_skims,
+                       DIJKSTRA_BLOCK_CELLS)
+from stage_timing import trace_count
+
+
+# Versione del formato del file di preprocessing su disco
+CCH_CACHE_VERSION = 1
+
+# Nested dissection: parti con al massimo questi nodi non vengono piu' divise
+ND_LEAF_SIZE = 32
+
+
+def _undirected_edges(csr):
+    """Archi non orientati (lo < hi, indici nodo) senza duplicati ne' self-loop."""
+    n    = csr.n_nodes
+    src  = csr.arc_src.astype(np.int64)
+    dst  = csr.indices.astype(np.int64)
+    keep = src != dst
+    keys = np.unique(np.minimum(src[keep], dst[keep]) * n
+                     + np.maximum(src[keep], dst[keep]))
+    return keys // n, keys % n
+
+
+def topology_key(csr):
+    """Hash della topologia (id nodo + archi non orientati) per il file di cache."""
+    lo, hi = _undirected_edges(csr)
+    h = hashlib.sha1()
+    h.update(np.int64(CCH_CACHE_VERSION).tobytes())
+    h.update(csr.node_ids.astype(np.int64).tobytes())
+    h.update(lo.tobytes())
+    h.update(hi.tobytes())
+    return h.hexdigest()[:16]
+
+
+def _nested_dissection(csr, leaf_size=ND_LEAF_SIZE):
+    """
+    Ordine nested dissection: separatore = livello BFS mediano da un nodo
+    pseudo-periferico (solo i nodi che toccano il livello successivo), parti
+    ordinate ricorsivamente prima del separatore. Parti piccole: ordine del grafo.
+    """
+    from scipy.sparse import csr_matrix
+    from scipy.sparse.csgraph import connected_components, dijkstra
+
+    n = csr.n_nodes
+    lo, hi = _undirected_edges(csr)
+    A = csr_matrix((np.ones(2 * len(lo)), (np.r_[lo, hi], np.r_[hi, lo])), shape=(n, n))
+
+    out   = []
+    stack = [(False, np.arange(n))]
+    while stack:
+        is_sep, S = stack.pop()
+        if is_sep or len(S) <= leaf_size:
+            out.append(S)
+            continue
+        sub = A[S][:, S]
+        n_comp, labels = connected_components(sub, directed=False)
+        if n_comp > 1:
+            for c in range(n_comp - 1, -1, -1):
+                stack.append((False, S[labels == c]))
+            continue
+        # due visite BFS: la seconda parte dal nodo piu' lontano dalla prima
+        far   = int(np.argmax(dijkstra(sub, unweighted=True, indices=0)))
+        level = dijkstra(sub, unweighted=True, indices=far).astype(np.int64)
+        mid   = int(np.searchsorted(np.cumsum(np.bincount(level)), len(S) / 2))
+        after = (level > mid).astype(np.float64)
+        sep   = (level == mid) & (sub @ after > 0)
+        left  = (level < mid) | ((level == mid) & ~sep)
+        stack.append((True,  S[sep]))
+        stack.append((False, S[level > mid]))
+        stack.append((False, S[left]))
+    return np.concatenate(out).astype(np.int32)
+
+
+def contraction_order(csr):
+    """
+    Ordine di contrazione (nested dissection) e grafo cordale per
+    eliminazione simbolica lungo l'albero di eliminazione.
+
+    Ritorna (order, edge_lo, edge_hi): order[r] = indice nodo di rango r,
+    archi cordali in spazio rango (edge_lo < edge_hi), ordinati per (lo, hi).
+    """
+    n     = csr.n_nodes
+    order = _nested_dissection(csr)
+    rank  = np.empty(n, dtype=np.int64)
+    rank[order] = np.arange(n)
+    lo, hi = _undirected_edges(csr)
+    adj = [set() for _ in range(n)]
+    for u, v in zip(rank[lo].tolist(), rank[hi].tolist()):
+        adj[u].add(v)
+        adj[v].add(u)
+
+    up_src, up_dst = [], []
+    for v in range(n):
+        upper = [u for u in adj[v] if u > v]
+        up_src.extend([v] * len(upper))
+        up_dst.extend(upper)
+        if upper:
+            # i vicini superiori di v passano al padre (fill-in)
+            parent = min(upper)
+            adj[parent].update(upper)
+            adj[parent].discard(parent)
+        adj[v] = None
+
+    keys = np.sort(np.array(up_src, dtype=np.int64) * n + np.array(up_dst, dtype=np.int64))
+    return order, (keys // n).astype(np.int32), (keys % n).astype(np.int32)
+
+
+class CCH:
+    """
+    Gerarchia customizzabile su un CSRGraph.
+
+    Spazio rango: il nodo di rango r e' order[r]; ogni arco cordale
+    e = (lo, hi) con lo < hi ha due pesi:
+        up[e]   = costo lo -> hi       down[e] = costo hi -> lo
+    mid_up / mid_down = nodo intermedio dello shortcut (-1 = arco originale).
+    """
+
+    def __init__(self, csr, order, edge_lo, edge_hi):
+        self.csr     = csr
+        self.n       = csr.n_nodes
+        self.order   = order
+        self.rank    = np.empty(self.n, dtype=np.int32)
+        self.rank[order] = np.arange(self.n, dtype=np.int32)
+        self.edge_lo = edge_lo
+        self.edge_hi = edge_hi
+        self.n_edges = len(edge_lo)
+        self.keys    = edge_lo.astype(np.int64) * self.n + edge_hi
+        self.indptr  = np.zeros(self.n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(edge_lo, minlength=self.n), out=self.indptr[1:])
+
+        # archi originali -> arco cordale e verso
+        r_u  = self.rank[csr.arc_src].astype(np.int64)
+        r_v  = self.rank[csr.indices].astype(np.int64)
+        keep = r_u != r_v
+        self._orig_arc  = np.flatnonzero(keep)
+        self._orig_edge = np.searchsorted(
+            self.keys, np.minimum(r_u[keep], r_v[keep]) * self.n
+            + np.maximum(r_u[keep], r_v[keep]))
+        self._orig_up   = r_u[keep] < r_v[keep]
+
+        self._build_triangles()
+        self.weights  = None
+        self.up = self.down = self.mid_up = self.mid_down = None
+        self._up_graph = self._down_graph = None
+        self._edge_index = None
+        self._memo = {}
+
+    def _build_triangles(self):
+        """
+        Triangoli inferiori (m; a, b) con m < a < b: e1 = (m, a), e2 = (m, b),
+        e3 = (a, b). Ordinati per altezza di m nell'albero di eliminazione:
+        i triangoli dello stesso livello sono indipendenti.
+        """
+        n, indptr = self.n, self.indptr
+        # albero di eliminazione: padre = vicino superiore di rango minimo
+        parent = np.full(n, -1, dtype=np.int64)
+        has_up = indptr[1:] > indptr[:-1]
+        parent[has_up] = self.edge_hi[indptr[:-1][has_up]]
+        height = [0] * n
+        for v, p in enumerate(parent.tolist()):
+            if p >= 0 and height[p] < height[v] + 1:
+                height[p] = height[v] + 1
+        height = np.array(height, dtype=np.int64)
+        self.height = height
+
+        row_end = indptr[1:][self.edge_lo]
+        counts  = row_end - np.arange(self.n_edges) - 1
+        total   = int(counts.sum())
+        e1   = np.repeat(np.arange(self.n_edges, dtype=np.int64), counts)
+        offs = np.arange(total, dtype=np.int64) - np.repeat(np.cumsum(counts) - counts, counts)
+        e2   = e1 + 1 + offs
+        e3   = np.searchsorted(self.keys, self.edge_hi[e1].astype(np.int64) * n
+                               + self.edge_hi[e2])
+        m    = self.edge_lo[e1]
+
+        order = np.argsort(height[m], kind="stable")
+        self._tri_m  = m[order].astype(np.int32)
+        self._tri_e1 = e1[order]
+        self._tri_e2 = e2[order]
+        self._tri_e3 = e3[order]
+        lvl    = height[self._tri_m]
+        bounds = np.flatnonzero(np.diff(lvl)) + 1
+        self._tri_levels = list(zip(np.r_[0, bounds].tolist(),
+                                    np.r_[bounds, total].tolist())) if total else []
+
+    @staticmethod
+    def _relax(w, mid, e, cand, m):
+        """w[e] = min(w[e], cand) per gruppo di e, registrando il nodo intermedio."""
+        old = w[e]
+        np.minimum.at(w, e, cand)
+        win = (cand < old) & (cand == w[e])
+        mid[e[win]] = m[win]
+
+    def customize(self, weights):
+        """Ricalcola i pesi della gerarchia per i pesi arco CSR dati."""
+        if self.weights is not None and np.array_equal(weights, self.weights):
+            return False
+        up   = np.full(self.n_edges, np.inf)
+        down = np.full(self.n_edges, np.inf)
+        w    = weights[self._orig_arc]
+        up[self._orig_edge[self._orig_up]]    = w[self._orig_up]
+        down[self._orig_edge[~self._orig_up]] = w[~self._orig_up]
+        mid_up   = np.full(self.n_edges, -1, dtype=np.int32)
+        mid_down = np.full(self.n_edges, -1, dtype=np.int32)
+
+        for start, stop in self._tri_levels:
+            m  = self._tri_m[start:stop]
+            e1 = self._tri_e1[start:stop]
+            e2 = self._tri_e2[start:stop]
+            e3 = self._tri_e3[start:stop]
+            self._relax(up,   mid_up,   e3, down[e1] + up[e2], m)   # a -> m -> b
+            self._relax(down, mid_down, e3, down[e2] + up[e1], m)   # b -> m -> a
+
+        self.weights = np.array(weights, copy=True)
+        self.up, self.down, self.mid_up, self.mid_down = up, down, mid_up, mid_down
+        self._up_graph   = self._search_graph(up)
+        self._down_graph = self._search_graph(down)
+        self._mid_up_list   = mid_up.tolist()
+        self._mid_down_list = mid_down.tolist()
+        self._memo = {}
+        return True
+
+    def _search_graph(self, w):
+        """Grafo in salita (lo -> hi) in spazio rango con i soli pesi finiti."""
+        from scipy.sparse import csr_matrix
+        fin    = np.isfinite(w)
+        indptr = np.zeros(self.n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.edge_lo[fin], minlength=self.n), out=indptr[1:])
+        return csr_matrix((w[fin], self.edge_hi[fin], indptr), shape=(self.n, self.n))
+
+    def _backward_chains(self, target_ranks):
+        """
+        Ricerche all'indietro dalle destinazioni, compattate sui nodi raggiunti.
+        Ritorna (ptr, nodes, dist, pred): nodes/dist concatenati per
+        destinazione, pred = lista di dict {nodo: successivo verso la destinazione}.
+        """
+        from scipy.sparse.csgraph import dijkstra
+
+        block = max(1, DIJKSTRA_BLOCK_CELLS // max(self.n, 1))
+        nodes, dist, pred, lens = [], [], [], []
+        for i in range(0, len(target_ranks), block):
+            d, p = dijkstra(self._down_graph, directed=True,
+                            indices=target_ranks[i:i + block], return_predecessors=True)
+            for row in range(d.shape[0]):
+                reach = np.flatnonzero(np.isfinite(d[row]))
+                nodes.append(reach)
+                dist.append(d[row][reach])
+                pred.append(dict(zip(reach.tolist(), p[row][reach].tolist())))
+                lens.append(len(reach))
+        ptr = np.zeros(len(lens) + 1, dtype=np.int64)
+        np.cumsum(lens, out=ptr[1:])
+        return ptr, np.concatenate(nodes), np.concatenate(dist), pred
+
+    def _expand_hop(self, a, b):
+        """
+        Archi originali (chiavi a*n+b in spazio rango) dello shortcut a -> b,
+        memorizzati per customizzazione: gli shortcut alti sono condivisi da
+        molte coppie OD e vengono espansi una sola volta.
+        """
+        n, memo = self.n, self._memo
+        root = a * n + b
+        stack = [(a, b)]
+        while stack:
+            a, b = stack[-1]
+            key = a * n + b
+            if key in memo:
+                stack.pop()
+                continue
+            e = self._edge_index[min(a, b) * n + max(a, b)]
+            m = self._mid_up_list[e] if a < b else self._mid_down_list[e]
+            if m < 0:
+                memo[key] = [key]
+                stack.pop()
+                continue
+            k1, k2 = a * n + m, m * n + b
+            if k1 in memo and k2 in memo:
+                memo[key] = memo[k1] + memo[k2]
+                stack.pop()
+            else:
+                stack.append((m, b))
+                stack.append((a, m))
+        return memo[root]
+
+    def query_tasks(self, tasks):
+        """
+        Query molti-a-molti per i task di _plan_origins.
+        Ritorna (output nel formato di _skim_block, nodi esplorati).
+        """
+        from scipy.sparse.csgraph import dijkstra
+
+        if not tasks:
+            return [], 0
+        dest_idx = np.unique(np.array([t_idx for task in tasks for _, t_idx in task[2]],
+                                      dtype=np.int64))
+        tgt_pos  = {int(t): i for i, t in enumerate(dest_idx.tolist())}
+        chains   = self._backward_chains(self.rank[dest_idx])
+        settled  = int(len(chains[1]))
+
+        out   = []
+        block = max(1, DIJKSTRA_BLOCK_CELLS // max(self.n, 1))
+        for i in range(0, len(tasks), block):
+            chunk = tasks[i:i + block]
+            F, PF = dijkstra(self._up_graph, directed=True,
+                             indices=self.rank[[task[1] for task in chunk]],
+                             return_predecessors=True)
+            found = [self._meet(task, F[row], PF[row], tgt_pos, chains)
+                     for row, task in enumerate(chunk)]
+            settled += sum(f[3] for f in found)
+            out.extend(self._expand_block(chunk, found))
+        return out, settled
+
+    def _meet(self, task, f_row, pf_row, tgt_pos, chains):
+        """
+        Punto d'incontro migliore per le destinazioni di un task.
+        Ritorna (dest_zones, tempi, percorsi nella gerarchia (nodi rango),
+        nodi esplorati in salita).
+        """
+        ptr, c_nodes, c_dist, c_pred = chains
+        dests = task[2]
+        n_settled = int(np.isfinite(f_row).sum())
+        if not dests:
+            return [], [], [], n_settled
+        tids   = np.array([tgt_pos[t_idx] for _, t_idx in dests], dtype=np.int64)
+        starts = ptr[tids]
+        lens   = ptr[tids + 1] - starts
+        seg_start = np.cumsum(lens) - lens
+        seg    = np.repeat(np.arange(len(tids)), lens)
+        pos    = np.arange(int(lens.sum())) - np.repeat(seg_start, lens) + np.repeat(starts, lens)
+        cand   = f_row[c_nodes[pos]] + c_dist[pos]
+        best   = np.minimum.reduceat(cand, seg_start)
+        hit    = np.flatnonzero(cand == best[seg])
+        _, first = np.unique(seg[hit], return_index=True)
+        meet_pos = pos[hit[first]]
+
+        s_rank = int(self.rank[task[1]])
+        meet_nodes = c_nodes[meet_pos].tolist()
+        dest_zones, times, nodes = [], [], []
+        for k, (dest_zone, _) in enumerate(dests):
+            d = best[k]
+            if not d < 1e9:
+                continue
+            path = [meet_nodes[k]]
+            while path[-1] != s_rank:            # salita: x -> ... -> origine
+                path.append(int(pf_row[path[-1]]))
+            path.reverse()
+            pred = c_pred[tids[k]]
+            p = pred[path[-1]]
+            while p >= 0:                         # discesa: x -> ... -> destinazione
+                path.append(p)
+                p = pred[p]
+            dest_zones.append(dest_zone)
+            times.append(float(d))
+            nodes.append(path)
+        return dest_zones, times, nodes, n_settled
+
+    def _expand_block(self, chunk, found):
+        """Percorsi di un blocco di origini: shortcut espansi in id arco CSR."""
+        if self._edge_index is None:
+            self._edge_index = {k: i for i, k in enumerate(self.keys.tolist())}
+        leaf_keys, lengths = [], []
+        for _, _, nodes, _ in found:
+            for path in nodes:
+                start = len(leaf_keys)
+                for a, b in zip(path[:-1], path[1:]):
+                    leaf_keys.extend(self._expand_hop(a, b))
+                lengths.append(len(leaf_keys) - start)
+        leaf_keys = np.array(leaf_keys, dtype=np.int64)
+        lengths   = np.array(lengths, dtype=np.int64)
+        arcs      = self.csr.arc_ids(self.order[leaf_keys // self.n],
+                                     self.order[leaf_keys % self.n]).astype(np.int32)
+        arc_ptr   = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=arc_ptr[1:])
+
+        out, k = [], 0
+        for task, (dest_zones, times, _, n_settled) in zip(chunk, found):
+            k1 = k + len(dest_zones)
+            out.append((task[0], dest_zones, times, lengths[k:k1],
+                        arcs[arc_ptr[k]:arc_ptr[k1]], None, n_settled))
+            k = k1
+        return out
+
+
+def build_cch(csr, cache_dir=None, verbose=True):
+    """
+    Preprocessing della gerarchia: riletto da cache_dir se la topologia
+    coincide, altrimenti calcolato e salvato (cache_dir None = niente disco).
+    """
+    path = None
+    if cache_dir:
+        path = os.path.join(cache_dir, "cch_{}.npz".format(topology_key(csr)))
+        if os.path.exists(path):
+            try:
+                data = np.load(path)
+                if int(data["n_nodes"]) == csr.n_nodes:
+                    if verbose:
+                        print("  [OK] Ordine di contrazione da cache: {}".format(path))
+                    return CCH(csr, data["order"], data["edge_lo"], data["edge_hi"])
+            except (OSError, KeyError, ValueError) as e:
+                print("  [!] Cache CCH non leggibile ({}): ricalcolo".format(e))
+
+    t_start = time.perf_counter()
+    order, edge_lo, edge_hi = contraction_order(csr)
+    if verbose:
+        print("  Ordine di contrazione: {:,} nodi, {:,} archi cordali "
+              "({:.2f} s)".format(csr.n_nodes, len(edge_lo), time.perf_counter() - t_start))
+    if path:
+        os.makedirs(cache_dir, exist_ok=True)
+        np.savez(path, n_nodes=csr.n_nodes, order=order, edge_lo=edge_lo, edge_hi=edge_hi)
+        if verbose:
+            print("  [OK] Ordine di contrazione salvato: {}".format(path))
+    return CCH(csr, order, edge_lo, edge_hi)
+
+
+def get_cch(G, cache_dir=None, verbose=True):
+    """Ritorna la CCH di G (cachata in G.graph, ricostruita se cambia la topologia)."""
+    csr    = get_csr_graph(G)
+    cached = G.graph.get("_cch")
+    if cached is not None and cached.csr is csr:
+        return cached
+    cch = build_cch(csr, cache_dir, verbose)
+    G.graph["_cch"] = cch
+    if verbose:
+        print("  Gerarchia: {:,} triangoli, altezza albero {}".format(
+            len(cch._tri_m), int(cch.height.max()) if cch.n else 0))
+    return cch
+
+
+def compute_od_skims_cch(G, centroid_ids, weight="t0", verbose=True, od_filter=None):
+    """
+    Skim O/D per le coppie di od_filter sulla gerarchia (stesso contratto di
+    compute_od_skims_csr). La gerarchia viene costruita al primo uso se non
+    preparata con get_cch(); ad ogni chiamata si ricustomizzano solo i pesi.
+    """
+    cch = get_cch(G, verbose=verbose)
+    tasks, mode_label = _plan_origins(cch.csr, centroid_ids, od_filter)
+    if verbose:
+        print("\n  Calcolo shortest path [cch] (peso={}): {}".format(weight, mode_label))
+
+    t_start = time.perf_counter()
+    changed = cch.customize(edge_weights(G, weight))
+    t_cust  = time.perf_counter() - t_start
+    outputs, settled = cch.query_tasks(tasks)
+    od_times, od_paths = _collect_skims(cch.csr, outputs)
+    n_search = len(tasks) + len({t for task in tasks for _, t in task[2]})
+    trace_count("cch_searches", n_search)
+    trace_count("dijkstra_origins", len(tasks))
+    trace_count("settled_nodes", settled)
+
+    if verbose:
+        print("  Customizzazione: {}  |  query: {:.2f} s  |  nodi esplorati {:,} "
+              "(media {:.0f} per ricerca, rete {:,})".format(
+                  "{:.2f} s".format(t_cust) if changed else "pesi invariati",
+                  time.perf_counter() - t_start - t_cust, settled,
+                  settled / max(n_search, 1), cch.n))
+        print("  Coppie OD con percorso valido: {:,}".format(len(od_times)))
+    return od_times, od_paths
@@ -0,0 +1,1248 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+CSR Graph Engine per skim O/D
+=============================
+Backend compilato per il calcolo degli shortest path tra centroidi, usato da
+optimize_link_speeds.py e optimize_capacity.py al posto di
+nx.single_source_dijkstra.
+
+STRUTTURA:
+    - Nodi rimappati a indici int32 contigui (ordine di inserimento nel DiGraph)
+    - Archi in formato CSR (indptr, indices) ordinati per (nodo_da, nodo_a):
+      l'id arco coincide con la posizione nell'array CSR
+    - Pesi (t0 / tcur) letti ad ogni chiamata dall'EdgeStore: la topologia e'
+      compilata una sola volta e cachata in G.graph
+
+ATTRIBUTI ARCO (EdgeStore):
+    length, v0prt, t0, tcur, vcur, linktype, vol, cap, is_connector come
+    array paralleli per id arco (get_edge_store): aggiornamenti e riduzioni
+    per tipo sono espressioni vettoriali. Il DiGraph e' una vista, allineata
+    su richiesta con sync_edge_view(G).
+
+DIJKSTRA:
+    scipy.sparse.csgraph.dijkstra multi-sorgente a blocchi di origini,
+    con array dei predecessori. I percorsi vengono ricostruiti solo per le
+    coppie OD richieste (od_filter), con lo stesso contratto di
+    compute_od_skims:
+        od_times : dict {(orig_zone, dest_zone): tempo_minuti}
+        od_paths : ArcPaths {(orig_zone, dest_zone): [nodi_percorso]}
+
+PERCORSI (ArcPaths):
+    I percorsi sono memorizzati come sequenze di id arco in formato CSR
+    (indptr + id arco int32), costruite direttamente dai predecessori.
+    ArcPaths si comporta come il dict di liste di nodi (le liste vengono
+    generate solo se richieste), ma le matrici di composizione si
+    costruiscono con un'unica gather vettoriale sugli array per arco.
+
+PARALLELO (n_workers > 1):
+    Le origini vengono suddivise in blocchi ed eseguite da un pool di
+    processi. Topologia e pesi (indptr, indices, pesi, chiavi arco) sono copiati
+    una sola volta in multiprocessing.shared_memory: i worker vi si agganciano
+    senza ricevere il DiGraph. I risultati sono uniti nell'ordine delle
+    origini, quindi identici (anche nell'ordine dei dict) alla modalita' seriale.
+
+INCREMENTALE (IncrementalSkims):
+    Per skim ripetuti con pochi archi modificati (per_arc) ricalcola solo le
+    origini il cui albero puo' cambiare; le altre riusano tempi e percorsi.
+    PathRowCache fa lo stesso per le righe della matrice di composizione:
+    solo le OD con percorso cambiato (hash degli archi) vengono ricostruite.
+
+SKIM FINALE A BLOCCHI (iter_type_skims_csr):
+    Per l'export di tutte le coppie N x N le origini vengono elaborate a
+    blocchi: i metri per LinkType di ogni percorso sono accumulati risalendo
+    l'albero dei predecessori, senza dict dei tempi ne' ArcPaths globali
+    (vedi skim_export.py).
+
+RICERCA LIMITATA (target_radius):
+    Con od_filter le destinazioni richieste sono poche e vicine all'origine.
+    Con target_radius {orig_zone: raggio_minuti} il Dijkstra di ogni origine
+    si ferma al raggio (parametro `limit` di scipy): i nodi oltre non vengono
+    esplorati. Le origini con destinazioni richieste non raggiunte vengono
+    ripetute con raggio x TARGET_RADIUS_GROWTH e, all'ultimo tentativo,
+    senza limite: il risultato coincide con la ricerca completa.
+
+NOTA: a parita' di costo (percorsi equivalenti) il percorso scelto puo'
+      differire da NetworkX; i tempi coincidono.
+"""
+
+import os
+import time
+from collections.abc import Mapping
+
+import numpy as np
+
+from stage_timing import trace_count
+
+
+# Celle massime (origini x nodi) per blocco Dijkstra: limita la memoria
+# delle matrici distanze/predecessori (~12 byte per cella).
+DIJKSTRA_BLOCK_CELLS = 20_000_000
+
+# Valore scipy per "nessun predecessore"
+NO_PRED = -9999
+
+# Blocchi di origini per worker nel pool (bilanciamento del carico)
+BLOCKS_PER_WORKER = 4
+
+# Memoria massima (MB) per la matrice distanze (origini x nodi, float32)
+# conservata dal re-routing incrementale
+INCREMENTAL_DIST_MAX_MB = 2048
+
+# Ricerca limitata: fattore di allargamento del raggio e tentativi prima
+# della ricerca senza limite
+TARGET_RADIUS_GROWTH  = 4.0
+TARGET_RADIUS_RETRIES = 2
+
+
+class CSRGraph:
+    """
+    Topologia di un nx.DiGraph compilata in array CSR.
+
+    Attributi:
+        node_ids   : np.ndarray int64  -- id originale per indice nodo
+        node_index : dict {node_id: indice}
+        indptr     : np.ndarray int32 (n_nodes + 1)
+        indices    : np.ndarray int32 (n_arcs)  -- nodo di arrivo per arco
+        arc_src    : np.ndarray int32 (n_arcs)  -- nodo di partenza per arco
+    """
+
+    def __init__(self, node_ids, indptr, indices, arc_src, adj_perm):
+        self.node_ids   = node_ids
+        self.node_index = {int(n): i for i, n in enumerate(node_ids.tolist())}
+        self.indptr     = indptr
+        self.indices    = indices
+        self.arc_src    = arc_src
+        self.n_nodes    = len(node_ids)
+        self.n_arcs     = len(indices)
+        # Permutazione: ordine di G.adjacency() -> id arco CSR
+        self._adj_perm  = adj_perm
+        self._arc_keys  = None
+        self._node_sort = None
+
+    @classmethod
+    def from_networkx(cls, G):
+        """Compila la topologia di G (nx.DiGraph) in formato CSR."""
+        node_ids   = np.fromiter(G.nodes(), dtype=np.int64, count=G.number_of_nodes())
+        node_index = {int(n): i for i, n in enumerate(node_ids.tolist())}
+        n_nodes    = len(node_ids)
+        n_arcs     = G.number_of_edges()
+
+        src = np.empty(n_arcs, dtype=np.int64)
+        dst = np.empty(n_arcs, dtype=np.int64)
+        k = 0
+        for u, nbrs in G.adjacency():
+            iu = node_index[u]
+            for v in nbrs:
+                src[k] = iu
+                dst[k] = node_index[v]
+                k += 1
+
+        # Ordina per (src, dst): l'id arco = posizione CSR
+        order   = np.lexsort((dst, src))
+        arc_src = src[order].astype(np.int32)
+        indices = dst[order].astype(np.int32)
+        counts  = np.bincount(arc_src, minlength=n_nodes)
+        indptr  = np.zeros(n_nodes + 1, dtype=np.int32)
+        np.cumsum(counts, out=indptr[1:])
+
+        adj_perm = np.empty(n_arcs, dtype=np.int64)
+        adj_perm[order] = np.arange(n_arcs, dtype=np.int64)
+        return cls(node_ids, indptr, indices, arc_src, adj_perm)
+
+    def weights_from_networkx(self, G, weight, default=1.0, dtype=np.float64):
+        """Legge l'attributo `weight` di ogni arco di G nell'ordine degli id arco."""
+        w_adj = np.fromiter(
+            (d.get(weight, default) for _, nbrs in G.adjacency() for d in nbrs.values()),
+            dtype=dtype, count=self.n_arcs)
+        w = np.empty(self.n_arcs, dtype=dtype)
+        w[self._adj_perm] = w_adj
+        return w
+
+    def arc_keys(self):
+        """Chiavi src*n_nodes + dst per arco, gia' ordinate (archi ordinati per (src, dst))."""
+        if self._arc_keys is None:
+            self._arc_keys = self.arc_src.astype(np.int64) * self.n_nodes + self.indices
+        return self._arc_keys
+
+    def arc_ids(self, src_idx, dst_idx):
+        """Id arco per coppie di indici nodo (archi esistenti in CSR)."""
+        return np.searchsorted(self.arc_keys(),
+                               np.asarray(src_idx, dtype=np.int64) * self.n_nodes
+                               + np.asarray(dst_idx, dtype=np.int64))
+
+    def arc_ids_from_pairs(self, pairs):
+        """Id degli archi (u, v) (id nodo originali) presenti nel grafo; gli altri sono ignorati."""
+        ids = self.arc_ids_lookup(pairs)
+        return ids[ids >= 0]
+
+    def arc_ids_lookup(self, pairs):
+        """Id arco per ogni coppia (u, v) nell'ordine dato, -1 se l'arco non esiste."""
+        idx = np.array([(self.node_index.get(u, -1), self.node_index.get(v, -1))
+                        for u, v in pairs], dtype=np.int64).reshape(-1, 2)
+        return self._checked_arc_ids(idx[:, 0], idx[:, 1])
+
+    def node_positions(self, node_ids):
+        """Indice nodo per ogni id originale (array), -1 se il nodo non e' nel grafo."""
+        ids = np.asarray(node_ids, dtype=np.int64)
+        out = np.full(len(ids), -1, dtype=np.int64)
+        if self.n_nodes == 0:
+            return out
+        if self._node_sort is None:
+            order = np.argsort(self.node_ids, kind="stable")
+            self._node_sort = (order, self.node_ids[order])
+        order, sorted_ids = self._node_sort
+        pos = np.minimum(np.searchsorted(sorted_ids, ids), self.n_nodes - 1)
+        found = sorted_ids[pos] == ids
+        out[found] = order[pos[found]]
+        return out
+
+    def arc_ids_for_nodes(self, from_ids, to_ids):
+        """
+        Versione vettoriale di arc_ids_lookup per array paralleli di id nodo
+        originali (es. colonne FROMNODENO / TONODENO): -1 se l'arco non esiste.
+        """
+        return self._checked_arc_ids(self.node_positions(from_ids),
+                                     self.node_positions(to_ids))
+
+    def _checked_arc_ids(self, src_idx, dst_idx):
+        """Id arco per indici nodo (-1 = nodo assente), -1 se l'arco non esiste."""
+        ids = np.full(len(src_idx), -1, dtype=np.int64)
+        valid = (src_idx >= 0) & (dst_idx >= 0)
+        if self.n_arcs == 0 or not valid.any():
+            return ids
+        src, dst = src_idx[valid], dst_idx[valid]
+        cand = np.minimum(self.arc_ids(src, dst), self.n_arcs - 1)
+        found = (self.arc_src[cand] == src) & (self.indices[cand] == dst)
+        ids[np.flatnonzero(valid)[found]] = cand[found]
+        return ids
+
+    def arc_pairs(self, arc_ids):
+        """Lista di tuple (u, v) (id nodo originali) per gli id arco dati."""
+        u = self.node_ids[self.arc_src[arc_ids]].tolist()
+        v = self.node_ids[self.indices[arc_ids]].tolist()
+        return list(zip(u, v))
+
+    def matrix(self, weights):
+        """Matrice sparsa (n_nodes x n_nodes) pronta per scipy.sparse.csgraph."""
+        from scipy.sparse import csr_matrix
+        return csr_matrix((weights, self.indices, self.indptr),
+                          shape=(self.n_nodes, self.n_nodes))
+
+
+def get_csr_graph(G):
+    """
+    Ritorna il CSRGraph di G, compilandolo solo se la topologia e' cambiata
+    (stesso numero di nodi/archi = cache valida: gli script aggiornano solo
+    gli attributi degli archi, mai la topologia).
+    """
+    key = (G.number_of_nodes(), G.number_of_edges())
+    cached = G.graph.get("_csr_graph")
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    csr = CSRGraph.from_networkx(G)
+    G.graph["_csr_graph"] = (key, csr)
+    return csr
+
+
+def share_csr_graph(G, csr):
+    """
+    Associa a G un CSRGraph gia' compilato per un grafo con la stessa
+    topologia e lo stesso ordine di inserimento degli archi (es. grafi
+    costruiti dagli stessi array): la topologia non viene ricompilata.
+    """
+    G.graph["_csr_graph"] = ((G.number_of_nodes(), G.number_of_edges()), csr)
+
+
+# -----------------------------------------------------------------------------
+# Attributi arco colonnari
+# -----------------------------------------------------------------------------
+
+# Attributi tenuti da EdgeStore: valore per archi senza l'attributo e dtype
+# (NaN = assente, es. v0prt dei connettori)
+EDGE_COLUMNS = {
+    "length":       (0.0,    np.float64),
+    "t0":           (0.0,    np.float64),
+    "v0prt":        (np.nan, np.float64),
+    "tcur":         (0.0,    np.float64),
+    "vcur":         (0.0,    np.float64),
+    "linktype":     (-1,     np.int64),
+    "vol":          (0.0,    np.float64),
+    "cap":          (0.0,    np.float64),
+    "is_connector": (False,  bool),
+}
+
+
+class EdgeStore:
+    """
+    Attributi degli archi come array NumPy paralleli indicizzati per id arco
+    CSR: e' la fonte dei dati per letture e aggiornamenti vettoriali
+    (update_graph_*, velocita' iniziali per tipo, pesi degli skim).
+
+    Il DiGraph resta una vista: i valori scritti con set() vengono riportati
+    negli edge dict solo da sync_graph() (sync_edge_view), da chiamare prima
+    di leggere gli attributi arco per arco via NetworkX. Chi scrive
+    direttamente negli edge dict deve chiamare reload().
+    """
+
+    def __init__(self, csr, columns):
+        self.csr     = csr
+        self.columns = columns
+        self._dirty  = {}
+
+    @classmethod
+    def from_networkx(cls, G, csr):
+        """Legge da G gli attributi di EDGE_COLUMNS presenti su almeno un arco."""
+        present = set().union(*(d.keys() for _, _, d in G.edges(data=True)))
+        store = cls(csr, {})
+        store.reload(G, [attr for attr in EDGE_COLUMNS if attr in present])
+        return store
+
+    @classmethod
+    def from_edge_arrays(cls, csr, arrays):
+        """
+        Store dagli array per arco del loader colonnare (from_node, to_node +
+        attributi), senza rileggere il DiGraph. Per gli archi ripetuti (es.
+        riga diretta + colonne R_* della riga opposta) vale l'ultima
+        occorrenza, come in add_edges_from. None se gli array non coprono
+        tutti gli archi di G.
+        """
+        order = np.argsort(csr.node_ids, kind="stable")
+        src = order[np.searchsorted(csr.node_ids, arrays["from_node"], sorter=order)]
+        dst = order[np.searchsorted(csr.node_ids, arrays["to_node"], sorter=order)]
+        ids = csr.arc_ids(src, dst)
+        _, last = np.unique(ids[::-1], return_index=True)
+        if len(last) != csr.n_arcs:
+            return None
+        rows = len(ids) - 1 - last
+        columns = {}
+        for attr, (default, dtype) in EDGE_COLUMNS.items():
+            if attr in arrays:
+                columns[attr] = np.empty(csr.n_arcs, dtype=dtype)
+                columns[attr][ids[rows]] = np.asarray(arrays[attr])[rows]
+        return cls(csr, columns)
+
+    def __contains__(self, attr):
+        return attr in self.columns
+
+    def __getitem__(self, attr):
+        """Array dell'attributo (in sola lettura: per modificare usare set())."""
+        if attr not in self.columns:
+            default, dtype = EDGE_COLUMNS[attr]
+            self.columns[attr] = np.full(self.csr.n_arcs, default, dtype=dtype)
+        return self.columns[attr]
+
+    def set(self, attr, arc_ids, values):
+        """Scrive values sugli archi arc_ids; la vista NetworkX e' aggiornata da sync_graph()."""
+        arc_ids = np.asarray(arc_ids, dtype=np.int64)
+        self[attr][arc_ids] = values
+        if arc_ids.size:
+            self._dirty.setdefault(attr, []).append(arc_ids)
+
+    def _per_type(self, keys, vals, default):
+        """vals[k] per gli archi con linktype == keys[k], default altrove."""
+        lt = self["linktype"]
+        if len(keys) == 0 or len(lt) == 0:
+            return np.full(len(lt), default, dtype=vals.dtype)
+        lo = min(int(keys.min()), int(lt.min()))
+        hi = max(int(keys.max()), int(lt.max()))
+        if hi - lo <= 4 * len(lt) + 1024:
+            # Tabella diretta linktype -> valore (TypeNo Visum: pochi interi piccoli)
+            lut = np.full(hi - lo + 1, default, dtype=vals.dtype)
+            lut[keys - lo] = vals
+            return lut[lt - lo]
+        order = np.argsort(keys, kind="stable")
+        pos = np.minimum(np.searchsorted(keys[order], lt), len(keys) - 1)
+        out = np.full(len(lt), default, dtype=vals.dtype)
+        found = keys[order][pos] == lt
+        out[found] = vals[order][pos[found]]
+        return out
+
+    def by_type(self, values, default=np.nan):
+        """Valore per arco da un dict {linktype: valore} (default se il tipo manca)."""
+        keys = np.fromiter(values, dtype=np.int64, count=len(values))
+        vals = np.array([np.nan if x is None else x for x in values.values()],
+                        dtype=np.float64)
+        return self._per_type(keys, vals, default)
+
+    def type_index(self, linktype_list):
+        """Posizione del linktype di ogni arco in linktype_list (-1 se assente)."""
+        keys = np.asarray(list(linktype_list), dtype=np.int64)
+        # a parita' di tipo vale la prima posizione, come list.index
+        keys, first = np.unique(keys, return_index=True)
+        return self._per_type(keys, first.astype(np.int64), -1)
+
+    def sync_graph(self, G):
+        """Riporta negli edge dict di G i valori scritti con set() dall'ultimo sync."""
+        if not self._dirty:
+            return 0
+        csr = self.csr
+        adj = G._adj
+        n_written = 0
+        for attr, chunks in self._dirty.items():
+            ids = np.unique(np.concatenate(chunks))
+            u = csr.node_ids[csr.arc_src[ids]].tolist()
+            v = csr.node_ids[csr.indices[ids]].tolist()
+            for a, b, x in zip(u, v, self.columns[attr][ids].tolist()):
+                adj[a][b][attr] = x
+            n_written += len(ids)
+        self._dirty = {}
+        return n_written
+
+    def reload(self, G, attrs=None):
+        """Rilegge da G gli attributi (tutti se None) dopo scritture dirette negli edge dict."""
+        for attr in (list(self.columns) if attrs is None else attrs):
+            default, dtype = EDGE_COLUMNS[attr]
+            self.columns[attr] = self.csr.weights_from_networkx(G, attr, default=default,
+                                                                dtype=dtype)
+            self._dirty.pop(attr, None)
+
+
+def get_edge_store(G):
+    """
+    Ritorna l'EdgeStore di G (cachato in G.graph come il CSRGraph), letto dagli
+    edge dict al primo uso o dopo un cambio di topologia.
+    """
+    cached = G.graph.get("_edge_store")
+    csr_cached = G.graph.get("_csr_graph")
+    # Confronto con il CSR in cache senza ricontare gli archi (O(n) in NetworkX):
+    # un cambio di topologia viene rilevato da get_csr_graph al prossimo skim
+    if cached is not None and csr_cached is not None and cached.csr is csr_cached[1]:
+        return cached
+    csr = get_csr_graph(G)
+    store = EdgeStore.from_networkx(G, csr)
+    G.graph["_edge_store"] = store
+    return store
+
+
+def seed_edge_store(G, arrays):
+    """Crea l'EdgeStore di G dagli array di build_edge_arrays (evita la lettura arco per arco)."""
+    store = EdgeStore.from_edge_arrays(get_csr_graph(G), arrays)
+    if store is not None:
+        G.graph["_edge_store"] = store
+
+
+def sync_edge_view(G):
+    """Allinea gli edge dict di G allo store (no-op se lo store non esiste o e' allineato)."""
+    store = G.graph.get("_edge_store")
+    if store is not None:
+        store.sync_graph(G)
+
+
+def edge_weights(G, weight):
+    """
+    Pesi per arco (copia, ordine id arco) per gli skim: dallo store per gli
+    attributi di EDGE_COLUMNS, altrimenti letti dal DiGraph.
+    """
+    if weight in EDGE_COLUMNS:
+        return get_edge_store(G)[weight].astype(np.float64, copy=True)
+    return get_csr_graph(G).weights_from_networkx(G, weight)
+
+
+class ArcPaths(Mapping):
+    """
+    Percorsi OD come sequenze di id arco (CSR): i-esimo percorso =
+    arcs[indptr[i]:indptr[i + 1]], chiave keys[i] = (orig_zone, dest_zone).
+
+    Interfaccia Mapping compatibile con il dict {od: [nodi_percorso]}:
+    paths[od] ricostruisce la lista dei nodi al volo.
+    """
+
+    def __init__(self, csr, keys, indptr, arcs):
+        self.csr    = csr
+        self._keys  = list(keys)
+        self._index = {k: i for i, k in enumerate(self._keys)}
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.arcs   = np.asarray(arcs, dtype=np.int32)
+
+    @classmethod
+    def from_node_paths(cls, csr, od_paths):
+        """Converte un dict {od: [nodi_percorso]} (es. engine networkx)."""
+        keys = list(od_paths.keys())
+        node_index = csr.node_index
+        lengths = np.zeros(len(keys), dtype=np.int64)
+        src, dst = [], []
+        for i, k in enumerate(keys):
+            path = [node_index[n] for n in od_paths[k]]
+            lengths[i] = max(len(path) - 1, 0)
+            src.extend(path[:-1])
+            dst.extend(path[1:])
+        indptr = np.zeros(len(keys) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=indptr[1:])
+        arcs = csr.arc_ids(np.array(src, dtype=np.int64), np.array(dst, dtype=np.int64))
+        return cls(csr, keys, indptr, arcs)
+
+    def __getitem__(self, key):
+        i = self._index[key]
+        a = self.arcs[self.indptr[i]:self.indptr[i + 1]]
+        if len(a) == 0:
+            return []
+        nodes = self.csr.arc_src[a].tolist() + [int(self.csr.indices[a[-1]])]
+        return self.csr.node_ids[nodes].tolist()
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def row_ids(self):
+        """Indice del percorso (riga) per ogni elemento di self.arcs."""
+        return np.repeat(np.arange(len(self._keys), dtype=np.int64), np.diff(self.indptr))
+
+    def row_hashes(self, arc_keys=None):
+        """
+        Hash uint64 di ogni percorso: somma modulo 2^64 di una chiave casuale
+        per arco (arc_keys, vedi arc_hash_keys). Due percorsi semplici tra la
+        stessa coppia OD coincidono se e solo se hanno lo stesso insieme di
+        archi.
+        """
+        if arc_keys is None:
+            arc_keys = arc_hash_keys(self.csr.n_arcs)
+        csum = np.zeros(len(self.arcs) + 1, dtype=np.uint64)
+        np.cumsum(arc_keys[self.arcs], out=csum[1:])
+        return csum[self.indptr[1:]] - csum[self.indptr[:-1]]
+
+    def key_codes(self):
+        """Chiavi OD come int64 orig * 2^32 + dest (vedi observed_times.py)."""
+        if not self._keys:
+            return np.zeros(0, dtype=np.int64)
+        k = np.array(self._keys, dtype=np.int64)
+        return (k[:, 0] << 32) + k[:, 1]
+
+    def subset(self, keys):
+        """Nuovo ArcPaths con i soli percorsi `keys` (nell'ordine dato)."""
+        keys = list(keys)
+        return self.subset_rows(np.array([self._index[k] for k in keys], dtype=np.int64), keys)
+
+    def subset_rows(self, rows, keys=None):
+        """Nuovo ArcPaths con i percorsi di indice `rows` (nell'ordine dato)."""
+        rows = np.asarray(rows, dtype=np.int64)
+        if keys is None:
+            keys = [self._keys[i] for i in rows.tolist()]
+        starts  = self.indptr[rows]
+        lengths = self.indptr[rows + 1] - starts
+        indptr  = np.zeros(len(keys) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=indptr[1:])
+        # posizioni sorgente: start di ogni percorso + offset interno
+        offsets = np.arange(indptr[-1], dtype=np.int64) - np.repeat(indptr[:-1], lengths)
+        return ArcPaths(self.csr, keys, indptr, self.arcs[np.repeat(starts, lengths) + offsets])
+
+
+def arc_hash_keys(n_arcs, seed=0):
+    """Chiavi uint64 pseudo-casuali per id arco (hash dei percorsi)."""
+    return np.random.RandomState(seed).randint(
+        0, np.iinfo(np.int64).max, size=n_arcs, dtype=np.int64).astype(np.uint64) * np.uint64(2) + np.uint64(1)
+
+
+class PathRowCache:
+    """
+    Righe di una matrice per percorso OD (es. la D per LinkType) conservate
+    tra le iterazioni: dopo il re-routing vengono ricalcolate solo le righe
+    delle coppie OD il cui percorso e' cambiato (ArcPaths.row_hashes).
+
+        cache = PathRowCache()
+        D, changed = cache.update(paths, build_rows, signature=tuple(linktype_list))
+
+    build_rows(sub_paths) -> np.ndarray (len(sub_paths) x n_col) calcola le
+    righe da zero (None = nessuna riga, solo la diagnostica dei percorsi
+    cambiati). signature identifica il contesto (colonne, attributi
+    usati): se cambia la cache viene svuotata. Le righe dipendono solo dal
+    percorso: valido finche' lunghezze e tipi degli archi non cambiano.
+
+    state() / restore() portano gli hash dei percorsi in un checkpoint:
+    dopo restore() il primo update segnala i percorsi cambiati come nel
+    run originale e ricalcola tutte le righe.
+    """
+
+    def __init__(self):
+        self.signature = None
+        self._codes = None     # chiavi OD ordinate (int64)
+        self._hashes = None    # hash percorso, allineati a _codes
+        self._rows = None      # righe, allineate a _codes
+        self.last_changed = None
+        self._arc_keys = None
+
+    def update(self, paths, build_rows, signature=None):
+        """
+        Ritorna (rows, changed): rows nell'ordine di paths, changed = maschera
+        bool delle righe ricalcolate (percorso nuovo o diverso).
+        """
+        if build_rows is None:
+            build_rows = lambda p: np.zeros((len(p), 0))
+        if self._arc_keys is None or len(self._arc_keys) != paths.csr.n_arcs:
+            if self._arc_keys is not None:
+                self._codes = self._hashes = self._rows = None
+            self._arc_keys = arc_hash_keys(paths.csr.n_arcs)
+        codes  = paths.key_codes()
+        hashes = paths.row_hashes(self._arc_keys)
+        n = len(codes)
+        changed = np.ones(n, dtype=bool)
+        if self._codes is not None and signature == self.signature and len(self._codes):
+            pos = np.minimum(np.searchsorted(self._codes, codes), len(self._codes) - 1)
+            changed = (self._codes[pos] != codes) | (self._hashes[pos] != hashes)
+
+        if changed.all() or self._rows is None:
+            rows = np.asarray(build_rows(paths))
+        else:
+            rows = np.empty((n,) + self._rows.shape[1:], dtype=self._rows.dtype)
+            rows[~changed] = self._rows[pos[~changed]]
+            if changed.any():
+                rows[changed] = build_rows(paths.subset_rows(np.flatnonzero(changed)))
+
+        order = np.argsort(codes, kind="stable")
+        self.signature = signature
+        self._codes, self._hashes, self._rows = codes[order], hashes[order], rows[order]
+        self.last_changed = changed
+        return rows, changed
+
+    def state(self):
+        """(chiavi OD, hash percorsi) dell'ultimo update, None se vuota."""
+        if self._codes is None:
+            return None
+        return self._codes, self._hashes
+
+    def restore(self, codes, hashes, signature=None):
+        """Ripristina gli hash di state() (righe non salvate: ricalcolate al primo update)."""
+        order = np.argsort(codes, kind="stable")
+        self.signature = signature
+        self._codes  = np.asarray(codes, dtype=np.int64)[order]
+        self._hashes = np.asarray(hashes, dtype=np.uint64)[order]
+        self._rows   = None
+
+
+def as_arc_paths(G, od_paths):
+    """ArcPaths per od_paths (gia' ArcPaths oppure dict di liste di nodi)."""
+    if isinstance(od_paths, ArcPaths):
+        return od_paths
+    return ArcPaths.from_node_paths(get_csr_graph(G), od_paths)
+
+
+def select_paths(od_paths, keys):
+    """Sottoinsieme dei percorsi `keys` (stesso tipo dell'input)."""
+    if isinstance(od_paths, ArcPaths):
+        return od_paths.subset(keys)
+    return {k: od_paths[k] for k in keys}
+
+
+def path_from_predecessors(pred_row, source_idx, target_idx):
+    """Ricostruisce la lista di indici nodo source -> target da una riga predecessori."""
+    path = [target_idx]
+    node = target_idx
+    while node != source_idx:
+        node = pred_row[node]
+        if node == NO_PRED:
+            return None
+        path.append(node)
+    path.reverse()
+    return path
+
+
+def origin_time_radius(od_values, slack):
+    """
+    Raggio di ricerca per origine: max tempo osservato verso le sue
+    destinazioni x slack. od_values: dict {(orig_zone, dest_zone): minuti}.
+    Ritorna None se slack e' None/<= 0 (ricerca completa).
+    """
+    if not slack or slack <= 0:
+        return None
+    radius = {}
+    for (o, _), t in od_values.items():
+        if t > 0 and np.isfinite(t) and t * slack > radius.get(o, 0.0):
+            radius[o] = float(t) * slack
+    return radius
+
+
+def resolve_n_workers(n_workers):
+    """Numero di processi effettivo: None/0 -> tutti i core, minimo 1."""
+    if not n_workers:
+        return os.cpu_count() or 1
+    return max(1, int(n_workers))
+
+
+def _skim_block(graph, arc_keys, tasks, keep_dist=False):
+    """
+    Dijkstra multi-sorgente per un blocco di origini.
+
+    tasks    : lista di (orig_zone, src_idx, [(dest_zone, dest_idx), ...], raggio)
+    arc_keys : chiavi ordinate src*n_nodes + dst degli archi (-> id arco)
+    Ritorna, per ogni task nello stesso ordine, una tupla
+        (orig_zone, [dest_zone], [tempo], n_archi per percorso, id archi, dist,
+         nodi esplorati)
+    con i percorsi raggiungibili concatenati come id arco (int32) e dist =
+    riga distanze float32 solo se keep_dist (altrimenti None).
+    Il Dijkstra del blocco si ferma al raggio massimo dei suoi task
+    (np.inf = ricerca completa).
+    """
+    from scipy.sparse.csgraph import dijkstra
+
+    n_nodes = graph.shape[0]
+    src_idx = np.array([task[1] for task in tasks], dtype=np.int32)
+    limit   = max(task[3] for task in tasks)
+    dist, pred = dijkstra(graph, directed=True, indices=src_idx,
+                          return_predecessors=True, limit=limit)
+    out = []
+    for row, (zone_id, s_idx, dests, _) in enumerate(tasks):
+        dist_row = dist[row]
+        pred_row = pred[row]
+        dest_zones, times, hops = [], [], []
+        for dest_zone, t_idx in dests:
+            d = dist_row[t_idx]
+            if not d < 1e9:
+                continue
+            path_idx = path_from_predecessors(pred_row, s_idx, t_idx)
+            if path_idx is None:
+                continue
+            dest_zones.append(dest_zone)
+            times.append(float(d))
+            hops.append(path_idx)
+        lengths = np.array([len(p) - 1 for p in hops], dtype=np.int64)
+        if hops:
+            nodes = np.concatenate([np.asarray(p, dtype=np.int64) for p in hops])
+            # archi consecutivi di ogni percorso (esclude il salto tra percorsi)
+            ends  = np.cumsum(lengths + 1)
+            valid = np.ones(len(nodes) - 1, dtype=bool)
+            valid[ends[:-1] - 1] = False
+            arcs = np.searchsorted(arc_keys, nodes[:-1][valid] * n_nodes
+                                   + nodes[1:][valid]).astype(np.int32)
+        else:
+            arcs = np.empty(0, dtype=np.int32)
+        extra = dist_row.astype(np.float32) if keep_dist else None
+        out.append((zone_id, dest_zones, times, lengths, arcs, extra,
+                    int(np.isfinite(dist_row).sum())))
+    return out
+
+
+# -----------------------------------------------------------------------------
+# Pool di processi con grafo in shared memory
+# -----------------------------------------------------------------------------
+
+class SharedArrays:
+    """
+    Copia un dict di np.ndarray in blocchi multiprocessing.shared_memory.
+    `spec` (picklabile) permette ai worker di riagganciarsi con attach_shared().
+    Usare come context manager: all'uscita i blocchi vengono rilasciati.
+    """
+
+    def __init__(self, arrays):
+        from multiprocessing import shared_memory
+
+        self._blocks = []
+        self.spec = {}
+        for name, arr in arrays.items():
+            arr = np.ascontiguousarray(arr)
+            shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+            np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)[...] = arr
+            self._blocks.append(shm)
+            self.spec[name] = (shm.name, arr.shape, arr.dtype.str)
+
+    def close(self):
+        for shm in self._blocks:
+            shm.close()
+            shm.unlink()
+        self._blocks = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def attach_shared(spec):
+    """
+    Aggancia (lato worker) i blocchi descritti da SharedArrays.spec.
+    Ritorna (dict di np.ndarray, lista handle da tenere vivi).
+    """
+    from multiprocessing import shared_memory
+
+    arrays, handles = {}, []
+    for name, (shm_name, shape, dtype) in spec.items():
+        try:
+            shm = shared_memory.SharedMemory(name=shm_name, track=False)
+        except TypeError:  # Python < 3.13: nessun parametro track
+            shm = shared_memory.SharedMemory(name=shm_name)
+        handles.append(shm)
+        arrays[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+    return arrays, handles
+
+
+# Stato del processo worker (impostato da _init_skim_worker)
+_WORKER_STATE = {}
+
+
+def _init_skim_worker(spec):
+    """Initializer del pool: aggancia gli array CSR e prepara la matrice scipy."""
+    from scipy.sparse import csr_matrix
+
+    arrays, handles = attach_shared(spec)
+    n_nodes = len(arrays["indptr"]) - 1
+    _WORKER_STATE["handles"]  = handles
+    _WORKER_STATE["arc_keys"] = arrays["arc_keys"]
+    _WORKER_STATE["graph"]    = csr_matrix(
+        (arrays["weights"], arrays["indices"], arrays["indptr"]),
+        shape=(n_nodes, n_nodes), copy=False)
+
+
+def _skim_worker(job):
+    """Task del pool: un blocco di origini sul grafo condiviso."""
+    tasks, keep_dist = job
+    return _skim_block(_WORKER_STATE["graph"], _WORKER_STATE["arc_keys"],
+                       tasks, keep_dist)
+
+
+# -----------------------------------------------------------------------------
+# Pianificazione ed esecuzione degli skim
+# -----------------------------------------------------------------------------
+
+def _valid_centroids(csr, centroid_ids):
+    """Coppie (zona, nodo centroide -zona) presenti nel grafo, nell'ordine dato."""
+    node_index = csr.node_index
+    valid_centroids = [(z, -z) for z in centroid_ids if -z in node_index]
+    if len(valid_centroids) < len(centroid_ids):
+        print("  [!] {} centroidi non trovati nel grafo "
+              "(mancano connettori?)".format(len(centroid_ids) - len(valid_centroids)))
+    return valid_centroids
+
+
+def _plan_origins(csr, centroid_ids, od_filter, target_radius=None):
+    """
+    Origini da calcolare e relative destinazioni (gia' risolte in indici nodo).
+    target_radius: dict {orig_zone: raggio} per la ricerca limitata
+    (origini assenti -> ricerca completa).
+    Ritorna (tasks, mode_label); tasks nel formato di _skim_block.
+    """
+    node_index = csr.node_index
+
+    valid_centroids = _valid_centroids(csr, centroid_ids)
+
+    if od_filter is not None:
+        needed_origins = {o for o, d in od_filter}
+        needed_by_origin = {}
+        for o, d in od_filter:
+            needed_by_origin.setdefault(o, set()).add(d)
+        origins_to_run = [(z, -z) for z, _ in valid_centroids if z in needed_origins]
+        mode_label = "filtrato ({} origini, {} coppie)".format(
+            len(origins_to_run), len(od_filter))
+    else:
+        origins_to_run   = valid_centroids
+        needed_by_origin = None
+        n_valid = len(valid_centroids)
+        mode_label = "{} origini x {} dest = {:,} coppie".format(
+            n_valid, n_valid, n_valid * (n_valid - 1))
+    dest_lookup = {z: node_index[-z] for z, _ in valid_centroids}
+
+    tasks = []
+    for zone_id, c in origins_to_run:
+        dest_zones = needed_by_origin[zone_id] if needed_by_origin else \
+                     [z for z, _ in valid_centroids if z != zone_id]
+        dests = [(dz, dest_lookup[dz]) for dz in dest_zones if dz in dest_lookup]
+        limit = target_radius.get(zone_id, np.inf) if target_radius else np.inf
+        tasks.append((zone_id, node_index[c], dests, limit))
+    if target_radius and any(np.isfinite(t[3]) for t in tasks):
+        mode_label += ", ricerca limitata"
+    return tasks, mode_label
+
+
+def _run_skim_blocks(csr, weights, tasks, n_workers=1, verbose=True, keep_dist=False):
+    """
+    Esegue i task (origini) a blocchi, in serie o sul pool di processi.
+    Ritorna l'output di _skim_block concatenato nell'ordine dei task.
+    """
+    n_run    = len(tasks)
+    arc_keys = csr.arc_keys()
+    block    = max(1, DIJKSTRA_BLOCK_CELLS // max(csr.n_nodes, 1) // n_workers)
+    if n_workers > 1:
+        block = min(block, -(-n_run // (n_workers * BLOCKS_PER_WORKER)))
+    blocks = [tasks[i:i + block] for i in range(0, n_run, block)]
+    out = []
+
+    if n_workers == 1:
+        graph = csr.matrix(weights)
+        for k, chunk in enumerate(blocks):
+            if verbose:
+                print("  Origini {}-{}/{} (blocco Dijkstra)...".format(
+                    k * block + 1, k * block + len(chunk), n_run))
+            out.extend(_skim_block(graph, arc_keys, chunk, keep_dist))
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+
+        shared = {"indptr": csr.indptr, "indices": csr.indices,
+                  "weights": weights, "arc_keys": arc_keys}
+        with SharedArrays(shared) as shm, \
+                ProcessPoolExecutor(max_workers=n_workers,
+                                    initializer=_init_skim_worker,
+                                    initargs=(shm.spec,)) as pool:
+            # map() restituisce i blocchi nell'ordine di invio -> deterministico
+            jobs = [(chunk, keep_dist) for chunk in blocks]
+            for k, block_out in enumerate(pool.map(_skim_worker, jobs)):
+                if verbose and (k + 1) % -(-len(blocks) // 10) == 0:
+                    print("  Blocchi completati: {}/{}".format(k + 1, len(blocks)))
+                out.extend(block_out)
+    trace_count("dijkstra_calls", len(blocks))
+    trace_count("dijkstra_origins", n_run)
+    trace_count("settled_nodes", sum(task_out[6] for task_out in out))
+    return out
+
+
+def _radius_groups(limits):
+    """
+    Raggruppa i task per raggio (classi di ampiezza x2, inf a parte): il
+    Dijkstra di un blocco si ferma al raggio massimo dei suoi task.
+    Ritorna liste di indici, ognuna ordinata per raggio crescente.
+    """
+    groups = {}
+    for i in sorted(range(len(limits)), key=lambda i: limits[i]):
+        lim = limits[i]
+        key = int(np.ceil(np.log2(lim))) if 0 < lim < np.inf else lim
+        groups.setdefault(key, []).append(i)
+    return list(groups.values())
+
+
+def _run_skim_tasks(csr, weights, tasks, n_workers=1, verbose=True, keep_dist=False):
+    """
+    Come _run_skim_blocks, con la ricerca limitata dei task con raggio finito:
+    le origini con destinazioni richieste non raggiunte entro il raggio vengono
+    ripetute con raggio allargato (infine senza limite), quindi l'output e'
+    identico alla ricerca completa.
+    """
+    if not any(np.isfinite(task[3]) for task in tasks):
+        return _run_skim_blocks(csr, weights, tasks, n_workers, verbose, keep_dist)
+
+    t_start = time.perf_counter()
+    out     = [None] * len(tasks)
+    settled = 0
+    n_retry = 0
+    todo    = list(range(len(tasks)))
+    growth  = 1.0
+    for attempt in range(TARGET_RADIUS_RETRIES + 2):
+        limits = [tasks[i][3] * growth for i in todo]
+        for group in _radius_groups(limits):
+            idx  = [todo[g] for g in group]
+            redo = [tasks[i][:3] + (limits[g],) for i, g in zip(idx, group)]
+            for i, task_out in zip(idx, _run_skim_blocks(
+                    csr, weights, redo, min(n_workers, len(redo)), verbose, keep_dist)):
+                settled += task_out[6]
+                out[i] = task_out
+        # origini con destinazioni richieste oltre il raggio (mai con raggio inf)
+        todo = [i for i in todo
+                if np.isfinite(tasks[i][3] * growth) and len(out[i][1]) < len(tasks[i][2])]
+        if not todo:
+            break
+        growth = TARGET_RADIUS_GROWTH ** (attempt + 1) \
+            if attempt < TARGET_RADIUS_RETRIES else np.inf
+        n_retry += len(todo)
+        if verbose:
+            print("  Ricerca limitata: {} origini con destinazioni oltre il raggio, "
+                  "raggio x{}".format(len(todo), growth))
+
+    if verbose:
+        full = csr.n_nodes * len(tasks)
+        print("  Ricerca limitata: nodi esplorati {:,} / {:,} ({:.1%}), "
+              "~{:.1f}x meno della ricerca completa, {} ripetizioni, {:.2f} s".format(
+                  settled, full, settled / max(full, 1),
+                  full / max(settled, 1), n_retry, time.perf_counter() - t_start))
+    return out
+
+
+def _collect_skims(csr, outputs):
+    """Unisce gli output di _skim_block in (od_times, ArcPaths) nell'ordine dato."""
+    od_times = {}
+    keys, lengths, arcs = [], [], []
+    for zone_id, dest_zones, times, path_len, path_arcs, *_ in outputs:
+        for dest_zone, d in zip(dest_zones, times):
+            od_times[(zone_id, dest_zone)] = d
+            keys.append((zone_id, dest_zone))
+        lengths.append(path_len)
+        arcs.append(path_arcs)
+    indptr = np.zeros(len(keys) + 1, dtype=np.int64)
+    if keys:
+        np.cumsum(np.concatenate(lengths), out=indptr[1:])
+    arcs = np.concatenate(arcs) if arcs else np.empty(0, dtype=np.int32)
+    return od_times, ArcPaths(csr, keys, indptr, arcs)
+
+
+def compute_od_skims_csr(G, centroid_ids, weight="t0", verbose=True,
+                         od_filter=None, n_workers=1, target_radius=None):
+    """
+    Equivalente di compute_od_skims (stesso contratto di input/output) con
+    Dijkstra multi-sorgente scipy su grafo CSR.
+
+    Args:
+        od_filter : set di tuple (orig_zone, dest_zone) da calcolare.
+                    Se None -> tutte le coppie tra centroidi validi.
+        n_workers : processi per il calcolo parallelo delle origini
+                    (1 = seriale, None/0 = tutti i core).
+        target_radius : dict {orig_zone: raggio_minuti} per la ricerca
+                    limitata (vedi origin_time_radius). None = completa.
+
+    Ritorna:
+        od_times  : dict {(orig_zone, dest_zone): tempo_minuti}
+        od_paths  : ArcPaths {(orig_zone, dest_zone): [nodi_percorso]}
+    """
+    csr = get_csr_graph(G)
+    tasks, mode_label = _plan_origins(csr, centroid_ids, od_filter, target_radius)
+
+    n_run = len(tasks)
+    n_workers = min(resolve_n_workers(n_workers), max(n_run, 1))
+
+    if verbose:
+        print("\n  Calcolo shortest path [csr] (peso={}): {}{}".format(
+            weight, mode_label,
+            ", {} processi".format(n_workers) if n_workers > 1 else ""))
+    if n_run == 0:
+        return _collect_skims(csr, [])
+
+    weights = edge_weights(G, weight)
+    od_times, od_paths = _collect_skims(
+        csr, _run_skim_tasks(csr, weights, tasks, n_workers, verbose))
+
+    if verbose:
+        print("  Coppie OD con percorso valido: {:,}".format(len(od_times)))
+
+    return od_times, od_paths
+
+
+# -----------------------------------------------------------------------------
+# Skim completo a blocchi di origini (export finale)
+# -----------------------------------------------------------------------------
+
+def type_lengths_from_predecessors(pred, rows, src_idx, dst_idx, arc_keys, n_nodes,
+                                   arc_col, arc_len, n_cols):
+    """
+    Metri per colonna (LinkType) dei percorsi src -> dst lungo gli alberi
+    dei predecessori, senza ricostruire le liste dei nodi.
+
+    pred    : matrice predecessori del blocco (origini x nodi)
+    rows    : riga di pred di ogni coppia; src_idx / dst_idx indici nodo
+    arc_col : colonna di ogni arco (-1 = escluso), arc_len lunghezza (m)
+    Tutte le coppie risalgono l'albero un passo alla volta (vettoriale);
+    gli archi di ogni passo (int32) vengono poi sommati in ordine
+    origine -> destinazione, come np.bincount in build_composition_matrix,
+    quindi le somme coincidono bit a bit.
+    Ritorna (L (n_coppie x n_cols), ok) con ok = False per le coppie senza
+    percorso nell'albero.
+    """
+    n_pairs = len(rows)
+    ok   = np.ones(n_pairs, dtype=bool)
+    cur  = np.asarray(dst_idx, dtype=np.int64).copy()
+    live = np.flatnonzero(cur != src_idx)
+    steps = []
+    while len(live):
+        prev = pred[rows[live], cur[live]].astype(np.int64)
+        lost = prev == NO_PRED
+        if lost.any():
+            ok[live[lost]] = False
+            live, prev = live[~lost], prev[~lost]
+        arcs = np.searchsorted(arc_keys, prev * n_nodes + cur[live])
+        keep = arc_col[arcs] >= 0
+        steps.append((live[keep].astype(np.int32), arcs[keep].astype(np.int32)))
+        cur[live] = prev
+        live = live[prev != src_idx[live]]
+
+    L = np.zeros((n_pairs, n_cols))
+    for idx, arcs in reversed(steps):
+        # una sola occorrenza per coppia in ogni passo: += vettoriale sicuro
+        L[idx, arc_col[arcs]] += arc_len[arcs]
+    return L, ok
+
+
+def iter_type_skims_csr(G, centroid_ids, linktype_list, weight="t0",
+                        chunk_origins=100, verbose=True):
+    """
+    Skim di tutte le coppie tra centroidi a blocchi di chunk_origins origini,
+    con i metri per LinkType di ogni percorso (righe di
+    build_composition_matrix) calcolati sull'albero dei predecessori.
+
+    Generatore: per ogni blocco (orig, dest, tempi, L) come array, nello
+    stesso ordine di compute_od_skims_csr senza od_filter e con le stesse
+    coppie escluse (irraggiungibili, orig == dest). Non vengono creati
+    ne' il dict dei tempi ne' ArcPaths: la memoria dipende solo dal blocco
+    (origini x nodi per Dijkstra, coppie x archi per le lunghezze).
+    """
+    from scipy.sparse.csgraph import dijkstra
+
+    csr     = get_csr_graph(G)
+    store   = get_edge_store(G)
+    n_cols  = len(linktype_list)
+    arc_len = store["length"]
+    arc_col = np.where(arc_len > 0, store.type_index(linktype_list), -1)
+
+    valid = _valid_centroids(csr, centroid_ids)
+    zones = np.array([z for z, _ in valid], dtype=np.int64)
+    nodes = np.array([csr.node_index[c] for _, c in valid], dtype=np.int64)
+    n_zones = len(zones)
+    block = max(1, min(int(chunk_origins), DIJKSTRA_BLOCK_CELLS // max(csr.n_nodes, 1)))
+
+    if verbose:
+        print("\n  Skim finale a blocchi [csr] (peso={}): {} origini x {} dest = {:,} "
+              "coppie, {} origini per blocco".format(
+                  weight, n_zones, n_zones, n_zones * (n_zones - 1), block))
+    if n_zones == 0:
+        return
+
+    graph    = csr.matrix(edge_weights(G, weight))
+    arc_keys = csr.arc_keys()
+    n_valid  = 0
+    for start in range(0, n_zones, block):
+        stop = min(start + block, n_zones)
+        if verbose:
+            print("  Origini {}-{}/{} (blocco Dijkstra)...".format(start + 1, stop, n_zones))
+        dist, pred = dijkstra(graph, directed=True, indices=nodes[start:stop],
+                              return_predecessors=True)
+        trace_count("dijkstra_calls")
+        trace_count("dijkstra_origins", stop - start)
+        trace_count("settled_nodes", int(np.isfinite(dist).sum()))
+        # coppie (origine del blocco, ogni altra zona) in ordine di centroide
+        rows = np.repeat(np.arange(stop - start), n_zones)
+        cols = np.tile(np.arange(n_zones), stop - start)
+        keep = cols != rows + start
+        rows, cols = rows[keep], cols[keep]
+        times = dist[rows, nodes[cols]]
+        reach = times < 1e9
+        rows, cols, times = rows[reach], cols[reach], times[reach]
+
+        L, ok = type_lengths_from_predecessors(
+            pred, rows, nodes[start + rows], nodes[cols], arc_keys, csr.n_nodes,
+            arc_col, arc_len, n_cols)
+        n_valid += int(ok.sum())
+        yield zones[start + rows[ok]], zones[cols[ok]], times[ok], L[ok]
+
+    if verbose:
+        print("  Coppie OD con percorso valido: {:,}".format(n_valid))
+
+
+# -----------------------------------------------------------------------------
+# Re-routing incrementale
+# -----------------------------------------------------------------------------
+
+class IncrementalSkims:
+    """
+    Skim O/D ripetuti sullo stesso grafo quando cambiano i pesi di pochi archi
+    (es. per_arc: max_active_arcs archi per iterazione).
+
+    Per ogni origine conserva la riga delle distanze d(.) (float32), i
+    percorsi (id arco) e gli archi usati dai percorsi richiesti. Al calcolo successivo un'origine viene
+    ricalcolata solo se:
+        - un arco piu' veloce (u, v) puo' migliorare il suo albero:
+          d(u) + w'(u, v) < d(v)   (con tolleranza per l'arrotondamento float32)
+        - un arco piu' lento e' usato da uno dei suoi percorsi OD.
+    Altrimenti d resta un potenziale ammissibile con i nuovi pesi e i percorsi
+    memorizzati restano minimi: tempi e percorsi vengono riusati.
+
+    Se la matrice distanze supera max_dist_mb si ricalcola sempre tutto.
+    Con target_radius le righe sono troncate al raggio (inf oltre): il
+    criterio resta valido perche' un arco fuori dal raggio non puo' migliorare
+    i percorsi verso nodi dentro il raggio.
+    """
+
+    def __init__(self, G, centroid_ids, weight="t0", od_filter=None,
+                 n_workers=1, max_dist_mb=INCREMENTAL_DIST_MAX_MB,
+                 target_radius=None):
+        self.G         = G
+        self.weight    = weight
+        self.csr       = get_csr_graph(G)
+        self.tasks, self.mode_label = _plan_origins(self.csr, centroid_ids, od_filter,
+                                                    target_radius)
+        self.n_workers = resolve_n_workers(n_workers)
+
+        n_run   = len(self.tasks)
+        dist_mb = n_run * self.csr.n_nodes * 4 / 1e6
+        self.enabled = dist_mb <= max_dist_mb
+        if not self.enabled:
+            print("  [i] Re-routing incrementale disattivato: matrice distanze "
+                  "{:.0f} MB > {:.0f} MB".format(dist_mb, max_dist_mb))
+
+        self._dist    = np.empty((n_run, self.csr.n_nodes), dtype=np.float32) \
+            if self.enabled else None
+        self._weights = None
+        self._outputs = [(task[0], [], [], np.empty(0, dtype=np.int64),
+                          np.empty(0, dtype=np.int32), None, 0)
+                         for task in self.tasks]
+        self._arcs    = [np.empty(0, dtype=np.int64) for _ in range(n_run)]
+        self.last_stats = {}
+
+    def _affected_origins(self, weights):
+        """Indici delle origini da ricalcolare dopo il cambio pesi."""
+        csr     = self.csr
+        n_run   = len(self.tasks)
+        changed = np.flatnonzero(weights != self._weights)
+        faster  = changed[weights[changed] < self._weights[changed]]
+        slower  = changed[weights[changed] > self._weights[changed]]
+        affected = np.zeros(n_run, dtype=bool)
+
+        if faster.size:
+            u  = csr.arc_src[faster]
+            v  = csr.indices[faster]
+            wf = weights[faster]
+            rows = max(1, DIJKSTRA_BLOCK_CELLS // 4 // faster.size)
+            for start in range(0, n_run, rows):
+                du = self._dist[start:start + rows][:, u].astype(np.float64)
+                dv = self._dist[start:start + rows][:, v].astype(np.float64)
+                tol = 1e-6 * (np.abs(du) + np.abs(dv)) + 1e-9
+                with np.errstate(invalid="ignore"):
+                    affected[start:start + rows] = (du + wf < dv + tol).any(axis=1)
+
+        if slower.size:
+            slow_mask = np.zeros(csr.n_arcs, dtype=bool)
+            slow_mask[slower] = True
+            for r in np.flatnonzero(~affected):
+                if slow_mask[self._arcs[r]].any():
+                    affected[r] = True
+
+        self.last_stats = {"arcs_faster": int(faster.size),
+                           "arcs_slower": int(slower.size)}
+        return np.flatnonzero(affected)
+
+    def compute(self, verbose=True):
+        """
+        Calcola (o aggiorna) gli skim con i pesi correnti di G.
+        Ritorna od_times, od_paths come compute_od_skims_csr.
+        """
+        csr     = self.csr
+        n_run   = len(self.tasks)
+        weights = edge_weights(self.G, self.weight)
+
+        if self._weights is None or not self.enabled:
+            rows = np.arange(n_run)
+            self.last_stats = {}
+        else:
+            rows = self._affected_origins(weights)
+        n_workers = min(self.n_workers, max(len(rows), 1))
+
+        if verbose:
+            print("\n  Calcolo shortest path [csr] (peso={}): {}{}".format(
+                self.weight, self.mode_label,
+                ", {} processi".format(n_workers) if n_workers > 1 else ""))
+
+        if len(rows):
+            out = _run_skim_tasks(csr, weights, [self.tasks[r] for r in rows],
+                                  n_workers, verbose, keep_dist=self.enabled)
+            for r, task_out in zip(rows, out):
+                dist_row = task_out[5]
+                self._outputs[r] = task_out[:5] + (None,) + task_out[6:]
+                if dist_row is not None:
+                    self._dist[r] = dist_row
+                    self._arcs[r] = np.unique(task_out[4])
+        self._weights = weights
+
+        self.last_stats.update({"origins_total": n_run,
+                                "origins_recomputed": int(len(rows)),
+                                "origins_skipped": int(n_run - len(rows))})
+        trace_count("incremental_origins_skipped", n_run - len(rows))
+
+        od_times, od_paths = _collect_skims(csr, self._outputs)
+
+        if verbose:
+            st = self.last_stats
+            if "arcs_faster" in st:
+                print("  Re-routing incrementale: {} origini ricalcolate, {} saltate "
+                      "(archi piu' veloci: {}, piu' lenti: {})".format(
+                          st["origins_recomputed"], st["origins_skipped"],
+                          st["arcs_faster"], st["arcs_slower"]))
+            print("  Coppie OD con percorso valido: {:,}".format(len(od_times)))
+
+        return od_times, od_paths
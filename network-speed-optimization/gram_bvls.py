@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Gram BVLS
+=========
+Minimi quadrati con bounds nello spazio dei LinkType, per la modalita'
+per_type di optimize_link_speeds.py e per optimize_capacity.py.
+
+    min ||D beta - T||^2   s.t.  lb <= beta <= ub
+
+con D (n_od x n_tipi) alta e stretta: poche decine di colonne, fino a
+10^5 righe. Invece di lsq_linear(method="bvls") sulla matrice densa:
+
+    Q = D^T D   (n_tipi x n_tipi)      c = D^T T
+
+costruiti una volta per iterazione (O(n_od * n_tipi^2)); il problema
+equivalente
+
+    min 0.5 beta^T Q beta - c^T beta   s.t.  lb <= beta <= ub
+
+e' risolto con un active-set primale (stesso schema di BVLS, Stark-Parker)
+che lavora solo su Q e c: il costo del solve non dipende dal numero di OD.
+Il punto di partenza (warm start) e' il beta dell'iterazione precedente:
+dopo il primo re-routing l'insieme dei tipi ai bounds cambia poco e bastano
+poche iterazioni.
+
+I vincoli di ordinamento tra classi di compute_speed_bounds sono gia'
+espressi come bounds per tipo e restano invariati.
+"""
+
+import numpy as np
+
+
+def gram_system(D, T):
+    """Q = D^T D e c = D^T T (float64)."""
+    D = np.asarray(D, dtype=np.float64)
+    return D.T @ D, D.T @ np.asarray(T, dtype=np.float64)
+
+
+def _solve_free(Q, c, x, free):
+    """Minimo non vincolato sulle variabili libere, le altre fisse in x."""
+    fixed = ~free
+    rhs = c[free] - Q[np.ix_(free, fixed)] @ x[fixed]
+    # lstsq: robusto se Q_FF e' singolare (tipi sempre percorsi insieme)
+    return np.linalg.lstsq(Q[np.ix_(free, free)], rhs, rcond=None)[0]
+
+
+def bvls_gram(Q, c, lb, ub, x0=None, max_iter=None, tol=1e-12):
+    """
+    Active-set primale per  min 0.5 x^T Q x - c^T x,  lb <= x <= ub.
+
+    x0 : punto di partenza (proiettato nei bounds); None = centro del box.
+    Ritorna (x, n_iter, converged).
+    """
+    n = len(c)
+    lb = np.asarray(lb, dtype=np.float64)
+    ub = np.asarray(ub, dtype=np.float64)
+    if max_iter is None:
+        max_iter = 10 * n + 50
+    x = 0.5 * (lb + ub) if x0 is None else np.clip(np.asarray(x0, dtype=np.float64), lb, ub)
+    scale = max(float(np.abs(c).max()) if n else 0.0, 1e-300)
+
+    # Variabili ai bounds nel punto di partenza
+    at_lb = x <= lb
+    at_ub = x >= ub
+    for it in range(1, max_iter + 1):
+        free = ~(at_lb | at_ub)
+        if free.any():
+            z = _solve_free(Q, c, x, free)
+            x_free = x[free]
+            lo, hi = lb[free], ub[free]
+            if np.all((z >= lo) & (z <= hi)):
+                x[free] = z
+            else:
+                # Passo verso z fino al primo bound incontrato; quella
+                # variabile entra nell'active set
+                d = z - x_free
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    alpha = np.where(d > 0, (hi - x_free) / d,
+                                     np.where(d < 0, (lo - x_free) / d, np.inf))
+                a = max(min(float(alpha.min()), 1.0), 0.0)
+                x_new = np.clip(x_free + a * d, lo, hi)
+                hit = alpha <= a
+                idx = np.flatnonzero(free)
+                x[free] = x_new
+                hit_lb = hit & (d < 0)
+                hit_ub = hit & (d > 0)
+                x[idx[hit_lb]] = lb[idx[hit_lb]]
+                x[idx[hit_ub]] = ub[idx[hit_ub]]
+                at_lb[idx[hit_lb]] = True
+                at_ub[idx[hit_ub]] = True
+                continue
+
+        # KKT: sulle variabili ai bounds il gradiente deve spingere verso fuori
+        g = Q @ x - c
+        viol_lb = at_lb & (g < -tol * scale)
+        viol_ub = at_ub & (g > tol * scale)
+        if not (viol_lb.any() or viol_ub.any()):
+            return x, it, True
+        # Libera la variabile con la violazione piu' forte
+        score = np.where(viol_lb, -g, 0.0) + np.where(viol_ub, g, 0.0)
+        j = int(np.argmax(score))
+        at_lb[j] = at_ub[j] = False
+
+    return x, max_iter, False
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Network cache
+=============
+Cache binaria della rete letta dagli shapefile Visum, condivisa da
+optimize_link_speeds.py e optimize_capacity.py: un riavvio con la stessa
+rete (es. cambiando solo speed_delta_lower_pct) salta lettura shapefile e
+parsing delle unita'.
+
+CONTENUTO (in <cache_dir>/network_<script>_<chiave>.*):
+    .npz   array per arco di build_edge_arrays + lista centroidi
+    .pkl   DataFrame link/nodi/centroidi/connettori (pickle pandas: tipi e
+           valori identici, servono al remap finale dei link)
+    .json  manifest: impronte dei file e mappatura colonne
+
+VALIDITA':
+    La chiave del nome file dipende da script, percorsi degli shapefile e
+    chiavi di configurazione che influenzano il parsing (nomi colonne).
+    Per ogni file (.shp e file collegati .dbf/.shx/.prj/.cpg) il manifest
+    registra dimensione, mtime e hash SHA-1 del contenuto: se dimensione e
+    mtime coincidono l'hash salvato viene riusato, altrimenti viene
+    ricalcolato e confrontato (un file solo "toccato" resta valido).
+
+UTILIZZO:
+    cache  = NetworkCache(cache_dir, "link_speeds", files, mapping)
+    cached = cache.load()          # None se miss (motivo nel log)
+    ...
+    cache.save(frames, arrays, centroid_ids)
+"""
+
+import hashlib
+import json
+import os
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+
+# Versione del formato: cambiarla invalida tutte le cache esistenti
+NETWORK_CACHE_VERSION = 1
+
+# Estensioni dei file che compongono uno shapefile
+SHAPEFILE_PARTS = (".shp", ".dbf", ".shx", ".prj", ".cpg")
+
+# Blocco di lettura per l'hash dei file
+HASH_CHUNK_BYTES = 8 * 1024 * 1024
+
+# Nomi dei DataFrame salvati (ordine di load_visum_network)
+FRAME_NAMES = ("links", "nodes", "centroids", "connectors")
+
+
+def _sha1_file(path):
+    """SHA-1 del contenuto del file."""
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_BYTES), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def file_fingerprint(path, previous=None):
+    """
+    Impronta {size, mtime_ns, sha1} del file. Se `previous` ha stessa
+    dimensione e mtime l'hash non viene ricalcolato.
+    """
+    st = os.stat(path)
+    fp = {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+    if previous and previous.get("size") == fp["size"] \
+            and previous.get("mtime_ns") == fp["mtime_ns"] and previous.get("sha1"):
+        fp["sha1"] = previous["sha1"]
+    else:
+        fp["sha1"] = _sha1_file(path)
+    return fp
+
+
+def shapefile_parts(shp_path):
+    """File esistenti che compongono lo shapefile (.shp, .dbf, ...)."""
+    if shp_path is None:
+        return []
+    shp_path = Path(shp_path)
+    parts = [shp_path.with_suffix(ext) for ext in SHAPEFILE_PARTS]
+    return [p for p in parts if p.exists()]
+
+
+class NetworkCache:
+    """
+    Cache della rete per uno script.
+
+    Args:
+        cache_dir : cartella della cache
+        kind      : nome dello script ("link_speeds", "capacity"): gli array
+                    per arco sono diversi tra i due script
+        files     : dict {etichetta: percorso .shp o None}
+        mapping   : dict delle chiavi config che influenzano il parsing
+    """
+
+    def __init__(self, cache_dir, kind, files, mapping):
+        self.cache_dir = Path(cache_dir)
+        self.files     = {label: [str(p.resolve()) for p in shapefile_parts(shp)]
+                          for label, shp in files.items()}
+        self.mapping   = {k: mapping[k] for k in sorted(mapping)}
+        key_src = json.dumps({"version": NETWORK_CACHE_VERSION, "kind": kind,
+                              "files": self.files, "mapping": self.mapping},
+                             sort_keys=True, default=str)
+        key = hashlib.sha1(key_src.encode("utf-8")).hexdigest()[:16]
+        self.base = self.cache_dir / "network_{}_{}".format(kind, key)
+
+    def _paths(self):
+        return (self.base.with_suffix(".json"), self.base.with_suffix(".npz"),
+                self.base.with_suffix(".pkl"))
+
+    def _current_fingerprints(self, stored=None):
+        stored = stored or {}
+        return {path: file_fingerprint(path, stored.get(path))
+                for paths in self.files.values() for path in paths}
+
+    def load(self):
+        """
+        Ritorna dict {frames, arrays, centroid_ids} se la cache e' valida,
+        altrimenti None. Hit e miss (con motivo) vengono stampati.
+        """
+        manifest_path, npz_path, pkl_path = self._paths()
+        if not (manifest_path.exists() and npz_path.exists() and pkl_path.exists()):
+            print("  [i] Cache rete: miss (nessuna cache per questi file/colonne)")
+            return None
+        try:
+            with open(manifest_path, "r", encoding="utf-8") as f:
+                manifest = json.load(f)
+            stored  = manifest.get("fingerprints", {})
+            current = self._current_fingerprints(stored)
+            if set(current) != set(stored):
+                print("  [i] Cache rete: miss (insieme dei file cambiato)")
+                return None
+            changed = [Path(p).name for p, fp in current.items()
+                       if fp["size"] != stored[p]["size"] or fp["sha1"] != stored[p]["sha1"]]
+            if changed:
+                print("  [i] Cache rete: miss (file modificati: {})".format(", ".join(changed)))
+                return None
+
+            with np.load(npz_path, allow_pickle=False) as data:
+                arrays = {k[len("edge_"):]: data[k] for k in data.files if k.startswith("edge_")}
+                centroid_ids = data["centroid_ids"].tolist()
+            frames = pd.read_pickle(pkl_path)
+        except Exception as e:
+            print("  [!] Cache rete non leggibile ({}): ricarico gli shapefile".format(e))
+            return None
+
+        if current != stored:
+            # file solo "toccati" (mtime diverso, contenuto uguale): aggiorna il manifest
+            manifest["fingerprints"] = current
+            self._write_json(manifest_path, manifest)
+        print("  [OK] Cache rete: hit ({}, creata {})".format(
+            self.base.name, manifest.get("created", "?")))
+        return {"frames": [frames.get(name) for name in FRAME_NAMES],
+                "arrays": arrays, "centroid_ids": centroid_ids}
+
+    def save(self, frames, arrays, centroid_ids):
+        """Salva DataFrame (ordine FRAME_NAMES), array per arco e centroidi."""
+        manifest_path, npz_path, pkl_path = self._paths()
+        try:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            tmp_npz = npz_path.with_name(npz_path.stem + ".tmp.npz")
+            np.savez(tmp_npz, centroid_ids=np.asarray(centroid_ids, dtype=np.int64),
+                     **{"edge_" + k: np.asarray(v) for k, v in arrays.items()})
+            os.replace(tmp_npz, npz_path)
+            tmp_pkl = pkl_path.with_name(pkl_path.name + ".tmp")
+            pd.to_pickle(dict(zip(FRAME_NAMES, frames)), tmp_pkl)
+            os.replace(tmp_pkl, pkl_path)
+            manifest = {
+                "version":      NETWORK_CACHE_VERSION,
+                "created":      time.strftime("%Y-%m-%d %H:%M:%S"),
+                "files":        self.files,
+                "mapping":      self.mapping,
+                "fingerprints": self._current_fingerprints(),
+            }
+            self._write_json(manifest_path, manifest)
+            print("  [OK] Cache rete salvata: {}".format(self.base))
+        except Exception as e:
+            print("  [!] Cache rete non salvata: {}".format(e))
+
+    @staticmethod
+    def _write_json(path, data):
+        tmp = path.with_name(path.name + ".tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(data, f, indent=2, default=str)
+        os.replace(tmp, path)
@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Observed times
+==============
+Loader tipizzato dei tempi OD osservati (export floating car, milioni di
+righe), condiviso da optimize_link_speeds.py e optimize_capacity.py.
+
+LETTURA:
+    - separatore rilevato sui primi SNIFF_BYTES byte (csv.Sniffer), non con
+      il parser "python" di pandas sull'intero file
+    - solo le 3 colonne OD/tempo, con dtype espliciti (zone int32, tempo
+      float64 o float32 con observed_time_dtype), motore pyarrow se
+      installato altrimenti il parser C a blocchi di OBS_CHUNK_ROWS righe
+      (conversione dei decimali identica al parser "python")
+    - file .parquet / .pq letti con pandas.read_parquet (richiede pyarrow
+      o fastparquet)
+    - righe con zona o tempo vuoti e righe con zone non intere (4.7)
+      scartate, con il conteggio nel log
+
+CHIAVI OD:
+    Ogni coppia e' codificata in un int64: orig * OD_KEY_FACTOR + dest.
+    Le osservazioni ripetute della stessa coppia vengono aggregate in forma
+    vettoriale (np.unique + bincount / sort), config "observed_aggregation":
+        "mean"   media (default)
+        "median" mediana
+        "last"   ultima riga (comportamento del vecchio loader a dict)
+    con il numero di osservazioni per coppia (counts). L'ordine delle coppie
+    e' quello di prima comparsa nel file.
+
+UTILIZZO:
+    obs = load_observed_times(path, config, OD_COL_ALIASES)
+    T_obs_dict = obs.as_dict()      # {(orig, dest): minuti}
+"""
+
+import csv
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+
+# Codifica chiave OD: orig * OD_KEY_FACTOR + dest (zone fino a 2^31)
+OD_KEY_FACTOR = 1 << 32
+
+# Byte letti per rilevare il separatore
+SNIFF_BYTES = 64 * 1024
+
+# Separatori ammessi (ordine di preferenza a parita' di conteggio)
+OBS_DELIMITERS = ",;\t|"
+
+# Righe per blocco con il parser C
+OBS_CHUNK_ROWS = 1_000_000
+
+# Aggregazioni ammesse per coppie OD ripetute
+OBS_AGGREGATIONS = ("mean", "median", "last")
+
+# Estensioni lette come Parquet
+PARQUET_SUFFIXES = (".parquet", ".pq")
+
+
+def encode_od_keys(orig, dest):
+    """Chiavi int64 orig * OD_KEY_FACTOR + dest."""
+    return np.asarray(orig, dtype=np.int64) * OD_KEY_FACTOR + np.asarray(dest, dtype=np.int64)
+
+
+def decode_od_keys(keys):
+    """Inverso di encode_od_keys: (orig, dest) come array int64."""
+    return np.divmod(np.asarray(keys, dtype=np.int64), OD_KEY_FACTOR)
+
+
+def sniff_delimiter(path, n_bytes=SNIFF_BYTES):
+    """Separatore del CSV dai primi n_bytes (',' se non determinabile)."""
+    with open(path, "r", encoding="utf-8-sig", newline="") as f:
+        sample = f.read(n_bytes)
+    # Solo righe complete: l'ultima puo' essere troncata
+    if len(sample) == n_bytes and "\n" in sample:
+        sample = sample[:sample.rfind("\n")]
+    try:
+        return csv.Sniffer().sniff(sample, delimiters=OBS_DELIMITERS).delimiter
+    except csv.Error:
+        header = sample.splitlines()[0] if sample else ""
+        counts = [(header.count(d), -i, d) for i, d in enumerate(OBS_DELIMITERS)]
+        best = max(counts)
+        return best[2] if best[0] > 0 else ","
+
+
+def resolve_od_columns(columns, config, aliases):
+    """
+    Colonne (orig, dest, time) del file: nome configurato esatto ->
+    case-insensitive -> alias di OD_COL_ALIASES. None per le colonne mancanti.
+    """
+    def resolve(configured_name, alias_key):
+        if configured_name in columns:
+            return configured_name
+        match = next((c for c in columns if c.lower() == configured_name.lower()), None)
+        if match:
+            return match
+        for alias in aliases.get(alias_key, []):
+            match = next((c for c in columns if c.lower() == alias.lower()), None)
+            if match:
+                print("  [i] Colonna '{}' non trovata -> uso '{}' (alias)".format(
+                    configured_name, match))
+                return match
+        return None
+
+    return (resolve(config["od_col_orig"], "origin"),
+            resolve(config["od_col_dest"], "destination"),
+            resolve(config["od_col_time"], "time_m"))
+
+
+def _has_pyarrow():
+    try:
+        import pyarrow  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def _zone_column(series):
+    """
+    Zone come int64 (anche se il file le scrive come 12.0) e maschere delle
+    righe da scartare: (vuote, non intere).
+    """
+    if series.dtype.kind in "iu":
+        ok = np.zeros(len(series), dtype=bool)
+        return series.to_numpy(dtype=np.int64), ok, ok
+    values = series.to_numpy(dtype=np.float64)
+    blank = ~np.isfinite(values)
+    fractional = ~blank & (values != np.round(values))
+    return np.where(blank | fractional, 0, values).astype(np.int64), blank, fractional
+
+
+def read_observed_columns(path, config, aliases):
+    """
+    Legge le sole colonne OD/tempo del file osservato.
+
+    Ritorna (orig, dest, time, info): array int64/int64/float e dict
+    {columns, delimiter, engine, dropped_blank, dropped_fractional} per il
+    log. Le righe con zona/tempo vuoti o zone non intere sono scartate.
+    Esce con SystemExit se mancano colonne (come gli script).
+    """
+    path = Path(path)
+    time_dtype = np.dtype(config.get("observed_time_dtype", "float64"))
+
+    if path.suffix.lower() in PARQUET_SUFFIXES:
+        try:
+            df = pd.read_parquet(path)
+        except ImportError:
+            print("[ERR] Lettura Parquet non disponibile: installare pyarrow o fastparquet "
+                  "(oppure esportare i tempi osservati in CSV)")
+            raise SystemExit(1)
+        columns, delimiter, engine = list(df.columns), None, "parquet"
+    else:
+        delimiter = sniff_delimiter(path)
+        columns = list(pd.read_csv(path, sep=delimiter, nrows=0,
+                                   encoding="utf-8-sig").columns)
+        df, engine = None, None
+
+    orig_col, dest_col, time_col = resolve_od_columns(columns, config, aliases)
+    missing = [name for name, found in ((config["od_col_orig"], orig_col),
+                                        (config["od_col_dest"], dest_col),
+                                        (config["od_col_time"], time_col)) if found is None]
+    if missing:
+        for name in missing:
+            print("[ERR] Colonna '{}' non trovata. Colonne disponibili: {}".format(name, columns))
+        raise SystemExit(1)
+
+    if df is None:
+        usecols = [orig_col, dest_col, time_col]
+        dtypes  = {orig_col: np.int32, dest_col: np.int32, time_col: time_dtype}
+        engine  = "pyarrow" if _has_pyarrow() else "c"
+        read_kw = dict(sep=delimiter, usecols=usecols, encoding="utf-8-sig")
+        try:
+            if engine == "pyarrow":
+                df = pd.read_csv(path, engine="pyarrow", dtype=dtypes, **read_kw)
+            else:
+                df = pd.concat(pd.read_csv(path, engine="c", dtype=dtypes,
+                                           chunksize=OBS_CHUNK_ROWS, **read_kw),
+                               ignore_index=True)
+        except (ValueError, TypeError):
+            # Zone scritte come decimali (12.0) o valori non interi: tipi dedotti
+            df = pd.read_csv(path, engine="c", **read_kw)
+
+    orig, orig_blank, orig_frac = _zone_column(df[orig_col])
+    dest, dest_blank, dest_frac = _zone_column(df[dest_col])
+    time = df[time_col].to_numpy(dtype=time_dtype)
+    blank = orig_blank | dest_blank | np.isnan(time)
+    fractional = (orig_frac | dest_frac) & ~blank
+    drop = blank | fractional
+    if drop.any():
+        keep = ~drop
+        orig, dest, time = orig[keep], dest[keep], time[keep]
+    info = {"columns": columns, "delimiter": delimiter, "engine": engine,
+            "used": (orig_col, dest_col, time_col),
+            "dropped_blank": int(blank.sum()), "dropped_fractional": int(fractional.sum())}
+    return orig, dest, time, info
+
+
+def aggregate_observations(keys, times, how="mean"):
+    """
+    Aggrega le osservazioni per chiave OD in forma vettoriale.
+
+    Ritorna (keys_u, times_u, counts) nell'ordine di prima comparsa.
+    """
+    if how not in OBS_AGGREGATIONS:
+        raise ValueError("observed_aggregation non valida: {!r} (usa {})".format(
+            how, ", ".join(OBS_AGGREGATIONS)))
+    keys_s, first, inverse, counts = np.unique(keys, return_index=True,
+                                               return_inverse=True, return_counts=True)
+    if how == "mean":
+        agg = np.bincount(inverse, weights=times, minlength=len(keys_s)) / counts
+    elif how == "median":
+        order = np.lexsort((times, inverse))
+        starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        lo = times[order[starts + (counts - 1) // 2]]
+        hi = times[order[starts + counts // 2]]
+        agg = (lo.astype(np.float64) + hi) / 2.0
+    else:
+        last = np.empty(len(keys_s), dtype=np.int64)
+        last[inverse] = np.arange(len(keys))      # l'ultima scrittura vince
+        agg = times[last]
+
+    # Coppie con una sola osservazione: valore originale (anche per mean/median)
+    single = counts == 1
+    agg = np.asarray(agg, dtype=times.dtype)
+    agg[single] = times[first[single]]
+
+    order = np.argsort(first, kind="stable")
+    return keys_s[order], agg[order], counts[order]
+
+
+class ObservedTimes:
+    """
+    Tempi osservati aggregati per coppia OD, come array paralleli.
+
+    Attributi:
+        keys   : int64  orig * OD_KEY_FACTOR + dest
+        orig   : int64
+        dest   : int64
+        times  : minuti (dtype di observed_time_dtype)
+        counts : osservazioni per coppia
+        n_rows : righe lette (dopo l'eventuale campionamento)
+    """
+
+    def __init__(self, keys, times, counts, n_rows):
+        self.keys   = keys
+        self.orig, self.dest = decode_od_keys(keys)
+        self.times  = times
+        self.counts = counts
+        self.n_rows = n_rows
+
+    def __len__(self):
+        return len(self.keys)
+
+    def as_dict(self):
+        """{(orig, dest): minuti} con valori float Python (usato dagli ottimizzatori)."""
+        return dict(zip(zip(self.orig.tolist(), self.dest.tolist()),
+                        self.times.astype(np.float64).tolist()))
+
+
+def load_observed_times(path, config, aliases):
+    """
+    Legge, campiona (sample_od_pairs, sulle righe come il vecchio
+    obs_df.sample) e aggrega i tempi osservati.
+    """
+    orig, dest, times, info = read_observed_columns(path, config, aliases)
+    print("  Righe caricate: {}, colonne: {}".format(len(times), info["columns"]))
+    print("  Lettura: motore {}{}".format(
+        info["engine"], ", separatore {!r}".format(info["delimiter"]) if info["delimiter"] else ""))
+    print("  Colonne OD usate: origin={}, dest={}, time={}".format(*info["used"]))
+    if info["dropped_blank"]:
+        print("  [!] {} righe scartate: zona o tempo vuoti".format(info["dropped_blank"]))
+    if info["dropped_fractional"]:
+        print("  [!] {} righe scartate: zone non intere".format(info["dropped_fractional"]))
+
+    sample = config.get("sample_od_pairs")
+    if sample and len(times) > sample:
+        # Stessa estrazione di DataFrame.sample(n, random_state=seed)
+        rows = np.random.RandomState(config.get("random_seed", 42)).choice(
+            len(times), size=sample, replace=False)
+        orig, dest, times = orig[rows], dest[rows], times[rows]
+        print("  Campione: {} righe selezionate casualmente".format(len(times)))
+
+    how = config.get("observed_aggregation", "mean")
+    keys, agg, counts = aggregate_observations(encode_od_keys(orig, dest), times, how)
+    n_repeated = int((counts > 1).sum())
+    if n_repeated:
+        print("  [i] {} coppie OD con osservazioni ripetute (max {}): aggregazione '{}'".format(
+            n_repeated, int(counts.max()), how))
+    return ObservedTimes(keys, agg, counts, len(times))
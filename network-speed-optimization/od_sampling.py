@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+OD sampling
+===========
+Campionamento coarse-to-fine delle coppie OD per i loop iterativi per_type
+di optimize_link_speeds.py e di optimize_capacity.py.
+
+sample_od_pairs estrae un campione fisso per tutto il run. Con config
+"od_sample_initial_frac" = f0 le prime iterazioni usano invece un campione
+stratificato piccolo, che cresce quando le velocita' si stabilizzano:
+
+    - frazione iniziale f0 delle coppie OD
+    - dopo ogni iterazione, se la massima variazione relativa delle velocita'
+      e' sotto od_sample_grow_below_pct (%), la frazione viene moltiplicata
+      per od_sample_growth
+    - l'ultima iterazione usa sempre tutte le coppie; se il campione
+      raggiunge la convergenza (slope / R2) si esegue un'iterazione finale
+      su tutte le coppie prima di fermarsi. Metriche finali e skim finale
+      sono quindi sempre sull'insieme completo.
+
+STRATIFICAZIONE (frazione f):
+    Il costo dello skim dipende dalle origini (un Dijkstra per origine), la
+    matrice D dalle coppie: il campione e' a due stadi, ognuno con frazione
+    sqrt(f) (coppie ~ f, origini ~ sqrt(f)):
+      1. origini, stratificate per fascia del tempo osservato mediano
+      2. coppie delle origini scelte, stratificate per (origine, fascia del
+         tempo osservato)
+    Le fasce sono i quantili del tempo osservato (od_sample_time_bands).
+    In ogni strato vengono prese le unita' con priorita' casuale piu' bassa,
+    in numero n_strato x frazione arrotondato con un offset casuale fisso per
+    strato: i campioni sono annidati (crescendo si aggiungono coppie, le
+    righe di D gia' calcolate restano valide) e riproducibili (random_seed).
+
+UTILIZZO:
+    sampler = ODSampleSchedule(T_obs_dict, config)
+    od_pairs, od_filter, radius = sampler.current(slack)   # coppie dell'iterazione
+    ...
+    sampler.advance(max_rel_change_pct, converged, last)   # dopo l'iterazione
+"""
+
+import numpy as np
+
+from csr_graph import origin_time_radius
+
+
+# Default dello schedule (chiavi config od_sample_*)
+SAMPLE_GROWTH         = 2.0
+SAMPLE_GROW_BELOW_PCT = 2.0
+SAMPLE_TIME_BANDS     = 4
+
+
+def _time_bands(times, n_bands):
+    """Fascia (0..n_bands-1) di ogni tempo sui quantili della distribuzione."""
+    if n_bands <= 1 or len(times) == 0:
+        return np.zeros(len(times), dtype=np.int64)
+    edges = np.quantile(times, np.linspace(0.0, 1.0, n_bands + 1)[1:-1])
+    return np.searchsorted(edges, times, side="right").astype(np.int64)
+
+
+def _stratum_ranks(strata, priority):
+    """Rango di ogni unita' nel suo strato (per priorita' crescente) e dimensione dello strato."""
+    order = np.lexsort((priority, strata))
+    s_sorted = strata[order]
+    start = np.searchsorted(s_sorted, s_sorted, side="left")
+    ranks = np.empty(len(strata), dtype=np.int64)
+    ranks[order] = np.arange(len(strata)) - start
+    _, inverse, counts = np.unique(strata, return_inverse=True, return_counts=True)
+    return ranks, counts[inverse], inverse
+
+
+class ODSampleSchedule:
+    """Campione OD annidato e stratificato con frazione crescente (vedi modulo)."""
+
+    def __init__(self, T_obs_dict, config):
+        f0 = config.get("od_sample_initial_frac")
+        self.od_pairs = list(T_obs_dict.keys())
+        self.times    = np.array(list(T_obs_dict.values()), dtype=np.float64)
+        self.enabled  = bool(f0) and 0.0 < float(f0) < 1.0 and len(self.od_pairs) > 1
+        self.frac     = float(f0) if self.enabled else 1.0
+        self.growth   = max(float(config.get("od_sample_growth", SAMPLE_GROWTH)), 1.0)
+        self.grow_below_pct = float(config.get("od_sample_grow_below_pct",
+                                               SAMPLE_GROW_BELOW_PCT))
+        self._cache = None
+        self._current = None
+        if not self.enabled:
+            return
+
+        rng = np.random.RandomState(config.get("random_seed", 42))
+        n_bands = max(int(config.get("od_sample_time_bands", SAMPLE_TIME_BANDS)), 1)
+        orig = np.array([o for o, _ in self.od_pairs], dtype=np.int64)
+        band = _time_bands(self.times, n_bands)
+
+        # Stadio 1: origini per fascia del tempo mediano
+        origins, o_inv = np.unique(orig, return_inverse=True)
+        o_band = _time_bands(self._group_median(o_inv, len(origins)), n_bands)
+        self._o_rank, self._o_size, o_stratum = _stratum_ranks(o_band, rng.random_sample(len(origins)))
+        self._o_offset = rng.random_sample(o_stratum.max() + 1)[o_stratum]
+        self._pair_origin = o_inv
+
+        # Stadio 2: coppie per (origine, fascia)
+        strata = o_inv * n_bands + band
+        self._p_rank, self._p_size, p_stratum = _stratum_ranks(strata, rng.random_sample(len(strata)))
+        self._p_offset = rng.random_sample(p_stratum.max() + 1)[p_stratum]
+        self.n_origins = len(origins)
+
+    def _group_median(self, inverse, n_groups):
+        """Mediana del tempo osservato per gruppo (origine), vettoriale."""
+        order = np.lexsort((self.times, inverse))
+        counts = np.bincount(inverse, minlength=n_groups)
+        start = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        t_sorted = self.times[order]
+        lo = start + (counts - 1) // 2
+        hi = start + counts // 2
+        return 0.5 * (t_sorted[lo] + t_sorted[hi])
+
+    @property
+    def full(self):
+        return self.frac >= 1.0
+
+    def _mask(self):
+        """Maschera delle coppie nel campione corrente."""
+        if self.full:
+            return np.ones(len(self.od_pairs), dtype=bool)
+        f = np.sqrt(self.frac)
+        o_take = self._o_rank < np.floor(self._o_size * f + self._o_offset)
+        if not o_take.any():
+            o_take[np.argmin(self._o_rank)] = True
+        mask = o_take[self._pair_origin] & (self._p_rank < np.floor(self._p_size * f + self._p_offset))
+        if not mask.any():
+            mask[np.flatnonzero(o_take[self._pair_origin])[0]] = True
+        return mask
+
+    def pairs(self):
+        """Coppie OD del campione corrente, nell'ordine di T_obs_dict."""
+        if self._cache is None or self._cache[0] != self.frac:
+            mask = self._mask()
+            pairs = [od for od, keep in zip(self.od_pairs, mask.tolist()) if keep]
+            self._cache = (self.frac, pairs, mask)
+        return self._cache[1]
+
+    def values(self):
+        """{od: minuti} del campione corrente (raggio di ricerca per origine)."""
+        pairs = self.pairs()
+        return dict(zip(pairs, self.times[self._cache[2]].tolist()))
+
+    def current(self, radius_slack):
+        """
+        (coppie, set per od_filter, raggio di ricerca per origine) del campione
+        corrente; ricalcolati solo quando la frazione cambia. Senza schedule:
+        tutte le coppie, come prima.
+        """
+        if self._current is None or self._current[0] != self.frac:
+            pairs = self.pairs()
+            self._current = (self.frac, pairs, set(pairs),
+                             origin_time_radius(self.values(), radius_slack))
+        return self._current[1:]
+
+    def history_fields(self):
+        """Campi della history per l'iterazione corrente (vuoto senza schedule)."""
+        if not self.enabled:
+            return {}
+        return {"od_sample_frac": self.frac, "od_sample_pct": self.sample_pct()}
+
+    def describe(self):
+        """Riga di log del campione corrente."""
+        pairs = self.pairs()
+        n_orig = len({o for o, _ in pairs})
+        total = self.n_origins if self.enabled else len({o for o, _ in self.od_pairs})
+        return "Campione OD: {:.1f}% ({} / {} coppie, {} / {} origini)".format(
+            100.0 * len(pairs) / max(len(self.od_pairs), 1), len(pairs),
+            len(self.od_pairs), n_orig, total)
+
+    def sample_pct(self):
+        """Percentuale di coppie nel campione corrente (per la history)."""
+        return round(100.0 * len(self.pairs()) / max(len(self.od_pairs), 1), 2)
+
+    def advance(self, max_rel_change_pct, converged=False, last=False):
+        """
+        Frazione per l'iterazione successiva: tutte le coppie se la prossima
+        e' l'ultima o se il campione e' a convergenza, altrimenti crescita
+        geometrica quando le velocita' cambiano meno della soglia.
+        Ritorna True se il campione e' cambiato.
+        """
+        if self.full:
+            return False
+        before = self.frac
+        if converged or last:
+            self.frac = 1.0
+        elif max_rel_change_pct < self.grow_below_pct:
+            self.frac = min(1.0, self.frac * self.growth)
+        return self.frac != before
+
+    def resume(self, history):
+        """
+        Ripresa da checkpoint: frazione dell'ultima iterazione registrata, poi
+        advance() (con converged se la history segna od_sample_converged).
+        """
+        if not self.enabled:
+            return
+        for h in reversed(history):
+            if "od_sample_frac" in h:
+                self.frac = float(h["od_sample_frac"])
+                self.advance(h.get("max_rel_change_pct", 0.0),
+                             converged=bool(h.get("od_sample_converged", False)))
+                return
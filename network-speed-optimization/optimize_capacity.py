@@ -31,8 +31,22 @@ APPROCCIO MATEMATICO:
         cap_pct_target = (ratio - 1) * 100 + cap_pct_corrente
         C_index = argmin |CAP_PCT[i] - cap_pct_target|
 
+CALIBRAZIONE CON ASSEGNAZIONE LOCALE ("capacity_method": "assignment"):
+    L'ipotesi di linearita' ignora che cambiando capacita' cambiano anche
+    i flussi. Con questo metodo ogni candidato di C_index per tipo viene
+    valutato riassegnando la domanda (demand_csv, da Visum) con
+    un'assegnazione all'equilibrio locale (traffic_assignment.py: BPR,
+    Frank-Wolfe coniugato); i tempi congestionati risultanti danno l'RMSE
+    sulle coppie osservate. Candidati: spostamento congiunto secondo la
+    regola v/c (vc_threshold_high / vc_threshold_low) e, con
+    assignment_single_type_candidates, spostamenti di un solo tipo. Si
+    accetta il candidato migliore solo se riduce l'RMSE; Visum riesegue
+    l'assegnazione solo per confermare la scelta finale.
+
 UTILIZZO:
-    python optimize_capacity.py config.json
+    python optimize_capacity.py config.json [--no-cache]
+
+    --no-cache : ignora la cache binaria della rete e rilegge gli shapefile
 
 CONFIG.JSON:
     {
@@ -60,6 +74,19 @@ from pathlib import Path
 import numpy as np
 import pandas as pd
 
+from csr_graph import (compute_od_skims_csr, get_edge_store,
+                       seed_edge_store, sync_edge_view, as_arc_paths, select_paths,
+                       origin_time_radius, PathRowCache)
+from cch_graph import compute_od_skims_cch, get_cch
+from gram_bvls import gram_system, bvls_gram
+from network_cache import NetworkCache
+from observed_times import load_observed_times
+from od_sampling import ODSampleSchedule
+from skim_export import export_type_skims
+from stage_timing import (stage_timer, start_trace, get_trace, trace_count,
+                          trace_info)
+from traffic_assignment import StaticAssignment, load_demand_csv
+
 warnings.filterwarnings("ignore")
 
 
@@ -75,6 +102,8 @@ DEFAULT_CONFIG = {
     "od_col_orig": "from_O",
     "od_col_dest": "to_D",
     "od_col_time": "observed_time",
+    "observed_aggregation": "mean", # OD ripetute nel CSV: "mean" | "median" | "last" (ultima riga)
+    "observed_time_dtype": "float64", # dtype tempi osservati ("float32" dimezza la memoria su milioni di righe)
     # Colonne shapefile
     "tcur_field": "TCUR_PRT",
     "vol_field": "VOLVEHPRT",
@@ -87,6 +116,7 @@ DEFAULT_CONFIG = {
     # Ottimizzazione
     "vc_threshold": 0.6,            # solo archi con v/c > soglia
     "speed_delta_pct": 25.0,        # max variazione % velocita' congestionata
+    "type_solver": "gram",          # "gram" (active-set su D^T D, warm start) | "bvls" (lsq_linear denso)
     "n_iterations": 5,
     "convergence_threshold": 0.005,
     "slope_target_min": 0.9,
@@ -94,7 +124,31 @@ DEFAULT_CONFIG = {
     "r2_target": 0.9,
     "fix_connector_t0": True,
     "sample_od_pairs": None,
+    "od_sample_initial_frac": None, # Campione OD iniziale stratificato (es. 0.1), cresce fino a tutte le coppie; None = off
+    "od_sample_growth": 2.0,        # Fattore di crescita del campione
+    "od_sample_grow_below_pct": 2.0, # Il campione cresce quando la max variazione vcur (%) e' sotto soglia
+    "od_sample_time_bands": 4,      # Fasce di tempo osservato (quantili) per la stratificazione
     "random_seed": 42,
+    # Calibrazione con assegnazione locale (traffic_assignment.py)
+    "capacity_method": "bvls",      # "bvls" (TCur fisso, D @ beta) | "assignment" (equilibrio locale, C_index per tipo base)
+    "demand_csv": None,             # assignment: CSV domanda dseg;from_O;to_D;value (path o lista)
+    "demand_dseg_factors": None,    # assignment: {DSeg: fattore} (es. equivalenti autovettura), None = 1
+    "vdf_bpr": None,                # assignment: {"default": [a, b], "<TypeNo|base>": [a, b]}, None = BPR 0.15 / 4
+    "assignment_cap_factor": 1.0,   # assignment: capacita' x fattore (periodo domanda / periodo capacita')
+    "assignment_method": "cfw",     # assignment: "cfw" (conjugate Frank-Wolfe) | "fw"
+    "assignment_max_iter": 50,      # assignment: iterazioni max per equilibrio
+    "assignment_rel_gap": 1e-4,     # assignment: relative gap di arresto
+    "assignment_single_type_candidates": True, # assignment: valuta anche i cambi dei singoli tipi
+    "vc_threshold_high": 0.80,      # assignment: v/c oltre cui aumentare la capacita'
+    "vc_threshold_low": 0.40,       # assignment: v/c sotto cui diminuire la capacita'
+    "skim_engine": "csr",           # "csr" (scipy, array CSR) | "cch" (gerarchia customizzabile) | "networkx" (riferimento)
+    "n_workers": 1,                 # Processi per lo skim "csr" (1 = seriale, 0 = tutti i core)
+    "final_skim_chunk_origins": None, # Skim finale: None = in memoria; int = origini per blocco, od_comparison scritto a blocchi
+    "final_skim_format": "csv",     # Skim finale a blocchi: "csv" | "parquet" (richiede pyarrow)
+    "target_radius_slack": 1.5,     # csr: Dijkstra fermato a max(T_obs origine) x slack (None = rete intera)
+    "cch_cache_dir": None,          # cch: cartella ordine di contrazione (None = <output_dir>/cch_cache)
+    "network_cache": True,          # Cache binaria rete (npz+pickle), invalidata se cambiano shapefile o colonne
+    "network_cache_dir": None,      # Cartella cache rete (None = <output_dir>/network_cache)
 }
 
 # Mapping C_index -> percentuale capacita'
@@ -128,6 +182,10 @@ OD_COL_ALIASES = {
                     "t_min", "tmin", "travel_time", "tempo_min", "tempo"],
 }
 
+# Chiavi config che influenzano il parsing della rete (chiave cache rete)
+NETWORK_CACHE_KEYS = ("file_prefix", "tcur_field", "vol_field", "cap_field", "v0prt_field",
+                      "length_field", "linktype_field", "fromnodeno_field", "tonodeno_field")
+
 
 # =============================================================================
 # UTILITY
@@ -243,10 +301,9 @@ def tcur_to_minutes(val):
 # CARICAMENTO RETE
 # =============================================================================
 
-def load_visum_network(network_dir, file_prefix=None, config=None):
-    """Carica shapefile rete Visum (link, node, centroid, connector)."""
+def find_network_files(network_dir, file_prefix=None):
+    """Individua gli shapefile rete: dict {link, node, centroid, connector} -> Path o None."""
     net_path = Path(network_dir)
-    config = config or {}
 
     def find_shp(pattern):
         found = list(net_path.glob(pattern))
@@ -263,6 +320,16 @@ def load_visum_network(network_dir, file_prefix=None, config=None):
         cent_shp = find_shp("*_zone_centroid.shp") or find_shp("*centroid*.shp") or find_shp("*zone*.shp")
         conn_shp = find_shp("*_connector.shp") or find_shp("*connector*.shp")
 
+    return {"link": link_shp, "node": node_shp, "centroid": cent_shp, "connector": conn_shp}
+
+
+def load_visum_network(network_dir, file_prefix=None, config=None):
+    """Carica shapefile rete Visum (link, node, centroid, connector)."""
+    config = config or {}
+    files = find_network_files(network_dir, file_prefix)
+    link_shp, node_shp = files["link"], files["node"]
+    cent_shp, conn_shp = files["centroid"], files["connector"]
+
     links_df = load_shapefile_as_dataframe(link_shp, "Link") if link_shp else None
     nodes_df = load_shapefile_as_dataframe(node_shp, "Node") if node_shp else None
     centroids_df = load_shapefile_as_dataframe(cent_shp, "Centroid") if cent_shp else None
@@ -275,30 +342,128 @@ def load_visum_network(network_dir, file_prefix=None, config=None):
     return links_df, nodes_df, centroids_df, connectors_df
 
 
+# -----------------------------------------------------------------------------
+# Versioni vettoriali (intera colonna) delle funzioni sopra. Ritornano anche
+# una maschera `ok`: False dove la funzione scalare solleverebbe ValueError
+# (es. '1.2.3'), cosi' il chiamante scarta le stesse righe del loader per riga.
+# Le celle non stringa (rare in colonne testuali) passano dalla funzione scalare.
+# -----------------------------------------------------------------------------
+
+def _scalar_fallback(func, raw, idx, values, ok):
+    """Applica `func` cella per cella sugli indici `idx` (celle non stringa)."""
+    for i in idx:
+        try:
+            values[i] = func(raw[i])
+        except (TypeError, ValueError):
+            ok[i] = False
+
+
+def _stripped_str_cells(series):
+    """Celle stringa con strip(); NaN per le celle non stringa (numeri, None)."""
+    is_str = series.map(lambda v: isinstance(v, str)).astype(bool)
+    return series.where(is_str).str.strip()
+
+
+def parse_visum_column(series):
+    """Versione vettoriale di parse_visum_value. Ritorna (valori float64, ok)."""
+    n = len(series)
+    if pd.api.types.is_numeric_dtype(series.dtype):
+        return series.to_numpy(dtype=np.float64), np.ones(n, dtype=bool)
+
+    values = np.zeros(n, dtype=np.float64)
+    ok     = np.ones(n, dtype=bool)
+    s      = _stripped_str_cells(series)           # NaN per celle non stringa
+    is_str = s.notna().to_numpy()
+    num    = s.str.extract(r'^([\d.]+)', expand=False)
+    matched = num.notna().to_numpy()
+    if matched.any():
+        parsed = pd.to_numeric(num[matched], errors="coerce").to_numpy(dtype=np.float64)
+        values[matched] = parsed
+        ok[matched] = ~np.isnan(parsed)           # float() fallito
+    _scalar_fallback(parse_visum_value, series.to_numpy(dtype=object),
+                     np.flatnonzero(~is_str), values, ok)
+    return values, ok
+
+
+def length_column_to_meters(series):
+    """Versione vettoriale di length_to_meters. Ritorna (metri float64, ok)."""
+    import re
+    n = len(series)
+    if pd.api.types.is_numeric_dtype(series.dtype):
+        v = series.to_numpy(dtype=np.float64)
+        return np.where(v < 100, v * 1000.0, v), np.ones(n, dtype=bool)
+
+    values = np.zeros(n, dtype=np.float64)
+    ok     = np.ones(n, dtype=bool)
+    s      = _stripped_str_cells(series)
+    is_str = s.notna().to_numpy()
+    parts  = s.str.extract(r'^([\d.]+)\s*(km|m)?', flags=re.IGNORECASE)
+    matched = parts[0].notna().to_numpy()
+    if matched.any():
+        parsed = pd.to_numeric(parts[0][matched], errors="coerce").to_numpy(dtype=np.float64)
+        is_km  = (parts[1][matched].str.lower() == "km").to_numpy(dtype=bool)
+        values[matched] = np.where(is_km, parsed * 1000.0, parsed)
+        ok[matched] = ~np.isnan(parsed)
+    _scalar_fallback(length_to_meters, series.to_numpy(dtype=object),
+                     np.flatnonzero(~is_str), values, ok)
+    return values, ok
+
+
+def speed_column_to_kmh(series):
+    """Versione vettoriale di speed_to_kmh."""
+    return parse_visum_column(series)
+
+
+def tcur_column_to_minutes(series):
+    """Versione vettoriale di tcur_to_minutes (sentinella >= 99999s -> -1)."""
+    v, ok = parse_visum_column(series)
+    return np.where(v >= 99999, -1.0, v / 60.0), ok
+
+
+def int_column(series):
+    """
+    Converte una colonna in interi come farebbe int(valore) cella per cella.
+    Ritorna (valori np.ndarray int64, maschera celle valide).
+    """
+    n = len(series)
+    if pd.api.types.is_integer_dtype(series.dtype) and not series.hasnans:
+        return series.to_numpy(dtype=np.int64), np.ones(n, dtype=bool)
+    if pd.api.types.is_numeric_dtype(series.dtype):
+        f = series.to_numpy(dtype=np.float64)
+        ok = np.isfinite(f)
+        out = np.zeros(n, dtype=np.int64)
+        out[ok] = np.trunc(f[ok]).astype(np.int64)
+        return out, ok
+    out = np.zeros(n, dtype=np.int64)
+    ok  = np.zeros(n, dtype=bool)
+    for i, val in enumerate(series.to_numpy(dtype=object)):
+        try:
+            out[i] = int(val)
+            ok[i] = True
+        except (TypeError, ValueError, OverflowError):
+            pass
+    return out, ok
+
+
 # =============================================================================
 # GRAFO NETWORKX (con TCur come peso)
 # =============================================================================
 
-def build_graph(links_df, connectors_df, centroids_df, config):
-    """
-    Costruisce grafo NetworkX dalla rete Visum con TCur come peso.
+EDGE_ATTRS = ("tcur", "t0", "length", "v0prt", "vcur", "linktype",
+              "vol", "cap", "vc_ratio", "is_connector")
 
-    Attributi arco:
-        tcur      : tempo congestionato (MINUTI)
-        t0        : tempo a flusso nullo (MINUTI)
-        length    : lunghezza (METRI)
-        v0prt     : velocita' a flusso nullo (km/h)
-        vcur      : velocita' congestionata (km/h) = length / tcur * 60/1000
-        linktype  : numero tipo link
-        vol       : volume veicolare
-        cap       : capacita'
-        vc_ratio  : volume / capacita'
-        is_connector : bool
-    """
-    import networkx as nx
-
-    G = nx.DiGraph()
 
+def build_edge_arrays(links_df, connectors_df, config):
+    """
+    Loader colonnare della rete: converte link (diretti + reverse R_*) e
+    connettori in array NumPy paralleli, uno per attributo arco (EDGE_ATTRS),
+    piu' from_node / to_node. Nessun iterrows: ogni colonna e' convertita in
+    un solo passaggio.
+
+    L'ordine degli archi riproduce quello del loader per riga: per ogni link
+    prima la direzione diretta poi la reverse, quindi i connettori
+    (zona->nodo, nodo->zona).
+    """
     # Colonne
     tcur_col = find_column(links_df, config.get("tcur_field", "TCUR_PRT"))
     vol_col  = find_column(links_df, config.get("vol_field", "VOLVEHPRT"))
@@ -350,99 +515,94 @@ def build_graph(links_df, connectors_df, centroids_df, config):
         print("\n  [WARN] Colonna R_TCUR non trovata! TCur reverse = T0 (no congestione)")
         print("         Per avere TCur reverse, riesportare con AddKeyColumns()")
 
-    def _add_link(fn, tn, length, v0, lt, tcur_val, vol, cap):
-        """Aggiunge un arco al grafo. Ritorna True se aggiunto, False se scartato."""
-        nonlocal n_sentinel
-        if tcur_val < 0:
-            n_sentinel += 1
-            return False  # TCur sentinella: direzione non percorribile
-        if v0 > 0 and length > 0:
-            t0 = (length / 1000.0 / v0) * 60.0
+    n_links = len(links_df)
+    ones  = np.ones(n_links, dtype=bool)
+    zeros = np.zeros(n_links, dtype=np.float64)
+
+    def _col(col, parser, default):
+        """(valori, ok) per una colonna, o il default se la colonna manca."""
+        if col is None:
+            return np.full(n_links, default, dtype=np.float64), ones
+        return parser(links_df[col])
+
+    # Direzione diretta (FROM -> TO): una riga e' valida solo se tutti i campi
+    # sono convertibili (come il try/except del loader per riga)
+    if from_col and to_col:
+        fn, fn_ok = int_column(links_df[from_col])
+        tn, tn_ok = int_column(links_df[to_col])
+        valid = fn_ok & tn_ok
+    else:
+        fn = tn = np.zeros(n_links, dtype=np.int64)
+        valid = np.zeros(n_links, dtype=bool)
+    length, ok = _col(len_col, length_column_to_meters, 0.0);  valid &= ok
+    v0, ok     = _col(v0_col, speed_column_to_kmh, 50.0);      valid &= ok
+    if type_col:
+        lt, ok = int_column(links_df[type_col]);               valid &= ok
+    else:
+        lt = np.zeros(n_links, dtype=np.int64)
+    tcur, ok   = tcur_column_to_minutes(links_df[tcur_col]);   valid &= ok
+    vol, ok    = _col(vol_col, parse_visum_column, 0.0);       valid &= ok
+    cap, ok    = _col(cap_col, parse_visum_column, 1.0);       valid &= ok
+    raw_tcur   = links_df[tcur_col].to_numpy(dtype=object)
+
+    # Direzione reverse (TO -> FROM) dalle colonne R_*: solo se R_TYPENO > 0
+    rev_try = np.zeros(n_links, dtype=bool)
+    rev_ok  = np.zeros(n_links, dtype=bool)
+    if r_type_col:
+        r_lt, ok = int_column(links_df[r_type_col])
+        rev_try  = valid & ok & (r_lt > 0)
+        r_length, r_ok = (length_column_to_meters(links_df[r_len_col]) if r_len_col
+                          else (length, ones))
+        r_v0, ok  = speed_column_to_kmh(links_df[r_v0_col]) if r_v0_col else (v0, ones)
+        r_ok      = r_ok & ok
+        r_vol, ok = _col(r_vol_col, parse_visum_column, 0.0);  r_ok &= ok
+        r_cap, ok = parse_visum_column(links_df[r_cap_col]) if r_cap_col else (cap, ones)
+        r_ok      = r_ok & ok
+        if r_tcur_col:
+            r_tcur, ok = tcur_column_to_minutes(links_df[r_tcur_col])
+            r_ok = r_ok & ok
+            raw_r_tcur = links_df[r_tcur_col].to_numpy(dtype=object)
         else:
-            t0 = 0.001
-        tcur_m = tcur_val
-        if tcur_m <= 0:
-            tcur_m = t0
-        vcur = (length / 1000.0) / (tcur_m / 60.0) if tcur_m > 0 and length > 0 else v0
-        vc_ratio = vol / cap if cap > 0 else 0.0
-        G.add_edge(fn, tn,
-                   tcur=tcur_m, t0=t0, length=length,
-                   v0prt=v0, vcur=vcur, linktype=lt,
-                   vol=vol, cap=cap, vc_ratio=vc_ratio,
-                   is_connector=False)
-        return True
-
-    link_count = 0
-    skipped = 0
-    n_reverse = 0
-    n_reverse_tcur_from_t0 = 0
-    n_sentinel = 0  # TCur sentinella (non percorribili)
-
-    for idx, row in links_df.iterrows():
-        try:
-            fn = int(row[from_col]) if from_col else None
-            tn = int(row[to_col])   if to_col   else None
-            if fn is None or tn is None:
-                skipped += 1
-                continue
-
-            # Direzione diretta (FROM -> TO)
-            length = length_to_meters(row[len_col]) if len_col else 0.0
-            v0     = speed_to_kmh(row[v0_col])      if v0_col  else 50.0
-            lt     = int(row[type_col])              if type_col else 0
-            tcur   = tcur_to_minutes(row[tcur_col])  if tcur_col else 0.0
-            vol    = parse_visum_value(row[vol_col])  if vol_col else 0.0
-            cap    = parse_visum_value(row[cap_col])  if cap_col else 1.0
-
-            if _add_link(fn, tn, length, v0, lt, tcur, vol, cap):
-                link_count += 1
-
-            # Log primi 3 link per verifica
-            if link_count <= 3:
-                vcur_check = (length / 1000.0) / (tcur / 60.0) if tcur > 0 and length > 0 else v0
-                print("    Link#{}: {}->{}  Type={}  L={:.0f}m  V0={:.1f}km/h  "
-                      "TCur_raw={}  TCur={:.4f}min  Vcur={:.1f}km/h  Vol={:.0f}  Cap={:.0f}".format(
-                          link_count, fn, tn, lt, length, v0,
-                          row[tcur_col] if tcur_col else "?",
-                          tcur, vcur_check, vol, cap))
-
-            # Direzione reverse (TO -> FROM) dalle colonne R_*
-            if r_type_col:
-                try:
-                    r_lt = int(row[r_type_col])
-                except (TypeError, ValueError):
-                    r_lt = None
-                if r_lt is not None and r_lt > 0:
-                    r_length = length_to_meters(row[r_len_col]) if r_len_col else length
-                    r_v0 = speed_to_kmh(row[r_v0_col]) if r_v0_col else v0
-                    r_vol = parse_visum_value(row[r_vol_col]) if r_vol_col else 0.0
-                    r_cap = parse_visum_value(row[r_cap_col]) if r_cap_col else cap
-                    # TCur reverse: dalla colonna R_TCUR
-                    if r_tcur_col:
-                        r_tcur = tcur_to_minutes(row[r_tcur_col])
-                    else:
-                        r_tcur = 0.0  # nessuna colonna R_TCUR -> T0
-                        n_reverse_tcur_from_t0 += 1
-                    if _add_link(tn, fn, r_length, r_v0, r_lt, r_tcur, r_vol, r_cap):
-                        n_reverse += 1
-                        link_count += 1
-
-                    # Log primi 3 reverse per verifica
-                    if n_reverse <= 3:
-                        r_raw = row[r_tcur_col] if r_tcur_col else "N/A"
-                        r_vcur_check = (r_length / 1000.0) / (r_tcur / 60.0) if r_tcur > 0 and r_length > 0 else r_v0
-                        print("    Rev#{}: {}->{}  Type={}  L={:.0f}m  V0={:.1f}km/h  "
-                              "TCur_raw={}  TCur={:.4f}min{}  Vcur={:.1f}km/h  Vol={:.0f}  Cap={:.0f}".format(
-                                  n_reverse, tn, fn, r_lt, r_length, r_v0,
-                                  r_raw,
-                                  r_tcur, " (=T0)" if not r_tcur_col else "",
-                                  r_vcur_check, r_vol, r_cap))
-
-        except (TypeError, ValueError, KeyError):
-            skipped += 1
-            continue
+            r_tcur = zeros  # nessuna colonna R_TCUR -> T0
+        rev_ok = rev_try & r_ok
+    else:
+        r_lt = r_length = r_v0 = r_vol = r_cap = r_tcur = None
+
+    # TCur sentinella (< 0): direzione non percorribile
+    d_added = valid & ~(tcur < 0)
+    r_added = rev_ok & ~(r_tcur < 0) if r_type_col else rev_ok
+    n_sentinel = int((valid & (tcur < 0)).sum() + (rev_ok & ~r_added).sum())
+    n_direct   = int(d_added.sum())
+    n_reverse  = int(r_added.sum())
+    link_count = n_direct + n_reverse
+    # Riga saltata: errore nei campi diretti, oppure nei campi reverse
+    skipped = int((~valid).sum() + (rev_try & ~rev_ok).sum())
+    n_reverse_tcur_from_t0 = 0 if r_tcur_col else int(rev_ok.sum())
+
+    # Log primi 3 link / reverse per verifica (contatori come nel loop per riga)
+    count_after_direct = np.cumsum(d_added.astype(np.int64) + r_added) - r_added
+    rev_count = np.cumsum(r_added)
+    log_direct = valid & (count_after_direct <= 3)
+    log_rev    = rev_ok & (rev_count <= 3)
+    for i in np.flatnonzero(log_direct | log_rev):
+        if log_direct[i]:
+            vcur_check = (length[i] / 1000.0) / (tcur[i] / 60.0) \
+                if tcur[i] > 0 and length[i] > 0 else v0[i]
+            print("    Link#{}: {}->{}  Type={}  L={:.0f}m  V0={:.1f}km/h  "
+                  "TCur_raw={}  TCur={:.4f}min  Vcur={:.1f}km/h  Vol={:.0f}  Cap={:.0f}".format(
+                      count_after_direct[i], fn[i], tn[i], lt[i], length[i], v0[i],
+                      raw_tcur[i], tcur[i], vcur_check, vol[i], cap[i]))
+        if log_rev[i]:
+            r_raw = raw_r_tcur[i] if r_tcur_col else "N/A"
+            r_vcur_check = (r_length[i] / 1000.0) / (r_tcur[i] / 60.0) \
+                if r_tcur[i] > 0 and r_length[i] > 0 else r_v0[i]
+            print("    Rev#{}: {}->{}  Type={}  L={:.0f}m  V0={:.1f}km/h  "
+                  "TCur_raw={}  TCur={:.4f}min{}  Vcur={:.1f}km/h  Vol={:.0f}  Cap={:.0f}".format(
+                      rev_count[i], tn[i], fn[i], r_lt[i], r_length[i], r_v0[i],
+                      r_raw,
+                      r_tcur[i], " (=T0)" if not r_tcur_col else "",
+                      r_vcur_check, r_vol[i], r_cap[i]))
 
-    n_direct = link_count - n_reverse
     print("  Archi rete aggiunti: {}  (diretti: {}, reverse: {}, saltati: {})".format(
         link_count, n_direct, n_reverse, skipped))
     if n_sentinel > 0:
@@ -450,6 +610,45 @@ def build_graph(links_df, connectors_df, centroids_df, config):
     if n_reverse_tcur_from_t0 > 0:
         print("  [WARN] {} archi reverse senza colonna R_TCUR (usato T0)".format(n_reverse_tcur_from_t0))
 
+    # Archi diretti e reverse alternati per riga (riga*2 + direzione)
+    d_idx = np.flatnonzero(d_added)
+    r_idx = np.flatnonzero(r_added)
+    order = np.argsort(np.concatenate([d_idx * 2, r_idx * 2 + 1]), kind="stable")
+
+    def _stack(direct, reverse):
+        if reverse is None:
+            return direct[d_idx]
+        return np.concatenate([direct[d_idx], reverse[r_idx]])[order]
+
+    e_length = _stack(length, r_length)
+    e_v0     = _stack(v0, r_v0)
+    e_tcur   = _stack(tcur, r_tcur)
+    e_vol    = _stack(vol, r_vol)
+    e_cap    = _stack(cap, r_cap)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        e_t0   = np.where((e_v0 > 0) & (e_length > 0),
+                          (e_length / 1000.0 / e_v0) * 60.0, 0.001)
+        e_tcur = np.where(e_tcur <= 0, e_t0, e_tcur)
+        e_vcur = np.where((e_tcur > 0) & (e_length > 0),
+                          (e_length / 1000.0) / (e_tcur / 60.0), e_v0)
+        e_vc   = np.where(e_cap > 0, e_vol / e_cap, 0.0)
+
+    arrays = {
+        "from_node":    _stack(fn, tn),
+        "to_node":      _stack(tn, fn),
+        "tcur":         e_tcur,
+        "t0":           e_t0,
+        "length":       e_length,
+        "v0prt":        e_v0,
+        "vcur":         e_vcur,
+        "linktype":     _stack(lt, r_lt),
+        "vol":          e_vol,
+        "cap":          e_cap,
+        "vc_ratio":     e_vc,
+        "is_connector": np.zeros(link_count, dtype=bool),
+    }
+
     # Connettori
     connector_count = 0
     if connectors_df is not None:
@@ -457,40 +656,88 @@ def build_graph(links_df, connectors_df, centroids_df, config):
         node_col = find_column(connectors_df, "NODENO")
 
         if zone_col and node_col:
-            for _, row in connectors_df.iterrows():
-                try:
-                    zone_id = int(row[zone_col])
-                    node_id = int(row[node_col])
-
-                    # TCur connettore: prova a leggere, altrimenti 0
-                    t0_c = 0.0
-                    v0_conn_col = find_column(connectors_df, config.get("v0prt_field", "V0PRT"))
-                    len_conn_col = find_column(connectors_df, config.get("length_field", "LENGTH"))
-                    if v0_conn_col and len_conn_col:
-                        len_c = length_to_meters(row[len_conn_col])
-                        v0_c = speed_to_kmh(row[v0_conn_col])
-                        t0_c = (len_c / 1000.0 / max(v0_c, 1.0)) * 60.0 if v0_c > 0 else 0.0
-
-                    centroid_node = -zone_id
-                    G.add_edge(centroid_node, node_id,
-                               tcur=max(t0_c, 0.0), t0=max(t0_c, 0.0),
-                               length=0.0, linktype=-1, vol=0.0, cap=0.0,
-                               vc_ratio=0.0, vcur=0.0, v0prt=0.0,
-                               is_connector=True)
-                    G.add_edge(node_id, centroid_node,
-                               tcur=max(t0_c, 0.0), t0=max(t0_c, 0.0),
-                               length=0.0, linktype=-1, vol=0.0, cap=0.0,
-                               vc_ratio=0.0, vcur=0.0, v0prt=0.0,
-                               is_connector=True)
-                    connector_count += 1
-                except (TypeError, ValueError, KeyError):
-                    continue
+            n_conn = len(connectors_df)
+            zone_id, ok = int_column(connectors_df[zone_col])
+            node_id, n_ok = int_column(connectors_df[node_col])
+            ok &= n_ok
+
+            # TCur connettore: da V0PRT + LENGTH, altrimenti 0
+            t0_c = np.zeros(n_conn, dtype=np.float64)
+            v0_conn_col = find_column(connectors_df, config.get("v0prt_field", "V0PRT"))
+            len_conn_col = find_column(connectors_df, config.get("length_field", "LENGTH"))
+            if v0_conn_col and len_conn_col:
+                len_c, l_ok = length_column_to_meters(connectors_df[len_conn_col])
+                v0_c, v_ok  = speed_column_to_kmh(connectors_df[v0_conn_col])
+                ok &= l_ok & v_ok
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    t0_c = np.where(v0_c > 0,
+                                    (len_c / 1000.0 / np.maximum(v0_c, 1.0)) * 60.0, 0.0)
+
+            t0_c = np.repeat(np.maximum(t0_c[ok], 0.0), 2)
+            centroid_node = -zone_id[ok]
+            node_id = node_id[ok]
+            connector_count = int(ok.sum())
+            n_arcs = 2 * connector_count
+            conn = {
+                "from_node":    np.column_stack([centroid_node, node_id]).ravel(),
+                "to_node":      np.column_stack([node_id, centroid_node]).ravel(),
+                "tcur":         t0_c,
+                "t0":           t0_c,
+                "length":       np.zeros(n_arcs),
+                "v0prt":        np.zeros(n_arcs),
+                "vcur":         np.zeros(n_arcs),
+                "linktype":     np.full(n_arcs, -1, dtype=np.int64),
+                "vol":          np.zeros(n_arcs),
+                "cap":          np.zeros(n_arcs),
+                "vc_ratio":     np.zeros(n_arcs),
+                "is_connector": np.ones(n_arcs, dtype=bool),
+            }
+            arrays = {k: np.concatenate([arrays[k], conn[k]]) for k in arrays}
 
     print("  Connettori aggiunti: {} zone ({} archi)".format(
         connector_count, connector_count * 2))
+    return arrays
+
+
+def graph_from_edge_arrays(arrays):
+    """Costruisce il networkx.DiGraph dagli array di build_edge_arrays."""
+    import networkx as nx
+
+    G = nx.DiGraph()
+    columns = [arrays[k].tolist() for k in EDGE_ATTRS]
+    G.add_edges_from(
+        (u, v, dict(zip(EDGE_ATTRS, values)))
+        for u, v, *values in zip(arrays["from_node"].tolist(),
+                                 arrays["to_node"].tolist(), *columns))
+    return G
+
+
+def build_graph(links_df, connectors_df, centroids_df, config, arrays=None):
+    """
+    Costruisce grafo NetworkX dalla rete Visum con TCur come peso.
+
+    Attributi arco:
+        tcur      : tempo congestionato (MINUTI)
+        t0        : tempo a flusso nullo (MINUTI)
+        length    : lunghezza (METRI)
+        v0prt     : velocita' a flusso nullo (km/h)
+        vcur      : velocita' congestionata (km/h) = length / tcur * 60/1000
+        linktype  : numero tipo link
+        vol       : volume veicolare
+        cap       : capacita'
+        vc_ratio  : volume / capacita'
+        is_connector : bool
+
+    Il parsing e' colonnare (build_edge_arrays); il DiGraph viene popolato in
+    un'unica chiamata add_edges_from. `arrays` (es. dalla cache rete) evita
+    il parsing dei DataFrame.
+    """
+    if arrays is None:
+        arrays = build_edge_arrays(links_df, connectors_df, config)
+    G = graph_from_edge_arrays(arrays)
+    seed_edge_store(G, arrays)
     print("\n  Grafo finale: {} nodi, {} archi".format(
         G.number_of_nodes(), G.number_of_edges()))
-
     return G
 
 
@@ -520,10 +767,29 @@ def get_centroid_ids(centroids_df, connectors_df=None):
 # =============================================================================
 
 def compute_od_skims(G, centroid_ids, weight="tcur", verbose=True,
-                     od_filter=None):
-    """Calcola shortest path da ogni centroide usando TCur come peso."""
+                     od_filter=None, engine="csr", n_workers=1, target_radius=None):
+    """Calcola shortest path da ogni centroide usando TCur come peso.
+
+    engine: "csr" (Dijkstra scipy su array CSR, vedi csr_graph.py),
+            "cch" (gerarchia customizzabile, cch_graph.py; solo con od_filter,
+            altrimenti "csr") oppure "networkx" (riferimento su reti piccole).
+    n_workers: solo "csr", processi per le origini (1 = seriale, 0 = tutti i core).
+    target_radius: solo "csr", {orig_zone: raggio_minuti} per il Dijkstra
+            limitato (origin_time_radius); risultati identici alla ricerca completa.
+    """
+    if engine == "cch" and od_filter is not None:
+        return compute_od_skims_cch(G, centroid_ids, weight=weight,
+                                    verbose=verbose, od_filter=od_filter)
+    if engine in ("csr", "cch"):
+        return compute_od_skims_csr(G, centroid_ids, weight=weight,
+                                    verbose=verbose, od_filter=od_filter,
+                                    n_workers=n_workers, target_radius=target_radius)
+    if engine != "networkx":
+        raise ValueError("skim_engine non valido: {!r} (usa 'csr', 'cch' o 'networkx')".format(engine))
+
     import networkx as nx
 
+    sync_edge_view(G)
     centroid_nodes = [-z for z in centroid_ids]
     valid_centroids = [(z, -z) for z in centroid_ids if -z in G]
 
@@ -559,6 +825,9 @@ def compute_od_skims(G, centroid_ids, weight="tcur", verbose=True,
                 G, centroid_node, weight=weight)
         except Exception:
             continue
+        trace_count("dijkstra_calls")
+        trace_count("dijkstra_origins")
+        trace_count("settled_nodes", len(lengths))
 
         dest_zones = needed_by_origin[zone_id] if needed_by_origin else \
                      [z for z, _ in valid_centroids if z != zone_id]
@@ -585,25 +854,25 @@ def build_composition_matrix(G, od_paths_subset, linktype_list):
     """
     Costruisce D (n_od x n_linktypes):
         D[i, k] = lunghezza totale (m) di archi di tipo k nel percorso OD i
+
+    Percorsi come id arco (ArcPaths): una sola gather vettoriale per arco.
     """
-    type_index = {lt: j for j, lt in enumerate(linktype_list)}
-    od_order = list(od_paths_subset.keys())
+    store = get_edge_store(G)
+    paths = as_arc_paths(G, od_paths_subset)
+    od_order = list(paths.keys())
     n_od = len(od_order)
     n_types = len(linktype_list)
 
-    D = np.zeros((n_od, n_types), dtype=np.float64)
-
-    for i, od_key in enumerate(od_order):
-        path = od_paths_subset[od_key]
-        for u, v in zip(path[:-1], path[1:]):
-            if not G.has_edge(u, v):
-                continue
-            edge = G[u][v]
-            lt = edge.get("linktype", -1)
-            length = edge.get("length", 0.0)
-            if lt in type_index and length > 0:
-                D[i, type_index[lt]] += length
+    # Colonna per arco (-1 = tipo non in linktype_list o lunghezza nulla)
+    len_arc = store["length"]
+    col_arc = np.where(len_arc > 0, store.type_index(linktype_list), -1)
 
+    arcs = paths.arcs
+    col = col_arc[arcs]
+    keep = col >= 0
+    D = np.bincount(paths.row_ids()[keep] * n_types + col[keep],
+                    weights=len_arc[arcs][keep],
+                    minlength=n_od * n_types).reshape(n_od, n_types)
     return D, od_order
 
 
@@ -654,10 +923,14 @@ def compute_congested_speed_bounds(linktype_list, initial_vcur,
 def optimize_congested_speeds(D, T_obs, linktype_list,
                                initial_vcur=None,
                                speed_bounds=None,
-                               v_min=5.0, v_max=150.0):
+                               v_min=5.0, v_max=150.0,
+                               warm_vcur=None,
+                               solver="gram"):
     """
     Risolve il BVLS per trovare velocita' congestionate ottimali.
     Stessa formulazione di optimize_speeds_lsq ma con vcur al posto di v0.
+    solver "gram": active-set su D^T D (gram_bvls.py) con warm start da
+    warm_vcur; "bvls": lsq_linear sulla matrice densa.
     """
     from scipy.optimize import lsq_linear
 
@@ -697,20 +970,39 @@ def optimize_congested_speeds(D, T_obs, linktype_list,
     print("\n  BVLS: {} coppie OD x {} LinkType attivi".format(
         n_od, int(np.sum(active))))
 
-    result = lsq_linear(
-        D_active, T_obs_h,
-        bounds=(lb_active, ub_active),
-        method="bvls",
-        verbose=0,
-        max_iter=5000,
-    )
+    beta_active = None
+    if solver == "gram":
+        x0 = None
+        if warm_vcur:
+            x0 = np.array([1.0 / max(warm_vcur.get(lt, 30.0), 0.01)
+                           for lt, a in zip(linktype_list, active) if a])
+        Q, c = gram_system(D_active, T_obs_h)
+        beta_active, n_it, ok = bvls_gram(Q, c, lb_active, ub_active, x0=x0)
+        print("  Gram BVLS: {} iterazioni active-set{}".format(
+            n_it, " (warm start)" if x0 is not None else ""))
+        if not ok:
+            print("  [!] Active-set non convergente -> lsq_linear bvls")
+            beta_active = None
+        trace_count("solver_iterations", n_it)
+        trace_info(solver="gram", solver_converged=bool(ok))
+    if beta_active is None:
+        result = lsq_linear(
+            D_active, T_obs_h,
+            bounds=(lb_active, ub_active),
+            method="bvls",
+            verbose=0,
+            max_iter=5000,
+        )
+        beta_active = result.x
+        trace_count("solver_iterations", result.nit)
+        trace_info(solver="bvls", solver_converged=bool(result.status > 0))
 
     # Ricostruisci beta completo
     beta_full = np.full(n_types, 1.0 / 30.0)
     j = 0
     for i in range(n_types):
         if active[i]:
-            beta_full[i] = result.x[j]
+            beta_full[i] = beta_active[j]
             j += 1
         elif initial_vcur:
             lt = linktype_list[i]
@@ -738,20 +1030,17 @@ def optimize_congested_speeds(D, T_obs, linktype_list,
 
 def get_initial_vcur_from_graph(G, linktype_list):
     """Ricava velocita' congestionate medie per LinkType dal grafo."""
-    type_vcur_sum = {lt: 0.0 for lt in linktype_list}
-    type_vcur_cnt = {lt: 0   for lt in linktype_list}
-
-    for _, _, data in G.edges(data=True):
-        lt = data.get("linktype", -1)
-        vcur = data.get("vcur", 0.0)
-        if lt in type_vcur_sum and vcur > 0:
-            type_vcur_sum[lt] += vcur
-            type_vcur_cnt[lt] += 1
+    store = get_edge_store(G)
+    idx = store.type_index(linktype_list)
+    arc_vcur = store["vcur"]
+    ok = (idx >= 0) & (arc_vcur > 0)
+    type_vcur_sum = np.bincount(idx[ok], weights=arc_vcur[ok], minlength=len(linktype_list)).tolist()
+    type_vcur_cnt = np.bincount(idx[ok], minlength=len(linktype_list)).tolist()
 
     vcur = {}
-    for lt in linktype_list:
-        if type_vcur_cnt[lt] > 0:
-            vcur[lt] = round(type_vcur_sum[lt] / type_vcur_cnt[lt], 2)
+    for k, lt in enumerate(linktype_list):
+        if type_vcur_cnt[k] > 0:
+            vcur[lt] = round(type_vcur_sum[k] / type_vcur_cnt[k], 2)
         else:
             vcur[lt] = 30.0
 
@@ -764,25 +1053,17 @@ def get_initial_vcur_from_graph(G, linktype_list):
 
 def update_graph_tcur(G, vcur_dict, fix_connectors=True):
     """Aggiorna TCur nel grafo: tcur = (length_m / 1000 / vcur_kmh) * 60."""
-    updated = 0
-    for u, v, data in G.edges(data=True):
-        lt = data.get("linktype", -1)
-        length = data.get("length", 0.0)
-        is_con = data.get("is_connector", False)
-
-        if is_con and fix_connectors:
-            continue
-        if lt < 0 or length <= 0:
-            continue
+    store = get_edge_store(G)
+    length = store["length"]
+    new_vcur = store.by_type(vcur_dict)
+    mask = (store["linktype"] >= 0) & (length > 0) & (new_vcur > 0)
+    if fix_connectors:
+        mask &= ~store["is_connector"]
 
-        new_vcur = vcur_dict.get(lt)
-        if new_vcur and new_vcur > 0:
-            new_tcur = (length / 1000.0 / new_vcur) * 60.0
-            data["tcur"] = new_tcur
-            data["vcur"] = new_vcur
-            updated += 1
-
-    return updated
+    ids = np.flatnonzero(mask)
+    store.set("tcur", ids, (length[ids] / 1000.0 / new_vcur[ids]) * 60.0)
+    store.set("vcur", ids, new_vcur[ids])
+    return len(ids)
 
 
 # =============================================================================
@@ -872,7 +1153,8 @@ def remap_links_by_optimized_capacity(links_df, optimal_vcur, initial_vcur,
 
     Produce DataFrame con FROMNODENO, TONODENO, TYPENO_ORIG, TYPENO_NEW, CHANGED
     identico al formato di remap_links_by_optimized_speed per riuso di
-    apply_typeno_remap_to_visum.
+    apply_typeno_remap_to_visum. I passi 1-4 sono calcolati una volta per
+    TypeNo distinto e applicati per colonne a tutti gli archi.
     """
     from_col = find_column(links_df, "FROMNODENO")
     to_col = find_column(links_df, "TONODENO")
@@ -882,17 +1164,18 @@ def remap_links_by_optimized_capacity(links_df, optimal_vcur, initial_vcur,
         print("  [!] Colonne chiave mancanti -- remap non eseguito")
         return pd.DataFrame()
 
+    fn, _ = int_column(links_df[from_col])
+    tn, _ = int_column(links_df[to_col])
+    lt_col, _ = int_column(links_df[type_col])
+
     # Fattori CAP_PCT per lookup veloce
     cap_pct_sorted = sorted(CAP_PCT.items(), key=lambda x: x[0])
 
-    records = []
-    changed = 0
-
-    for _, row in links_df.iterrows():
-        fn = int(row[from_col])
-        tn = int(row[to_col])
-        lt_old = int(row[type_col])
-
+    # Il nuovo TypeNo dipende solo dal TypeNo corrente: una riga di tabella
+    # per tipo distinto, poi applicata a tutti gli archi
+    types, inverse = np.unique(lt_col, return_inverse=True)
+    new_types = np.empty(len(types), dtype=np.int64)
+    for k, lt_old in enumerate(types.tolist()):
         # Decodifica tipo corrente
         if lt_old >= 1000:
             base = lt_old // 100
@@ -925,23 +1208,21 @@ def remap_links_by_optimized_capacity(links_df, optimal_vcur, initial_vcur,
                 best_dist = dist
                 best_ci = ci
 
-        lt_new = base * 100 + v_idx * 10 + best_ci
-
-        rec = {
-            "FROMNODENO": fn,
-            "TONODENO": tn,
-            "TYPENO_ORIG": lt_old,
-            "TYPENO_NEW": lt_new,
-            "CHANGED": int(lt_new != lt_old),
-        }
-        records.append(rec)
-        if lt_new != lt_old:
-            changed += 1
-
-    remap_df = pd.DataFrame(records)
-    pct = changed / max(len(records), 1) * 100
+        new_types[k] = base * 100 + v_idx * 10 + best_ci
+
+    lt_new = new_types[inverse]
+    changed_mask = lt_new != lt_col
+    remap_df = pd.DataFrame({
+        "FROMNODENO": fn,
+        "TONODENO": tn,
+        "TYPENO_ORIG": lt_col,
+        "TYPENO_NEW": lt_new,
+        "CHANGED": changed_mask.astype(np.int64),
+    }) if len(links_df) else pd.DataFrame()
+    changed = int(changed_mask.sum())
+    pct = changed / max(len(links_df), 1) * 100
     print("  Archi riassegnati: {} / {}  ({:.1f}%)".format(
-        changed, len(records), pct))
+        changed, len(links_df), pct))
 
     if not remap_df.empty:
         print("  Distribuzione nuovi LinkType:")
@@ -964,26 +1245,20 @@ def filter_congested_types(G, linktype_list, vc_threshold=0.6):
         active_types: lista link type attivi per ottimizzazione
         type_stats: dict {lt: {avg_vc, total_vol, total_cap, n_links}}
     """
-    type_stats = {}
-    for _, _, data in G.edges(data=True):
-        lt = data.get("linktype", -1)
-        if lt < 0 or data.get("is_connector", False):
-            continue
-        if lt not in {t for t in linktype_list}:
-            continue
-
-        vol = data.get("vol", 0.0)
-        cap = data.get("cap", 0.0)
-
-        if lt not in type_stats:
-            type_stats[lt] = {"total_vol": 0.0, "total_cap": 0.0, "n_links": 0}
-        type_stats[lt]["total_vol"] += vol
-        type_stats[lt]["total_cap"] += cap
-        type_stats[lt]["n_links"] += 1
+    store = get_edge_store(G)
+    types = sorted(set(linktype_list))
+    idx = store.type_index(types)
+    ok = (idx >= 0) & (store["linktype"] >= 0) & ~store["is_connector"]
+    n_links = np.bincount(idx[ok], minlength=len(types)).tolist()
+    total_vol = np.bincount(idx[ok], weights=store["vol"][ok], minlength=len(types)).tolist()
+    total_cap = np.bincount(idx[ok], weights=store["cap"][ok], minlength=len(types)).tolist()
 
-    for lt in type_stats:
-        s = type_stats[lt]
-        s["avg_vc"] = s["total_vol"] / max(s["total_cap"], 1.0)
+    type_stats = {}
+    for k, lt in enumerate(types):
+        if n_links[k] > 0:
+            type_stats[lt] = {"total_vol": total_vol[k], "total_cap": total_cap[k],
+                              "n_links": n_links[k],
+                              "avg_vc": total_vol[k] / max(total_cap[k], 1.0)}
 
     # Filtra per v/c > soglia e volume > 0
     active_types = sorted([lt for lt, s in type_stats.items()
@@ -1016,9 +1291,15 @@ def run_iterative_optimization(G, centroid_ids, T_obs_dict, config):
     slope_min = config.get("slope_target_min", 0.9)
     slope_max = config.get("slope_target_max", 1.1)
     r2_target = config.get("r2_target", 0.9)
+    engine = config.get("skim_engine", "csr")
+    n_workers = config.get("n_workers", 1)
+    slack = config.get("target_radius_slack", 1.5)
 
-    od_pairs = list(T_obs_dict.keys())
-    od_filter = set(od_pairs)
+    # Campione OD coarse-to-fine (tutte le coppie senza od_sample_initial_frac)
+    sampler = ODSampleSchedule(T_obs_dict, config)
+    if n_iter <= 1:
+        sampler.advance(0.0, last=True)
+    od_pairs, od_filter, radius = sampler.current(slack)
 
     # Identifica tipi congestionati
     active_types, all_types, type_stats = filter_congested_types(
@@ -1066,6 +1347,10 @@ def run_iterative_optimization(G, centroid_ids, T_obs_dict, config):
     print("  Soglia v/c: {:.2f}".format(vc_threshold))
     print("  Delta max: +-{:.0f}% (congestionati), +-5% (altri)".format(delta_pct))
     print("  Iterazioni max: {}".format(n_iter))
+    if sampler.enabled:
+        print("  Campione OD: {:.1f}% iniziale, x{:.1f} con variazioni < {:.1f}%, "
+              "ultima iterazione su tutte le coppie".format(
+                  100 * sampler.frac, sampler.growth, sampler.grow_below_pct))
     print("\nVelocita' congestionate iniziali e bounds:")
     for lt in sorted(linktype_list):
         v = initial_vcur.get(lt, 30.0)
@@ -1078,9 +1363,12 @@ def run_iterative_optimization(G, centroid_ids, T_obs_dict, config):
     print("\n" + "-" * 50)
     print("ERRORE INIZIALE (con TCur da assegnazione)")
     print("-" * 50)
+    if sampler.enabled:
+        print("  " + sampler.describe())
     sys.stdout.flush()
     od_times_init, od_paths_init = compute_od_skims(
-        G, centroid_ids, weight="tcur", verbose=True, od_filter=od_filter)
+        G, centroid_ids, weight="tcur", verbose=True, od_filter=od_filter,
+        engine=engine, n_workers=n_workers, target_radius=radius)
     valid_init = [(od, T_obs_dict[od]) for od in od_pairs if od in od_paths_init]
     if valid_init:
         T_obs_arr = np.array([t for _, t in valid_init])
@@ -1096,116 +1384,447 @@ def run_iterative_optimization(G, centroid_ids, T_obs_dict, config):
                         "max_rel_change_pct": 0.0,
                         "_T_obs_arr": T_obs_arr.tolist(),
                         "_T_pred_arr": T_pred_arr.tolist(),
-                        "vcur": {str(lt): v for lt, v in initial_vcur.items()}})
+                        "vcur": {str(lt): v for lt, v in initial_vcur.items()},
+                        **sampler.history_fields()})
+
+    # Righe di D conservate tra le iterazioni (solo OD con percorso cambiato)
+    d_cache = PathRowCache()
 
     # Loop
     for iteration in range(1, n_iter + 1):
-        print("\n" + "=" * 40)
-        print("ITERAZIONE {} / {}".format(iteration, n_iter))
-        print("=" * 40)
-        sys.stdout.flush()
-
-        # Step 1: Shortest path su TCur
-        od_times, od_paths = compute_od_skims(
-            G, centroid_ids, weight="tcur", verbose=True, od_filter=od_filter)
-
-        # Step 2: Filtra OD valide
-        valid_ods = [(od, T_obs_dict[od]) for od in od_pairs if od in od_paths]
-        if not valid_ods:
-            print("  ERRORE: Nessuna coppia OD valida!")
-            break
-
-        od_paths_filt = {od: od_paths[od] for od, _ in valid_ods}
-        T_obs_filt = np.array([t for _, t in valid_ods])
-
-        # Step 3: Matrice composizione
-        D, od_order = build_composition_matrix(G, od_paths_filt, linktype_list)
-
-        d_per_type = D.sum(axis=0)
-        print("\n  Lunghezze percorse per LinkType (top 10):")
-        sorted_idx = np.argsort(d_per_type)[::-1]
-        for rank, j in enumerate(sorted_idx[:10]):
-            lt = linktype_list[j]
-            pct = d_per_type[j] / max(d_per_type.sum(), 1) * 100
-            tag = " **" if lt in active_types else ""
-            print("    Type {:5d}: {:8.1f} km  ({:5.1f}%){}".format(
-                lt, d_per_type[j] / 1000, pct, tag))
-
-        # Step 4: BVLS
-        new_vcur, metrics = optimize_congested_speeds(
-            D, T_obs_filt, linktype_list,
-            initial_vcur=initial_vcur,
-            speed_bounds=speed_bounds)
-
-        # Step 5: Log variazioni
-        print("\n  Velocita' congestionate aggiornate:")
-        for lt in sorted(new_vcur.keys()):
-            v_old = current_vcur.get(lt, 30.0)
-            v_new = new_vcur[lt]
-            delta = v_new - v_old
-            rel_pct = delta / max(v_old, 1.0) * 100.0
-            tag = " **" if lt in active_types else ""
-            if abs(rel_pct) > 0.5:
-                print("    Type {:5d}: {:6.1f} -> {:6.1f} km/h  ({:+.1f}%){}".format(
-                    lt, v_old, v_new, rel_pct, tag))
-
-        # Calcola T_pred su tutte le coppie per scatter e max_rel_change
-        D_km_full = D / 1000.0
-        beta_iter = np.array([1.0 / max(new_vcur.get(lt, 30.0), 0.1)
-                              for lt in linktype_list])
-        T_pred_iter = D_km_full @ beta_iter * 60.0
-        T_obs_iter = T_obs_filt
-
-        max_rel_change = 0.0
-        for lt in linktype_list:
-            v_old = current_vcur.get(lt, 30.0)
-            v_new = new_vcur.get(lt, v_old)
-            rel = abs(v_new - v_old) / max(v_old, 0.1) * 100
-            if rel > max_rel_change:
-                max_rel_change = rel
-
-        history.append({
-            "iteration": iteration,
-            "n_od_used": len(valid_ods),
-            "metrics": metrics,
-            "max_rel_change_pct": round(max_rel_change, 4),
-            "_T_obs_arr": T_obs_iter.tolist(),
-            "_T_pred_arr": T_pred_iter.tolist(),
-            "vcur": {str(lt): v for lt, v in new_vcur.items()},
-        })
+        with stage_timer("iteration", iteration=iteration):
+            print("\n" + "=" * 40)
+            print("ITERAZIONE {} / {}".format(iteration, n_iter))
+            print("=" * 40)
+            od_pairs, od_filter, radius = sampler.current(slack)
+            if sampler.enabled:
+                print("  " + sampler.describe())
+                trace_info(od_sample_pct=sampler.sample_pct())
+            sys.stdout.flush()
+
+            # Step 1: Shortest path su TCur
+            od_times, od_paths = compute_od_skims(
+                G, centroid_ids, weight="tcur", verbose=True, od_filter=od_filter,
+                engine=engine, n_workers=n_workers, target_radius=radius)
+
+            # Step 2: Filtra OD valide
+            valid_ods = [(od, T_obs_dict[od]) for od in od_pairs if od in od_paths]
+            if not valid_ods:
+                print("  ERRORE: Nessuna coppia OD valida!")
+                break
+
+            od_paths_filt = select_paths(od_paths, [od for od, _ in valid_ods])
+            T_obs_filt = np.array([t for _, t in valid_ods])
+
+            # Step 3: Matrice composizione (ricalcolate solo le righe con percorso cambiato)
+            paths_filt = as_arc_paths(G, od_paths_filt)
+            D, changed = d_cache.update(
+                paths_filt, lambda p: build_composition_matrix(G, p, linktype_list)[0],
+                signature=tuple(linktype_list))
+            paths_changed_pct = round(100.0 * changed.mean(), 3) if len(changed) else 0.0
+            trace_info(D_shape=list(D.shape), D_nnz=int(np.count_nonzero(D)),
+                       paths_changed_pct=paths_changed_pct)
+            print("  Percorsi cambiati: {:.1f}% ({} / {} OD)".format(
+                paths_changed_pct, int(changed.sum()), len(changed)))
+
+            d_per_type = D.sum(axis=0)
+            print("\n  Lunghezze percorse per LinkType (top 10):")
+            sorted_idx = np.argsort(d_per_type)[::-1]
+            for rank, j in enumerate(sorted_idx[:10]):
+                lt = linktype_list[j]
+                pct = d_per_type[j] / max(d_per_type.sum(), 1) * 100
+                tag = " **" if lt in active_types else ""
+                print("    Type {:5d}: {:8.1f} km  ({:5.1f}%){}".format(
+                    lt, d_per_type[j] / 1000, pct, tag))
+
+            # Step 4: BVLS
+            new_vcur, metrics = optimize_congested_speeds(
+                D, T_obs_filt, linktype_list,
+                initial_vcur=initial_vcur,
+                speed_bounds=speed_bounds,
+                warm_vcur=current_vcur,
+                solver=config.get("type_solver", "gram"))
+
+            # Step 5: Log variazioni
+            print("\n  Velocita' congestionate aggiornate:")
+            for lt in sorted(new_vcur.keys()):
+                v_old = current_vcur.get(lt, 30.0)
+                v_new = new_vcur[lt]
+                delta = v_new - v_old
+                rel_pct = delta / max(v_old, 1.0) * 100.0
+                tag = " **" if lt in active_types else ""
+                if abs(rel_pct) > 0.5:
+                    print("    Type {:5d}: {:6.1f} -> {:6.1f} km/h  ({:+.1f}%){}".format(
+                        lt, v_old, v_new, rel_pct, tag))
+
+            # Calcola T_pred su tutte le coppie per scatter e max_rel_change
+            D_km_full = D / 1000.0
+            beta_iter = np.array([1.0 / max(new_vcur.get(lt, 30.0), 0.1)
+                                  for lt in linktype_list])
+            T_pred_iter = D_km_full @ beta_iter * 60.0
+            T_obs_iter = T_obs_filt
+
+            max_rel_change = 0.0
+            for lt in linktype_list:
+                v_old = current_vcur.get(lt, 30.0)
+                v_new = new_vcur.get(lt, v_old)
+                rel = abs(v_new - v_old) / max(v_old, 0.1) * 100
+                if rel > max_rel_change:
+                    max_rel_change = rel
+
+            history.append({
+                "iteration": iteration,
+                "n_od_used": len(valid_ods),
+                "metrics": metrics,
+                "max_rel_change_pct": round(max_rel_change, 4),
+                "_T_obs_arr": T_obs_iter.tolist(),
+                "_T_pred_arr": T_pred_iter.tolist(),
+                "vcur": {str(lt): v for lt, v in new_vcur.items()},
+                "paths_changed_pct": paths_changed_pct,
+                **sampler.history_fields(),
+            })
 
-        # Step 6: Aggiorna grafo
-        n_updated = update_graph_tcur(G, new_vcur, fix_connectors=fix_conn)
-        print("  Grafo aggiornato: {} archi TCur modificati".format(n_updated))
+            # Step 6: Aggiorna grafo
+            n_updated = update_graph_tcur(G, new_vcur, fix_connectors=fix_conn)
+            print("  Grafo aggiornato: {} archi TCur modificati".format(n_updated))
+
+            current_vcur = new_vcur
+
+            # Convergenza
+            slope_ok = slope_min <= metrics["slope"] <= slope_max
+            r2_ok = metrics["r2"] >= r2_target
+            if slope_ok and r2_ok and not sampler.full:
+                # Convergenza sul campione: verifica finale su tutte le coppie
+                print("  [..] Convergenza sul campione ({:.1f}% OD): iterazione finale "
+                      "su tutte le coppie".format(sampler.sample_pct()))
+                sampler.advance(max_rel_change, converged=True)
+            elif slope_ok and r2_ok:
+                print("  [OK] CONVERGENZA: slope={:.4f}  R2={:.4f}".format(
+                    metrics["slope"], metrics["r2"]))
+                break
+            else:
+                missing = []
+                if not slope_ok:
+                    missing.append("slope={:.4f}".format(metrics["slope"]))
+                if not r2_ok:
+                    missing.append("R2={:.4f}".format(metrics["r2"]))
+                print("  [..] Non convergito: {}".format(" | ".join(missing)))
+                sampler.advance(max_rel_change, last=iteration + 1 >= n_iter)
+
+    sync_edge_view(G)
+    return current_vcur, initial_vcur, linktype_list, active_types, history
 
-        current_vcur = new_vcur
 
-        # Convergenza
-        slope_ok = slope_min <= metrics["slope"] <= slope_max
-        r2_ok = metrics["r2"] >= r2_target
-        if slope_ok and r2_ok:
-            print("  [OK] CONVERGENZA: slope={:.4f}  R2={:.4f}".format(
-                metrics["slope"], metrics["r2"]))
-            break
-        else:
-            missing = []
-            if not slope_ok:
-                missing.append("slope={:.4f}".format(metrics["slope"]))
-            if not r2_ok:
-                missing.append("R2={:.4f}".format(metrics["r2"]))
-            print("  [..] Non convergito: {}".format(" | ".join(missing)))
+# =============================================================================
+# CALIBRAZIONE CON ASSEGNAZIONE LOCALE (capacity_method = "assignment")
+# =============================================================================
 
-    return current_vcur, initial_vcur, linktype_list, active_types, history
+# Moltiplicatore di capacita' per C_index (CAP_PCT come array)
+CAP_MULT = np.array([1.0 + CAP_PCT[ci] / 100.0 for ci in range(10)])
+
+
+def decode_typeno(typeno):
+    """
+    (tipo base, V_index, C_index) per array di TypeNo BBSC; TypeNo < 1000 =
+    tipo base con indici 5, come in apply_capacity_remap_to_visum.
+    """
+    lt = np.asarray(typeno, dtype=np.int64)
+    encoded = lt >= 1000
+    return (np.where(encoded, lt // 100, lt),
+            np.where(encoded, (lt % 100) // 10, 5),
+            np.where(encoded, lt % 10, 5))
+
+
+def _store_assignment(G, state, cap_factor):
+    """Scrive nello store tcur, vcur, vol e cap dello stato di assegnazione."""
+    store = get_edge_store(G)
+    res, cap = state["result"], state["cap"]
+    ids = np.arange(len(cap))
+    length = store["length"]
+    tcur = res["times"]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        vcur = np.where((tcur > 0) & (length > 0),
+                        (length / 1000.0) / (tcur / 60.0), store["v0prt"])
+    store.set("tcur", ids, tcur)
+    store.set("vcur", ids, vcur)
+    store.set("vol", ids, res["flows"])
+    store.set("cap", ids, cap / cap_factor)
+
+
+def run_assignment_calibration(G, centroid_ids, T_obs_dict, config):
+    """
+    Calibrazione delle capacita' con assegnazione all'equilibrio locale
+    (traffic_assignment.py) al posto di Visum.Procedures.Execute().
+
+    Schema di optimize_capacity_from_observed_times (import-osm-network.py):
+    per ogni tipo base con v/c medio oltre vc_threshold_high e modello
+    troppo lento C_index +1, sotto vc_threshold_low e modello troppo veloce
+    C_index -1. Ogni iterazione valuta in locale il cambio congiunto e, con
+    assignment_single_type_candidates, i cambi dei singoli tipi (warm start
+    dai flussi correnti): viene accettato il candidato con RMSE minore,
+    solo se migliora. Le capacita' scelte vanno poi confermate in Visum.
+
+    Il C_index di un tipo base e' quello piu' frequente sui suoi archi: un
+    cambio di C_index si applica come variazione al C_index di ogni arco
+    (limitato a 0-9), i tipi base fermi restano come nella rete.
+
+    Ritorna come run_iterative_optimization, piu' capacity_remap
+    {base: C_index} e capacity_details per tipo base.
+    """
+    n_iter     = config.get("n_iterations", 5)
+    threshold  = config.get("convergence_threshold", 0.005)
+    vc_high    = config.get("vc_threshold_high", 0.80)
+    vc_low     = config.get("vc_threshold_low", 0.40)
+    single     = config.get("assignment_single_type_candidates", True)
+    engine     = config.get("skim_engine", "csr")
+    n_workers  = config.get("n_workers", 1)
+    cap_factor = float(config.get("assignment_cap_factor", 1.0))
+
+    if not config.get("demand_csv"):
+        print("[ERR] capacity_method 'assignment' richiede 'demand_csv' "
+              "(export_demand_matrices_to_csv in import-osm-network.py)")
+        sys.exit(1)
+
+    with stage_timer("load_demand"):
+        demand = load_demand_csv(config["demand_csv"], config)
+    assignment = StaticAssignment(G, demand, config)
+
+    store = get_edge_store(G)
+    links = (store["linktype"] >= 0) & ~store["is_connector"]
+    base, _, c_arc = decode_typeno(store["linktype"])
+    opt_arcs = links & (base >= 10)
+    base_types = sorted(set(base[opt_arcs].tolist()))
+    base_pos = np.searchsorted(base_types, base)
+    linktype_list = sorted(set(store["linktype"][links].tolist()))
+
+    # C_index corrente per tipo base: il piu' frequente sui suoi archi
+    current = {bt: int(np.bincount(c_arc[opt_arcs & (base == bt)], minlength=10).argmax())
+               for bt in base_types}
+    start_c_index = dict(current)
+
+    od_pairs  = list(T_obs_dict.keys())
+    od_filter = set(od_pairs)
+    radius    = origin_time_radius(T_obs_dict, config.get("target_radius_slack", 1.5))
+
+    def capacities(c_map):
+        """Capacita' per arco con C_index c_map: variazione sul C_index di ogni arco."""
+        shift = np.array([c_map[bt] - start_c_index[bt] for bt in base_types], dtype=np.int64)
+        cap = assignment.cap.copy()
+        ids = np.flatnonzero(opt_arcs)
+        ids = ids[shift[base_pos[ids]] != 0]
+        c_new = np.clip(c_arc[ids] + shift[base_pos[ids]], 0, 9)
+        cap[ids] *= CAP_MULT[c_new] / CAP_MULT[c_arc[ids]]
+        return cap
+
+    def evaluate(c_map, flows=None, verbose=False):
+        """Equilibrio con le capacita' di c_map, skim TCur delle OD osservate e metriche."""
+        cap = capacities(c_map)
+        state = {"cap": cap, "result": assignment.solve(cap=cap, flows=flows, verbose=verbose)}
+        _store_assignment(G, state, cap_factor)
+        od_times, _ = compute_od_skims(
+            G, centroid_ids, weight="tcur", verbose=False, od_filter=od_filter,
+            engine=engine, n_workers=n_workers, target_radius=radius)
+        valid = [od for od in od_pairs if od in od_times]
+        state["T_obs"]   = np.array([T_obs_dict[od] for od in valid])
+        state["T_pred"]  = np.array([od_times[od] for od in valid])
+        state["metrics"] = compute_metrics(state["T_pred"], state["T_obs"])
+        return state
+
+    def type_vc(state):
+        """v/c medio per tipo base (somma volumi / somma capacita')."""
+        ids = np.flatnonzero(opt_arcs)
+        vol = np.bincount(base_pos[ids], weights=state["result"]["flows"][ids],
+                          minlength=len(base_types))
+        cap = np.bincount(base_pos[ids], weights=state["cap"][ids], minlength=len(base_types))
+        return {bt: vol[k] / cap[k] for k, bt in enumerate(base_types) if cap[k] > 0}
+
+    def log_metrics(m):
+        print("  RMSE: {:.3f} min  |  MAE: {:.3f} min  |  "
+              "R2(origin): {:.4f}  |  slope: {:.4f}  |  MAPE: {:.2f}%".format(
+                  m["rmse"], m["mae"], m["r2"], m["slope"], m["mape"]))
+
+    def history_entry(iteration, state, vcur, prev_vcur, n_candidates=0, label=None):
+        max_rel = max([abs(vcur.get(lt, 0.0) - v) / max(v, 0.1) * 100
+                       for lt, v in prev_vcur.items()] or [0.0])
+        entry = {"iteration": iteration,
+                 "n_od_used": len(state["T_obs"]),
+                 "metrics": state["metrics"],
+                 "max_rel_change_pct": round(max_rel, 4),
+                 "_T_obs_arr": state["T_obs"].tolist(),
+                 "_T_pred_arr": state["T_pred"].tolist(),
+                 "vcur": {str(lt): v for lt, v in vcur.items()},
+                 "assignment_rel_gap": state["result"]["rel_gap"],
+                 "n_candidates": n_candidates,
+                 "c_index": {str(bt): ci for bt, ci in current.items()}}
+        if label:
+            entry["label"] = label
+        return entry
+
+    print("\n" + "=" * 70)
+    print("CALIBRAZIONE CAPACITA' CON ASSEGNAZIONE LOCALE")
+    print("=" * 70)
+    print("\nParametri:")
+    print("  Assegnazione: {} (max {} iterazioni, relative gap {:g})".format(
+        assignment.method, assignment.max_iter, assignment.rel_gap))
+    print("  Soglie v/c: > {:.2f} aumenta, < {:.2f} diminuisce".format(vc_high, vc_low))
+    print("  Iterazioni max: {}".format(n_iter))
+    print("  Tipi base ottimizzabili: {}".format(len(base_types)))
+    for bt in base_types:
+        print("    Base {:3d}: C_index={} (cap {:+d}%)".format(
+            bt, current[bt], CAP_PCT[current[bt]]))
+
+    print("\n" + "-" * 50)
+    print("ERRORE INIZIALE (assegnazione locale)")
+    print("-" * 50)
+    visum_vol = store["vol"].copy()
+    with stage_timer("assignment", iteration=0):
+        state = evaluate(current, verbose=True)
+    log_metrics(state["metrics"])
+
+    # Controllo VDF / assignment_cap_factor: volumi locali vs assegnazione Visum esportata
+    ref = links & (visum_vol > 0)
+    if ref.any():
+        local, v = state["result"]["flows"][ref], visum_vol[ref]
+        r2 = 1.0 - np.sum((local - v) ** 2) / max(np.sum((v - v.mean()) ** 2), 1e-12)
+        print("  [i] Volumi locali vs Visum ({} archi): R2={:.3f}, pendenza={:.3f}".format(
+            int(ref.sum()), r2, float(local @ v) / max(float(v @ v), 1e-12)))
+
+    initial_vcur = get_initial_vcur_from_graph(G, linktype_list)
+    history = [history_entry(0, state, initial_vcur, initial_vcur, label="initial")]
+    current_vcur = initial_vcur
+
+    for iteration in range(1, n_iter + 1):
+        with stage_timer("iteration", iteration=iteration):
+            print("\n" + "=" * 40)
+            print("ITERAZIONE {} / {}".format(iteration, n_iter))
+            print("=" * 40)
+            mean_error = float(np.mean(state["T_pred"] - state["T_obs"])) \
+                if len(state["T_obs"]) else 0.0
+            vc = type_vc(state)
+            moves = {}
+            for bt in base_types:
+                ci = current[bt]
+                if bt not in vc:
+                    continue
+                if mean_error > 0 and vc[bt] > vc_high and ci < 9:
+                    moves[bt] = +1
+                elif mean_error < 0 and vc[bt] < vc_low and ci > 0:
+                    moves[bt] = -1
+            print("  Errore medio: {:+.3f} min  |  tipi da modificare: {}".format(
+                mean_error, len(moves)))
+            if not moves:
+                print("  [OK] Nessun cambio capacita' -> convergenza")
+                break
+
+            candidates = [moves]
+            if single and len(moves) > 1:
+                candidates += [{bt: d} for bt, d in sorted(moves.items())]
+            best = None
+            for cand in candidates:
+                c_map = {**current, **{bt: current[bt] + d for bt, d in cand.items()}}
+                cand_state = evaluate(c_map, flows=state["result"]["flows"])
+                label = ", ".join("{}{:+d}".format(bt, d) for bt, d in sorted(cand.items()))
+                print("    Candidato [{}]: RMSE {:.3f} min  (gap {:.1e})".format(
+                    label, cand_state["metrics"]["rmse"], cand_state["result"]["rel_gap"]))
+                if best is None or cand_state["metrics"]["rmse"] < best[1]["metrics"]["rmse"]:
+                    best = (c_map, cand_state)
+
+            rmse_prev = state["metrics"]["rmse"]
+            improv = (rmse_prev - best[1]["metrics"]["rmse"]) / max(rmse_prev, 0.001)
+            if improv <= 0:
+                print("  [OK] Nessun candidato migliora l'RMSE -> convergenza")
+                break
+            for bt in base_types:
+                if best[0][bt] != current[bt]:
+                    print("    Base {:3d}: v/c={:.2f} -> C_index {} -> {} "
+                          "(cap {:+d}% -> {:+d}%)".format(
+                              bt, vc.get(bt, 0.0), current[bt], best[0][bt],
+                              CAP_PCT[current[bt]], CAP_PCT[best[0][bt]]))
+            current, state = best
+            _store_assignment(G, state, cap_factor)
+            new_vcur = get_initial_vcur_from_graph(G, linktype_list)
+            history.append(history_entry(iteration, state, new_vcur, current_vcur,
+                                         n_candidates=len(candidates)))
+            current_vcur = new_vcur
+            log_metrics(state["metrics"])
+            print("  Miglioramento RMSE: {:.2f}%".format(improv * 100))
+            if improv < threshold:
+                print("  [OK] CONVERGENZA: miglioramento sotto soglia")
+                break
+
+    # Stato accettato nello store (l'ultimo candidato valutato puo' essere stato scartato)
+    _store_assignment(G, state, cap_factor)
+    sync_edge_view(G)
+
+    changed = {bt for bt in base_types if current[bt] != start_c_index[bt]}
+    type_base = dict(zip(linktype_list, decode_typeno(linktype_list)[0].tolist()))
+    active_types = [lt for lt in linktype_list if type_base[lt] in changed]
+    capacity_details = {}
+    for bt in base_types:
+        types = [lt for lt in linktype_list if type_base[lt] == bt]
+        v_init = np.mean([initial_vcur[lt] for lt in types]) if types else 30.0
+        v_opt = np.mean([current_vcur[lt] for lt in types]) if types else v_init
+        capacity_details[bt] = {
+            "vcur_init": round(float(v_init), 2),
+            "vcur_opt": round(float(v_opt), 2),
+            "ratio": round(float(v_opt / max(v_init, 0.1)), 4),
+            "cap_pct_current": CAP_PCT[start_c_index[bt]],
+            "cap_pct_target": CAP_PCT[current[bt]],
+            "c_index_old": start_c_index[bt],
+            "c_index_new": current[bt],
+            "cap_pct_new": CAP_PCT[current[bt]],
+        }
+    return (current_vcur, initial_vcur, linktype_list, active_types, history,
+            dict(current), capacity_details)
+
+
+def remap_links_by_capacity_index(links_df, c_index_shift):
+    """
+    TypeNo per arco con la variazione di C_index scelta per tipo base
+    {base: delta} (base * 100 + V_index * 10 + C_index + delta, C_index
+    limitato a 0-9): archi di tipi base assenti o con delta 0 invariati.
+    Stesso formato di remap_links_by_optimized_capacity.
+    """
+    from_col = find_column(links_df, "FROMNODENO")
+    to_col = find_column(links_df, "TONODENO")
+    type_col = find_column(links_df, "TYPENO")
+
+    if not from_col or not to_col or not type_col:
+        print("  [!] Colonne chiave mancanti -- remap non eseguito")
+        return pd.DataFrame()
+
+    fn, _ = int_column(links_df[from_col])
+    tn, _ = int_column(links_df[to_col])
+    lt_col, _ = int_column(links_df[type_col])
+
+    base, v_idx, c_idx = decode_typeno(lt_col)
+    shift = np.array([c_index_shift.get(b, 0) for b in base.tolist()], dtype=np.int64)
+    new_c = np.clip(c_idx + shift, 0, 9)
+    lt_new = np.where(shift != 0, base * 100 + v_idx * 10 + new_c, lt_col)
+    changed_mask = lt_new != lt_col
+    remap_df = pd.DataFrame({
+        "FROMNODENO": fn,
+        "TONODENO": tn,
+        "TYPENO_ORIG": lt_col,
+        "TYPENO_NEW": lt_new,
+        "CHANGED": changed_mask.astype(np.int64),
+    }) if len(links_df) else pd.DataFrame()
+    print("  Archi riassegnati: {} / {}  ({:.1f}%)".format(
+        int(changed_mask.sum()), len(links_df),
+        changed_mask.sum() / max(len(links_df), 1) * 100))
+    return remap_df
 
 
 # =============================================================================
 # SKIM FINALI
 # =============================================================================
 
-def compute_final_skims(G, centroid_ids, optimal_vcur, linktype_list):
+def compute_final_skims(G, centroid_ids, optimal_vcur, linktype_list,
+                        engine="csr", n_workers=1):
     """Calcola skim finale con velocita' congestionate ottimizzate."""
     od_times, od_paths = compute_od_skims(G, centroid_ids, weight="tcur",
-                                           verbose=True)
+                                           verbose=True, engine=engine,
+                                           n_workers=n_workers)
     D, od_order = build_composition_matrix(G, od_paths, linktype_list)
 
     rows = []
@@ -1222,6 +1841,23 @@ def compute_final_skims(G, centroid_ids, optimal_vcur, linktype_list):
     return pd.DataFrame(rows)
 
 
+def stream_final_skims(G, centroid_ids, linktype_list, T_obs_dict, config):
+    """
+    Skim finale a blocchi di final_skim_chunk_origins origini (skim_export.py):
+    od_comparison viene scritto durante il calcolo, senza tenere in memoria
+    i percorsi N x N. Ritorna le sole righe con tempo osservato.
+    """
+    engine = config.get("skim_engine", "csr")
+    if engine != "csr":
+        print("  [i] Skim finale a blocchi: motore csr "
+              "(skim_engine '{}' ignorato)".format(engine))
+    return export_type_skims(G, centroid_ids, linktype_list,
+                             config["output_dir"], T_obs_dict, weight="tcur",
+                             chunk_origins=config["final_skim_chunk_origins"],
+                             fmt=config.get("final_skim_format", "csv"),
+                             sep=";")
+
+
 # =============================================================================
 # STATISTICHE PER LINKTYPE
 # =============================================================================
@@ -1477,10 +2113,16 @@ def save_scatter_plots(output_dir, history, skim_df, T_obs_dict,
 def save_results(output_dir, optimal_vcur, initial_vcur, linktype_list,
                  active_types, history, T_obs_dict, config,
                  capacity_remap=None, capacity_details=None,
-                 skim_df=None, G=None):
-    """Salva tutti i risultati nella cartella output."""
+                 skim_df=None, G=None, comparison_streamed=False):
+    """
+    Salva tutti i risultati nella cartella output.
+    comparison_streamed: od_comparison gia' scritto da stream_final_skims
+    (skim_df contiene solo le righe con tempo osservato).
+    """
     out = Path(output_dir)
     out.mkdir(parents=True, exist_ok=True)
+    if G is not None:
+        sync_edge_view(G)   # letture per arco dagli edge dict
 
     # 1. Velocita' congestionate ottimizzate
     rows = []
@@ -1531,6 +2173,12 @@ def save_results(output_dir, optimal_vcur, initial_vcur, linktype_list,
             "slope": round(m.get("slope", 0), 4),
             "mape": round(m.get("mape", 0), 2),
         }
+        if "paths_changed_pct" in h:
+            row["paths_changed_pct"] = h["paths_changed_pct"]
+        if "od_sample_pct" in h:
+            row["od_sample_pct"] = h["od_sample_pct"]
+        if "assignment_rel_gap" in h:
+            row["assignment_rel_gap"] = h["assignment_rel_gap"]
         for lt_str, v in h.get("vcur", {}).items():
             row["vcur_type_{}".format(lt_str)] = v
         hist_rows.append(row)
@@ -1539,7 +2187,7 @@ def save_results(output_dir, optimal_vcur, initial_vcur, linktype_list,
     print("  [OK] History iterazioni: {}".format(out / "optimization_history.csv"))
 
     # 4. Confronto OD tempi modello vs osservati
-    if skim_df is not None and T_obs_dict:
+    if skim_df is not None and T_obs_dict and not comparison_streamed:
         skim_df["time_observed_min"] = skim_df.apply(
             lambda r: T_obs_dict.get(
                 (int(r["origin"]), int(r["destination"])), np.nan), axis=1)
@@ -1616,6 +2264,9 @@ def save_results(output_dir, optimal_vcur, initial_vcur, linktype_list,
     if capacity_remap:
         flag_data["capacity_remap"] = {str(k): v
                                         for k, v in capacity_remap.items()}
+    if get_trace() is not None:
+        # Fasi concluse fino al salvataggio; dettaglio completo in trace.json
+        flag_data["trace"] = get_trace().summary()
 
     with open(str(out / "optimization_complete.flag"), "w") as f:
         json.dump(flag_data, f, indent=2)
@@ -1633,11 +2284,13 @@ def main():
     print("=" * 70)
 
     # Config
-    if len(sys.argv) < 2:
-        print("Uso: python optimize_capacity.py config.json")
+    args     = [a for a in sys.argv[1:] if not a.startswith("--")]
+    no_cache = "--no-cache" in sys.argv[1:]
+    if not args:
+        print("Uso: python optimize_capacity.py config.json [--no-cache]")
         sys.exit(1)
 
-    config_path = Path(sys.argv[1])
+    config_path = Path(args[0])
     if not config_path.exists():
         print("[ERR] Config non trovato: {}".format(config_path))
         sys.exit(1)
@@ -1646,11 +2299,14 @@ def main():
         user_config = json.load(f)
 
     config = {**DEFAULT_CONFIG, **user_config}
+    trace = start_trace("optimize_capacity", config.get("output_dir"))
 
     print("\nConfig: {}".format(config_path))
     print("  Rete:            {}".format(config["network_dir"]))
     print("  Tempi osservati: {}".format(config["observed_times_csv"]))
     print("  Output:          {}".format(config["output_dir"]))
+    print("  Motore skim:     {}".format(config.get("skim_engine", "csr")))
+    print("  Processi skim:   {}".format(config.get("n_workers", 1)))
 
     for key in ["network_dir", "observed_times_csv", "output_dir"]:
         if not config.get(key):
@@ -1661,54 +2317,28 @@ def main():
     print("\n" + "-" * 60)
     print("STEP 1: Caricamento rete Visum (con TCur)")
     print("-" * 60)
-    links_df, nodes_df, centroids_df, connectors_df = load_visum_network(
-        config["network_dir"], file_prefix=config.get("file_prefix"), config=config)
+    cache = None
+    if config.get("network_cache", True) and not no_cache:
+        cache = NetworkCache(
+            config.get("network_cache_dir") or Path(config["output_dir"]) / "network_cache",
+            "capacity",
+            find_network_files(config["network_dir"], config.get("file_prefix")),
+            {k: config.get(k) for k in NETWORK_CACHE_KEYS})
+    cached = cache.load() if cache is not None else None
+    with stage_timer("load_visum_network"):
+        if cached:
+            links_df, nodes_df, centroids_df, connectors_df = cached["frames"]
+        else:
+            links_df, nodes_df, centroids_df, connectors_df = load_visum_network(
+                config["network_dir"], file_prefix=config.get("file_prefix"), config=config)
 
     # 2. Tempi osservati
     print("\n" + "-" * 60)
     print("STEP 2: Caricamento tempi osservati")
     print("-" * 60)
-    obs_df = pd.read_csv(
-        config["observed_times_csv"],
-        sep=None, engine="python", encoding="utf-8-sig")
-    print("  Righe: {}, colonne: {}".format(len(obs_df), list(obs_df.columns)))
-
-    # Risolvi nomi colonne
-    def resolve_col(configured_name, alias_key):
-        if configured_name in obs_df.columns:
-            return configured_name
-        match = next((c for c in obs_df.columns
-                      if c.lower() == configured_name.lower()), None)
-        if match:
-            return match
-        for alias in OD_COL_ALIASES.get(alias_key, []):
-            match = next((c for c in obs_df.columns
-                          if c.lower() == alias.lower()), None)
-            if match:
-                return match
-        return None
-
-    orig_col = resolve_col(config["od_col_orig"], "origin")
-    dest_col = resolve_col(config["od_col_dest"], "destination")
-    time_col = resolve_col(config["od_col_time"], "time_m")
-
-    for name, found in [(config["od_col_orig"], orig_col),
-                        (config["od_col_dest"], dest_col),
-                        (config["od_col_time"], time_col)]:
-        if found is None:
-            print("[ERR] Colonna '{}' non trovata. Disponibili: {}".format(
-                name, list(obs_df.columns)))
-            sys.exit(1)
-
-    # Campionamento
-    sample = config.get("sample_od_pairs")
-    if sample and len(obs_df) > sample:
-        obs_df = obs_df.sample(n=sample, random_state=config.get("random_seed", 42))
-
-    T_obs_dict = {
-        (int(row[orig_col]), int(row[dest_col])): float(row[time_col])
-        for _, row in obs_df.iterrows()
-    }
+    with stage_timer("load_observed_times"):
+        observed = load_observed_times(config["observed_times_csv"], config, OD_COL_ALIASES)
+        T_obs_dict = observed.as_dict()
     print("  Coppie OD osservate: {}".format(len(T_obs_dict)))
     obs_arr = np.array(list(T_obs_dict.values()))
     print("  Tempi: min={:.1f}  mean={:.1f}  max={:.1f} min".format(
@@ -1718,13 +2348,22 @@ def main():
     print("\n" + "-" * 60)
     print("STEP 3: Costruzione grafo NetworkX (peso=TCur)")
     print("-" * 60)
-    G = build_graph(links_df, connectors_df, centroids_df, config)
+    with stage_timer("build_graph"):
+        arrays = cached["arrays"] if cached else build_edge_arrays(links_df, connectors_df, config)
+        G = build_graph(links_df, connectors_df, centroids_df, config, arrays=arrays)
+    if config.get("skim_engine", "csr") == "cch":
+        # Ordine di contrazione: calcolato una volta per rete e riusato da disco
+        with stage_timer("cch_preprocess"):
+            get_cch(G, cache_dir=config.get("cch_cache_dir")
+                    or str(Path(config["output_dir"]) / "cch_cache"))
 
     # 4. Centroidi
-    centroid_ids = get_centroid_ids(centroids_df, connectors_df)
+    centroid_ids = cached["centroid_ids"] if cached else get_centroid_ids(centroids_df, connectors_df)
     if not centroid_ids:
         print("[ERR] Nessun centroide!")
         sys.exit(1)
+    if cache is not None and not cached:
+        cache.save([links_df, nodes_df, centroids_df, connectors_df], arrays, centroid_ids)
     print("\n  Centroidi: {}".format(len(centroid_ids)))
 
     # 5. Ottimizzazione
@@ -1732,16 +2371,30 @@ def main():
     print("STEP 4: Ottimizzazione iterativa")
     print("-" * 60)
 
-    optimal_vcur, initial_vcur, linktype_list, active_types, history = \
-        run_iterative_optimization(G, centroid_ids, T_obs_dict, config)
+    by_assignment = config.get("capacity_method", "bvls") == "assignment"
+    with stage_timer("optimization"):
+        if by_assignment:
+            (optimal_vcur, initial_vcur, linktype_list, active_types, history,
+             capacity_remap, capacity_details) = \
+                run_assignment_calibration(G, centroid_ids, T_obs_dict, config)
+        else:
+            optimal_vcur, initial_vcur, linktype_list, active_types, history = \
+                run_iterative_optimization(G, centroid_ids, T_obs_dict, config)
 
     # 6. Remap per-link: assegna nuovo TypeNo a ogni singolo arco
     print("\n" + "-" * 60)
     print("STEP 5: Remap capacita' per singolo arco")
     print("-" * 60)
 
-    remap_df = remap_links_by_optimized_capacity(
-        links_df, optimal_vcur, initial_vcur, linktype_list, G=G)
+    with stage_timer("remap_links"):
+        if by_assignment:
+            remap_df = remap_links_by_capacity_index(
+                links_df, {bt: d["c_index_new"] - d["c_index_old"]
+                           for bt, d in capacity_details.items()
+                           if d["c_index_new"] != d["c_index_old"]})
+        else:
+            remap_df = remap_links_by_optimized_capacity(
+                links_df, optimal_vcur, initial_vcur, linktype_list, G=G)
 
     # Salva links_remapped.csv (formato compatibile con apply_typeno_remap_to_visum)
     remap_file = Path(config["output_dir"]) / "links_remapped.csv"
@@ -1749,25 +2402,26 @@ def main():
     remap_df.to_csv(str(remap_file), index=False, sep=";")
     print("  [OK] links_remapped.csv: {}".format(remap_file))
 
-    # Anche capacity_remap per-base-type (per report)
-    type_col = find_column(links_df, config.get("linktype_field", "TYPENO"))
-    current_c_index = {}
-    if type_col:
-        for _, row in links_df.iterrows():
-            try:
-                tn = int(row[type_col])
-                if tn >= 1000:
-                    base = tn // 100
-                    ci = tn % 10
-                else:
-                    base = tn
-                    ci = 5
-                current_c_index[base] = ci
-            except (ValueError, TypeError):
-                pass
-
-    capacity_remap, capacity_details = vcur_to_capacity_index(
-        linktype_list, initial_vcur, optimal_vcur, current_c_index)
+    # Anche capacity_remap per-base-type (per report; con "assignment" gia' calcolato)
+    if not by_assignment:
+        type_col = find_column(links_df, config.get("linktype_field", "TYPENO"))
+        current_c_index = {}
+        if type_col:
+            for _, row in links_df.iterrows():
+                try:
+                    tn = int(row[type_col])
+                    if tn >= 1000:
+                        base = tn // 100
+                        ci = tn % 10
+                    else:
+                        base = tn
+                        ci = 5
+                    current_c_index[base] = ci
+                except (ValueError, TypeError):
+                    pass
+
+        capacity_remap, capacity_details = vcur_to_capacity_index(
+            linktype_list, initial_vcur, optimal_vcur, current_c_index)
 
     print("\nCapacita' ottimali per base type:")
     for base_type in sorted(capacity_details.keys()):
@@ -1785,17 +2439,26 @@ def main():
     print("\n" + "-" * 60)
     print("STEP 6: Skim finali con velocita' congestionate ottimizzate")
     print("-" * 60)
-    skim_df = compute_final_skims(G, centroid_ids, optimal_vcur, linktype_list)
+    streamed = bool(config.get("final_skim_chunk_origins"))
+    with stage_timer("final_skims"):
+        if streamed:
+            skim_df = stream_final_skims(G, centroid_ids, linktype_list,
+                                         T_obs_dict, config)
+        else:
+            skim_df = compute_final_skims(G, centroid_ids, optimal_vcur, linktype_list,
+                                          engine=config.get("skim_engine", "csr"),
+                                          n_workers=config.get("n_workers", 1))
 
     # 8. Salva
     print("\n" + "-" * 60)
     print("STEP 7: Salvataggio risultati")
     print("-" * 60)
-    save_results(config["output_dir"], optimal_vcur, initial_vcur,
-                 linktype_list, active_types, history, T_obs_dict, config,
-                 capacity_remap=capacity_remap,
-                 capacity_details=capacity_details,
-                 skim_df=skim_df, G=G)
+    with stage_timer("save_results"):
+        save_results(config["output_dir"], optimal_vcur, initial_vcur,
+                     linktype_list, active_types, history, T_obs_dict, config,
+                     capacity_remap=capacity_remap,
+                     capacity_details=capacity_details,
+                     skim_df=skim_df, G=G, comparison_streamed=streamed)
 
     # Riepilogo
     print("\n" + "=" * 70)
@@ -1813,6 +2476,7 @@ def main():
         n_changed, len(capacity_details)))
     print("\n  Output: {}".format(config["output_dir"]))
     print("=" * 70)
+    trace.save()
 
 
 if __name__ == "__main__":
@@ -1824,4 +2488,6 @@ if __name__ == "__main__":
     except Exception as e:
         print("\n[ERR] ERRORE: {}".format(e))
         traceback.print_exc()
+        if get_trace() is not None:
+            get_trace().save(status="failed")
         sys.exit(2)
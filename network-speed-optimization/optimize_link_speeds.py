@@ -31,7 +31,18 @@ APPROCCIO MATEMATICO:
         5. Ripeti fino a convergenza
 
 UTILIZZO:
-    python optimize_link_speeds.py config.json
+    python optimize_link_speeds.py config.json [--no-cache]
+
+    --no-cache : ignora la cache binaria della rete (network_cache.py) e
+                 rilegge gli shapefile
+
+MULTI-PERIODO ("periods"):
+    Piu' file di tempi osservati (es. AM / interpunta / PM) sulla stessa
+    rete in un solo processo: rete caricata e topologia CSR/CCH compilata
+    una volta, ogni periodo su un proprio grafo con attributi arco privati
+    e output in <output_dir>/<nome>. Con period_workers > 1 (default: un
+    processo per periodo, nei limiti dei core) i periodi girano in
+    parallelo; il flag in output_dir riassume l'esito per periodo.
 
 COLONNE SHAPEFILE VISUM (default export):
     wkt_geom  FROMNODENO  TONODENO  TYPENO  TSYSSET  LENGTH    NUMLANES  CAPPRT  V0PRT    ...
@@ -60,8 +71,11 @@ CONFIG.JSON:
     }
 """
 
+import os
 import sys
 import json
+import hashlib
+import time
 import traceback
 import warnings
 from pathlib import Path
@@ -70,6 +84,19 @@ from itertools import islice
 import numpy as np
 import pandas as pd
 
+from csr_graph import (compute_od_skims_csr, IncrementalSkims, get_csr_graph,
+                       get_edge_store, seed_edge_store, share_csr_graph, sync_edge_view,
+                       as_arc_paths, select_paths, origin_time_radius, PathRowCache,
+                       resolve_n_workers)
+from cch_graph import compute_od_skims_cch, get_cch
+from gram_bvls import gram_system, bvls_gram
+from network_cache import NetworkCache
+from observed_times import load_observed_times
+from od_sampling import ODSampleSchedule
+from skim_export import export_type_skims
+from stage_timing import (stage_timer, start_trace, get_trace, resume_trace, trace_count,
+                          trace_info)
+
 warnings.filterwarnings("ignore")
 
 
@@ -85,6 +112,8 @@ DEFAULT_CONFIG = {
     "od_col_orig": "origin",        # Nome colonna origine nel CSV
     "od_col_dest": "destination",   # Nome colonna destinazione nel CSV
     "od_col_time": "time_m",       # Nome colonna tempi osservati (in MINUTI)
+    "observed_aggregation": "mean", # OD ripetute nel CSV: "mean" | "median" | "last" (ultima riga)
+    "observed_time_dtype": "float64", # dtype tempi osservati ("float32" dimezza la memoria su milioni di righe)
     # - Colonne shapefile
     "v0prt_field": "V0PRT",         # Campo velocita libera (es. "50km/h") -- T0 calcolato da V0PRT+LENGTH
     "length_field": "LENGTH",       # Campo lunghezza (es. "0.041km" -- unit suffix gestita automaticamente)
@@ -97,10 +126,16 @@ DEFAULT_CONFIG = {
     "speed_max_kmh": 150.0,
     "speed_delta_kmh": 10.0,         # per_type: max variazione per tipo (km/h)
     "speed_class_gap_kmh": 1.0,      # per_type: gap minimo tra classi
+    "type_solver": "gram",           # per_type: "gram" (active-set su D^T D, warm start) | "bvls" (lsq_linear denso)
     "speed_delta_arc_kmh": 20.0,     # per_arc:  max variazione per arco (km/h) -- LEGACY (non usato se _pct presenti)
     "speed_delta_lower_pct": 25.0,    # per_arc:  max riduzione %  (classe 0 = -25%)
     "speed_delta_upper_pct": 20.0,    # per_arc:  max aumento %    (classe 9 = +20%)
     "max_active_arcs":   500,       # per_arc:  top archi per sub-cycle (piccolo -> bvls dense rapido)
+    "per_arc_solver":    "batched", # per_arc:  "batched" (top max_active_arcs disgiunti) | "global" (tutti gli archi percorsi)
+    "global_solver_method": "pg",   # global:   "pg" (gradiente proiettato, warm start) | "trf" (lsq_linear trf+lsmr)
+    "global_max_iter":   300,       # global:   max iterazioni del solver
+    "global_tol":        1e-4,      # global:   soglia passo relativo per la convergenza
+    "global_memory_mb":  2048,      # global:   budget matrice D (oltre: campione OD riproducibile)
     "od_error_frac":     None,      # per_arc:  frazione OD peggiori per sub-cycle (None=auto: 30/20/10%)
     "n_sub_cycles":      3,         # per_arc:  sub-cicli per iterazione (ri-selezione OD senza Dijkstra)
     "n_iterations":      10,        # Max iterazioni ottimizzazione (outer loop con Dijkstra)
@@ -110,7 +145,24 @@ DEFAULT_CONFIG = {
     "r2_target":         0.9,       # Convergenza: R2(origin) minimo accettabile (default 0.9)
     "fix_connector_t0": True,       # True = connettori NON ottimizzati (T0 fisso)
     "sample_od_pairs": None,        # None = tutte le coppie OD; int = campione casuale
+    "od_sample_initial_frac": None, # per_type: campione OD iniziale stratificato (es. 0.1), cresce fino a tutte le coppie; None = off
+    "od_sample_growth": 2.0,        # per_type: fattore di crescita del campione
+    "od_sample_grow_below_pct": 2.0, # per_type: il campione cresce quando la max variazione velocita' (%) e' sotto soglia
+    "od_sample_time_bands": 4,      # per_type: fasce di tempo osservato (quantili) per la stratificazione
     "random_seed": 42,
+    "skim_engine": "csr",           # "csr" (scipy, array CSR) | "cch" (gerarchia customizzabile) | "networkx" (riferimento)
+    "n_workers": 1,                 # Processi per lo skim "csr" (1 = seriale, 0 = tutti i core)
+    "final_skim_chunk_origins": None, # Skim finale: None = in memoria; int = origini per blocco, od_comparison scritto a blocchi
+    "final_skim_format": "csv",     # Skim finale a blocchi: "csv" | "parquet" (richiede pyarrow)
+    "incremental_reroute": True,    # per_arc + csr: ricalcola solo le origini toccate dagli archi modificati
+    "target_radius_slack": 1.5,     # csr: Dijkstra fermato a max(T_obs origine) x slack (None = rete intera)
+    "cch_cache_dir": None,          # cch: cartella ordine di contrazione (None = <output_dir>/cch_cache)
+    "network_cache": True,          # Cache binaria rete (npz+pickle), invalidata se cambiano shapefile o colonne
+    "network_cache_dir": None,      # Cartella cache rete (None = <output_dir>/network_cache)
+    "checkpoint": True,             # Salva optimization_checkpoint.npz in output_dir a fine iterazione
+    "resume_from": None,            # Checkpoint (file o output_dir del run interrotto) da cui riprendere; con periods: output_dir del run multi-periodo
+    "periods": None,                # Multi-periodo: [{"name", "observed_times_csv", ...override}] -> <output_dir>/<name>
+    "period_workers": 0,            # Multi-periodo: processi paralleli (0 = tutti i core, max un processo per periodo; 1 = in sequenza)
 }
 
 # Nomi alternativi per le colonne (case-insensitive lookup)
@@ -137,6 +189,11 @@ OD_COL_ALIASES = {
                     "traveltime", "time_minutes", "tempo_min", "tempo", "tt"],
 }
 
+# Chiavi config che influenzano il parsing della rete: fanno parte della
+# chiave della cache rete (network_cache.py)
+NETWORK_CACHE_KEYS = ("file_prefix", "v0prt_field", "length_field", "linktype_field",
+                      "fromnodeno_field", "tonodeno_field")
+
 def find_column(df, field_key, aliases_dict=None):
     """Cerca una colonna nel DataFrame usando il dizionario di alias (case-insensitive)."""
     cols_upper = {c.upper(): c for c in df.columns}
@@ -183,16 +240,13 @@ def load_shapefile_as_dataframe(filepath, description=""):
             raise ImportError(f"Impossibile caricare {filepath}: installa geopandas o pyshp.\n{e2}")
 
 
-def load_visum_network(network_dir, file_prefix=None, config=None):
+def find_network_files(network_dir, file_prefix=None):
     """
-    Carica la rete Visum da shapefile esportati.
+    Individua gli shapefile della rete Visum.
 
     Ritorna:
-        links_df, nodes_df, centroids_df, connectors_df (DataFrame pandas)
+        dict {"link", "node", "centroid", "connector"} -> Path (o None)
     """
-    if config is None:
-        config = {}
-
     network_path = Path(network_dir)
     if not network_path.exists():
         raise FileNotFoundError(f"Cartella rete non trovata: {network_dir}")
@@ -214,6 +268,25 @@ def load_visum_network(network_dir, file_prefix=None, config=None):
                          or find_shp("*zone*.shp")
         connector_file = find_shp("*_connector.shp") or find_shp("*connector*.shp")
 
+    return {"link": link_file, "node": node_file,
+            "centroid": centroid_file, "connector": connector_file}
+
+
+def load_visum_network(network_dir, file_prefix=None, config=None):
+    """
+    Carica la rete Visum da shapefile esportati.
+
+    Ritorna:
+        links_df, nodes_df, centroids_df, connectors_df (DataFrame pandas)
+    """
+    if config is None:
+        config = {}
+
+    network_path = Path(network_dir)
+    files = find_network_files(network_dir, file_prefix)
+    link_file, node_file = files["link"], files["node"]
+    centroid_file, connector_file = files["centroid"], files["connector"]
+
     print(f"\nFile shapefile trovati in {network_path}:")
     for label, f in [("Link", link_file), ("Node", node_file),
                      ("Centroide", centroid_file), ("Connettore", connector_file)]:
@@ -294,31 +367,103 @@ def speed_to_kmh(val):
     return v  # km/h e il default Visum
 
 
-# =============================================================================
-# COSTRUZIONE GRAFO NETWORKX
-# =============================================================================
+# -----------------------------------------------------------------------------
+# Versioni vettoriali (intera colonna): stesso risultato delle funzioni
+# scalari sopra, ma con un solo passaggio pandas per colonna invece di una
+# regex per cella. Le celle non stringa o non riconosciute dalla regex
+# (rare) passano comunque dalla funzione scalare, per garantire valori identici.
+# -----------------------------------------------------------------------------
 
-def build_graph(links_df, connectors_df, centroids_df, config):
-    """
-    Costruisce un grafo networkx.DiGraph dalla rete Visum.
+_VISUM_VALUE_RE = r'^([+-]?[\d]*\.?[\d]+(?:[eE][+-]?\d+)?)\s*([a-zA-Z/]*)\s*$'
 
-    Nodi centroide: -zone_no  (negativi per non collidere con nodi rete)
-    Nodi rete:       node_no  (positivi)
 
-    Attributi degli archi:
-        t0        : tempo di percorrenza (MINUTI), calcolato da V0PRT + LENGTH
-        length    : lunghezza (METRI)
-        v0prt     : velocita libera (km/h), dal campo V0PRT shapefile
-        linktype  : numero tipo link (int)
-        is_connector: bool
+def _stripped_str_cells(series):
+    """Celle stringa con strip(); NaN per le celle non stringa (numeri, None)."""
+    is_str = series.map(lambda v: isinstance(v, str)).astype(bool)
+    return series.where(is_str).str.strip()
 
-    NOTA: T0_PRTSYS non viene esportato di default da Visum.
-          Il T0 viene calcolato come: (LENGTH_km / V0PRT_kmh) * 60 [minuti]
+
+def parse_visum_column(series):
     """
-    import networkx as nx
+    Versione vettoriale di parse_visum_value per un'intera colonna.
+    Ritorna (valori np.ndarray float64, unita' np.ndarray object di str).
+    """
+    n = len(series)
+    if pd.api.types.is_numeric_dtype(series.dtype):
+        return series.to_numpy(dtype=np.float64), np.full(n, "", dtype=object)
+
+    values = np.zeros(n, dtype=np.float64)
+    units  = np.full(n, "", dtype=object)
+    parts  = _stripped_str_cells(series).str.extract(_VISUM_VALUE_RE)
+    matched = parts[0].notna().to_numpy()
+    if matched.any():
+        values[matched] = parts[0][matched].to_numpy(dtype=np.float64)
+        units[matched]  = parts[1][matched].str.lower().str.strip().to_numpy(dtype=object)
+    if not matched.all():
+        raw = series.to_numpy(dtype=object)
+        for i in np.flatnonzero(~matched):
+            values[i], units[i] = parse_visum_value(raw[i])
+    return values, units
+
+
+def length_column_to_meters(series):
+    """Versione vettoriale di length_to_meters (np.ndarray float64 in METRI)."""
+    v, unit = parse_visum_column(series)
+    is_km = np.isin(unit, ("km", "kilometer", "kilometres", "kilometre", ""))
+    is_m  = np.isin(unit, ("m", "meter", "metres", "metre"))
+    other = np.where(v < 100, v * 1000.0, v)
+    return np.where(is_km, v * 1000.0, np.where(is_m, v, other))
+
+
+def speed_column_to_kmh(series):
+    """Versione vettoriale di speed_to_kmh (np.ndarray float64 in km/h)."""
+    v, unit = parse_visum_column(series)
+    return np.where(unit == "mph", v * 1.60934,
+                    np.where(np.isin(unit, ("m/s", "ms")), v * 3.6, v))
+
+
+def int_column(series):
+    """
+    Converte una colonna in interi come farebbe int(valore) cella per cella.
+    Ritorna (valori np.ndarray int64, maschera celle valide).
+    """
+    n = len(series)
+    if pd.api.types.is_integer_dtype(series.dtype) and not series.hasnans:
+        return series.to_numpy(dtype=np.int64), np.ones(n, dtype=bool)
+    if pd.api.types.is_numeric_dtype(series.dtype):
+        f = series.to_numpy(dtype=np.float64)
+        ok = np.isfinite(f)
+        out = np.zeros(n, dtype=np.int64)
+        out[ok] = np.trunc(f[ok]).astype(np.int64)
+        return out, ok
+    out = np.zeros(n, dtype=np.int64)
+    ok  = np.zeros(n, dtype=bool)
+    for i, val in enumerate(series.to_numpy(dtype=object)):
+        try:
+            out[i] = int(val)
+            ok[i] = True
+        except (TypeError, ValueError, OverflowError):
+            pass
+    return out, ok
 
-    G = nx.DiGraph()
 
+# =============================================================================
+# COSTRUZIONE GRAFO NETWORKX
+# =============================================================================
+
+def build_edge_arrays(links_df, connectors_df, config):
+    """
+    Loader colonnare della rete: converte link e connettori in array NumPy
+    paralleli (un elemento per arco), senza iterare riga per riga.
+
+    Ritorna dict con chiavi:
+        from_node, to_node : np.ndarray int64
+        t0, length, v0prt  : np.ndarray float64  (MINUTI, METRI, km/h)
+        linktype           : np.ndarray int64
+        is_connector       : np.ndarray bool
+    L'ordine degli archi riproduce quello del vecchio loader (link nell'ordine
+    delle righe, poi per ogni connettore zona->nodo e nodo->zona).
+    """
     # --------------- NOMI COLONNE LINKS ---------------
     v0prt_col = find_column(links_df, config.get("v0prt_field", "V0PRT"))
     len_col   = find_column(links_df, config.get("length_field", "LENGTH"))
@@ -349,43 +494,46 @@ def build_graph(links_df, connectors_df, centroids_df, config):
         print(f"  Esempio prima riga: LENGTH={s_len!r} -> {s_len_m:.1f}m, "
               f"V0PRT={s_v0!r} -> {s_v0_kmh:.1f}km/h, T0_calc={s_t0:.4f}min")
 
-    # --------------- AGGIUNGI ARCHI RETE ---------------
-    link_count = 0
-    skipped = 0
-    for _, row in links_df.iterrows():
-        try:
-            fn = int(row[from_col]) if from_col else None
-            tn = int(row[to_col])   if to_col   else None
-            if fn is None or tn is None:
-                skipped += 1
-                continue
+    # --------------- ARCHI RETE (vettoriale) ---------------
+    n_links = len(links_df)
+    if from_col and to_col:
+        fn, fn_ok = int_column(links_df[from_col])
+        tn, tn_ok = int_column(links_df[to_col])
+        valid = fn_ok & tn_ok
+    else:
+        fn = tn = np.zeros(n_links, dtype=np.int64)
+        valid = np.zeros(n_links, dtype=bool)
+    if type_col:
+        lt, lt_ok = int_column(links_df[type_col])
+        valid &= lt_ok
+    else:
+        lt = np.zeros(n_links, dtype=np.int64)
 
-            length = length_to_meters(row[len_col])  if len_col   else 0.0
-            v0     = speed_to_kmh(row[v0prt_col])    if v0prt_col else 50.0
-            lt     = int(row[type_col])               if type_col  else 0
+    length = length_column_to_meters(links_df[len_col]) if len_col \
+        else np.zeros(n_links, dtype=np.float64)
+    v0 = speed_column_to_kmh(links_df[v0prt_col]) if v0prt_col \
+        else np.full(n_links, 50.0, dtype=np.float64)
 
-            # T0 = (length_km / v0_kmh) * 60 min
-            if v0 > 0 and length > 0:
-                t0 = (length / 1000.0 / v0) * 60.0
-            elif length > 0:
-                t0 = (length / 1000.0 / 50.0) * 60.0  # fallback 50 km/h
-            else:
-                t0 = 0.001  # evita T0=0 (loop infinito in Dijkstra)
-
-            G.add_edge(fn, tn,
-                       t0=t0,
-                       length=length,
-                       v0prt=v0,
-                       linktype=lt,
-                       is_connector=False)
-            link_count += 1
-        except (TypeError, ValueError, KeyError):
-            skipped += 1
-            continue
+    # T0 = (length_km / v0_kmh) * 60 min; fallback 50 km/h; T0=0.001 se lunghezza nulla
+    with np.errstate(divide="ignore", invalid="ignore"):
+        t0 = np.where((v0 > 0) & (length > 0), (length / 1000.0 / v0) * 60.0,
+                      np.where(length > 0, (length / 1000.0 / 50.0) * 60.0, 0.001))
 
+    link_count = int(valid.sum())
+    skipped = n_links - link_count
     print(f"  Archi rete aggiunti: {link_count}  (saltati: {skipped})")
 
-    # --------------- AGGIUNGI CONNETTORI ---------------
+    arrays = {
+        "from_node":    fn[valid],
+        "to_node":      tn[valid],
+        "t0":           t0[valid],
+        "length":       length[valid],
+        "v0prt":        v0[valid],
+        "linktype":     lt[valid],
+        "is_connector": np.zeros(link_count, dtype=bool),
+    }
+
+    # --------------- CONNETTORI ---------------
     connector_count = 0
     if connectors_df is not None:
         zone_col = find_column(connectors_df, "ZONENO")
@@ -401,44 +549,109 @@ def build_graph(links_df, connectors_df, centroids_df, config):
                              if "NODE" in c.upper() or "KNOTEN" in c.upper()), None)
 
         if zone_col and node_col:
-            for _, row in connectors_df.iterrows():
-                try:
-                    zone_id = int(row[zone_col])
-                    node_id = int(row[node_col])
-                    # Connettori: prova a leggere T0 direttamente se presente,
-                    # altrimenti calcola da V0PRT+LENGTH (o usa 0.0 se assenti)
-                    if t0_conn_col and pd.notna(row.get(t0_conn_col, None)):
-                        t0_c = float(row[t0_conn_col]) / 60.0  # secondi -> minuti
-                    else:
-                        # Prova V0PRT + LENGTH per il connettore
-                        v0_conn_col  = find_column(connectors_df, config.get("v0prt_field", "V0PRT"))
-                        len_conn_col = find_column(connectors_df, config.get("length_field", "LENGTH"))
-                        if v0_conn_col and len_conn_col:
-                            len_c = length_to_meters(row[len_conn_col])
-                            v0_c  = speed_to_kmh(row[v0_conn_col])
-                            t0_c  = (len_c / 1000.0 / max(v0_c, 1.0)) * 60.0 if v0_c > 0 else 0.0
-                        else:
-                            t0_c = 0.0
-
-                    centroid_node = -zone_id  # nodo centroide (negativo)
-
-                    # Connettori bidirezionali
-                    G.add_edge(centroid_node, node_id,
-                               t0=max(t0_c, 0.0), length=0.0,
-                               linktype=-1, is_connector=True)
-                    G.add_edge(node_id, centroid_node,
-                               t0=max(t0_c, 0.0), length=0.0,
-                               linktype=-1, is_connector=True)
-                    connector_count += 1
-                except (TypeError, ValueError, KeyError):
-                    continue
+            n_conn = len(connectors_df)
+            zone_id, z_ok = int_column(connectors_df[zone_col])
+            node_id, n_ok = int_column(connectors_df[node_col])
+            ok = z_ok & n_ok
+
+            # Prova V0PRT + LENGTH per il connettore (o 0.0 se assenti)
+            v0_conn_col  = find_column(connectors_df, config.get("v0prt_field", "V0PRT"))
+            len_conn_col = find_column(connectors_df, config.get("length_field", "LENGTH"))
+            if v0_conn_col and len_conn_col:
+                len_c = length_column_to_meters(connectors_df[len_conn_col])
+                v0_c  = speed_column_to_kmh(connectors_df[v0_conn_col])
+                with np.errstate(divide="ignore", invalid="ignore"):
+                    t0_c = np.where(v0_c > 0,
+                                    (len_c / 1000.0 / np.maximum(v0_c, 1.0)) * 60.0, 0.0)
+            else:
+                t0_c = np.zeros(n_conn, dtype=np.float64)
+
+            # T0 diretto (secondi -> minuti) dove presente
+            if t0_conn_col:
+                raw_t0  = connectors_df[t0_conn_col]
+                present = raw_t0.notna().to_numpy()
+                t0_num  = pd.to_numeric(raw_t0, errors="coerce").to_numpy(dtype=np.float64)
+                ok &= ~present | ~np.isnan(t0_num)   # float() fallito -> connettore scartato
+                t0_c = np.where(present, t0_num / 60.0, t0_c)
+
+            t0_c = np.maximum(t0_c[ok], 0.0)
+            centroid_node = -zone_id[ok]   # nodo centroide (negativo)
+            node_id = node_id[ok]
+            connector_count = int(ok.sum())
+
+            # Connettori bidirezionali: (zona->nodo, nodo->zona) alternati
+            arrays["from_node"] = np.concatenate(
+                [arrays["from_node"], np.column_stack([centroid_node, node_id]).ravel()])
+            arrays["to_node"] = np.concatenate(
+                [arrays["to_node"], np.column_stack([node_id, centroid_node]).ravel()])
+            arrays["t0"] = np.concatenate([arrays["t0"], np.repeat(t0_c, 2)])
+            arrays["length"] = np.concatenate(
+                [arrays["length"], np.zeros(2 * connector_count)])
+            arrays["v0prt"] = np.concatenate(
+                [arrays["v0prt"], np.full(2 * connector_count, np.nan)])
+            arrays["linktype"] = np.concatenate(
+                [arrays["linktype"], np.full(2 * connector_count, -1, dtype=np.int64)])
+            arrays["is_connector"] = np.concatenate(
+                [arrays["is_connector"], np.ones(2 * connector_count, dtype=bool)])
         else:
             print(f"  [!] Connettori: colonne ZONENO/NODENO non trovate. "
                   f"Colonne disponibili: {list(connectors_df.columns)}")
 
     print(f"  Connettori aggiunti: {connector_count} zone ({connector_count*2} archi)")
-    print(f"\n  Grafo finale: {G.number_of_nodes()} nodi, {G.number_of_edges()} archi")
+    return arrays
+
 
+def graph_from_edge_arrays(arrays):
+    """
+    Costruisce il networkx.DiGraph dagli array di build_edge_arrays.
+    I connettori non hanno l'attributo v0prt (come nel loader originale).
+    """
+    import networkx as nx
+
+    G = nx.DiGraph()
+    fn   = arrays["from_node"].tolist()
+    tn   = arrays["to_node"].tolist()
+    t0   = arrays["t0"].tolist()
+    ln   = arrays["length"].tolist()
+    v0   = arrays["v0prt"].tolist()
+    lt   = arrays["linktype"].tolist()
+    conn = arrays["is_connector"].tolist()
+    G.add_edges_from(
+        (u, v, {"t0": t, "length": l, "linktype": k, "is_connector": True} if c else
+               {"t0": t, "length": l, "v0prt": s, "linktype": k, "is_connector": False})
+        for u, v, t, l, s, k, c in zip(fn, tn, t0, ln, v0, lt, conn))
+    return G
+
+
+def build_graph(links_df, connectors_df, centroids_df, config, arrays=None, csr=None):
+    """
+    Costruisce un grafo networkx.DiGraph dalla rete Visum.
+
+    Nodi centroide: -zone_no  (negativi per non collidere con nodi rete)
+    Nodi rete:       node_no  (positivi)
+
+    Attributi degli archi:
+        t0        : tempo di percorrenza (MINUTI), calcolato da V0PRT + LENGTH
+        length    : lunghezza (METRI)
+        v0prt     : velocita libera (km/h), dal campo V0PRT shapefile
+        linktype  : numero tipo link (int)
+        is_connector: bool
+
+    NOTA: T0_PRTSYS non viene esportato di default da Visum.
+          Il T0 viene calcolato come: (LENGTH_km / V0PRT_kmh) * 60 [minuti]
+
+    Il parsing e' colonnare (build_edge_arrays); il DiGraph viene popolato in
+    un'unica chiamata add_edges_from. `arrays` (es. dalla cache rete) evita
+    il parsing dei DataFrame. `csr` (CSRGraph di un grafo costruito dagli
+    stessi array) evita di ricompilare la topologia.
+    """
+    if arrays is None:
+        arrays = build_edge_arrays(links_df, connectors_df, config)
+    G = graph_from_edge_arrays(arrays)
+    if csr is not None:
+        share_csr_graph(G, csr)
+    seed_edge_store(G, arrays)
+    print(f"\n  Grafo finale: {G.number_of_nodes()} nodi, {G.number_of_edges()} archi")
     return G
 
 
@@ -466,7 +679,7 @@ def get_centroid_ids(centroids_df, connectors_df=None):
 
 
 def compute_od_skims(G, centroid_ids, weight="t0", verbose=True,
-                     od_filter=None):
+                     od_filter=None, engine="csr", n_workers=1, target_radius=None):
     """
     Calcola shortest path da ogni centroide a tutti gli altri.
 
@@ -476,13 +689,34 @@ def compute_od_skims(G, centroid_ids, weight="t0", verbose=True,
                     Se fornito -> Dijkstra solo per le origini presenti nel filtro,
                     e memorizza solo i percorsi verso le destinazioni richieste.
                     Riduce drasticamente tempo e memoria su reti grandi.
+        engine    : "csr"      -> Dijkstra multi-sorgente scipy su array CSR (csr_graph.py)
+                    "cch"      -> query sulla gerarchia customizzabile (cch_graph.py),
+                                  solo con od_filter; senza filtro si usa "csr"
+                    "networkx" -> nx.single_source_dijkstra per origine (riferimento,
+                                  utile per verificare i risultati su reti piccole)
+        n_workers : solo engine "csr": processi per le origini (1 = seriale,
+                    0/None = tutti i core). Risultati identici al seriale.
+        target_radius : solo engine "csr": dict {orig_zone: raggio_minuti},
+                    Dijkstra limitato al raggio (origin_time_radius).
+                    Risultati identici alla ricerca completa.
 
     Ritorna:
         od_times  : dict {(orig_zone, dest_zone): tempo_minuti}
         od_paths  : dict {(orig_zone, dest_zone): [nodi_percorso]}
     """
+    if engine == "cch" and od_filter is not None:
+        return compute_od_skims_cch(G, centroid_ids, weight=weight,
+                                    verbose=verbose, od_filter=od_filter)
+    if engine in ("csr", "cch"):
+        return compute_od_skims_csr(G, centroid_ids, weight=weight,
+                                    verbose=verbose, od_filter=od_filter,
+                                    n_workers=n_workers, target_radius=target_radius)
+    if engine != "networkx":
+        raise ValueError("skim_engine non valido: {!r} (usa 'csr', 'cch' o 'networkx')".format(engine))
+
     import networkx as nx
 
+    sync_edge_view(G)
     n = len(centroid_ids)
     centroid_nodes = [-z for z in centroid_ids]
 
@@ -525,6 +759,9 @@ def compute_od_skims(G, centroid_ids, weight="t0", verbose=True,
             lengths, paths = nx.single_source_dijkstra(G, centroid_node, weight=weight)
         except Exception:
             continue
+        trace_count("dijkstra_calls")
+        trace_count("dijkstra_origins")
+        trace_count("settled_nodes", len(lengths))
 
         # Destinazioni da salvare per questa origine
         dest_zones = needed_by_origin[zone_id] if needed_by_origin else \
@@ -559,24 +796,22 @@ def build_composition_matrix(G, od_paths_subset, linktype_list):
         D        : np.ndarray (n_od x n_linktypes)
         od_order : lista di coppie (orig, dest) nell'ordine delle righe
     """
-    type_index = {lt: j for j, lt in enumerate(linktype_list)}
-    od_order   = list(od_paths_subset.keys())
-    n_od       = len(od_order)
-    n_types    = len(linktype_list)
-
-    D = np.zeros((n_od, n_types), dtype=np.float64)
-
-    for i, od_key in enumerate(od_order):
-        path = od_paths_subset[od_key]
-        for u, v in zip(path[:-1], path[1:]):
-            if not G.has_edge(u, v):
-                continue
-            edge = G[u][v]
-            lt     = edge.get("linktype", -1)
-            length = edge.get("length", 0.0)
-            if lt in type_index and length > 0:
-                D[i, type_index[lt]] += length
-
+    store    = get_edge_store(G)
+    paths    = as_arc_paths(G, od_paths_subset)
+    od_order = list(paths.keys())
+    n_od     = len(od_order)
+    n_types  = len(linktype_list)
+
+    # Colonna per arco (-1 = tipo non in linktype_list o lunghezza nulla)
+    len_arc = store["length"]
+    col_arc = np.where(len_arc > 0, store.type_index(linktype_list), -1)
+
+    arcs = paths.arcs
+    col  = col_arc[arcs]
+    keep = col >= 0
+    D = np.bincount(paths.row_ids()[keep] * n_types + col[keep],
+                    weights=len_arc[arcs][keep],
+                    minlength=n_od * n_types).reshape(n_od, n_types)
     return D, od_order
 
 
@@ -667,7 +902,9 @@ def compute_speed_bounds(linktype_list, initial_speeds,
 def optimize_speeds_lsq(D, T_obs, linktype_list,
                         v_min=10.0, v_max=150.0,
                         initial_speeds=None,
-                        speed_bounds=None):
+                        speed_bounds=None,
+                        warm_speeds=None,
+                        solver="gram"):
     """
     Risolve il problema di ottimizzazione velocita con scipy.optimize.lsq_linear.
 
@@ -679,6 +916,13 @@ def optimize_speeds_lsq(D, T_obs, linktype_list,
       Se speed_bounds fornito: usa bounds per-tipo {lt: (lb_kmh, ub_kmh)}
       Altrimenti: bounds globali [v_min, v_max]
 
+    Solver:
+      "gram" : active-set su D^T D / D^T T (gram_bvls.py), warm start da
+               warm_speeds (velocita' dell'iterazione precedente); il solve
+               non dipende dal numero di OD
+      "bvls" : lsq_linear(method="bvls") sulla matrice densa (legacy, e
+               fallback se l'active-set non converge)
+
     R2 e slope calcolati per regressione PASSANTE PER L'ORIGINE.
     """
     from scipy.optimize import lsq_linear
@@ -731,20 +975,39 @@ def optimize_speeds_lsq(D, T_obs, linktype_list,
                 print("    Type {:3d}: [{:.1f}, {:.1f}] km/h  (init={:.1f})".format(
                     lt, lo, hi, v_init))
 
-    result = lsq_linear(
-        D_active, T_obs_h,
-        bounds=(lb_active, ub_active),
-        method="bvls",
-        verbose=0,
-        max_iter=5000,
-    )
+    beta_active = None
+    if solver == "gram":
+        x0 = None
+        if warm_speeds:
+            x0 = np.array([1.0 / max(warm_speeds.get(lt, 50.0), 0.01)
+                           for lt, a in zip(linktype_list, active) if a])
+        Q, c = gram_system(D_active, T_obs_h)
+        beta_active, n_it, ok = bvls_gram(Q, c, lb_active, ub_active, x0=x0)
+        print("  Gram BVLS: {} iterazioni active-set{}".format(
+            n_it, " (warm start)" if x0 is not None else ""))
+        if not ok:
+            print("  [!] Active-set non convergente -> lsq_linear bvls")
+            beta_active = None
+        trace_count("solver_iterations", n_it)
+        trace_info(solver="gram", solver_converged=bool(ok))
+    if beta_active is None:
+        result = lsq_linear(
+            D_active, T_obs_h,
+            bounds=(lb_active, ub_active),
+            method="bvls",
+            verbose=0,
+            max_iter=5000,
+        )
+        beta_active = result.x
+        trace_count("solver_iterations", result.nit)
+        trace_info(solver="bvls", solver_converged=bool(result.status > 0))
 
     # Ricostruisci vettore beta completo
     beta_full = np.full(n_types, 1.0 / 50.0)
     j = 0
     for i in range(n_types):
         if active[i]:
-            beta_full[i] = result.x[j]
+            beta_full[i] = beta_active[j]
             j += 1
         elif initial_speeds:
             lt = linktype_list[i]
@@ -775,33 +1038,28 @@ def get_initial_speeds_from_graph(G, linktype_list):
         2. Calcolata da length/T0
         3. Default 50 km/h
     """
-    type_v0_sum    = {lt: 0.0 for lt in linktype_list}
-    type_v0_count  = {lt: 0   for lt in linktype_list}
-    type_lengths   = {lt: 0.0 for lt in linktype_list}
-    type_times     = {lt: 0.0 for lt in linktype_list}
-
-    for _, _, data in G.edges(data=True):
-        lt     = data.get("linktype", -1)
-        length = data.get("length", 0.0)
-        t0     = data.get("t0", 0.0)
-        v0prt  = data.get("v0prt", None)   # dal campo V0PRT shapefile
-        if lt not in type_v0_sum:
-            continue
-        if v0prt is not None and v0prt > 0:
-            type_v0_sum[lt]   += v0prt
-            type_v0_count[lt] += 1
-        if length > 0 and t0 > 0:
-            type_lengths[lt] += length
-            type_times[lt]   += t0
+    store  = get_edge_store(G)
+    n_lt   = len(linktype_list)
+    idx    = store.type_index(linktype_list)
+    length = store["length"]
+    t0     = store["t0"]
+    v0prt  = store["v0prt"]             # dal campo V0PRT shapefile (NaN se assente)
+
+    has_v0 = (idx >= 0) & (v0prt > 0)
+    has_t0 = (idx >= 0) & (length > 0) & (t0 > 0)
+    type_v0_sum   = np.bincount(idx[has_v0], weights=v0prt[has_v0], minlength=n_lt).tolist()
+    type_v0_count = np.bincount(idx[has_v0], minlength=n_lt).tolist()
+    type_lengths  = np.bincount(idx[has_t0], weights=length[has_t0], minlength=n_lt).tolist()
+    type_times    = np.bincount(idx[has_t0], weights=t0[has_t0], minlength=n_lt).tolist()
 
     speeds = {}
-    for lt in linktype_list:
-        if type_v0_count[lt] > 0:
+    for k, lt in enumerate(linktype_list):
+        if type_v0_count[k] > 0:
             # Media aritmetica di V0PRT (velocita di progetto del LinkType)
-            speeds[lt] = round(type_v0_sum[lt] / type_v0_count[lt], 2)
-        elif type_times[lt] > 0:
+            speeds[lt] = round(type_v0_sum[k] / type_v0_count[k], 2)
+        elif type_times[k] > 0:
             # Fallback: v = (length_m / 1000) / (t0_min / 60)  [km/h]
-            speeds[lt] = round((type_lengths[lt] / 1000.0) / (type_times[lt] / 60.0), 2)
+            speeds[lt] = round((type_lengths[k] / 1000.0) / (type_times[k] / 60.0), 2)
         else:
             speeds[lt] = 50.0
 
@@ -818,24 +1076,16 @@ def update_graph_t0(G, speeds_dict, fix_connectors=True):
         T0 [min] = (length [m] / 1000 / speed [km/h]) * 60
     Connettori (linktype=-1) sono ignorati se fix_connectors=True.
     """
-    updated = 0
-    for u, v, data in G.edges(data=True):
-        lt     = data.get("linktype", -1)
-        length = data.get("length", 0.0)
-        is_con = data.get("is_connector", False)
+    store     = get_edge_store(G)
+    length    = store["length"]
+    new_speed = store.by_type(speeds_dict)
+    mask = (store["linktype"] >= 0) & ~np.isnan(new_speed) & (length > 0)
+    if fix_connectors:
+        mask &= ~store["is_connector"]
 
-        if fix_connectors and is_con:
-            continue
-        if lt < 0 or lt not in speeds_dict:
-            continue
-        if length <= 0:
-            continue
-
-        new_speed = speeds_dict[lt]
-        data["t0"] = (length / 1000.0 / new_speed) * 60.0
-        updated += 1
-
-    return updated
+    ids = np.flatnonzero(mask)
+    store.set("t0", ids, (length[ids] / 1000.0 / new_speed[ids]) * 60.0)
+    return len(ids)
 
 
 # =============================================================================
@@ -853,60 +1103,91 @@ def build_composition_matrix_per_arc(G, od_paths_subset, max_arcs=None,
     Se max_arcs e' specificato, mantiene solo i max_arcs archi con piu'
     km totali percorsi (i piu' importanti per l'ottimizzazione).
 
+    Percorsi come id arco (ArcPaths): D, copertura, selezione top e
+    esclusioni sono operazioni vettoriali sugli array per arco.
+
     Ritorna:
         D_sparse     : scipy.sparse.csr_matrix  (n_od x n_archi)
         arc_list     : lista di tuple (u, v) nell'ordine delle colonne
         od_order     : lista di coppie OD nell'ordine delle righe
         arc_coverage : {(u,v): km_totali} per tutti gli archi candidati
     """
-    from scipy.sparse import lil_matrix, csr_matrix
+    from scipy.sparse import csr_matrix
+
+    csr      = get_csr_graph(G)
+    paths    = as_arc_paths(G, od_paths_subset)
+    od_order = list(paths.keys())
+    n_od     = len(od_order)
+    arcs     = paths.arcs
+    store    = get_edge_store(G)
+    len_arc  = store["length"]
+
+    # Archi candidati: non connettori, non esclusi
+    candidate = ~store["is_connector"]
+    if exclude_arcs:
+        candidate[csr.arc_ids_from_pairs(exclude_arcs)] = False
+    in_set = candidate[arcs]
+
+    # Copertura (km totali) per arco candidato, nell'ordine di prima comparsa
+    occ      = arcs[in_set]
+    coverage = np.bincount(occ, weights=len_arc[occ], minlength=csr.n_arcs)
+    uniq, first = np.unique(occ, return_index=True)
+    cand = uniq[np.argsort(first, kind="stable")]
+    arc_coverage = dict(zip(csr.arc_pairs(cand), coverage[cand].tolist()))
+
+    # Se richiesto, tieni solo i max_arcs piu' coperti (maggior volume totale)
+    selected = cand
+    if max_arcs and len(cand) > max_arcs:
+        selected = cand[np.argsort(-coverage[cand], kind="stable")[:max_arcs]]
+        print("  [i] Archi limitati ai top {} piu' percorsi (su {} candidati)".format(
+            max_arcs, len(cand)))
 
-    _excl = exclude_arcs or set()
+    # Colonne ordinate per (u, v)
+    u_ids = csr.node_ids[csr.arc_src[selected]]
+    v_ids = csr.node_ids[csr.indices[selected]]
+    selected = selected[np.lexsort((v_ids, u_ids))]
+    arc_list = csr.arc_pairs(selected)
+    n_arcs   = len(arc_list)
 
-    # Raccoglie tutti gli archi (non connettori, non esclusi) presenti in almeno un percorso
-    arc_set = set()
-    for path in od_paths_subset.values():
-        for u, v in zip(path[:-1], path[1:]):
-            if (u, v) in _excl:
-                continue
-            if G.has_edge(u, v) and not G[u][v].get("is_connector", False):
-                arc_set.add((u, v))
+    col_arc = np.full(csr.n_arcs, -1, dtype=np.int64)
+    col_arc[selected] = np.arange(n_arcs)
+    col  = col_arc[arcs]
+    keep = (col >= 0) & (len_arc[arcs] > 0)
+    D = csr_matrix((len_arc[arcs][keep], (paths.row_ids()[keep], col[keep])),
+                   shape=(n_od, n_arcs), dtype=np.float64)
+    D.sum_duplicates()
+    trace_info(D_shape=[n_od, n_arcs], D_nnz=int(D.nnz))
 
-    # Calcola copertura (km totali) per tutti gli archi candidati
-    arc_coverage = {}
-    for path in od_paths_subset.values():
-        for u, v in zip(path[:-1], path[1:]):
-            if (u, v) in arc_set:
-                length = G[u][v].get("length", 0.0) if G.has_edge(u, v) else 0.0
-                arc_coverage[(u, v)] = arc_coverage.get((u, v), 0.0) + length
+    return D, arc_list, od_order, arc_coverage
 
-    # Se richiesto, tieni solo i max_arcs piu' coperti (maggior volume totale)
-    if max_arcs and len(arc_set) > max_arcs:
-        top_arcs = sorted(arc_coverage, key=lambda a: arc_coverage[a], reverse=True)[:max_arcs]
-        arc_set = set(top_arcs)
-        print("  [i] Archi limitati ai top {} piu' percorsi (su {} candidati)".format(
-            max_arcs, len(arc_coverage)))
-
-    arc_list  = sorted(arc_set)
-    arc_index = {arc: j for j, arc in enumerate(arc_list)}
-    od_order  = list(od_paths_subset.keys())
-    n_od      = len(od_order)
-    n_arcs    = len(arc_list)
-
-    D = lil_matrix((n_od, n_arcs), dtype=np.float64)
-    for i, od_key in enumerate(od_order):
-        path = od_paths_subset[od_key]
-        for u, v in zip(path[:-1], path[1:]):
-            if not G.has_edge(u, v):
-                continue
-            edge = G[u][v]
-            if edge.get("is_connector", False):
-                continue
-            length = edge.get("length", 0.0)
-            if length > 0 and (u, v) in arc_index:
-                D[i, arc_index[(u, v)]] += length
 
-    return csr_matrix(D), arc_list, od_order, arc_coverage
+def arc_beta_bounds(arc_list, arc_initial_speeds, delta_v=20.0, v_min=10.0,
+                    v_max=150.0, delta_lower_pct=None, delta_upper_pct=None):
+    """
+    Bounds per arco in spazio beta (beta = 1/v), nell'ordine di arc_list.
+      - delta_lower_pct/delta_upper_pct forniti: bounds percentuali
+        v_lb = v0 * (1 - lower_pct/100),  v_ub = v0 * (1 + upper_pct/100)
+      - altrimenti (legacy): +- delta_v km/h assoluti
+    Garantisce lb < ub in modo stretto (richiesto da lsq_linear).
+    """
+    use_pct = (delta_lower_pct is not None and delta_upper_pct is not None)
+    EPS = 1e-6
+    v0 = np.array([arc_initial_speeds.get(arc, 50.0) for arc in arc_list], dtype=np.float64)
+    if use_pct:
+        lb = 1.0 / np.minimum(v0 * (1.0 + delta_upper_pct / 100.0), v_max)
+        ub = 1.0 / np.maximum(v0 * (1.0 - delta_lower_pct / 100.0), v_min)
+        print("  Bounds: percentuali (-{:.0f}% / +{:.0f}%)".format(delta_lower_pct, delta_upper_pct))
+    else:
+        lb = 1.0 / np.minimum(v0 + delta_v, v_max)
+        ub = 1.0 / np.maximum(v0 - delta_v, v_min)
+
+    # Garanzia lb < ub stretto
+    bad = lb >= ub - EPS
+    if np.any(bad):
+        lb[bad] = np.maximum(ub[bad] - EPS * 100, 0.0)
+        still_bad = lb >= ub - EPS
+        ub[still_bad] = lb[still_bad] + EPS * 100
+    return lb, ub
 
 
 def optimize_speeds_per_arc(D_sparse, T_obs, arc_list, arc_initial_speeds,
@@ -929,43 +1210,15 @@ def optimize_speeds_per_arc(D_sparse, T_obs, arc_list, arc_initial_speeds,
     from scipy.optimize import lsq_linear
     from scipy.sparse import issparse
 
-    use_pct = (delta_lower_pct is not None and delta_upper_pct is not None)
     DENSE_LIMIT = 4_000_000   # celle: se n_od*n_arcs <= 4M usa dense+bvls
 
     n_od, n_arcs = D_sparse.shape
     D_km    = D_sparse / 1000.0
     T_obs_h = T_obs / 60.0
 
-    # Bounds per arco in spazio beta (beta = 1/v)
-    EPS = 1e-6
-    if use_pct:
-        # Bounds percentuali: -lower% / +upper%
-        lb = np.array([
-            1.0 / min(arc_initial_speeds.get(arc, 50.0) * (1.0 + delta_upper_pct / 100.0), v_max)
-            for arc in arc_list
-        ], dtype=np.float64)
-        ub = np.array([
-            1.0 / max(arc_initial_speeds.get(arc, 50.0) * (1.0 - delta_lower_pct / 100.0), v_min)
-            for arc in arc_list
-        ], dtype=np.float64)
-        print("  Bounds: percentuali (-{:.0f}% / +{:.0f}%)".format(delta_lower_pct, delta_upper_pct))
-    else:
-        # Bounds assoluti (legacy) +- delta_v km/h
-        lb = np.array([
-            1.0 / min(arc_initial_speeds.get(arc, 50.0) + delta_v, v_max)
-            for arc in arc_list
-        ], dtype=np.float64)
-        ub = np.array([
-            1.0 / max(arc_initial_speeds.get(arc, 50.0) - delta_v, v_min)
-            for arc in arc_list
-        ], dtype=np.float64)
-
-    # Garanzia lb < ub stretto
-    bad = lb >= ub - EPS
-    if np.any(bad):
-        lb[bad] = np.maximum(ub[bad] - EPS * 100, 0.0)
-        still_bad = lb >= ub - EPS
-        ub[still_bad] = lb[still_bad] + EPS * 100
+    lb, ub = arc_beta_bounds(arc_list, arc_initial_speeds, delta_v=delta_v,
+                             v_min=v_min, v_max=v_max, delta_lower_pct=delta_lower_pct,
+                             delta_upper_pct=delta_upper_pct)
 
     # Scelta solver
     use_dense = (n_od * n_arcs <= DENSE_LIMIT)
@@ -991,6 +1244,9 @@ def optimize_speeds_per_arc(D_sparse, T_obs, arc_list, arc_initial_speeds,
         kwargs["lsq_solver"] = lsq_solver
 
     result = lsq_linear(D_solve, T_obs_h, **kwargs)
+    trace_count("solver_calls")
+    trace_count("solver_iterations", result.nit)
+    trace_count("solver_not_converged", int(result.status <= 0))
 
     beta = result.x
     speeds_opt = {arc: round(1.0 / max(beta[j], 1e-8), 2)
@@ -1013,6 +1269,143 @@ def optimize_speeds_per_arc(D_sparse, T_obs, arc_list, arc_initial_speeds,
     return speeds_opt, metrics
 
 
+def per_arc_matrix_mb(nnz, n_rows):
+    """Memoria stimata (MB) del problema globale: D, D scalata e trasposta in CSR."""
+    return 3 * (nnz * (8 + 4) + (n_rows + 1) * 8) / 1e6
+
+
+def solve_bounded_lsq_pg(A, b, lb, ub, x0, max_iter=300, tol=1e-4, trace_every=25):
+    """
+    min 0.5 ||A x - b||^2  con  lb <= x <= ub, gradiente proiettato accelerato
+    (FISTA con restart quando l'obiettivo cresce), passo 1/L con L = ||A||^2
+    stimato per power iteration. Parte da x0 (warm start).
+
+    Ritorna (x, trace, converged): trace = [(iter, obiettivo, passo_relativo)].
+    """
+    AT = A.T.tocsr()
+
+    # L = autovalore massimo di A^T A (power iteration, margine 5%)
+    v = np.random.RandomState(0).rand(A.shape[1])
+    L = 1.0
+    for _ in range(30):
+        w = AT @ (A @ v)
+        L = float(np.linalg.norm(w))
+        if L <= 0:
+            L = 1.0
+            break
+        v = w / L
+    L *= 1.05
+
+    x = np.clip(x0, lb, ub)
+    r = A @ x - b
+    f = 0.5 * float(r @ r)
+    y, t = x.copy(), 1.0
+    trace = [(0, f, float("nan"))]
+    converged = False
+    for k in range(1, max_iter + 1):
+        g = AT @ (A @ y - b)
+        x_new = np.clip(y - g / L, lb, ub)
+        r = A @ x_new - b
+        f_new = 0.5 * float(r @ r)
+        if f_new > f and t > 1.0:
+            # Restart: il momento ha fatto salire l'obiettivo, riparti da x
+            y, t = x.copy(), 1.0
+            continue
+        step = float(np.linalg.norm(x_new - x)) / max(float(np.linalg.norm(x)), 1e-12)
+        t_new = 0.5 * (1.0 + np.sqrt(1.0 + 4.0 * t * t))
+        y = x_new + ((t - 1.0) / t_new) * (x_new - x)
+        x, f, t = x_new, f_new, t_new
+        if k % trace_every == 0:
+            trace.append((k, f, step))
+        if step < tol:
+            converged = True
+            break
+    if trace[-1][0] != k:
+        trace.append((k, f, step))
+    return x, trace, converged
+
+
+def optimize_speeds_per_arc_global(D_sparse, T_obs, arc_list, arc_initial_speeds,
+                                   beta_warm=None, delta_v=20.0, v_min=10.0, v_max=150.0,
+                                   delta_lower_pct=None, delta_upper_pct=None,
+                                   method="pg", max_iter=300, tol=1e-4):
+    """
+    Ottimizzazione per-arco su TUTTI gli archi percorsi in un solo problema
+    (per_arc_solver "global"), stesso modello di optimize_speeds_per_arc:
+        T_od [h] = sum_j  D_j [km] * beta_j,   lb_j <= beta_j <= ub_j
+
+    Colonne scalate per norma (x_j = s_j * beta_j, s_j = ||D_j||): archi
+    molto e poco percorsi hanno lo stesso peso numerico e il passo del
+    gradiente non e' dominato dagli archi piu' lunghi.
+
+    Solver:
+      - "pg"  : gradiente proiettato accelerato, warm start da beta_warm
+                (beta della iterazione precedente, NaN = 1/v corrente)
+      - "trf" : lsq_linear trf + lsmr (partenza a freddo)
+
+    Ritorna (speeds_opt, metrics, beta): beta nell'ordine di arc_list.
+    """
+    from scipy.optimize import lsq_linear
+    from scipy.sparse import diags
+
+    n_od, n_arcs = D_sparse.shape
+    D_km    = (D_sparse / 1000.0).tocsr()
+    T_obs_h = T_obs / 60.0
+
+    lb, ub = arc_beta_bounds(arc_list, arc_initial_speeds, delta_v=delta_v,
+                             v_min=v_min, v_max=v_max, delta_lower_pct=delta_lower_pct,
+                             delta_upper_pct=delta_upper_pct)
+
+    # Scaling colonne: norma euclidea (archi senza km -> scala 1)
+    col_norm = np.sqrt(np.asarray(D_km.multiply(D_km).sum(axis=0)).ravel())
+    scale = np.where(col_norm > 0, col_norm, 1.0)
+    A = (D_km @ diags(1.0 / scale)).tocsr()
+
+    print("  Solver globale per-arco: {} OD x {} archi  ({} nnz, ~{:.0f} MB)  metodo={}".format(
+        n_od, n_arcs, D_km.nnz, per_arc_matrix_mb(D_km.nnz, n_od), method))
+
+    if method == "trf":
+        result = lsq_linear(A, T_obs_h, bounds=(lb * scale, ub * scale), method="trf",
+                            lsq_solver="lsmr", max_iter=max_iter, tol=tol, verbose=0)
+        x = result.x
+        trace = [(int(result.nit), float(result.cost), float("nan"))]
+        converged = result.status > 0
+    else:
+        beta0 = np.full(n_arcs, np.nan) if beta_warm is None else np.asarray(beta_warm, dtype=np.float64)
+        v_cur = np.array([arc_initial_speeds.get(arc, 50.0) for arc in arc_list], dtype=np.float64)
+        beta0 = np.where(np.isnan(beta0), 1.0 / v_cur, beta0)
+        n_warm = int(np.sum(~np.isnan(beta_warm))) if beta_warm is not None else 0
+        print("  Warm start: {} / {} archi dalla soluzione precedente".format(n_warm, n_arcs))
+        x, trace, converged = solve_bounded_lsq_pg(
+            A, T_obs_h, lb * scale, ub * scale, beta0 * scale, max_iter=max_iter, tol=tol)
+
+    # Traccia di convergenza (obiettivo come RMSE in minuti)
+    for it, f, step in trace:
+        print("    iter {:4d}: RMSE={:.4f} min{}".format(
+            it, np.sqrt(2.0 * f / max(n_od, 1)) * 60.0,
+            "" if np.isnan(step) else "  passo rel={:.2e}".format(step)))
+    print("  {} dopo {} iterazioni".format(
+        "[OK] Convergenza" if converged else "[!] Max iterazioni raggiunto", trace[-1][0]))
+    trace_count("solver_iterations", trace[-1][0])
+    trace_info(solver=method, solver_converged=bool(converged))
+
+    beta = np.clip(x / scale, lb, ub)
+    speeds_opt = {arc: round(1.0 / max(b, 1e-8), 2) for arc, b in zip(arc_list, beta.tolist())}
+
+    T_pred_min = np.asarray(D_km @ beta).ravel() * 60.0
+    metrics = compute_metrics(T_pred_min, T_obs)
+    metrics["n_od"]              = n_od
+    metrics["n_arcs_active"]     = n_arcs
+    metrics["solver_iterations"] = int(trace[-1][0])
+    metrics["solver_converged"]  = bool(converged)
+
+    print("  RMSE: {:.3f} min  |  MAE: {:.3f} min  |  "
+          "R2(origin): {:.4f}  |  slope: {:.4f}  |  MAPE: {:.2f}%".format(
+              metrics["rmse"], metrics["mae"], metrics["r2"],
+              metrics["slope"], metrics["mape"]))
+    return speeds_opt, metrics, beta
+
+
 def snap_arc_to_type(v_opt, v_orig, type_speeds, delta_v=20.0):
     """
     Trova il tipo ammissibile la cui velocita e' piu' vicina a v_opt.
@@ -1032,21 +1425,22 @@ def update_graph_types(G, arc_assignments, type_speeds, fix_connectors=True):
         arc_assignments : {(u, v): new_linktype}
         type_speeds     : {linktype: speed_kmh}
     """
-    updated = 0
-    for (u, v), new_lt in arc_assignments.items():
-        if not G.has_edge(u, v):
-            continue
-        data = G[u][v]
-        if fix_connectors and data.get("is_connector", False):
-            continue
-        length    = data.get("length", 0.0)
-        new_speed = type_speeds.get(new_lt, 50.0)
-        data["linktype"] = new_lt
-        data["v0prt"]    = new_speed
-        if length > 0:
-            data["t0"] = (length / 1000.0 / new_speed) * 60.0
-        updated += 1
-    return updated
+    store  = get_edge_store(G)
+    ids    = get_csr_graph(G).arc_ids_lookup(arc_assignments)
+    new_lt = np.fromiter(arc_assignments.values(), dtype=np.int64, count=len(ids))
+    new_speed = np.array([type_speeds.get(lt, 50.0) for lt in new_lt.tolist()],
+                         dtype=np.float64)
+    keep = ids >= 0
+    if fix_connectors:
+        keep[keep] = ~store["is_connector"][ids[keep]]
+    ids, new_lt, new_speed = ids[keep], new_lt[keep], new_speed[keep]
+
+    store.set("linktype", ids, new_lt)
+    store.set("v0prt", ids, new_speed)
+    length = store["length"][ids]
+    pos = length > 0
+    store.set("t0", ids[pos], (length[pos] / 1000.0 / new_speed[pos]) * 60.0)
+    return len(ids)
 
 
 def update_graph_arc_speeds(G, arc_opt_speeds, fix_connectors=True):
@@ -1056,19 +1450,18 @@ def update_graph_arc_speeds(G, arc_opt_speeds, fix_connectors=True):
     perdita di informazione dovuta allo snap al tipo piu' vicino.
         arc_opt_speeds : {(u, v): speed_kmh}  velocita' continua ottimale
     """
-    updated = 0
-    for (u, v), v_new in arc_opt_speeds.items():
-        if not G.has_edge(u, v):
-            continue
-        data = G[u][v]
-        if fix_connectors and data.get("is_connector", False):
-            continue
-        length = data.get("length", 0.0)
-        if length > 0 and v_new > 0:
-            data["v0prt"] = v_new
-            data["t0"]    = (length / 1000.0 / v_new) * 60.0
-            updated += 1
-    return updated
+    store = get_edge_store(G)
+    ids   = get_csr_graph(G).arc_ids_lookup(arc_opt_speeds)
+    v_new = np.fromiter(arc_opt_speeds.values(), dtype=np.float64, count=len(ids))
+    keep  = ids >= 0
+    if fix_connectors:
+        keep[keep] = ~store["is_connector"][ids[keep]]
+    keep[keep] = (store["length"][ids[keep]] > 0) & (v_new[keep] > 0)
+    ids, v_new = ids[keep], v_new[keep]
+
+    store.set("v0prt", ids, v_new)
+    store.set("t0", ids, (store["length"][ids] / 1000.0 / v_new) * 60.0)
+    return len(ids)
 
 
 def recompute_od_times_from_paths(G, od_paths):
@@ -1077,16 +1470,173 @@ def recompute_od_times_from_paths(G, od_paths):
     Nessun Dijkstra: O(n_od * lunghezza_media_percorso). Usato dopo aggiornamento
     velocita' per aggiornare gli errori senza dover rifare shortest path.
     """
-    od_times = {}
-    for od, path in od_paths.items():
-        t = 0.0
-        for u, v in zip(path[:-1], path[1:]):
-            if G.has_edge(u, v):
-                t += G[u][v].get("t0", 0.0)
-        od_times[od] = t
-    return od_times
+    paths = as_arc_paths(G, od_paths)
+    t0    = get_edge_store(G)["t0"]
+    t_od  = np.bincount(paths.row_ids(), weights=t0[paths.arcs], minlength=len(paths))
+    return dict(zip(paths.keys(), t_od.tolist()))
+
+
+def compute_fixed_arc_times(G, od_paths_subset, fixed_arcs):
+    """
+    Tempo (minuti) percorso su archi gia' ottimizzati (fixed_arcs, set di
+    tuple (u, v)) per ogni percorso, con la velocita' v0prt corrente.
+    Connettori esclusi. Ritorna np.ndarray nell'ordine dei percorsi.
+    """
+    csr   = get_csr_graph(G)
+    paths = as_arc_paths(G, od_paths_subset)
+    fixed = np.zeros(csr.n_arcs, dtype=bool)
+    fixed[csr.arc_ids_from_pairs(fixed_arcs)] = True
+    store = get_edge_store(G)
+    fixed &= ~store["is_connector"]
+
+    length_km = store["length"] / 1000.0
+    v_cur     = np.maximum(np.nan_to_num(store["v0prt"], nan=50.0), 1e-6)
+    t_arc     = np.where(fixed, (length_km / v_cur) * 60.0, 0.0)
+    return np.bincount(paths.row_ids(), weights=t_arc[paths.arcs], minlength=len(paths))
+
+
+# =============================================================================
+# CHECKPOINT E RIPRESA
+# =============================================================================
+
+# File scritto in output_dir a fine di ogni iterazione (config "checkpoint")
+CHECKPOINT_FILE = "optimization_checkpoint.npz"
+
+# Parametri che, se diversi tra checkpoint e ripresa, cambiano il risultato
+CHECKPOINT_CONFIG_KEYS = ("observed_times_csv", "sample_od_pairs", "random_seed",
+                          "od_sample_initial_frac", "od_sample_growth",
+                          "od_sample_grow_below_pct", "od_sample_time_bands",
+                          "observed_aggregation", "observed_time_dtype",
+                          "speed_min_kmh", "speed_max_kmh", "speed_delta_kmh",
+                          "speed_class_gap_kmh", "speed_delta_arc_kmh",
+                          "speed_delta_lower_pct", "speed_delta_upper_pct",
+                          "max_active_arcs", "fix_connector_t0", "per_arc_solver")
 
 
+def _graph_signature(G):
+    """Impronta della topologia (nodi + archi in ordine CSR)."""
+    csr = get_csr_graph(G)
+    h = hashlib.sha1(csr.node_ids.astype(np.int64).tobytes())
+    h.update(csr.arc_keys().astype(np.int64).tobytes())
+    return h.hexdigest()[:16]
+
+
+def checkpoint_path(config):
+    """Percorso del checkpoint da scrivere (None se disattivato o senza output_dir)."""
+    if not config.get("checkpoint", True) or not config.get("output_dir"):
+        return None
+    return Path(config["output_dir"]) / CHECKPOINT_FILE
+
+
+def save_checkpoint(path, G, mode, iteration, history, config, finished=False,
+                    already_optimized=None, n_pass=1, current_speeds=None,
+                    beta_warm=None, path_cache=None):
+    """
+    Salva lo stato a fine iterazione in un unico .npz (scrittura atomica):
+        t0, v0prt          : attributi per arco in ordine CSR (EdgeStore del grafo)
+        already_optimized  : id arco (per_arc)
+        beta_warm          : warm start del solver globale per id arco (per_arc)
+        path_codes/_hashes : PathRowCache.state() (percorsi cambiati in ripresa)
+        hist_<i>_obs/_pred : array privati di history (scatter plot)
+        state              : JSON con modo, iterazione, history, _n_pass,
+                             velocita per tipo (per_type), firma grafo e config
+    """
+    csr   = get_csr_graph(G)
+    store = get_edge_store(G)
+    arrays = {
+        "t0":    store["t0"],
+        "v0prt": store["v0prt"],
+        "already_optimized": np.sort(csr.arc_ids_from_pairs(already_optimized or ())),
+    }
+    if beta_warm is not None:
+        arrays["beta_warm"] = np.asarray(beta_warm, dtype=float)
+    if path_cache is not None and path_cache.state() is not None:
+        arrays["path_codes"], arrays["path_hashes"] = path_cache.state()
+    history_json = []
+    for i, h in enumerate(history):
+        for key, tag in (("_T_obs_arr", "obs"), ("_T_pred_arr", "pred")):
+            if h.get(key) is not None:
+                arrays["hist_{}_{}".format(i, tag)] = np.asarray(h[key])
+        history_json.append({k: v for k, v in h.items() if not k.startswith("_")})
+    state = {
+        "mode":           mode,
+        "iteration":      iteration,
+        "finished":       finished,
+        "n_pass":         n_pass,
+        "current_speeds": [[lt, v] for lt, v in (current_speeds or {}).items()],
+        "history":        history_json,
+        "graph":          _graph_signature(G),
+        "config":         {k: config.get(k) for k in CHECKPOINT_CONFIG_KEYS},
+    }
+    arrays["state"] = np.array(json.dumps(state, default=float))
+
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(path.stem + ".tmp.npz")
+    np.savez(tmp, **arrays)
+    os.replace(tmp, path)
+
+
+def restore_checkpoint(path, G, mode, config):
+    """
+    Carica un checkpoint di save_checkpoint, riporta t0/v0prt nel grafo e
+    ritorna lo stato: {iteration, finished, n_pass, history,
+    already_optimized (set di (u, v)), current_speeds, beta_warm e
+    path_hashes ((chiavi OD, hash) per PathRowCache.restore) o None}.
+    `path` puo' essere il file o la cartella output del run interrotto.
+    """
+    path = Path(path)
+    if path.is_dir():
+        path = path / CHECKPOINT_FILE
+    if not path.exists():
+        raise FileNotFoundError("Checkpoint non trovato: {}".format(path))
+
+    with np.load(path, allow_pickle=False) as data:
+        arrays = {k: data[k] for k in data.files}
+    state = json.loads(str(arrays["state"]))
+    if state["mode"] != mode:
+        raise ValueError("Checkpoint {} e' di modo '{}', non '{}'".format(
+            path, state["mode"], mode))
+    if state["graph"] != _graph_signature(G):
+        raise ValueError("Checkpoint {}: la rete non corrisponde (archi/nodi diversi)".format(path))
+    for key, value in state["config"].items():
+        if config.get(key) != value:
+            print("  [!] Checkpoint: '{}' era {!r}, ora {!r} - il risultato "
+                  "puo' differire dal run originale".format(key, value, config.get(key)))
+
+    # Stato del grafo: t0 per tutti gli archi, v0prt dove presente
+    csr   = get_csr_graph(G)
+    store = get_edge_store(G)
+    for attr in ("t0", "v0prt"):
+        ids = np.flatnonzero(~np.isnan(arrays[attr]))
+        store.set(attr, ids, arrays[attr][ids])
+
+    history = state["history"]
+    for i, h in enumerate(history):
+        for key, tag in (("_T_obs_arr", "obs"), ("_T_pred_arr", "pred")):
+            arr_key = "hist_{}_{}".format(i, tag)
+            if arr_key in arrays:
+                h[key] = arrays[arr_key]
+
+    print("  [OK] Ripresa da checkpoint {}: iterazione {} completata{}".format(
+        path, state["iteration"], ", run gia' terminato" if state["finished"] else ""))
+    return {
+        "iteration":         state["iteration"],
+        "finished":          state["finished"],
+        "n_pass":            state["n_pass"],
+        "history":           history,
+        "already_optimized": set(csr.arc_pairs(arrays["already_optimized"])),
+        "current_speeds":    {int(lt): v for lt, v in state["current_speeds"]},
+        "beta_warm":         arrays.get("beta_warm"),
+        "path_hashes":       ((arrays["path_codes"], arrays["path_hashes"])
+                              if "path_codes" in arrays else None),
+    }
+
+
+# =============================================================================
+# OTTIMIZZAZIONE ITERATIVA PER ARCO
+# =============================================================================
+
 def run_iterative_optimization_per_arc(G, centroid_ids, T_obs_dict, linktype_list, config):
     """
     Ottimizzazione iterativa con re-routing per singolo arco.
@@ -1099,6 +1649,19 @@ def run_iterative_optimization_per_arc(G, centroid_ids, T_obs_dict, linktype_lis
       5. Aggiorna grafo (linktype + T0)
       6. Ripete fino a convergenza (% archi riassegnati < soglia)
 
+    Con per_arc_solver "global" i passi 2-3 coinvolgono tutti gli archi
+    percorsi in un solo problema (optimize_speeds_per_arc_global, warm start
+    dal beta dell'iterazione precedente) invece dei top max_active_arcs
+    esclusi quelli gia' ottimizzati.
+
+    Con engine "csr" e incremental_reroute (default) il ricalcolo dei percorsi
+    dopo ogni BVLS usa IncrementalSkims: solo le origini interessate dagli
+    archi modificati rifanno Dijkstra (vedi csr_graph.py).
+
+    A fine iterazione lo stato (velocita per arco, archi gia' ottimizzati,
+    _n_pass, history) viene salvato in output_dir/optimization_checkpoint.npz;
+    con "resume_from" il run riparte dall'ultima iterazione completata.
+
     Ritorna:
         best_arc_assignments : {(u,v): linktype}
         type_speeds          : {linktype: speed_kmh}  (velocita originali tipi)
@@ -1115,15 +1678,25 @@ def run_iterative_optimization_per_arc(G, centroid_ids, T_obs_dict, linktype_lis
     delta_upper_pct = config.get("speed_delta_upper_pct", None)  # % aumento   (20 = +20%)
     fix_conn    = config.get("fix_connector_t0", True)
     max_arcs    = config.get("max_active_arcs", 500)
+    global_solver = config.get("per_arc_solver", "batched") == "global"
+    global_method = config.get("global_solver_method", "pg")
+    global_iter   = config.get("global_max_iter", 300)
+    global_tol    = config.get("global_tol", 1e-4)
+    global_mb     = config.get("global_memory_mb", 2048)
     od_frac_cfg = config.get("od_error_frac", None)   # non usato, ignorato
     slope_min   = config.get("slope_target_min", 0.9)
     slope_max   = config.get("slope_target_max", 1.1)
     r2_target   = config.get("r2_target", 0.9)
+    engine      = config.get("skim_engine", "csr")
+    n_workers   = config.get("n_workers", 1)
+    incremental = engine == "csr" and config.get("incremental_reroute", True)
+    radius      = origin_time_radius(T_obs_dict, config.get("target_radius_slack", 1.5))
 
     od_pairs    = list(T_obs_dict.keys())
     type_speeds = get_initial_speeds_from_graph(G, linktype_list)
 
     # Velocita iniziali per singolo arco (da V0PRT o dal tipo)
+    sync_edge_view(G)
     arc_initial_speeds = {}
     for u, v, data in G.edges(data=True):
         if data.get("is_connector", False):
@@ -1143,6 +1716,25 @@ def run_iterative_optimization_per_arc(G, centroid_ids, T_obs_dict, linktype_lis
     history = []
     od_filter = set(od_pairs)
 
+    # Checkpoint: lo stato del grafo viene ripristinato prima del primo skim
+    ckpt_path = checkpoint_path(config)
+    resumed   = None
+    if config.get("resume_from"):
+        resumed = restore_checkpoint(config["resume_from"], G, "per_arc", config)
+
+    # Skim incrementale: stato per origine conservato tra le iterazioni
+    skimmer = None
+    if incremental:
+        skimmer = IncrementalSkims(G, centroid_ids, weight="t0", od_filter=od_filter,
+                                   n_workers=n_workers, target_radius=radius)
+
+    def _skims():
+        if skimmer is not None:
+            return skimmer.compute(verbose=True)
+        return compute_od_skims(G, centroid_ids, verbose=True, od_filter=od_filter,
+                                engine=engine, n_workers=n_workers,
+                                target_radius=radius)
+
     # ------------------------------------------------------------------ #
     # LOG FILE: Tee su file - stesso contenuto della console               #
     # Checkpoint (close+reopen) a fine di ogni iterazione                  #
@@ -1151,11 +1743,11 @@ def run_iterative_optimization_per_arc(G, centroid_ids, T_obs_dict, linktype_lis
 
     class _TeeLogger:
         """Specchia sys.stdout su file. checkpoint() chiude e riapre (flush disco)."""
-        def __init__(self, orig, path):
+        def __init__(self, orig, path, mode="w"):
             self._orig = orig
             self._path = path
             Path(path).parent.mkdir(parents=True, exist_ok=True)
-            self._fh = open(path, "w", encoding="utf-8")
+            self._fh = open(path, mode, encoding="utf-8")
         def write(self, msg):
             self._orig.write(msg)
             self._fh.write(msg)
@@ -1174,21 +1766,88 @@ def run_iterative_optimization_per_arc(G, centroid_ids, T_obs_dict, linktype_lis
     _tee = None
     if _out_dir:
         _log_path = str(Path(_out_dir) / "optimization_log.txt")
-        _tee = _TeeLogger(_sys.stdout, _log_path)
+        # In ripresa il log del run interrotto viene continuato
+        _tee = _TeeLogger(_sys.stdout, _log_path, mode="a" if resumed else "w")
         _sys.stdout = _tee
 
     def _log_checkpoint():
         if _tee is not None:
             _tee.checkpoint()
 
+    def _save_checkpoint(iteration, finished=False):
+        if ckpt_path is not None:
+            save_checkpoint(ckpt_path, G, "per_arc", iteration, history, config,
+                            finished=finished, already_optimized=already_optimized,
+                            n_pass=_n_pass, beta_warm=beta_warm, path_cache=path_cache)
+
+    # Hash dei percorsi dell'iterazione precedente (percorsi cambiati)
+    path_cache = PathRowCache()
+    if resumed and resumed["path_hashes"] is not None:
+        path_cache.restore(*resumed["path_hashes"])
+
+    # Warm start del solver globale: beta per id arco CSR (NaN = mai risolto)
+    beta_warm = np.full(get_csr_graph(G).n_arcs, np.nan)
+    if resumed and resumed["beta_warm"] is not None:
+        beta_warm[:] = resumed["beta_warm"]
+
+    def _solve_global(full_paths):
+        # Tutti gli archi percorsi in un solo problema (entro global_memory_mb)
+        paths  = as_arc_paths(G, full_paths)
+        n_rows = len(paths)
+        est_mb = per_arc_matrix_mb(len(paths.arcs), n_rows)
+        if global_mb and est_mb > global_mb:
+            n_keep = max(int(n_rows * global_mb / est_mb), 1)
+            rows = np.sort(np.random.RandomState(config.get("random_seed", 42))
+                           .permutation(n_rows)[:n_keep])
+            keys  = list(paths)
+            paths = paths.subset([keys[i] for i in rows.tolist()])
+            print("  [i] Budget memoria {} MB (stima {:.0f} MB): {} / {} OD nel problema".format(
+                global_mb, est_mb, n_keep, n_rows))
+
+        D_glob, arc_list, od_order, _ = build_composition_matrix_per_arc(G, paths)
+        if not arc_list:
+            return {}, [], None
+
+        # Connettori esclusi da D: il loro tempo (fisso) e' tolto dal target
+        store  = get_edge_store(G)
+        t_conn = np.where(store["is_connector"], store["t0"], 0.0)
+        t_fixed = np.bincount(paths.row_ids(), weights=t_conn[paths.arcs], minlength=len(paths))
+        T_target = np.maximum(np.array([T_obs_dict[od] for od in od_order]) - t_fixed, 0.01)
+        _sys.stdout.flush()
+
+        ids = get_csr_graph(G).arc_ids_lookup(arc_list)
+        speeds, metrics, beta = optimize_speeds_per_arc_global(
+            D_glob, T_target, arc_list, arc_initial_speeds, beta_warm=beta_warm[ids],
+            delta_v=delta_v, v_min=v_min, v_max=v_max,
+            delta_lower_pct=delta_lower_pct, delta_upper_pct=delta_upper_pct,
+            method=global_method, max_iter=global_iter, tol=global_tol)
+        beta_warm[ids] = beta
+        return speeds, arc_list, metrics
+
+    def _snap_assignments():
+        # Snap di ogni arco al tipo piu' vicino (solo per report)
+        v_cur = get_edge_store(G)["v0prt"][
+            get_csr_graph(G).arc_ids_lookup(arc_initial_speeds)].tolist()
+        for (u, v), v_c, v_orig in zip(arc_initial_speeds, v_cur, arc_initial_speeds.values()):
+            if not np.isnan(v_c):
+                new_lt, _ = snap_arc_to_type(v_c, v_orig, type_speeds, delta_v)
+                best_arc_assignments[(u, v)] = new_lt
+
     print("\n" + "=" * 70)
-    print("OTTIMIZZAZIONE PER ARCO - archi disgiunti tra iterazioni")
+    if global_solver:
+        print("OTTIMIZZAZIONE PER ARCO - problema globale su tutti gli archi percorsi")
+    else:
+        print("OTTIMIZZAZIONE PER ARCO - archi disgiunti tra iterazioni")
     print("=" * 70)
     if delta_lower_pct is not None and delta_upper_pct is not None:
         print("  Bounds arco:    -{:.0f}% / +{:.0f}%".format(delta_lower_pct, delta_upper_pct))
     else:
         print("  delta_v arco:   +- {:.1f} km/h".format(delta_v))
-    print("  max archi/iter: {}".format(max_arcs))
+    if global_solver:
+        print("  solver globale: {} (max {} iter, tol {:g}, budget {} MB)".format(
+            global_method, global_iter, global_tol, global_mb))
+    else:
+        print("  max archi/iter: {}".format(max_arcs))
     print("  n_iterations:   {}".format(n_iter))
     print("  Archi ottimizzabili: {}".format(len(arc_initial_speeds)))
     print("\nVelocita tipi:")
@@ -1199,12 +1858,14 @@ def run_iterative_optimization_per_arc(G, centroid_ids, T_obs_dict, linktype_lis
     # ERRORE INIZIALE                                                      #
     # ------------------------------------------------------------------ #
     print("\n" + "-" * 50)
-    print("ERRORE INIZIALE (V0PRT originale)")
+    if resumed:
+        print("RIPRESA DA CHECKPOINT (iterazione {} completata)".format(resumed["iteration"]))
+    else:
+        print("ERRORE INIZIALE (V0PRT originale)")
     print("-" * 50)
     _sys.stdout.flush()
 
-    od_times, od_paths = compute_od_skims(
-        G, centroid_ids, verbose=True, od_filter=od_filter)
+    od_times, od_paths = _skims()
 
     valid_ods_all = [(od, T_obs_dict[od]) for od in od_pairs if od in od_paths]
     if not valid_ods_all:
@@ -1212,194 +1873,216 @@ def run_iterative_optimization_per_arc(G, centroid_ids, T_obs_dict, linktype_lis
         if _tee is not None:
             _sys.stdout = _tee._orig
             _tee.restore()
+        sync_edge_view(G)
         return best_arc_assignments, type_speeds, history
 
-    # Errori iniziali
-    od_errors = {od: abs(od_times[od] - T_obs_dict[od]) for od, _ in valid_ods_all}
-    T_obs_arr0  = np.array([t for _, t in valid_ods_all])
-    T_pred_arr0 = np.array([od_times[od] for od, _ in valid_ods_all])
-    m0 = compute_metrics(T_pred_arr0, T_obs_arr0)
-    print("  Coppie OD valide: {} / {}".format(len(valid_ods_all), len(od_pairs)))
-    print("  RMSE: {:.3f} min  |  MAE: {:.3f} min  |  "
-          "R2(origin): {:.4f}  |  slope: {:.4f}  |  MAPE: {:.2f}%".format(
-              m0["rmse"], m0["mae"], m0["r2"], m0["slope"], m0["mape"]))
-    history.append({"iteration": 0, "sub_cycle": 0, "label": "initial",
-                    "n_od_used": len(valid_ods_all),
-                    "max_rel_change_pct": 0.0,
-                    "metrics": m0,
-                    "_T_obs_arr": T_obs_arr0,
-                    "_T_pred_arr": T_pred_arr0})
-
-    print("  OD validi per BVLS: {}".format(len(valid_ods_all)))
-    _log_checkpoint()
-
     # Archi gia' ottimizzati nelle iterazioni precedenti (persistente)
     already_optimized = set()
     _n_pass = 1   # numero del passaggio corrente (reset counter)
+    start_iter = 1
+
+    if resumed:
+        history           = resumed["history"]
+        already_optimized = resumed["already_optimized"]
+        _n_pass           = resumed["n_pass"]
+        start_iter        = n_iter + 1 if resumed["finished"] else resumed["iteration"] + 1
+        if resumed["iteration"] > 0:
+            _snap_assignments()
+        print("  Coppie OD valide: {} / {}  |  archi gia' ottimizzati: {}  |  passaggio {}".format(
+            len(valid_ods_all), len(od_pairs), len(already_optimized), _n_pass))
+    else:
+        # Errori iniziali
+        od_errors = {od: abs(od_times[od] - T_obs_dict[od]) for od, _ in valid_ods_all}
+        T_obs_arr0  = np.array([t for _, t in valid_ods_all])
+        T_pred_arr0 = np.array([od_times[od] for od, _ in valid_ods_all])
+        m0 = compute_metrics(T_pred_arr0, T_obs_arr0)
+        print("  Coppie OD valide: {} / {}".format(len(valid_ods_all), len(od_pairs)))
+        print("  RMSE: {:.3f} min  |  MAE: {:.3f} min  |  "
+              "R2(origin): {:.4f}  |  slope: {:.4f}  |  MAPE: {:.2f}%".format(
+                  m0["rmse"], m0["mae"], m0["r2"], m0["slope"], m0["mape"]))
+        history.append({"iteration": 0, "sub_cycle": 0, "label": "initial",
+                        "n_od_used": len(valid_ods_all),
+                        "max_rel_change_pct": 0.0,
+                        "metrics": m0,
+                        "_T_obs_arr": T_obs_arr0,
+                        "_T_pred_arr": T_pred_arr0})
+
+    print("  OD validi per BVLS: {}".format(len(valid_ods_all)))
+    _log_checkpoint()
 
     # ------------------------------------------------------------------ #
     # LOOP PRINCIPALE                                                      #
     # ------------------------------------------------------------------ #
-    for iteration in range(1, n_iter + 1):
-        print("\n" + "=" * 60)
-        print("ITERAZIONE {} / {}".format(iteration, n_iter))
-        print("=" * 60)
-        _sys.stdout.flush()
+    for iteration in range(start_iter, n_iter + 1):
+        with stage_timer("iteration", iteration=iteration):
+            print("\n" + "=" * 60)
+            print("ITERAZIONE {} / {}".format(iteration, n_iter))
+            print("=" * 60)
+            _sys.stdout.flush()
+
+            # -------------------------------------------------------------- #
+            # BVLS su top max_arcs piu' percorsi, esclusi quelli gia'         #
+            # ottimizzati nelle iterazioni precedenti.                        #
+            # -------------------------------------------------------------- #
+            if not od_paths:
+                print("  [!] Nessun percorso disponibile - skip iterazione")
+                continue
 
-        # -------------------------------------------------------------- #
-        # BVLS su top max_arcs piu' percorsi, esclusi quelli gia'         #
-        # ottimizzati nelle iterazioni precedenti.                        #
-        # -------------------------------------------------------------- #
-        if not od_paths:
-            print("  [!] Nessun percorso disponibile - skip iterazione")
-            continue
+            full_paths = select_paths(od_paths, [od for od in od_pairs if od in od_paths])
+            if not full_paths:
+                print("  [!] Nessun percorso valido - skip iterazione")
+                continue
 
-        full_paths = {od: od_paths[od] for od in od_pairs if od in od_paths}
-        if not full_paths:
-            print("  [!] Nessun percorso valido - skip iterazione")
-            continue
+            # Diagnostica di convergenza: quota di OD con percorso cambiato
+            full_paths = as_arc_paths(G, full_paths)
+            _, changed = path_cache.update(full_paths, None)
+            paths_changed_pct = round(100.0 * changed.mean(), 3)
+            print("  Percorsi cambiati: {:.1f}% ({} / {} OD)".format(
+                paths_changed_pct, int(changed.sum()), len(changed)))
+
+            solve_metrics = None
+            if global_solver:
+                arc_opt_speeds, arc_list_iter, solve_metrics = _solve_global(full_paths)
+                if not arc_list_iter:
+                    print("  [!] Nessun arco da ottimizzare - stop.")
+                    _save_checkpoint(iteration - 1, finished=True)
+                    _log_checkpoint()
+                    break
+            else:
+                print("  Archi gia' ottimizzati (esclusi): {}".format(len(already_optimized)))
+
+                D_iter, arc_list_iter, od_order_iter, _ = build_composition_matrix_per_arc(
+                    G, full_paths,
+                    max_arcs=max_arcs,
+                    exclude_arcs=already_optimized)
+
+                if len(arc_list_iter) == 0:
+                    print("  [!] Nessun arco rimasto da ottimizzare - reset e ricomincia (passaggio {})".format(_n_pass))
+                    already_optimized = set()
+                    _n_pass += 1
+                    D_iter, arc_list_iter, od_order_iter, _ = build_composition_matrix_per_arc(
+                        G, full_paths, max_arcs=max_arcs, exclude_arcs=already_optimized)
+                    if len(arc_list_iter) == 0:
+                        print("  [!] Nessun arco disponibile neanche dopo il reset - stop.")
+                        _save_checkpoint(iteration - 1, finished=True)
+                        _log_checkpoint()
+                        break
+                    print("  Reset OK: {} archi nel passaggio {}.".format(len(arc_list_iter), _n_pass))
+
+                # Target BVLS = T_obs - contributo degli archi gia' ottimizzati (beta fisso).
+                # Questo porta il BVLS a ottimizzare i beta attivi rispetto al *residuo*
+                # corretto, tenendo conto di tutti gli archi nella funzione obiettivo.
+                T_obs_raw_bvls = np.array([T_obs_dict[od] for od in od_order_iter])
+                if already_optimized:
+                    t_fixed = compute_fixed_arc_times(G, full_paths, already_optimized)  # minuti
+                    T_obs_iter_bvls = np.maximum(T_obs_raw_bvls - t_fixed, 0.01)
+                    pct_fisso = 100.0 * t_fixed.mean() / max(T_obs_raw_bvls.mean(), 1e-6)
+                    print("  T_target=T_obs-T_fisso: {:.1f}% rimosso da archi congelati"
+                          "  (residuo medio {:.3f} min)".format(pct_fisso, T_obs_iter_bvls.mean()))
+                else:
+                    T_obs_iter_bvls = T_obs_raw_bvls
+
+                print("  BVLS: {} OD x {} archi".format(len(od_order_iter), len(arc_list_iter)))
+                _sys.stdout.flush()
+
+                arc_opt_speeds, _ = optimize_speeds_per_arc(
+                    D_iter, T_obs_iter_bvls, arc_list_iter, arc_initial_speeds,
+                    delta_v=delta_v, v_min=v_min, v_max=v_max,
+                    delta_lower_pct=delta_lower_pct, delta_upper_pct=delta_upper_pct)
+
+            update_graph_arc_speeds(G, arc_opt_speeds, fix_connectors=fix_conn)
+
+            # Registra archi ottimizzati in questo giro
+            already_optimized.update(arc_list_iter)
+
+            total_arcs_touched = len(arc_list_iter)
+            total_reassigned = sum(
+                1 for arc in arc_list_iter
+                if abs(arc_opt_speeds.get(arc, arc_initial_speeds.get(arc, 50.0))
+                       - arc_initial_speeds.get(arc, 50.0)) > 0.5)
+            print("  Archi modificati (>0.5 km/h): {} / {}".format(
+                total_reassigned, total_arcs_touched))
+
+            # Metrica veloce (percorsi fissi, senza Dijkstra)
+            od_times_fast_all = recompute_od_times_from_paths(G, od_paths)
+            valid_fast = [(od, T_obs_dict[od]) for od in od_pairs
+                          if od in od_times_fast_all and od in od_paths]
+            if valid_fast:
+                T_obs_fast  = np.array([t for _, t in valid_fast])
+                T_pred_fast = np.array([od_times_fast_all[od] for od, _ in valid_fast])
+                m_fast = compute_metrics(T_pred_fast, T_obs_fast)
+                print("  Metrica FAST (percorsi fissi): RMSE={:.3f}  slope={:.4f}  R2={:.4f}".format(
+                    m_fast["rmse"], m_fast["slope"], m_fast["r2"]))
+            _sys.stdout.flush()
+
+            # ---- Fine sub-cycles: Dijkstra completo per rotta ----
+            _sys.stdout.flush()
+            print("  Ricalcolo percorsi ({})...".format(
+                "Dijkstra incrementale" if skimmer is not None else "Dijkstra completo"))
+            od_times, od_paths = _skims()
+
+            valid_ods_all = [(od, T_obs_dict[od]) for od in od_pairs if od in od_paths]
+            if not valid_ods_all:
+                print("  [!] Nessuna coppia OD valida - uscita anticipata")
+                break
 
-        print("  Archi gia' ottimizzati (esclusi): {}".format(len(already_optimized)))
-
-        D_iter, arc_list_iter, od_order_iter, _ = build_composition_matrix_per_arc(
-            G, full_paths,
-            max_arcs=max_arcs,
-            exclude_arcs=already_optimized)
-
-        if len(arc_list_iter) == 0:
-            print("  [!] Nessun arco rimasto da ottimizzare - reset e ricomincia (passaggio {})".format(_n_pass))
-            already_optimized = set()
-            _n_pass += 1
-            D_iter, arc_list_iter, od_order_iter, _ = build_composition_matrix_per_arc(
-                G, full_paths, max_arcs=max_arcs, exclude_arcs=already_optimized)
-            if len(arc_list_iter) == 0:
-                print("  [!] Nessun arco disponibile neanche dopo il reset - stop.")
+            T_obs_iter  = np.array([t for _, t in valid_ods_all])
+            T_pred_iter = np.array([od_times[od] for od, _ in valid_ods_all])
+            m_iter = compute_metrics(T_pred_iter, T_obs_iter)
+            od_errors = {od: abs(od_times[od] - T_obs_dict[od]) for od, _ in valid_ods_all}
+
+            # Snap finale per aggiornare best_arc_assignments (solo per report)
+            _snap_assignments()
+
+            print("  RMSE: {:.3f} min  |  MAE: {:.3f} min  |  "
+                  "R2(origin): {:.4f}  |  slope: {:.4f}  |  MAPE: {:.2f}%".format(
+                      m_iter["rmse"], m_iter["mae"], m_iter["r2"],
+                      m_iter["slope"], m_iter["mape"]))
+            print("  Archi modificati: {} / {}  |  Totale ottimizzati: {}".format(
+                total_reassigned, total_arcs_touched, len(already_optimized)))
+
+            history.append({
+                "iteration": iteration,
+                "n_od_used": len(valid_ods_all),
+                "origins_skipped": skimmer.last_stats.get("origins_skipped", 0)
+                                   if skimmer is not None else 0,
+                "arcs_this_iter": total_arcs_touched,
+                "arcs_modified": total_reassigned,
+                "arcs_optimized_total": len(already_optimized),
+                "max_rel_change_pct": round(total_reassigned / max(total_arcs_touched, 1) * 100, 3),
+                "paths_changed_pct": paths_changed_pct,
+                "metrics": m_iter,
+                "_T_obs_arr": T_obs_iter,
+                "_T_pred_arr": T_pred_iter,
+            })
+            if solve_metrics is not None:
+                history[-1]["solver_iterations"] = solve_metrics["solver_iterations"]
+                history[-1]["solver_converged"]  = solve_metrics["solver_converged"]
+
+            # Convergenza su slope e R2
+            slope_ok = slope_min <= m_iter["slope"] <= slope_max
+            r2_ok    = m_iter["r2"] >= r2_target
+            if slope_ok and r2_ok:
+                print("  [OK] CONVERGENZA: slope={:.4f} in [{:.2f},{:.2f}]  R2={:.4f} >= {:.2f}".format(
+                    m_iter["slope"], slope_min, slope_max, m_iter["r2"], r2_target))
+                _save_checkpoint(iteration, finished=True)
                 _log_checkpoint()
                 break
-            print("  Reset OK: {} archi nel passaggio {}.".format(len(arc_list_iter), _n_pass))
-
-        # Target BVLS = T_obs - contributo degli archi gia' ottimizzati (beta fisso).
-        # Questo porta il BVLS a ottimizzare i beta attivi rispetto al *residuo*
-        # corretto, tenendo conto di tutti gli archi nella funzione obiettivo.
-        T_obs_raw_bvls = np.array([T_obs_dict[od] for od in od_order_iter])
-        if already_optimized:
-            t_fixed = np.zeros(len(od_order_iter), dtype=np.float64)
-            for i_od, od in enumerate(od_order_iter):
-                path = full_paths.get(od, [])
-                for u, v in zip(path[:-1], path[1:]):
-                    if (u, v) in already_optimized and G.has_edge(u, v):
-                        edge = G[u][v]
-                        if edge.get("is_connector", False):
-                            continue
-                        length_km = edge.get("length", 0.0) / 1000.0
-                        v_cur = max(edge.get("v0prt", 50.0), 1e-6)
-                        t_fixed[i_od] += (length_km / v_cur) * 60.0  # minuti
-            T_obs_iter_bvls = np.maximum(T_obs_raw_bvls - t_fixed, 0.01)
-            pct_fisso = 100.0 * t_fixed.mean() / max(T_obs_raw_bvls.mean(), 1e-6)
-            print("  T_target=T_obs-T_fisso: {:.1f}% rimosso da archi congelati"
-                  "  (residuo medio {:.3f} min)".format(pct_fisso, T_obs_iter_bvls.mean()))
-        else:
-            T_obs_iter_bvls = T_obs_raw_bvls
-
-        print("  BVLS: {} OD x {} archi".format(len(od_order_iter), len(arc_list_iter)))
-        _sys.stdout.flush()
-
-        arc_opt_speeds, _ = optimize_speeds_per_arc(
-            D_iter, T_obs_iter_bvls, arc_list_iter, arc_initial_speeds,
-            delta_v=delta_v, v_min=v_min, v_max=v_max,
-            delta_lower_pct=delta_lower_pct, delta_upper_pct=delta_upper_pct)
-
-        update_graph_arc_speeds(G, arc_opt_speeds, fix_connectors=fix_conn)
-
-        # Registra archi ottimizzati in questo giro
-        already_optimized.update(arc_list_iter)
-
-        total_arcs_touched = len(arc_list_iter)
-        total_reassigned = sum(
-            1 for arc in arc_list_iter
-            if abs(arc_opt_speeds.get(arc, arc_initial_speeds.get(arc, 50.0))
-                   - arc_initial_speeds.get(arc, 50.0)) > 0.5)
-        print("  Archi modificati (>0.5 km/h): {} / {}".format(
-            total_reassigned, total_arcs_touched))
-
-        # Metrica veloce (percorsi fissi, senza Dijkstra)
-        od_times_fast_all = recompute_od_times_from_paths(G, od_paths)
-        valid_fast = [(od, T_obs_dict[od]) for od in od_pairs
-                      if od in od_times_fast_all and od in od_paths]
-        if valid_fast:
-            T_obs_fast  = np.array([t for _, t in valid_fast])
-            T_pred_fast = np.array([od_times_fast_all[od] for od, _ in valid_fast])
-            m_fast = compute_metrics(T_pred_fast, T_obs_fast)
-            print("  Metrica FAST (percorsi fissi): RMSE={:.3f}  slope={:.4f}  R2={:.4f}".format(
-                m_fast["rmse"], m_fast["slope"], m_fast["r2"]))
-        _sys.stdout.flush()
-
-        # ---- Fine sub-cycles: Dijkstra completo per rotta ----
-        _sys.stdout.flush()
-        print("  Ricalcolo percorsi (Dijkstra completo)...")
-        od_times, od_paths = compute_od_skims(
-            G, centroid_ids, verbose=True, od_filter=od_filter)
-
-        valid_ods_all = [(od, T_obs_dict[od]) for od in od_pairs if od in od_paths]
-        if not valid_ods_all:
-            print("  [!] Nessuna coppia OD valida - uscita anticipata")
-            break
-
-        T_obs_iter  = np.array([t for _, t in valid_ods_all])
-        T_pred_iter = np.array([od_times[od] for od, _ in valid_ods_all])
-        m_iter = compute_metrics(T_pred_iter, T_obs_iter)
-        od_errors = {od: abs(od_times[od] - T_obs_dict[od]) for od, _ in valid_ods_all}
-
-        # Snap finale per aggiornare best_arc_assignments (solo per report)
-        for u, v, data in G.edges(data=True):
-            if data.get("is_connector", False):
-                continue
-            v_cur  = data.get("v0prt", None)
-            v_orig = arc_initial_speeds.get((u, v), None)
-            if v_cur is not None and v_orig is not None:
-                new_lt, _ = snap_arc_to_type(v_cur, v_orig, type_speeds, delta_v)
-                best_arc_assignments[(u, v)] = new_lt
-
-        print("  RMSE: {:.3f} min  |  MAE: {:.3f} min  |  "
-              "R2(origin): {:.4f}  |  slope: {:.4f}  |  MAPE: {:.2f}%".format(
-                  m_iter["rmse"], m_iter["mae"], m_iter["r2"],
-                  m_iter["slope"], m_iter["mape"]))
-        print("  Archi modificati: {} / {}  |  Totale ottimizzati: {}".format(
-            total_reassigned, total_arcs_touched, len(already_optimized)))
-
-        history.append({
-            "iteration": iteration,
-            "n_od_used": len(valid_ods_all),
-            "arcs_this_iter": total_arcs_touched,
-            "arcs_modified": total_reassigned,
-            "arcs_optimized_total": len(already_optimized),
-            "max_rel_change_pct": round(total_reassigned / max(total_arcs_touched, 1) * 100, 3),
-            "metrics": m_iter,
-            "_T_obs_arr": T_obs_iter,
-            "_T_pred_arr": T_pred_iter,
-        })
-
-        # Convergenza su slope e R2
-        slope_ok = slope_min <= m_iter["slope"] <= slope_max
-        r2_ok    = m_iter["r2"] >= r2_target
-        if slope_ok and r2_ok:
-            print("  [OK] CONVERGENZA: slope={:.4f} in [{:.2f},{:.2f}]  R2={:.4f} >= {:.2f}".format(
-                m_iter["slope"], slope_min, slope_max, m_iter["r2"], r2_target))
-            _log_checkpoint()
-            break
-        else:
-            missing = []
-            if not slope_ok:
-                missing.append("slope={:.4f} fuori [{:.2f},{:.2f}]".format(
-                    m_iter["slope"], slope_min, slope_max))
-            if not r2_ok:
-                missing.append("R2={:.4f} < {:.2f}".format(m_iter["r2"], r2_target))
-            print("  [..] Non convergito: {}".format(" | ".join(missing)))
-            _log_checkpoint()
+            else:
+                missing = []
+                if not slope_ok:
+                    missing.append("slope={:.4f} fuori [{:.2f},{:.2f}]".format(
+                        m_iter["slope"], slope_min, slope_max))
+                if not r2_ok:
+                    missing.append("R2={:.4f} < {:.2f}".format(m_iter["r2"], r2_target))
+                print("  [..] Non convergito: {}".format(" | ".join(missing)))
+                _save_checkpoint(iteration)
+                _log_checkpoint()
 
     if _tee is not None:
         _sys.stdout = _tee._orig
         _tee.restore()
+    sync_edge_view(G)
     return best_arc_assignments, type_speeds, history
 
 
@@ -1412,6 +2095,7 @@ def run_iterative_optimization(G, centroid_ids, T_obs_dict, linktype_list,
     """
     Ottimizzazione iterativa con re-routing (tipo Frank-Wolfe).
     Bounds di velocita: +-delta_v km/h dall'iniziale, ordinamento classi preservato.
+    Checkpoint a fine iterazione e ripresa con "resume_from" come in per_arc.
     """
     n_iter      = config.get("n_iterations", 10)
     conv_thresh = config.get("convergence_threshold", 0.005)
@@ -1423,8 +2107,12 @@ def run_iterative_optimization(G, centroid_ids, T_obs_dict, linktype_list,
     slope_min   = config.get("slope_target_min", 0.9)
     slope_max   = config.get("slope_target_max", 1.1)
     r2_target   = config.get("r2_target", 0.9)
+    engine      = config.get("skim_engine", "csr")
+    n_workers   = config.get("n_workers", 1)
+    slack       = config.get("target_radius_slack", 1.5)
 
-    od_pairs = list(T_obs_dict.keys())
+    # Campione OD coarse-to-fine (tutte le coppie senza od_sample_initial_frac)
+    sampler = ODSampleSchedule(T_obs_dict, config)
 
     initial_speeds = get_initial_speeds_from_graph(G, linktype_list)
 
@@ -1437,6 +2125,20 @@ def run_iterative_optimization(G, centroid_ids, T_obs_dict, linktype_list,
     current_speeds = dict(initial_speeds)  # copia
     history = []
 
+    ckpt_path  = checkpoint_path(config)
+    start_iter = 1
+    resumed    = None
+    if config.get("resume_from"):
+        resumed = restore_checkpoint(config["resume_from"], G, "per_type", config)
+        history = resumed["history"]
+        if resumed["current_speeds"]:
+            current_speeds = resumed["current_speeds"]
+        start_iter = n_iter + 1 if resumed["finished"] else resumed["iteration"] + 1
+        sampler.resume(history)
+    if start_iter >= n_iter:
+        sampler.advance(0.0, last=True)
+    od_pairs, od_filter, radius = sampler.current(slack)
+
     print("\n" + "=" * 70)
     print("OTTIMIZZAZIONE ITERATIVA VELOCITA LINKTYPE")
     print("=" * 70)
@@ -1444,6 +2146,10 @@ def run_iterative_optimization(G, centroid_ids, T_obs_dict, linktype_list,
     print("  delta_v max:  +- {:.1f} km/h per classe".format(delta_v))
     print("  gap min:       {:.1f} km/h tra classi adiacenti".format(gap))
     print("  n_iterazioni:  {}".format(n_iter))
+    if sampler.enabled:
+        print("  campione OD:   {:.1f}% iniziale, x{:.1f} con variazioni < {:.1f}%, "
+              "ultima iterazione su tutte le coppie".format(
+                  100 * sampler.frac, sampler.growth, sampler.grow_below_pct))
     print("\nVelocita iniziali e bounds:")
     for lt in sorted(linktype_list):
         v  = initial_speeds.get(lt, 50.0)
@@ -1451,14 +2157,20 @@ def run_iterative_optimization(G, centroid_ids, T_obs_dict, linktype_list,
         print("  Type {:3d}: {:.1f} km/h  bounds=[{:.1f}, {:.1f}]".format(lt, v, lo, hi))
 
     # ---- ERRORE INIZIALE (prima di qualsiasi modifica) ----
-    print("\n" + "-" * 50)
-    print("ERRORE INIZIALE (con V0PRT originale)")
-    print("-" * 50)
-    od_filter = set(od_pairs)
     import sys as _sys; _sys.stdout.flush()
-    od_times_init, od_paths_init = compute_od_skims(
-        G, centroid_ids, verbose=True, od_filter=od_filter)
-    valid_init = [(od, T_obs_dict[od]) for od in od_pairs if od in od_paths_init]
+    if history:
+        # Ripresa: errore iniziale gia' nella history del checkpoint
+        valid_init = []
+    else:
+        print("\n" + "-" * 50)
+        print("ERRORE INIZIALE (con V0PRT originale)")
+        print("-" * 50)
+        if sampler.enabled:
+            print("  " + sampler.describe())
+        od_times_init, od_paths_init = compute_od_skims(
+            G, centroid_ids, verbose=True, od_filter=od_filter, engine=engine,
+            n_workers=n_workers, target_radius=radius)
+        valid_init = [(od, T_obs_dict[od]) for od in od_pairs if od in od_paths_init]
     if valid_init:
         T_obs_arr  = np.array([t for _, t in valid_init])
         T_pred_arr = np.array([od_times_init[od] for od, _ in valid_init])
@@ -1472,99 +2184,141 @@ def run_iterative_optimization(G, centroid_ids, T_obs_dict, linktype_list,
                         "max_rel_change_pct": 0.0,
                         "speeds": {str(lt): v for lt, v in initial_speeds.items()},
                         "metrics": m0,
+                        **sampler.history_fields(),
                         # Usati per scatter plot; non serializzati in JSON
                         "_T_obs_arr":  T_obs_arr,
                         "_T_pred_arr": T_pred_arr})
-    else:
+    elif not history:
         print("  [!] Nessuna coppia OD valida per calcolo errore iniziale")
 
-    for iteration in range(1, n_iter + 1):
-        print("\n" + "=" * 40)
-        print("ITERAZIONE {} / {}".format(iteration, n_iter))
-        print("=" * 40)
-        _sys.stdout.flush()
-
-        # Step 1: Shortest path
-        od_times, od_paths = compute_od_skims(
-            G, centroid_ids, verbose=True, od_filter=od_filter)
-
-        # Step 2: Filtra coppie OD valide
-        valid_ods = [(od, T_obs_dict[od]) for od in od_pairs if od in od_paths]
-        if not valid_ods:
-            print("  ERRORE: Nessuna coppia OD valida!")
-            break
-
-        od_paths_filt = {od: od_paths[od] for od, _ in valid_ods}
-        T_obs_filt    = np.array([t for _, t in valid_ods])
-
-        if len(valid_ods) < len(od_pairs):
-            print("  [!] Coppie OD usate: {} / {}".format(len(valid_ods), len(od_pairs)))
-
-        # Step 3: Matrice composizione
-        D, od_order = build_composition_matrix(G, od_paths_filt, linktype_list)
-
-        d_per_type = D.sum(axis=0)
-        print("\n  Lunghezze percorse per LinkType:")
-        for j, lt in enumerate(linktype_list):
-            pct = d_per_type[j] / max(d_per_type.sum(), 1) * 100
-            print("    Type {:3d}: {:.1f} km  ({:.1f}%)".format(
-                lt, d_per_type[j] / 1000, pct))
-
-        # Step 4: Ottimizzazione con bounds per-tipo
-        new_speeds, metrics = optimize_speeds_lsq(
-            D, T_obs_filt, linktype_list, v_min, v_max,
-            initial_speeds=initial_speeds,
-            speed_bounds=speed_bounds,
-        )
-
-        # Step 5: Log variazioni (con segno corretto)
-        print("\n  Velocita aggiornate:")
-        max_rel_change = 0.0
-        for lt in sorted(new_speeds.keys()):
-            v_old    = current_speeds.get(lt, 50.0)
-            v_new    = new_speeds[lt]
-            delta    = v_new - v_old
-            rel_pct  = delta / max(v_old, 1.0) * 100.0
-            abs_rel  = abs(rel_pct)
-            max_rel_change = max(max_rel_change, abs_rel / 100.0)
-            flag = " <-" if abs_rel > 1.0 else ""
-            lo, hi = speed_bounds.get(lt, (v_min, v_max))
-            print("    Type {:3d}: {:6.1f} -> {:6.1f} km/h  ({:+.1f}%)  "
-                  "bounds=[{:.1f},{:.1f}]{}".format(
-                      lt, v_old, v_new, rel_pct, lo, hi, flag))
-
-        history.append({
-            "iteration": iteration,
-            "n_od_used": len(valid_ods),
-            "max_rel_change_pct": round(max_rel_change * 100, 3),
-            "speeds": {str(lt): v for lt, v in new_speeds.items()},
-            "metrics": metrics,
-        })
-
-        # Step 6: Aggiorna grafo
-        n_updated = update_graph_t0(G, new_speeds, fix_connectors=fix_conn)
-        print("  Grafo aggiornato: {} archi T0 modificati".format(n_updated))
-
-        current_speeds = new_speeds
-
-        print("\n  Max variazione rel: {:.3f}%  (soglia: {:.2f}%)".format(
-            max_rel_change * 100, conv_thresh * 100))
-
-        slope_ok = slope_min <= metrics["slope"] <= slope_max
-        r2_ok    = metrics["r2"] >= r2_target
-        if slope_ok and r2_ok:
-            print("  [OK] CONVERGENZA: slope={:.4f} in [{:.2f},{:.2f}]  R2={:.4f} >= {:.2f}".format(
-                metrics["slope"], slope_min, slope_max, metrics["r2"], r2_target))
-            break
-        else:
-            missing = []
-            if not slope_ok:
-                missing.append("slope={:.4f} fuori [{:.2f},{:.2f}]".format(
-                    metrics["slope"], slope_min, slope_max))
-            if not r2_ok:
-                missing.append("R2={:.4f} < {:.2f}".format(metrics["r2"], r2_target))
-            print("  [..] Non convergito: {}".format(" | ".join(missing)))
+    # Righe di D conservate tra le iterazioni (solo OD con percorso cambiato)
+    d_cache = PathRowCache()
+    if resumed and resumed["path_hashes"] is not None:
+        d_cache.restore(*resumed["path_hashes"], signature=tuple(linktype_list))
+
+    for iteration in range(start_iter, n_iter + 1):
+        with stage_timer("iteration", iteration=iteration):
+            print("\n" + "=" * 40)
+            print("ITERAZIONE {} / {}".format(iteration, n_iter))
+            print("=" * 40)
+            od_pairs, od_filter, radius = sampler.current(slack)
+            if sampler.enabled:
+                print("  " + sampler.describe())
+                trace_info(od_sample_pct=sampler.sample_pct())
+            _sys.stdout.flush()
+
+            # Step 1: Shortest path
+            od_times, od_paths = compute_od_skims(
+                G, centroid_ids, verbose=True, od_filter=od_filter, engine=engine,
+                n_workers=n_workers, target_radius=radius)
+
+            # Step 2: Filtra coppie OD valide
+            valid_ods = [(od, T_obs_dict[od]) for od in od_pairs if od in od_paths]
+            if not valid_ods:
+                print("  ERRORE: Nessuna coppia OD valida!")
+                break
 
+            od_paths_filt = select_paths(od_paths, [od for od, _ in valid_ods])
+            T_obs_filt    = np.array([t for _, t in valid_ods])
+
+            if len(valid_ods) < len(od_pairs):
+                print("  [!] Coppie OD usate: {} / {}".format(len(valid_ods), len(od_pairs)))
+
+            # Step 3: Matrice composizione (ricalcolate solo le righe con percorso cambiato)
+            paths_filt = as_arc_paths(G, od_paths_filt)
+            D, changed = d_cache.update(
+                paths_filt, lambda p: build_composition_matrix(G, p, linktype_list)[0],
+                signature=tuple(linktype_list))
+            paths_changed_pct = round(100.0 * changed.mean(), 3) if len(changed) else 0.0
+            trace_info(D_shape=list(D.shape), D_nnz=int(np.count_nonzero(D)),
+                       paths_changed_pct=paths_changed_pct)
+            print("  Percorsi cambiati: {:.1f}% ({} / {} OD)".format(
+                paths_changed_pct, int(changed.sum()), len(changed)))
+
+            d_per_type = D.sum(axis=0)
+            print("\n  Lunghezze percorse per LinkType:")
+            for j, lt in enumerate(linktype_list):
+                pct = d_per_type[j] / max(d_per_type.sum(), 1) * 100
+                print("    Type {:3d}: {:.1f} km  ({:.1f}%)".format(
+                    lt, d_per_type[j] / 1000, pct))
+
+            # Step 4: Ottimizzazione con bounds per-tipo
+            new_speeds, metrics = optimize_speeds_lsq(
+                D, T_obs_filt, linktype_list, v_min, v_max,
+                initial_speeds=initial_speeds,
+                speed_bounds=speed_bounds,
+                warm_speeds=current_speeds,
+                solver=config.get("type_solver", "gram"),
+            )
+
+            # Step 5: Log variazioni (con segno corretto)
+            print("\n  Velocita aggiornate:")
+            max_rel_change = 0.0
+            for lt in sorted(new_speeds.keys()):
+                v_old    = current_speeds.get(lt, 50.0)
+                v_new    = new_speeds[lt]
+                delta    = v_new - v_old
+                rel_pct  = delta / max(v_old, 1.0) * 100.0
+                abs_rel  = abs(rel_pct)
+                max_rel_change = max(max_rel_change, abs_rel / 100.0)
+                flag = " <-" if abs_rel > 1.0 else ""
+                lo, hi = speed_bounds.get(lt, (v_min, v_max))
+                print("    Type {:3d}: {:6.1f} -> {:6.1f} km/h  ({:+.1f}%)  "
+                      "bounds=[{:.1f},{:.1f}]{}".format(
+                          lt, v_old, v_new, rel_pct, lo, hi, flag))
+
+            history.append({
+                "iteration": iteration,
+                "n_od_used": len(valid_ods),
+                "max_rel_change_pct": round(max_rel_change * 100, 3),
+                "speeds": {str(lt): v for lt, v in new_speeds.items()},
+                "metrics": metrics,
+                "paths_changed_pct": paths_changed_pct,
+                **sampler.history_fields(),
+            })
+
+            # Step 6: Aggiorna grafo
+            n_updated = update_graph_t0(G, new_speeds, fix_connectors=fix_conn)
+            print("  Grafo aggiornato: {} archi T0 modificati".format(n_updated))
+
+            current_speeds = new_speeds
+
+            print("\n  Max variazione rel: {:.3f}%  (soglia: {:.2f}%)".format(
+                max_rel_change * 100, conv_thresh * 100))
+
+            slope_ok = slope_min <= metrics["slope"] <= slope_max
+            r2_ok    = metrics["r2"] >= r2_target
+            if slope_ok and r2_ok and not sampler.full:
+                # Convergenza sul campione: verifica finale su tutte le coppie
+                print("  [..] Convergenza sul campione ({:.1f}% OD): iterazione finale "
+                      "su tutte le coppie".format(sampler.sample_pct()))
+                sampler.advance(max_rel_change * 100, converged=True)
+                history[-1]["od_sample_converged"] = True
+                if ckpt_path is not None:
+                    save_checkpoint(ckpt_path, G, "per_type", iteration, history, config,
+                                    current_speeds=current_speeds, path_cache=d_cache)
+            elif slope_ok and r2_ok:
+                print("  [OK] CONVERGENZA: slope={:.4f} in [{:.2f},{:.2f}]  R2={:.4f} >= {:.2f}".format(
+                    metrics["slope"], slope_min, slope_max, metrics["r2"], r2_target))
+                if ckpt_path is not None:
+                    save_checkpoint(ckpt_path, G, "per_type", iteration, history, config,
+                                    finished=True, current_speeds=current_speeds,
+                                    path_cache=d_cache)
+                break
+            else:
+                missing = []
+                if not slope_ok:
+                    missing.append("slope={:.4f} fuori [{:.2f},{:.2f}]".format(
+                        metrics["slope"], slope_min, slope_max))
+                if not r2_ok:
+                    missing.append("R2={:.4f} < {:.2f}".format(metrics["r2"], r2_target))
+                print("  [..] Non convergito: {}".format(" | ".join(missing)))
+                sampler.advance(max_rel_change * 100, last=iteration + 1 >= n_iter)
+                if ckpt_path is not None:
+                    save_checkpoint(ckpt_path, G, "per_type", iteration, history, config,
+                                    current_speeds=current_speeds, path_cache=d_cache)
+
+    sync_edge_view(G)
     return current_speeds, history
 
 
@@ -1572,9 +2326,11 @@ def run_iterative_optimization(G, centroid_ids, T_obs_dict, linktype_list,
 # OUTPUT E REPORT
 # =============================================================================
 
-def compute_final_skims(G, centroid_ids, best_speeds, linktype_list):
+def compute_final_skims(G, centroid_ids, best_speeds, linktype_list, engine="csr",
+                        n_workers=1):
     """Calcola skim finale con velocita ottimizzate e composizione percorsi."""
-    od_times, od_paths = compute_od_skims(G, centroid_ids, verbose=True)
+    od_times, od_paths = compute_od_skims(G, centroid_ids, verbose=True, engine=engine,
+                                          n_workers=n_workers)
 
     D, od_order = build_composition_matrix(G, od_paths, linktype_list)
 
@@ -1591,6 +2347,21 @@ def compute_final_skims(G, centroid_ids, best_speeds, linktype_list):
     return pd.DataFrame(rows)
 
 
+def stream_final_skims(G, centroid_ids, linktype_list, T_obs_dict, config):
+    """
+    Skim finale a blocchi di final_skim_chunk_origins origini (skim_export.py):
+    od_comparison viene scritto durante il calcolo, senza tenere in memoria
+    i percorsi N x N. Ritorna le sole righe con tempo osservato.
+    """
+    engine = config.get("skim_engine", "csr")
+    if engine != "csr":
+        print("  [i] Skim finale a blocchi: motore csr (skim_engine '{}' ignorato)".format(engine))
+    return export_type_skims(G, centroid_ids, linktype_list, config["output_dir"], T_obs_dict,
+                             weight="t0",
+                             chunk_origins=config["final_skim_chunk_origins"],
+                             fmt=config.get("final_skim_format", "csv"), sep=",")
+
+
 # =============================================================================
 # STATISTICHE PER LINKTYPE E REMAPPING
 # =============================================================================
@@ -1639,6 +2410,29 @@ def compute_linktype_stats(G, linktype_list, initial_speeds, best_speeds):
     return pd.DataFrame(rows)
 
 
+def _nearest_sorted(values, x):
+    """
+    Indice del valore piu' vicino a ogni x in values (ordinato crescente):
+    stesso risultato di np.argmin(np.abs(values - x)) riga per riga (a pari
+    distanza vince la prima posizione, x NaN -> 0), con una searchsorted.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    last = len(values) - 1
+    pos = np.searchsorted(values, x, side="left")
+    lo = np.clip(pos - 1, 0, last)
+    hi = np.minimum(pos, last)
+    idx = np.where(np.abs(values[lo] - x) <= np.abs(values[hi] - x), lo, hi)
+    # Valori ripetuti (tipi con la stessa velocita'): vince la prima occorrenza
+    idx = np.searchsorted(values, values[idx], side="left")
+    idx[np.isnan(x)] = 0
+    return idx
+
+
+def _round_list(values, ndigits=2):
+    """round() Python elemento per elemento (come i record scritti riga per riga)."""
+    return [round(v, ndigits) for v in np.asarray(values, dtype=np.float64).tolist()]
+
+
 def remap_links_by_optimized_speed(links_df, best_speeds,
                                     v0prt_field="V0PRT", linktype_field="TYPENO",
                                     fromnodeno_field="FROMNODENO",
@@ -1664,6 +2458,12 @@ def remap_links_by_optimized_speed(links_df, best_speeds,
     Modalita legacy (use_4digit_types=False):
       Cerca il tipo con V0PRT default piu' vicina tra quelli con stesse corsie.
 
+    Elaborazione per colonne: V0PRT ottimizzata letta dall'EdgeStore con un
+    lookup vettoriale (FROMNODENO, TONODENO) -> id arco, classe/tipo piu'
+    vicino con searchsorted sui fattori o sulle velocita' candidate (una
+    tabella di candidati per numero di corsie). Stesso risultato del
+    calcolo riga per riga.
+
     Ritorna DataFrame con colonne:
         FROMNODENO | TONODENO | NUMLANES | V0PRT_ORIG_kmh | V0PRT_OPT_kmh |
         TYPENO_ORIG | TYPENO_NEW | SPEED_NEW_DEFAULT_kmh |
@@ -1679,12 +2479,29 @@ def remap_links_by_optimized_speed(links_df, best_speeds,
         print("  [!] best_speeds vuoto -- remapping non eseguito")
         return pd.DataFrame()
 
-    # Indice (u,v) -> v0prt ottimizzata nel grafo
-    arc_opt_v0 = {}
-    if G is not None:
-        for u, v, data in G.edges(data=True):
-            if not data.get("is_connector", False):
-                arc_opt_v0[(u, v)] = data.get("v0prt", None)
+    n = len(links_df)
+    v0_orig = speed_column_to_kmh(links_df[v0prt_col]) if v0prt_col \
+        else np.full(n, 50.0, dtype=np.float64)
+    lt_old, lt_ok = int_column(links_df[type_col]) if type_col \
+        else (np.zeros(n, dtype=np.int64), np.zeros(n, dtype=bool))
+    fn, fn_ok = int_column(links_df[from_col]) if from_col else (None, np.zeros(n, dtype=bool))
+    tn, tn_ok = int_column(links_df[to_col])   if to_col   else (None, np.zeros(n, dtype=bool))
+    nl, nl_ok = int_column(links_df[lanes_col]) if lanes_col else (None, np.zeros(n, dtype=bool))
+
+    # V0PRT ottimizzata: dallo store del grafo (archi non connettore), altrimenti l'originale
+    v0_opt = v0_orig.copy()
+    if G is not None and from_col and to_col:
+        store = get_edge_store(G)
+        if "v0prt" in store:
+            ids = np.full(n, -1, dtype=np.int64)
+            ok = fn_ok & tn_ok
+            ids[ok] = get_csr_graph(G).arc_ids_for_nodes(fn[ok], tn[ok])
+            found = ids >= 0
+            found[found] = ~store["is_connector"][ids[found]]
+            v0_opt[found] = store["v0prt"][ids[found]]
+
+    delta = v0_opt - v0_orig
+    small = np.abs(delta) < 0.5
 
     # ---- Tabella classi velocita (4-digit) ---- #
     # Classe S -> fattore moltiplicativo sulla velocita base
@@ -1695,12 +2512,6 @@ def remap_links_by_optimized_speed(links_df, best_speeds,
     _FACTOR_LIST = np.array([_CLASS_FACTORS[k] for k in range(10)])
     CAP_DIGIT = 5   # cifra capacita fissa per ora
 
-    def _base_type(lt):
-        """Estrae il tipo base (BB) da un TYPENO a 2 o 4 cifre."""
-        if lt >= 100:
-            return lt // 100
-        return lt
-
     # Velocita' default dei tipi base (2 cifre):
     # Prende da best_speeds i tipi con codice <= 99
     base_type_speeds = {}
@@ -1716,93 +2527,85 @@ def remap_links_by_optimized_speed(links_df, best_speeds,
             if bb not in base_type_speeds and sc == 5:
                 base_type_speeds[bb] = v
 
-    # --- Preparazione legacy (usata se use_4digit_types=False) --- #
-    sorted_items = sorted(best_speeds.items(), key=lambda x: x[1])
-    lt_arr_all = np.array([lt for lt, _ in sorted_items], dtype=int)
-    v_arr_all  = np.array([v  for _, v  in sorted_items], dtype=float)
-
-    type_lanes_set = {}
-    if lanes_col and not use_4digit_types:
-        type_lanes_map = {}
-        for _, row in links_df.iterrows():
-            lt = int(row[type_col]) if type_col else -1
-            nl = row[lanes_col]
-            if lt >= 0 and not pd.isna(nl):
-                nl = int(nl)
-                if lt not in type_lanes_map:
-                    type_lanes_map[lt] = {}
-                type_lanes_map[lt][nl] = type_lanes_map[lt].get(nl, 0) + 1
-        type_lanes_set = {lt: set(d.keys()) for lt, d in type_lanes_map.items()}
-
-    def _candidates_for_lanes(nl):
-        if not type_lanes_set:
-            return lt_arr_all, v_arr_all
-        mask = np.array([nl in type_lanes_set.get(int(lt), set()) for lt in lt_arr_all])
-        if mask.sum() == 0:
-            return lt_arr_all, v_arr_all
-        return lt_arr_all[mask], v_arr_all[mask]
-
-    records = []
-    changed = 0
-    for _, row in links_df.iterrows():
-        v0_orig = speed_to_kmh(row[v0prt_col]) if v0prt_col else 50.0
-        lt_old  = int(row[type_col]) if type_col else 0
-        fn      = int(row[from_col]) if from_col else None
-        tn      = int(row[to_col])   if to_col   else None
-        nl      = int(row[lanes_col]) if (lanes_col and not pd.isna(row[lanes_col])) else None
-
-        # V0PRT ottimizzata: dal grafo se disponibile, altrimenti quella originale
-        v0_opt = arc_opt_v0.get((fn, tn), v0_orig) if (fn is not None and tn is not None) else v0_orig
-        if v0_opt is None:
-            v0_opt = v0_orig
-
-        delta = v0_opt - v0_orig
-
-        if use_4digit_types:
-            # ---- Logica 4-digit BBSC ----
-            bb = _base_type(lt_old)
-            v_base = base_type_speeds.get(bb, v0_orig)
-
-            if abs(delta) < 0.5 or v_base <= 0:
-                # Nessuna variazione -> classe 5 (base), capacita 5
-                lt_new = bb * 100 + 5 * 10 + CAP_DIGIT
-                v_new_default = v_base
-            else:
-                ratio = v0_opt / v_base if v_base > 0 else 1.0
-                # Trova classe S piu' vicina
-                s_class = int(np.argmin(np.abs(_FACTOR_LIST - ratio)))
-                lt_new = bb * 100 + s_class * 10 + CAP_DIGIT
-                v_new_default = v_base * _CLASS_FACTORS[s_class]
-        else:
-            # ---- Logica legacy ----
-            if abs(delta) < 0.5:
-                lt_new = lt_old
-                v_new_default = float(best_speeds.get(lt_old, v0_orig))
-            else:
-                lt_cand, v_cand = _candidates_for_lanes(nl) if nl is not None else (lt_arr_all, v_arr_all)
-                idx    = int(np.argmin(np.abs(v_cand - v0_opt)))
-                lt_new = int(lt_cand[idx])
-                v_new_default = float(v_cand[idx])
-
-        rec = {
-            "FROMNODENO":              fn,
-            "TONODENO":                tn,
-            "NUMLANES":                nl,
-            "V0PRT_ORIG_kmh":          round(v0_orig, 2),
-            "V0PRT_OPT_kmh":           round(v0_opt,  2),
-            "TYPENO_ORIG":             lt_old,
-            "TYPENO_NEW":              lt_new,
-            "SPEED_NEW_DEFAULT_kmh":   round(v_new_default, 2),
-            "DELTA_OPT_VS_ORIG_kmh":   round(delta, 2),
-            "CHANGED":                 int(lt_new != lt_old),
-        }
-        records.append(rec)
-        if lt_new != lt_old:
-            changed += 1
-
-    remap_df = pd.DataFrame(records)
-    pct = changed / max(len(records), 1) * 100
-    print(f"  Archi riassegnati: {changed} / {len(records)}  ({pct:.1f}%)")
+    if use_4digit_types:
+        # ---- Logica 4-digit BBSC ----
+        # Tipo base (BB) da un TYPENO a 2 o 4 cifre
+        bb = np.where(lt_old >= 100, lt_old // 100, lt_old)
+        bb_uniq, bb_inv = np.unique(bb, return_inverse=True)
+        known_uniq = np.array([int(b) in base_type_speeds for b in bb_uniq.tolist()], dtype=bool)
+        v_base_uniq = np.array([base_type_speeds.get(int(b), np.nan) if k else np.nan
+                                for b, k in zip(bb_uniq.tolist(), known_uniq)], dtype=np.float64)
+        known  = known_uniq[bb_inv]
+        v_base = np.where(known, v_base_uniq[bb_inv], v0_orig)
+
+        # Nessuna variazione -> classe 5 (base); altrimenti classe S piu' vicina
+        keep = small | (v_base <= 0)
+        s_class = np.full(n, 5, dtype=np.int64)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ratio = np.where(v_base > 0, v0_opt / v_base, 1.0)
+        s_class[~keep] = _nearest_sorted(_FACTOR_LIST, ratio[~keep])
+        lt_new = bb * 100 + s_class * 10 + CAP_DIGIT
+
+        # Velocita' default del nuovo tipo: tabella (tipo base, classe) arrotondata
+        # sui valori di best_speeds cosi' come sono; fuori tabella V0PRT originale
+        speed_table = np.array([[round(base_type_speeds[int(b)] * _CLASS_FACTORS[s], 2)
+                                 if k else np.nan for s in range(10)]
+                                for b, k in zip(bb_uniq.tolist(), known_uniq)],
+                               dtype=np.float64).reshape(len(bb_uniq), 10)
+        v_new_default = np.array(_round_list(v_base * _FACTOR_LIST[s_class]), dtype=np.float64)
+        v_new_default[known] = speed_table[bb_inv[known], s_class[known]]
+    else:
+        # ---- Logica legacy ----
+        sorted_items = sorted(best_speeds.items(), key=lambda x: x[1])
+        lt_arr_all = np.array([lt for lt, _ in sorted_items], dtype=int)
+        v_arr_all  = np.array([v  for _, v  in sorted_items], dtype=float)
+
+        # Nessuna variazione -> tipo invariato, velocita' default del tipo corrente
+        lt_new = lt_old.copy()
+        lt_uniq, lt_inv = np.unique(lt_old, return_inverse=True)
+        in_best = np.array([int(lt) in best_speeds for lt in lt_uniq.tolist()], dtype=bool)
+        v_uniq = np.array([float(best_speeds[int(lt)]) if k else np.nan
+                           for lt, k in zip(lt_uniq.tolist(), in_best)], dtype=np.float64)
+        v_new_default = np.where(in_best[lt_inv], v_uniq[lt_inv], v0_orig)
+
+        # Corsie osservate per tipo: candidati per numero di corsie (tutti i tipi
+        # se nessun tipo ha quel numero di corsie o senza colonna corsie)
+        lane_pairs = np.empty((0, 2), dtype=np.int64)
+        if lanes_col and type_col:
+            has_lanes = lt_ok & nl_ok & (lt_old >= 0)
+            lane_pairs = np.unique(np.column_stack([lt_old[has_lanes], nl[has_lanes]]), axis=0)
+
+        move = ~small
+        groups = [(move & ~nl_ok, lt_arr_all, v_arr_all)]
+        if nl_ok.any():
+            for lanes in np.unique(nl[move & nl_ok]).tolist():
+                mask = np.isin(lt_arr_all, lane_pairs[lane_pairs[:, 1] == lanes, 0])
+                cand = (lt_arr_all[mask], v_arr_all[mask]) if mask.any() \
+                    else (lt_arr_all, v_arr_all)
+                groups.append((move & nl_ok & (nl == lanes),) + cand)
+        for rows, lt_cand, v_cand in groups:
+            if rows.any():
+                idx = _nearest_sorted(v_cand, v0_opt[rows])
+                lt_new[rows] = lt_cand[idx]
+                v_new_default[rows] = v_cand[idx]
+
+    changed_mask = lt_new != lt_old
+    remap_df = pd.DataFrame({
+        "FROMNODENO":              fn if from_col else [None] * n,
+        "TONODENO":                tn if to_col   else [None] * n,
+        "NUMLANES":                [x if k else None for x, k in zip(nl.tolist(), nl_ok.tolist())]
+                                   if lanes_col else [None] * n,
+        "V0PRT_ORIG_kmh":          _round_list(v0_orig),
+        "V0PRT_OPT_kmh":           _round_list(v0_opt),
+        "TYPENO_ORIG":             lt_old,
+        "TYPENO_NEW":              lt_new,
+        "SPEED_NEW_DEFAULT_kmh":   _round_list(v_new_default),
+        "DELTA_OPT_VS_ORIG_kmh":   _round_list(delta),
+        "CHANGED":                 changed_mask.astype(np.int64),
+    }) if n else pd.DataFrame()
+    changed = int(changed_mask.sum())
+    pct = changed / max(n, 1) * 100
+    print(f"  Archi riassegnati: {changed} / {n}  ({pct:.1f}%)")
 
     # Riepilogo per tipo
     if not remap_df.empty:
@@ -2052,10 +2855,16 @@ def save_arc_assignments(output_dir, arc_assignments, type_speeds,
 
 def save_results(output_dir, best_speeds, history, skim_df, T_obs_dict, config,
                  G=None, initial_speeds=None, links_df=None, linktype_list=None,
-                 arc_assignments=None, arc_initial_speeds=None):
-    """Salva tutti i risultati nella cartella output."""
+                 arc_assignments=None, arc_initial_speeds=None, comparison_streamed=False):
+    """
+    Salva tutti i risultati nella cartella output.
+    comparison_streamed: od_comparison.csv gia' scritto da stream_final_skims
+    (skim_df contiene solo le righe con tempo osservato).
+    """
     out_path = Path(output_dir)
     out_path.mkdir(parents=True, exist_ok=True)
+    if G is not None:
+        sync_edge_view(G)   # letture per arco dagli edge dict
     remap_df = None   # inizializzato qui, popolato sotto se links_df disponibile
 
     # 1. Velocita ottimizzate
@@ -2080,6 +2889,13 @@ def save_results(output_dir, best_speeds, history, skim_df, T_obs_dict, config,
         # speeds presente solo in per_type mode
         for lt_str, v in h.get("speeds", {}).items():
             row[f"speed_type_{lt_str}"] = v
+        # solver_iterations presente solo con per_arc_solver "global"
+        if "solver_iterations" in h:
+            row["solver_iterations"] = h["solver_iterations"]
+        if "paths_changed_pct" in h:
+            row["paths_changed_pct"] = h["paths_changed_pct"]
+        if "od_sample_pct" in h:
+            row["od_sample_pct"] = h["od_sample_pct"]
         history_rows.append(row)
     history_df = pd.DataFrame(history_rows)
     history_file = out_path / "optimization_history.csv"
@@ -2087,7 +2903,7 @@ def save_results(output_dir, best_speeds, history, skim_df, T_obs_dict, config,
     print(f"  [OK] History iterazioni: {history_file}")
 
     # 3. Confronto tempi modello vs osservati
-    if skim_df is not None and T_obs_dict:
+    if skim_df is not None and T_obs_dict and not comparison_streamed:
         skim_df["time_observed_min"] = skim_df.apply(
             lambda r: T_obs_dict.get((int(r["origin"]), int(r["destination"])), np.nan), axis=1
         )
@@ -2119,13 +2935,14 @@ def save_results(output_dir, best_speeds, history, skim_df, T_obs_dict, config,
                    and config.get("speed_delta_upper_pct") is not None)
         _mode_str = "4-digit BBSC" if _use_4d else "tipo piu' vicino"
         print(f"\n  Remapping LinkType (V0PRT ottimizzata -> {_mode_str}):")
-        remap_df = remap_links_by_optimized_speed(
-            links_df, best_speeds,
-            v0prt_field=config.get("v0prt_field", "V0PRT"),
-            linktype_field=config.get("linktype_field", "TYPENO"),
-            G=G,
-            use_4digit_types=_use_4d,
-        )
+        with stage_timer("remap_links"):
+            remap_df = remap_links_by_optimized_speed(
+                links_df, best_speeds,
+                v0prt_field=config.get("v0prt_field", "V0PRT"),
+                linktype_field=config.get("linktype_field", "TYPENO"),
+                G=G,
+                use_4digit_types=_use_4d,
+            )
         if not remap_df.empty:
             remap_file = out_path / "links_remapped.csv"
             remap_df.to_csv(remap_file, index=False, sep=",")
@@ -2142,14 +2959,16 @@ def save_results(output_dir, best_speeds, history, skim_df, T_obs_dict, config,
                 if r["FROMNODENO"] is not None and r["TONODENO"] is not None
             }
             # Applica temporaneamente le velocita' snappate al grafo
-            G_snap_backup = {}
-            for (u, v), v_snap in snap_map.items():
-                if G.has_edge(u, v):
-                    data = G[u][v]
-                    G_snap_backup[(u, v)] = (data.get("v0prt"), data.get("t0"))
-                    length = data.get("length", 0.0)
-                    data["v0prt"] = v_snap
-                    data["t0"]    = (length / 1000.0 / max(v_snap, 0.1)) * 60.0 if length > 0 else data["t0"]
+            store    = get_edge_store(G)
+            snap_ids = get_csr_graph(G).arc_ids_lookup(snap_map)
+            v_snap   = np.fromiter(snap_map.values(), dtype=np.float64, count=len(snap_ids))
+            v_snap   = v_snap[snap_ids >= 0]
+            snap_ids = snap_ids[snap_ids >= 0]
+            snap_backup = (store["v0prt"][snap_ids], store["t0"][snap_ids])
+            length = store["length"][snap_ids]
+            store.set("v0prt", snap_ids, v_snap)
+            store.set("t0", snap_ids, np.where(
+                length > 0, (length / 1000.0 / np.maximum(v_snap, 0.1)) * 60.0, snap_backup[1]))
             # Dijkstra con velocita' snappate.
             # Ricava i centroid IDs dalle chiavi di T_obs_dict (zone_id positivi usati
             # nell'ottimizzazione). I nodi centroide nel grafo hanno ID = -zone_id.
@@ -2162,7 +2981,11 @@ def save_results(output_dir, best_speeds, history, skim_df, T_obs_dict, config,
             print("    Ricalcolo percorsi con velocita' snappate "
                   "({} centroidi)...".format(len(centroid_ids_local)))
             od_times_snap, _ = compute_od_skims(
-                G, centroid_ids_local, verbose=False, od_filter=od_filter_snap)
+                G, centroid_ids_local, verbose=False, od_filter=od_filter_snap,
+                engine=config.get("skim_engine", "csr"),
+                n_workers=config.get("n_workers", 1),
+                target_radius=origin_time_radius(
+                    T_obs_dict, config.get("target_radius_slack", 1.5)))
             valid_snap = [(od, T_obs_dict[od]) for od in od_pairs_local
                           if od in od_times_snap]
             snap_plot_data = None
@@ -2181,10 +3004,9 @@ def save_results(output_dir, best_speeds, history, skim_df, T_obs_dict, config,
                       "({} centroidi, {} coppie filtro)".format(
                           len(centroid_ids_local), len(od_filter_snap)))
             # Ripristina il grafo originale (velocita' continue ottimizzate)
-            for (u, v), (v_old, t_old) in G_snap_backup.items():
-                if G.has_edge(u, v):
-                    G[u][v]["v0prt"] = v_old
-                    G[u][v]["t0"]    = t_old
+            store.set("v0prt", snap_ids, snap_backup[0])
+            store.set("t0", snap_ids, snap_backup[1])
+            sync_edge_view(G)
 
     # 5b. Per-arc assignments (solo in per-arc mode)
     # (snap_plot_data puo' essere None se il post-snap non e' stato eseguito)
@@ -2238,107 +3060,73 @@ def save_results(output_dir, best_speeds, history, skim_df, T_obs_dict, config,
 # MAIN
 # =============================================================================
 
-def main():
-    print("=" * 70)
-    print("NETWORK SPEED OPTIMIZATION")
-    print("Ottimizzazione velocita LinkType via Bounded Least Squares")
-    print("=" * 70)
+# Chiavi che definiscono la rete condivisa tra i periodi (non sovrascrivibili per periodo)
+PERIOD_SHARED_KEYS = ("network_dir", "network_cache", "network_cache_dir") + NETWORK_CACHE_KEYS
 
-    # -- Carica config
-    if len(sys.argv) < 2:
-        print("Uso: python optimize_link_speeds.py config.json")
-        sys.exit(1)
 
-    config_path = Path(sys.argv[1])
-    if not config_path.exists():
-        print(f"[ERR] Config non trovato: {config_path}")
+def load_network(config, no_cache=False):
+    """
+    STEP 1: rete Visum (shapefile o cache binaria), array per arco e centroidi.
+    Ritorna dict {links_df, nodes_df, centroids_df, connectors_df, arrays, centroid_ids}.
+    """
+    print("\n" + "-" * 60)
+    print("STEP 1: Caricamento rete Visum")
+    print("-" * 60)
+    cache = None
+    if config.get("network_cache", True) and not no_cache:
+        cache = NetworkCache(
+            config.get("network_cache_dir") or Path(config["output_dir"]) / "network_cache",
+            "link_speeds",
+            find_network_files(config["network_dir"], config.get("file_prefix")),
+            {k: config.get(k) for k in NETWORK_CACHE_KEYS})
+    cached = cache.load() if cache is not None else None
+    with stage_timer("load_visum_network"):
+        if cached:
+            links_df, nodes_df, centroids_df, connectors_df = cached["frames"]
+        else:
+            links_df, nodes_df, centroids_df, connectors_df = load_visum_network(
+                config["network_dir"],
+                file_prefix=config.get("file_prefix"),
+                config=config,
+            )
+    with stage_timer("build_edge_arrays"):
+        arrays = cached["arrays"] if cached else build_edge_arrays(links_df, connectors_df, config)
+
+    # Centroidi
+    centroid_ids = cached["centroid_ids"] if cached else get_centroid_ids(centroids_df, connectors_df)
+    if not centroid_ids:
+        print("[ERR] Nessun centroide trovato!")
         sys.exit(1)
+    if cache is not None and not cached:
+        cache.save([links_df, nodes_df, centroids_df, connectors_df], arrays, centroid_ids)
+    print(f"\n  Centroidi: {len(centroid_ids)}  "
+          f"(min={min(centroid_ids)}, max={max(centroid_ids)})")
+    return {"links_df": links_df, "nodes_df": nodes_df, "centroids_df": centroids_df,
+            "connectors_df": connectors_df, "arrays": arrays, "centroid_ids": centroid_ids}
 
-    with open(config_path, "r", encoding="utf-8") as f:
-        user_config = json.load(f)
-
-    config = {**DEFAULT_CONFIG, **user_config}
-
-    print(f"\nConfig: {config_path}")
-    print(f"  Rete:              {config['network_dir']}")
-    print(f"  Tempi osservati:   {config['observed_times_csv']}")
-    print(f"  Output:            {config['output_dir']}")
 
-    # -- Verifica input obbligatori
-    for key in ["network_dir", "observed_times_csv", "output_dir"]:
-        if not config.get(key):
-            print(f"[ERR] Config mancante: '{key}'")
-            sys.exit(1)
+def run_period(network, config):
+    """
+    STEP 2-6 su una rete caricata con load_network: tempi osservati, grafo
+    con attributi arco propri, ottimizzazione, skim finale e output in
+    config["output_dir"] (flag file e trace.json della trace attiva).
 
-    # -- 1. Carica rete Visum
-    print("\n" + "-" * 60)
-    print("STEP 1: Caricamento rete Visum")
-    print("-" * 60)
-    links_df, nodes_df, centroids_df, connectors_df = load_visum_network(
-        config["network_dir"],
-        file_prefix=config.get("file_prefix"),
-        config=config,
-    )
+    Con network["csr"] / network["cch"] (run multi-periodo) topologia CSR e
+    gerarchia sono condivise invece di essere ricompilate.
+    Ritorna il contenuto del flag file.
+    """
+    links_df      = network["links_df"]
+    centroids_df  = network["centroids_df"]
+    connectors_df = network["connectors_df"]
+    centroid_ids  = network["centroid_ids"]
 
     # -- 2. Carica tempi osservati
     print("\n" + "-" * 60)
     print("STEP 2: Caricamento tempi osservati")
     print("-" * 60)
-    obs_df = pd.read_csv(
-        config["observed_times_csv"],
-        sep=None, engine="python", encoding="utf-8-sig"
-    )
-    print(f"  Righe caricate: {len(obs_df)}, colonne: {list(obs_df.columns)}")
-
-    orig_col = config["od_col_orig"]
-    dest_col = config["od_col_dest"]
-    time_col = config["od_col_time"]
-
-    # Auto-detection colonne: exact match -> case-insensitive -> alias
-    def resolve_col(configured_name, alias_key):
-        if configured_name in obs_df.columns:
-            return configured_name
-        # Case-insensitive exact
-        match = next((c for c in obs_df.columns
-                      if c.lower() == configured_name.lower()), None)
-        if match:
-            return match
-        # Alias list
-        for alias in OD_COL_ALIASES.get(alias_key, []):
-            match = next((c for c in obs_df.columns
-                          if c.lower() == alias.lower()), None)
-            if match:
-                print(f"  [i] Colonna '{configured_name}' non trovata -> uso '{match}' (alias)")
-                return match
-        return None
-
-    orig_col_found = resolve_col(orig_col, "origin")
-    dest_col_found = resolve_col(dest_col, "destination")
-    time_col_found = resolve_col(time_col, "time_m")
-
-    ok = True
-    for name, found in [(orig_col, orig_col_found),
-                        (dest_col, dest_col_found),
-                        (time_col, time_col_found)]:
-        if found is None:
-            print(f"[ERR] Colonna '{name}' non trovata. Colonne disponibili: {list(obs_df.columns)}")
-            ok = False
-    if not ok:
-        sys.exit(1)
-
-    orig_col, dest_col, time_col = orig_col_found, dest_col_found, time_col_found
-    print(f"  Colonne OD usate: origin={orig_col}, dest={dest_col}, time={time_col}")
-
-    # Campionamento opzionale
-    sample = config.get("sample_od_pairs")
-    if sample and len(obs_df) > sample:
-        obs_df = obs_df.sample(n=sample, random_state=config.get("random_seed", 42))
-        print(f"  Campione: {len(obs_df)} coppie OD selezionate casualmente")
-
-    T_obs_dict = {
-        (int(row[orig_col]), int(row[dest_col])): float(row[time_col])
-        for _, row in obs_df.iterrows()
-    }
+    with stage_timer("load_observed_times"):
+        observed = load_observed_times(config["observed_times_csv"], config, OD_COL_ALIASES)
+        T_obs_dict = observed.as_dict()
     print(f"  Coppie OD osservate: {len(T_obs_dict)}")
     obs_arr = np.array(list(T_obs_dict.values()))
     print(f"  Tempi osservati: min={obs_arr.min():.1f}  "
@@ -2348,16 +3136,18 @@ def main():
     print("\n" + "-" * 60)
     print("STEP 3: Costruzione grafo NetworkX")
     print("-" * 60)
-    G = build_graph(links_df, connectors_df, centroids_df, config)
-
-    # -- 4. Ricava centroidi e LinkType
-    centroid_ids = get_centroid_ids(centroids_df, connectors_df)
-    if not centroid_ids:
-        print("[ERR] Nessun centroide trovato!")
-        sys.exit(1)
-    print(f"\n  Centroidi: {len(centroid_ids)}  "
-          f"(min={min(centroid_ids)}, max={max(centroid_ids)})")
-
+    with stage_timer("build_graph"):
+        G = build_graph(links_df, connectors_df, centroids_df, config,
+                        arrays=network["arrays"], csr=network.get("csr"))
+    if config.get("skim_engine", "csr") == "cch":
+        if network.get("cch") is not None:
+            G.graph["_cch"] = network["cch"]
+        # Ordine di contrazione: calcolato una volta per rete e riusato da disco
+        with stage_timer("cch_preprocess"):
+            get_cch(G, cache_dir=config.get("cch_cache_dir")
+                    or str(Path(config["output_dir"]) / "cch_cache"))
+
+    # -- 4. LinkType
     # Ricava LinkType unici dalla rete (escludi connettori -1 e tipo 0)
     linktype_list = sorted({
         data["linktype"]
@@ -2378,9 +3168,10 @@ def main():
 
     if opt_mode == "per_arc":
         print("  Modalita: PER ARCO (per-arc)")
-        best_arc_assignments, type_speeds, history = run_iterative_optimization_per_arc(
-            G, centroid_ids, T_obs_dict, linktype_list, config
-        )
+        with stage_timer("optimization"):
+            best_arc_assignments, type_speeds, history = run_iterative_optimization_per_arc(
+                G, centroid_ids, T_obs_dict, linktype_list, config
+            )
         # In per-arc mode, best_speeds = type speeds (invariati)
         best_speeds        = type_speeds
         arc_assignments    = best_arc_assignments
@@ -2396,25 +3187,35 @@ def main():
             arc_initial_speeds[(u, v)] = float(v0) if v0 else initial_speeds.get(lt, 50.0)
     else:
         print("  Modalita: PER TIPO (per_type)")
-        best_speeds, history = run_iterative_optimization(
-            G, centroid_ids, T_obs_dict, linktype_list, config
-        )
+        with stage_timer("optimization"):
+            best_speeds, history = run_iterative_optimization(
+                G, centroid_ids, T_obs_dict, linktype_list, config
+            )
 
     # -- 6. Skim finale
     print("\n" + "-" * 60)
     print("STEP 5: Calcolo skim finale")
     print("-" * 60)
-    skim_df = compute_final_skims(G, centroid_ids, best_speeds, linktype_list)
+    streamed = bool(config.get("final_skim_chunk_origins"))
+    with stage_timer("final_skims"):
+        if streamed:
+            skim_df = stream_final_skims(G, centroid_ids, linktype_list, T_obs_dict, config)
+        else:
+            skim_df = compute_final_skims(G, centroid_ids, best_speeds, linktype_list,
+                                          engine=config.get("skim_engine", "csr"),
+                                          n_workers=config.get("n_workers", 1))
 
     # -- 7. Salva risultati
     print("\n" + "-" * 60)
     print("STEP 6: Salvataggio risultati")
     print("-" * 60)
-    save_results(config["output_dir"], best_speeds, history, skim_df, T_obs_dict, config,
-                 G=G, initial_speeds=initial_speeds,
-                 links_df=links_df, linktype_list=linktype_list,
-                 arc_assignments=arc_assignments,
-                 arc_initial_speeds=arc_initial_speeds)
+    with stage_timer("save_results"):
+        save_results(config["output_dir"], best_speeds, history, skim_df, T_obs_dict, config,
+                     G=G, initial_speeds=initial_speeds,
+                     links_df=links_df, linktype_list=linktype_list,
+                     arc_assignments=arc_assignments,
+                     arc_initial_speeds=arc_initial_speeds,
+                     comparison_streamed=streamed)
 
     print("\n" + "=" * 70)
     print("OTTIMIZZAZIONE COMPLETATA  [mode={}]".format(opt_mode))
@@ -2444,8 +3245,238 @@ def main():
         flag_data["optimized_speeds"]  = {str(lt): v for lt, v in sorted(best_speeds.items())}
         flag_data["links_remapped_csv"] = str(Path(config["output_dir"]) / "links_remapped.csv")
         flag_data["linktype_stats_csv"] = str(Path(config["output_dir"]) / "linktype_stats.csv")
+    trace = get_trace()
+    if trace is not None:
+        trace.save()
+        flag_data["trace"] = trace.summary()
     with open(flag_file, "w") as f:
         json.dump(flag_data, f, indent=2)
+    return flag_data
+
+
+
+
+# -----------------------------------------------------------------------------
+# Multi-periodo: una rete, piu' file di tempi osservati (es. AM / IP / PM)
+# -----------------------------------------------------------------------------
+
+def period_configs(config):
+    """
+    Config per periodo da config["periods"]:
+        [{"name": "AM", "observed_times_csv": "am.csv", ...}, ...]
+    oppure {"AM": "am.csv", "PM": {"observed_times_csv": "pm.csv", ...}}.
+    Le altre chiavi di un periodo sovrascrivono quelle globali (tranne le
+    PERIOD_SHARED_KEYS della rete); output in <output_dir>/<name> se il
+    periodo non indica un proprio output_dir.
+    Un resume_from globale e' la cartella output del run multi-periodo
+    interrotto: ogni periodo riprende da <resume_from>/<name> (da zero se
+    li' non c'e' checkpoint), salvo un resume_from proprio del periodo.
+    Ritorna lista di (nome, config).
+    """
+    periods = config["periods"]
+    if isinstance(periods, dict):
+        periods = [{"name": name, **(p if isinstance(p, dict) else {"observed_times_csv": p})}
+                   for name, p in periods.items()]
+    resume_root = config.get("resume_from")
+    if resume_root and not Path(resume_root).is_dir():
+        print(f"[ERR] Con 'periods', resume_from deve essere la cartella output del "
+              f"run multi-periodo interrotto (checkpoint in <resume_from>/<periodo>): {resume_root}")
+        sys.exit(1)
+    out, seen = [], set()
+    for p in periods:
+        name = str(p.get("name") or "")
+        if not name or not p.get("observed_times_csv"):
+            print(f"[ERR] Periodo senza 'name' o 'observed_times_csv': {p}")
+            sys.exit(1)
+        if name in seen:
+            print(f"[ERR] Periodo duplicato: '{name}'")
+            sys.exit(1)
+        seen.add(name)
+        ignored = [k for k in PERIOD_SHARED_KEYS if k in p and p[k] != config.get(k)]
+        if ignored:
+            print(f"  [!] Periodo {name}: {ignored} ignorati (rete condivisa tra i periodi)")
+        overrides = {k: v for k, v in p.items() if k not in PERIOD_SHARED_KEYS and k != "name"}
+        cfg = {**config, **overrides, "periods": None}
+        cfg["output_dir"] = str(p.get("output_dir") or Path(config["output_dir"]) / name)
+        if resume_root and "resume_from" not in overrides:
+            period_dir = Path(resume_root) / name
+            if (period_dir / CHECKPOINT_FILE).exists():
+                cfg["resume_from"] = str(period_dir)
+            else:
+                print(f"  [i] Periodo {name}: nessun checkpoint in {period_dir}, parte da zero")
+                cfg["resume_from"] = None
+        out.append((name, cfg))
+    return out
+
+
+def _run_period_traced(network, name, config):
+    """run_period con trace propria in <output_dir periodo>; errori -> stato failed."""
+    t_start = time.perf_counter()
+    trace = start_trace(f"optimize_link_speeds[{name}]", config["output_dir"])
+    try:
+        flag_data = run_period(network, config)
+        status, error = "success", None
+    except (Exception, SystemExit) as e:
+        # SystemExit: errore di input gia' segnalato (es. colonne OD mancanti nel CSV)
+        exited = isinstance(e, SystemExit)
+        error = f"interrotto (exit code {e.code})" if exited else str(e)
+        print(f"\n[ERR] Periodo {name}: {error}")
+        if not exited:
+            traceback.print_exc(file=sys.stdout)
+        trace.save(status="failed")
+        flag_data, status = {}, "failed"
+    return {"status":        status,
+            "error":         error,
+            "output_dir":    config["output_dir"],
+            "n_iterations":  flag_data.get("n_iterations"),
+            "final_metrics": flag_data.get("final_metrics", {}),
+            "seconds":       round(time.perf_counter() - t_start, 2)}
+
+
+# Stato del processo worker multi-periodo (impostato da _init_period_worker)
+_PERIOD_STATE = {}
+
+
+def _init_period_worker(network):
+    """Initializer del pool: la rete arriva una volta per processo."""
+    _PERIOD_STATE["network"] = network
+
+
+def _period_worker(job):
+    """Un periodo in un processo del pool; log in <output_dir periodo>/optimization_stdout.log."""
+    import contextlib
+
+    name, config = job
+    Path(config["output_dir"]).mkdir(parents=True, exist_ok=True)
+    log_path = Path(config["output_dir"]) / "optimization_stdout.log"
+    with open(log_path, "w", encoding="utf-8") as log, contextlib.redirect_stdout(log):
+        result = _run_period_traced(_PERIOD_STATE["network"], name, config)
+    result["log"] = str(log_path)
+    return result
+
+
+def run_periods(network, config):
+    """
+    Ottimizzazione per piu' periodi sulla stessa rete: topologia CSR (e CCH)
+    compilata una volta, ogni periodo su un proprio grafo con attributi
+    arco privati. Con period_workers > 1 i periodi girano in processi
+    paralleli (ognuno con una copia della rete in memoria), altrimenti in
+    sequenza nello stesso processo.
+    Scrive in output_dir il flag riepilogativo; ritorna {nome: esito}.
+    """
+    periods = period_configs(config)
+    print("\n" + "-" * 60)
+    print(f"PERIODI: {', '.join(name for name, _ in periods)}")
+    print("-" * 60)
+
+    # Topologia condivisa: CSR (e gerarchia CCH) compilati su un grafo modello
+    with stage_timer("index_network"):
+        G = build_graph(network["links_df"], network["connectors_df"], network["centroids_df"],
+                        config, arrays=network["arrays"])
+        network = {**network, "csr": get_csr_graph(G)}
+        if any(cfg.get("skim_engine", "csr") == "cch" for _, cfg in periods):
+            network["cch"] = get_cch(G, cache_dir=config.get("cch_cache_dir")
+                                     or str(Path(config["output_dir"]) / "cch_cache"))
+        del G
+
+    n_proc = min(resolve_n_workers(config.get("period_workers", 0)), len(periods))
+    parent_trace = get_trace()
+    t_start = time.perf_counter()
+    results = {}
+    if n_proc > 1:
+        from concurrent.futures import ProcessPoolExecutor
+
+        print(f"  Periodi in parallelo: {n_proc} processi (log per periodo in optimization_stdout.log)")
+        with ProcessPoolExecutor(max_workers=n_proc, initializer=_init_period_worker,
+                                 initargs=(network,)) as pool:
+            for (name, _), result in zip(periods, pool.map(_period_worker, periods)):
+                results[name] = result
+                print(f"  [{'OK' if result['status'] == 'success' else 'ERR'}] "
+                      f"Periodo {name}: {result['seconds']:.1f} s  ({result['log']})")
+    else:
+        for name, cfg in periods:
+            print("\n" + "=" * 70)
+            print(f"PERIODO {name}  ->  {cfg['output_dir']}")
+            print("=" * 70)
+            try:
+                results[name] = _run_period_traced(network, name, cfg)
+            finally:
+                resume_trace(parent_trace)
+    wall = time.perf_counter() - t_start
+
+    n_ok = sum(r["status"] == "success" for r in results.values())
+    print("\n" + "=" * 70)
+    print(f"PERIODI COMPLETATI: {n_ok} / {len(results)}  ({wall:.1f} s)")
+    for name, r in results.items():
+        rmse = r["final_metrics"].get("rmse")
+        print(f"  {name:12s} {r['status']:8s} {r['seconds']:8.1f} s"
+              + (f"  RMSE={rmse:.3f} min" if rmse is not None else ""))
+    print("=" * 70)
+
+    flag_data = {
+        "status":         "success" if n_ok == len(results) else "failed",
+        "periods":        results,
+        "period_workers": n_proc,
+        "periods_seconds": round(wall, 2),
+    }
+    if parent_trace is not None:
+        parent_trace.save()
+        flag_data["trace"] = parent_trace.summary()
+    with open(Path(config["output_dir"]) / "optimization_complete.flag", "w") as f:
+        json.dump(flag_data, f, indent=2)
+    return results
+
+
+def main():
+    print("=" * 70)
+    print("NETWORK SPEED OPTIMIZATION")
+    print("Ottimizzazione velocita LinkType via Bounded Least Squares")
+    print("=" * 70)
+
+    # -- Carica config
+    args     = [a for a in sys.argv[1:] if not a.startswith("--")]
+    no_cache = "--no-cache" in sys.argv[1:]
+    if not args:
+        print("Uso: python optimize_link_speeds.py config.json [--no-cache]")
+        sys.exit(1)
+
+    config_path = Path(args[0])
+    if not config_path.exists():
+        print(f"[ERR] Config non trovato: {config_path}")
+        sys.exit(1)
+
+    with open(config_path, "r", encoding="utf-8") as f:
+        user_config = json.load(f)
+
+    config = {**DEFAULT_CONFIG, **user_config}
+    start_trace("optimize_link_speeds", config.get("output_dir"))
+    multi_period = bool(config.get("periods"))
+
+    print(f"\nConfig: {config_path}")
+    print(f"  Rete:              {config['network_dir']}")
+    if multi_period:
+        print(f"  Periodi:           {len(config['periods'])}  "
+              f"(processi: {config.get('period_workers', 0) or 'tutti i core'})")
+    else:
+        print(f"  Tempi osservati:   {config['observed_times_csv']}")
+    print(f"  Output:            {config['output_dir']}")
+    print(f"  Motore skim:       {config.get('skim_engine', 'csr')}")
+    print(f"  Processi skim:     {config.get('n_workers', 1)}")
+
+    # -- Verifica input obbligatori
+    required = ["network_dir", "output_dir"] + ([] if multi_period else ["observed_times_csv"])
+    for key in required:
+        if not config.get(key):
+            print(f"[ERR] Config mancante: '{key}'")
+            sys.exit(1)
+
+    network = load_network(config, no_cache)
+    if multi_period:
+        results = run_periods(network, config)
+        if any(r["status"] != "success" for r in results.values()):
+            sys.exit(2)
+        return
+    run_period(network, config)
 
 
 if __name__ == "__main__":
@@ -2457,4 +3488,6 @@ if __name__ == "__main__":
     except Exception as e:
         print(f"\n[ERR] ERRORE: {e}")
         traceback.print_exc()
+        if get_trace() is not None:
+            get_trace().save(status="failed")
         sys.exit(2)
@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Skim export
+===========
+Export in streaming dello skim finale (od_comparison) per
+optimize_link_speeds.py e optimize_capacity.py.
+
+Lo skim finale in memoria (compute_final_skims) conserva tutti i percorsi
+N x N prima di costruire la matrice di composizione: con migliaia di zone
+non entra in RAM. Con config "final_skim_chunk_origins" = k:
+
+    - le origini sono elaborate a blocchi di k (iter_type_skims_csr): metri
+      per LinkType accumulati sull'albero dei predecessori, nessun percorso
+      conservato
+    - ogni blocco diventa un DataFrame con le colonne e gli arrotondamenti
+      di compute_final_skims (+ tempo osservato ed errori) e viene accodato
+      al file di output
+    - restano in memoria solo le righe con tempo osservato (scatter plot)
+
+La memoria di picco dipende da k (origini x nodi per il Dijkstra), non dal
+numero di zone. Con lo stesso grafo il CSV e' identico a quello scritto da
+save_results con lo skim in memoria (motore csr).
+
+FORMATI ("final_skim_format"):
+    "csv"      od_comparison.csv, separatore dello script
+    "parquet"  od_comparison.parquet, un row group per blocco (richiede pyarrow)
+"""
+
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from csr_graph import iter_type_skims_csr
+from observed_times import encode_od_keys
+
+
+# Formati ammessi per l'export a blocchi
+SKIM_EXPORT_FORMATS = ("csv", "parquet")
+
+
+def type_skim_frame(orig, dest, times, L, linktype_list):
+    """
+    DataFrame dello skim per un blocco di coppie, con le colonne e gli
+    arrotondamenti di compute_final_skims:
+        origin | destination | time_model_min | length_type_<lt>_m | pct_type_<lt> ...
+    """
+    lengths = np.round(L, 1)
+    pct     = np.round(L / np.maximum(L.sum(axis=1), 1)[:, None] * 100, 2)
+    data = {"origin": orig, "destination": dest,
+            # round() Python sul float come lo skim in memoria
+            "time_model_min": [round(t, 4) for t in times.tolist()]}
+    for j, lt in enumerate(linktype_list):
+        data["length_type_{}_m".format(lt)] = lengths[:, j]
+        data["pct_type_{}".format(lt)]      = pct[:, j]
+    return pd.DataFrame(data)
+
+
+class ObservedLookup:
+    """Tempi osservati {(orig, dest): minuti} come chiavi OD ordinate (ricerca vettoriale)."""
+
+    def __init__(self, T_obs_dict):
+        od = np.array(list(T_obs_dict), dtype=np.int64).reshape(-1, 2)
+        keys  = encode_od_keys(od[:, 0], od[:, 1])
+        order = np.argsort(keys, kind="stable")
+        self.keys  = keys[order]
+        self.times = np.array(list(T_obs_dict.values()), dtype=np.float64)[order]
+
+    def get(self, orig, dest):
+        """Tempo osservato per coppia (NaN se assente)."""
+        keys = encode_od_keys(orig, dest)
+        if len(self.keys) == 0:
+            return np.full(len(keys), np.nan)
+        pos = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        return np.where(self.keys[pos] == keys, self.times[pos], np.nan)
+
+
+def add_observed_columns(df, lookup):
+    """time_observed_min, error_min, error_pct come in save_results."""
+    df["time_observed_min"] = lookup.get(df["origin"].to_numpy(), df["destination"].to_numpy())
+    df["error_min"] = df["time_model_min"] - df["time_observed_min"]
+    df["error_pct"] = (df["error_min"]
+                       / df["time_observed_min"].replace(0, np.nan) * 100)
+    return df
+
+
+class SkimTableWriter:
+    """
+    Scrittura a blocchi di DataFrame con le stesse colonne: CSV in append
+    (intestazione solo al primo blocco) o Parquet (un row group per blocco).
+    """
+
+    def __init__(self, path, fmt="csv", sep=","):
+        if fmt not in SKIM_EXPORT_FORMATS:
+            raise ValueError("final_skim_format non valido: {!r} (usa {})".format(
+                fmt, ", ".join(SKIM_EXPORT_FORMATS)))
+        self.path   = Path(path)
+        self.fmt    = fmt
+        self.sep    = sep
+        self.n_rows = 0
+        self._file  = None
+        self._pq    = None
+        if fmt == "parquet":
+            try:
+                import pyarrow
+                import pyarrow.parquet as pq
+            except ImportError:
+                print("[ERR] Export Parquet non disponibile: installare pyarrow "
+                      "(oppure final_skim_format = \"csv\")")
+                raise SystemExit(1)
+            self._pa, self._pq = pyarrow, pq
+        else:
+            self._file = open(self.path, "w", encoding="utf-8", newline="")
+
+    def write(self, df):
+        if self.fmt == "parquet":
+            table = self._pa.Table.from_pandas(df, preserve_index=False)
+            if self._file is None:
+                self._file = self._pq.ParquetWriter(str(self.path), table.schema)
+            self._file.write_table(table)
+        else:
+            df.to_csv(self._file, index=False, sep=self.sep, header=self.n_rows == 0)
+        self.n_rows += len(df)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+def export_type_skims(G, centroid_ids, linktype_list, output_dir, T_obs_dict,
+                      weight="t0", chunk_origins=100, fmt="csv", sep=",", verbose=True):
+    """
+    Skim finale a blocchi scritto direttamente in output_dir/od_comparison.<fmt>.
+
+    Ritorna le sole righe con tempo osservato (stesse colonne del file),
+    usate da save_scatter_plots al posto dello skim completo.
+    """
+    out = Path(output_dir)
+    out.mkdir(parents=True, exist_ok=True)
+    path   = out / "od_comparison.{}".format(fmt)
+    lookup = ObservedLookup(T_obs_dict or {})
+
+    observed = []
+    with SkimTableWriter(path, fmt, sep) as writer:
+        for orig, dest, times, L in iter_type_skims_csr(
+                G, centroid_ids, linktype_list, weight=weight,
+                chunk_origins=chunk_origins, verbose=verbose):
+            df = add_observed_columns(
+                type_skim_frame(orig, dest, times, L, linktype_list), lookup)
+            writer.write(df)
+            observed.append(df[df["time_observed_min"].notna()])
+
+    if verbose:
+        print("  [OK] Confronto OD ({} righe, a blocchi): {}".format(writer.n_rows, path))
+    if not observed:
+        return None
+    return pd.concat(observed, ignore_index=True)
@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Stage timing
+============
+Cronometro leggero per le fasi degli script di ottimizzazione
+(caricamento rete, costruzione grafo, skim, ...) con contatori e trace
+strutturata.
+
+UTILIZZO:
+    with stage_timer("build_graph"):
+        G = build_graph(...)
+
+    ->  "  [t] build_graph: 1.23 s"
+
+    Il context manager ritorna un dict riempito a fine fase
+    ({"label", "seconds", "peak_rss_mb", "counters", "info"}), usato da
+    benchmark_optimizers.py:
+
+    with stage_timer("build_graph") as timing:
+        ...
+    timing["seconds"]
+
+CONTATORI:
+    trace_count("dijkstra_calls", n) somma n ai contatori di tutte le fasi
+    aperte (una fase "iteration" raccoglie quelli delle sue chiamate);
+    trace_info(D_shape=[n, m]) registra un valore nella fase piu' interna.
+    Senza fasi aperte sono no-op: le funzioni di libreria li chiamano
+    sempre.
+
+TRACE (trace.json):
+    trace = start_trace("optimize_link_speeds", output_dir)
+    ...                                   # fasi cronometrate
+    trace.save()                          # output_dir/trace.json
+    flag_data["trace"] = trace.summary()  # riepilogo nel flag file
+
+    Una sola trace attiva per processo: start_trace() la sostituisce
+    (es. una trace per periodo), resume_trace() riattiva la precedente.
+
+    Ogni fase chiusa diventa una voce con inizio/durata, picco RSS del
+    processo a fine fase (high-water mark: non include i worker del pool),
+    fase padre, contatori e info.
+"""
+
+import json
+import sys
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+
+# Nome del file trace nella cartella output
+TRACE_FILE = "trace.json"
+
+# Fasi aperte (dal piu' esterno al piu' interno) e trace attiva
+_OPEN_STAGES = []
+_TRACE = None
+
+
+def peak_rss_mb():
+    """Picco di memoria residente del processo (MB), None se non disponibile."""
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux: KB, macOS: byte
+        return round(peak / (1024.0 * 1024.0 if sys.platform == "darwin" else 1024.0), 1)
+    except ImportError:
+        pass
+    try:
+        import ctypes
+        from ctypes import wintypes
+
+        class _Counters(ctypes.Structure):
+            _fields_ = [("cb", wintypes.DWORD), ("PageFaultCount", wintypes.DWORD),
+                        ("PeakWorkingSetSize", ctypes.c_size_t),
+                        ("WorkingSetSize", ctypes.c_size_t),
+                        ("QuotaPeakPagedPoolUsage", ctypes.c_size_t),
+                        ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                        ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t),
+                        ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                        ("PagefileUsage", ctypes.c_size_t),
+                        ("PeakPagefileUsage", ctypes.c_size_t)]
+
+        counters = _Counters()
+        counters.cb = ctypes.sizeof(counters)
+        handle = ctypes.windll.kernel32.GetCurrentProcess()
+        if ctypes.windll.psapi.GetProcessMemoryInfo(handle, ctypes.byref(counters),
+                                                    counters.cb):
+            return round(counters.PeakWorkingSetSize / (1024.0 * 1024.0), 1)
+    except (ImportError, AttributeError, OSError):
+        pass
+    return None
+
+
+def _json_value(value):
+    """Valori numpy -> tipi Python (serializzabili in JSON)."""
+    if hasattr(value, "tolist"):
+        return value.tolist()
+    if isinstance(value, (list, tuple)):
+        return [_json_value(v) for v in value]
+    return value
+
+
+def trace_count(name, n=1):
+    """Somma n al contatore `name` delle fasi aperte e della trace."""
+    if not _OPEN_STAGES and _TRACE is None:
+        return
+    n = _json_value(n)
+    for timing in _OPEN_STAGES:
+        timing["counters"][name] = timing["counters"].get(name, 0) + n
+    if _TRACE is not None:
+        _TRACE.counters[name] = _TRACE.counters.get(name, 0) + n
+
+
+def trace_info(**info):
+    """Registra valori (forma di D, stato del solver, ...) nella fase piu' interna."""
+    if _OPEN_STAGES:
+        _OPEN_STAGES[-1]["info"].update({k: _json_value(v) for k, v in info.items()})
+
+
+@contextmanager
+def stage_timer(label, **info):
+    """
+    Misura il tempo (wall clock) del blocco e lo stampa a fine fase.
+    info: valori fissi della fase (es. iteration=3, mostrato nel log).
+    """
+    timing = {"label": label, "counters": {}, "info": {k: _json_value(v) for k, v in info.items()}}
+    parent = _OPEN_STAGES[-1]["label"] if _OPEN_STAGES else None
+    _OPEN_STAGES.append(timing)
+    t_start = time.perf_counter()
+    try:
+        yield timing
+    finally:
+        _OPEN_STAGES.remove(timing)
+        timing["seconds"]     = time.perf_counter() - t_start
+        timing["peak_rss_mb"] = peak_rss_mb()
+        if _TRACE is not None:
+            _TRACE.add(timing, t_start, parent)
+        shown = label if "iteration" not in info else "{} {}".format(label, info["iteration"])
+        print("  [t] {}: {:.2f} s".format(shown, timing["seconds"]))
+
+
+class StageTrace:
+    """Fasi chiuse, contatori totali e riepilogo di un run (trace.json)."""
+
+    def __init__(self, script, output_dir=None):
+        self.script     = script
+        self.output_dir = output_dir
+        self.started    = datetime.now().isoformat(timespec="seconds")
+        self.t_start    = time.perf_counter()
+        self.stages     = []
+        self.counters   = {}
+
+    def add(self, timing, t_start, parent=None):
+        self.stages.append({
+            "name":        timing["label"],
+            "parent":      parent,
+            "start_s":     round(t_start - self.t_start, 4),
+            "seconds":     round(timing["seconds"], 4),
+            "peak_rss_mb": timing["peak_rss_mb"],
+            "counters":    dict(timing["counters"]),
+            "info":        dict(timing["info"]),
+        })
+
+    def to_dict(self, status="success"):
+        return {
+            "script":        self.script,
+            "status":        status,
+            "started":       self.started,
+            "total_seconds": round(time.perf_counter() - self.t_start, 4),
+            "peak_rss_mb":   peak_rss_mb(),
+            "counters":      dict(self.counters),
+            "stages":        sorted(self.stages, key=lambda s: s["start_s"]),
+        }
+
+    def summary(self):
+        """Riepilogo per il flag file: durata delle fasi principali e delle iterazioni."""
+        top = {}
+        for s in sorted(self.stages, key=lambda s: s["start_s"]):
+            if s["parent"] is None:
+                top[s["name"]] = round(top.get(s["name"], 0.0) + s["seconds"], 2)
+        iterations = [s for s in self.stages if s["name"] == "iteration"]
+        return {
+            "trace_file":    str(Path(self.output_dir) / TRACE_FILE) if self.output_dir else None,
+            "total_seconds": round(time.perf_counter() - self.t_start, 2),
+            "peak_rss_mb":   peak_rss_mb(),
+            "stages":        top,
+            "iteration_seconds": [round(s["seconds"], 2)
+                                  for s in sorted(iterations, key=lambda s: s["start_s"])],
+            "counters":      dict(self.counters),
+        }
+
+    def save(self, status="success"):
+        """Scrive output_dir/trace.json; ritorna il path (None senza output_dir)."""
+        if not self.output_dir:
+            return None
+        path = Path(self.output_dir) / TRACE_FILE
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(status), f, indent=2)
+        print("  [OK] Trace fasi: {}".format(path))
+        return path
+
+
+def start_trace(script, output_dir=None):
+    """Attiva la trace del processo (le fasi successive vengono registrate)."""
+    global _TRACE
+    _TRACE = StageTrace(script, output_dir)
+    return _TRACE
+
+
+def get_trace():
+    """Trace attiva o None."""
+    return _TRACE
+
+
+def resume_trace(trace):
+    """Riattiva una trace (es. quella del processo dopo i run per periodo)."""
+    global _TRACE
+    _TRACE = trace
+    return trace
@@ -0,0 +1,338 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Traffic assignment
+==================
+Assegnazione statica all'equilibrio (user equilibrium) sul grafo CSR, per
+la calibrazione delle capacita' in optimize_capacity.py
+(capacity_method = "assignment") senza eseguire Visum ad ogni candidato.
+
+MODELLO:
+    Funzione di costo BPR per arco (minuti):
+        t(v) = t0 * (1 + a * (v / (cap * assignment_cap_factor)) ** b)
+    con (a, b) per LinkType da config "vdf_bpr":
+        {"default": [0.15, 4.0], "<TypeNo o tipo base>": [a, b], ...}
+    (prima il TypeNo completo, poi il tipo base BB di BBSC, poi "default").
+    Connettori e archi senza capacita': tempo fisso t0.
+
+DOMANDA:
+    CSV nel formato di import_demand_matrices_from_csv
+    (import-osm-network.py), con o senza intestazione:
+        dseg ; from_O ; to_D ; value
+    Uno o piu' file ("demand_csv": path o lista), DSeg sommati con i
+    fattori opzionali "demand_dseg_factors" ({codice: fattore}, es.
+    equivalenti autovettura; 0 = escluso). Matrici esportabili da Visum con
+    export_demand_matrices_to_csv.
+
+ALGORITMO ("assignment_method"):
+    "fw"   Frank-Wolfe
+    "cfw"  Conjugate Frank-Wolfe (Mitradjieva & Lindberg, 2013): la
+           direzione combina il punto AON con quello dell'iterazione
+           precedente, coniugati rispetto all'hessiana diagonale di BPR
+    Passo: bisezione sulla derivata dell'obiettivo di Beckmann.
+    Arresto: relative gap (TSTT - SPTT) / TSTT <= assignment_rel_gap
+    oppure assignment_max_iter iterazioni.
+
+CARICAMENTO ALL-OR-NOTHING (vettoriale):
+    Dijkstra scipy multi-sorgente a blocchi di origini con predecessori.
+    La domanda di tutte le coppie del blocco risale gli alberi un passo alla
+    volta (come type_lengths_from_predecessors): ad ogni passo le coppie
+    arrivate allo stesso nodo della stessa origine vengono unite, quindi il
+    lavoro e' proporzionale agli archi degli alberi usati, non alla somma
+    delle lunghezze dei percorsi.
+
+UTILIZZO:
+    demand = load_demand_csv(config["demand_csv"], config)
+    assignment = StaticAssignment(G, demand, config)
+    res = assignment.solve(cap=cap_arco, flows=flussi_precedenti)   # warm start
+    res["flows"], res["times"], res["rel_gap"]
+"""
+
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from csr_graph import DIJKSTRA_BLOCK_CELLS, get_csr_graph, get_edge_store
+from observed_times import encode_od_keys, decode_od_keys, sniff_delimiter
+from stage_timing import trace_count
+
+
+# Parametri BPR di default (a, b)
+BPR_ALPHA = 0.15
+BPR_BETA  = 4.0
+
+# Default del solutore (chiavi config assignment_*)
+ASSIGNMENT_METHODS  = ("cfw", "fw")
+ASSIGNMENT_MAX_ITER = 50
+ASSIGNMENT_REL_GAP  = 1e-4
+
+# Passi di bisezione della line search (precisione 2^-30 sul passo)
+LINE_SEARCH_STEPS = 30
+
+# CFW: peso massimo della direzione precedente (1 - delta dell'articolo)
+CFW_MAX_WEIGHT = 0.99
+
+
+class ODDemand:
+    """Domanda OD aggregata: array paralleli orig, dest (zone) e veicoli."""
+
+    def __init__(self, orig, dest, trips):
+        self.orig  = np.asarray(orig, dtype=np.int64)
+        self.dest  = np.asarray(dest, dtype=np.int64)
+        self.trips = np.asarray(trips, dtype=np.float64)
+
+    def __len__(self):
+        return len(self.trips)
+
+    @property
+    def total(self):
+        return float(self.trips.sum())
+
+
+def _read_demand_file(path, separator=None):
+    """(dseg, orig, dest, value) da un CSV domanda; intestazione opzionale."""
+    sep = separator or sniff_delimiter(path)
+    df = pd.read_csv(path, sep=sep, header=None, dtype=str,
+                     skipinitialspace=True, encoding="utf-8-sig")
+    if df.shape[1] == 3:
+        df.insert(0, "dseg", "")
+    if df.shape[1] < 4:
+        raise ValueError("CSV domanda {}: attese 4 colonne (dseg, from_O, to_D, value), "
+                         "trovate {}".format(path, df.shape[1]))
+    df = df.iloc[:, :4]
+    df.columns = ["dseg", "orig", "dest", "value"]
+    value = pd.to_numeric(df["value"].str.replace(",", ".", regex=False), errors="coerce")
+    if len(df) and np.isnan(value.iloc[0]):
+        df, value = df.iloc[1:], value.iloc[1:]   # riga di intestazione
+    orig = pd.to_numeric(df["orig"], errors="coerce")
+    dest = pd.to_numeric(df["dest"], errors="coerce")
+    ok = orig.notna() & dest.notna() & value.notna()
+    return (df["dseg"][ok].str.strip().to_numpy(), orig[ok].to_numpy(np.int64),
+            dest[ok].to_numpy(np.int64), value[ok].to_numpy(np.float64))
+
+
+def load_demand_csv(paths, config=None):
+    """
+    Matrici di domanda da uno o piu' CSV (vedi modulo), sommate per coppia
+    OD con i fattori per DSeg. Coppie intrazonali e valori <= 0 esclusi.
+    """
+    config = config or {}
+    if isinstance(paths, (str, Path)):
+        paths = [paths]
+    factors = config.get("demand_dseg_factors") or {}
+
+    keys, trips = [], []
+    for path in paths:
+        dseg, orig, dest, value = _read_demand_file(path, config.get("demand_separator"))
+        weight = np.array([float(factors.get(d, 1.0)) for d in dseg.tolist()]) \
+            if factors else np.ones(len(value))
+        print("  Domanda: {} ({:,} righe, DSeg: {})".format(
+            path, len(value), ", ".join(sorted(set(dseg.tolist()))) or "-"))
+        keys.append(encode_od_keys(orig, dest))
+        trips.append(value * weight)
+
+    keys  = np.concatenate(keys) if keys else np.empty(0, dtype=np.int64)
+    trips = np.concatenate(trips) if trips else np.empty(0)
+    uniq, inverse = np.unique(keys, return_inverse=True)
+    total = np.bincount(inverse, weights=trips, minlength=len(uniq))
+    orig, dest = decode_od_keys(uniq)
+    keep = (orig != dest) & (total > 0)
+    demand = ODDemand(orig[keep], dest[keep], total[keep])
+    print("  Coppie OD con domanda: {:,}  (totale {:,.1f} veicoli)".format(
+        len(demand), demand.total))
+    return demand
+
+
+def bpr_parameters(store, vdf=None):
+    """
+    Array (a, b) per arco dai parametri "vdf_bpr" per LinkType; connettori
+    a = 0 (tempo fisso).
+    """
+    vdf = {str(k): v for k, v in (vdf or {}).items()}
+    a0, b0 = vdf.get("default", (BPR_ALPHA, BPR_BETA))
+    lt = store["linktype"]
+    alpha_by_type, beta_by_type = {}, {}
+    for t in np.unique(lt[lt >= 0]).tolist():
+        base = t // 100 if t >= 1000 else t
+        a, b = vdf.get(str(t), vdf.get(str(base), (a0, b0)))
+        alpha_by_type[t], beta_by_type[t] = float(a), float(b)
+    alpha = store.by_type(alpha_by_type, default=0.0)
+    beta  = store.by_type(beta_by_type, default=b0)
+    alpha[store["is_connector"] | (lt < 0)] = 0.0
+    return alpha, beta
+
+
+class StaticAssignment:
+    """
+    Assegnazione user equilibrium della domanda sul grafo G (topologia CSR
+    e attributi dall'EdgeStore: t0, cap, linktype, is_connector).
+    """
+
+    def __init__(self, G, demand, config=None):
+        config = config or {}
+        self.csr   = get_csr_graph(G)
+        store      = get_edge_store(G)
+        self.t0    = np.maximum(store["t0"].astype(np.float64), 1e-6)
+        self.cap   = store["cap"].astype(np.float64) * float(config.get("assignment_cap_factor", 1.0))
+        self.alpha, self.beta = bpr_parameters(store, config.get("vdf_bpr"))
+        self.method   = config.get("assignment_method", "cfw")
+        self.max_iter = int(config.get("assignment_max_iter", ASSIGNMENT_MAX_ITER))
+        self.rel_gap  = float(config.get("assignment_rel_gap", ASSIGNMENT_REL_GAP))
+        if self.method not in ASSIGNMENT_METHODS:
+            raise ValueError("assignment_method non valido: {!r} (usa {})".format(
+                self.method, ", ".join(ASSIGNMENT_METHODS)))
+
+        # Coppie con domanda raggruppate per origine (indici nodo centroide -zona)
+        o_pos = self.csr.node_positions(-demand.orig)
+        d_pos = self.csr.node_positions(-demand.dest)
+        ok = (o_pos >= 0) & (d_pos >= 0)
+        if not ok.all():
+            print("  [!] Domanda su zone assenti dal grafo: {} coppie, {:,.1f} veicoli "
+                  "esclusi".format(int((~ok).sum()), float(demand.trips[~ok].sum())))
+        order = np.lexsort((d_pos[ok], o_pos[ok]))
+        src, self.pair_dst, self.pair_q = o_pos[ok][order], d_pos[ok][order], demand.trips[ok][order]
+        self.origins, self.pair_row = np.unique(src, return_inverse=True)
+        self.pair_ptr = np.searchsorted(self.pair_row, np.arange(len(self.origins) + 1))
+        self.n_unreached = 0
+
+    def _capacity(self, cap):
+        cap = self.cap if cap is None else cap
+        return np.where(cap > 0, cap, np.inf)
+
+    def link_times(self, flows, cap=None):
+        """Tempi BPR (minuti) per arco con i flussi dati."""
+        ratio = np.maximum(flows, 0.0) / self._capacity(cap)
+        return self.t0 * (1.0 + self.alpha * ratio ** self.beta)
+
+    def _time_slopes(self, flows, cap):
+        """Derivata dt/dv di BPR per arco (hessiana diagonale dell'obiettivo)."""
+        c = self._capacity(cap)
+        b = self.beta
+        return self.t0 * self.alpha * b * np.maximum(flows, 0.0) ** (b - 1.0) / c ** b
+
+    def all_or_nothing(self, times):
+        """
+        Carica tutta la domanda sui percorsi minimi con i tempi dati.
+        Ritorna (flussi per arco, SPTT = somma domanda x tempo minimo).
+        """
+        from scipy.sparse.csgraph import dijkstra
+
+        csr      = self.csr
+        n_nodes  = csr.n_nodes
+        arc_keys = csr.arc_keys()
+        graph    = csr.matrix(times)
+        block    = max(1, DIJKSTRA_BLOCK_CELLS // max(n_nodes, 1))
+        flows    = np.zeros(csr.n_arcs)
+        sptt     = 0.0
+        unreached = 0
+
+        for start in range(0, len(self.origins), block):
+            stop = min(start + block, len(self.origins))
+            src_nodes = self.origins[start:stop]
+            dist, pred = dijkstra(graph, directed=True, indices=src_nodes,
+                                  return_predecessors=True)
+            trace_count("dijkstra_calls")
+            trace_count("dijkstra_origins", stop - start)
+            lo, hi = self.pair_ptr[start], self.pair_ptr[stop]
+            rows = self.pair_row[lo:hi] - start
+            cur  = self.pair_dst[lo:hi].astype(np.int64)
+            q    = self.pair_q[lo:hi]
+            d    = dist[rows, cur]
+            reach = np.isfinite(d)
+            unreached += int((~reach).sum())
+            rows, cur, q = rows[reach], cur[reach], q[reach]
+            sptt += float(q @ d[reach])
+
+            # Risalita degli alberi: coppie allo stesso nodo unite ad ogni passo
+            arcs_all, q_all = [], []
+            live = cur != src_nodes[rows]
+            rows, cur, q = rows[live], cur[live], q[live]
+            while len(rows):
+                prev = pred[rows, cur].astype(np.int64)
+                arcs_all.append(np.searchsorted(arc_keys, prev * n_nodes + cur))
+                q_all.append(q)
+                live = prev != src_nodes[rows]
+                keys, inverse = np.unique(rows[live] * n_nodes + prev[live],
+                                          return_inverse=True)
+                q = np.bincount(inverse, weights=q[live], minlength=len(keys))
+                rows, cur = np.divmod(keys, n_nodes)
+            if arcs_all:
+                flows += np.bincount(np.concatenate(arcs_all), weights=np.concatenate(q_all),
+                                     minlength=csr.n_arcs)
+
+        if unreached and unreached != self.n_unreached:
+            print("  [!] Coppie OD con domanda non raggiungibili: {}".format(unreached))
+        self.n_unreached = unreached
+        trace_count("aon_loads")
+        return flows, sptt
+
+    def _line_search(self, x, d, cap):
+        """Passo in [0, 1] che annulla la derivata di Beckmann lungo d (bisezione)."""
+        idx = np.flatnonzero(d)
+        if len(idx) == 0:
+            return 0.0
+        x, d = x[idx], d[idx]
+        t0, alpha, beta = self.t0[idx], self.alpha[idx], self.beta[idx]
+        c = self._capacity(cap)[idx]
+
+        def slope(step):
+            return float(d @ (t0 * (1.0 + alpha * (np.maximum(x + step * d, 0.0) / c) ** beta)))
+
+        if slope(1.0) <= 0:
+            return 1.0
+        lo, hi = 0.0, 1.0
+        for _ in range(LINE_SEARCH_STEPS):
+            mid = 0.5 * (lo + hi)
+            if slope(mid) > 0:
+                hi = mid
+            else:
+                lo = mid
+        return 0.5 * (lo + hi)
+
+    def solve(self, cap=None, flows=None, verbose=True):
+        """
+        Equilibrio con capacita' per arco `cap` (None = quelle della rete) a
+        partire dai flussi `flows` (warm start, es. soluzione del candidato
+        precedente) o da un carico AON a flusso nullo.
+
+        Ritorna {"flows", "times", "rel_gap", "iterations", "converged"}.
+        """
+        if flows is None:
+            x, _ = self.all_or_nothing(self.t0)
+        else:
+            x = np.asarray(flows, dtype=np.float64).copy()
+        s_prev = None
+        rel_gap = np.inf
+        iteration = 0
+        for iteration in range(1, self.max_iter + 1):
+            t = self.link_times(x, cap)
+            y, sptt = self.all_or_nothing(t)
+            tstt = float(x @ t)
+            rel_gap = (tstt - sptt) / max(tstt, 1e-12)
+            if rel_gap <= self.rel_gap:
+                break
+
+            s = y
+            if self.method == "cfw" and s_prev is not None:
+                # Direzione coniugata alla precedente rispetto a diag(dt/dv)
+                h = self._time_slopes(x, cap)
+                d_prev = s_prev - x
+                num = float(d_prev @ (h * (y - x)))
+                den = float(d_prev @ (h * (y - s_prev)))
+                if den != 0:
+                    weight = min(max(num / den, 0.0), CFW_MAX_WEIGHT)
+                    s = weight * s_prev + (1.0 - weight) * y
+            d = s - x
+            step = self._line_search(x, d, cap)
+            x = x + step * d
+            s_prev = s
+        trace_count("assignment_iterations", iteration)
+
+        converged = rel_gap <= self.rel_gap
+        if verbose:
+            print("  Assegnazione [{}]: {} iterazioni, relative gap {:.2e}{}".format(
+                self.method, iteration, rel_gap,
+                "" if converged else " (limite iterazioni)"))
+        return {"flows": x, "times": self.link_times(x, cap), "rel_gap": float(rel_gap),
+                "iterations": iteration, "converged": converged}
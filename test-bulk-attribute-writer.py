@@ -0,0 +1,199 @@
+"""
+Test di BulkAttributeWriter (import-osm-network.py) senza Visum.
+
+La collezione COM e' sostituita da un oggetto finto che registra le
+chiamate; i tre percorsi di scrittura vengono forzati disattivando i
+metodi in blocco:
+  1. SetMultiAttValues
+  2. SetMultipleAttributes (fallback)
+  3. SetAttValue oggetto per oggetto a blocchi (fallback finale)
+
+import-osm-network.py importa win32com a livello di modulo: le sole
+definizioni necessarie vengono estratte dal sorgente con ast.
+
+Uso:
+    python test-bulk-attribute-writer.py
+"""
+
+import ast
+import os
+import sys
+
+import numpy as np
+
+SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "import-osm-network.py")
+NEEDED = ("BULK_WRITE_CHUNK", "_NETWORK_SNAPSHOT", "_com_value", "BulkAttributeWriter",
+          "invalidate_network_snapshot")
+
+
+def load_writer_module():
+    """Esegue solo le definizioni in NEEDED di import-osm-network.py."""
+    with open(SOURCE, encoding="utf-8") as f:
+        tree = ast.parse(f.read(), SOURCE)
+    body = []
+    for node in tree.body:
+        if isinstance(node, (ast.FunctionDef, ast.ClassDef)) and node.name in NEEDED:
+            body.append(node)
+        elif isinstance(node, ast.Assign) and getattr(node.targets[0], "id", None) in NEEDED:
+            body.append(node)
+    ns = {"np": np}
+    exec(compile(ast.Module(body, []), SOURCE, "exec"), ns)
+    return ns
+
+
+class FakeObject:
+    """Oggetto di GetAll: SetAttValue scrive nella colonna della collezione."""
+
+    def __init__(self, collection, row):
+        self.collection = collection
+        self.row = row
+
+    def SetAttValue(self, attr, value):
+        self.collection.calls.append("SetAttValue")
+        self.collection.data[attr][self.row] = value
+
+
+class FakeCollection:
+    """
+    Collezione Visum finta (Net.Links, Net.Nodes, ...). `methods` indica
+    quali metodi in blocco funzionano; gli altri sollevano come un COM
+    che non li espone.
+    """
+
+    def __init__(self, n, attrs=("TypeNo", "AddVal1"), methods=()):
+        self.data = {attr: [0] * n for attr in attrs}
+        self.methods = set(methods)
+        self.calls = []
+
+    def _check(self, method):
+        if method not in self.methods:
+            raise AttributeError("<unknown>.{}".format(method))
+        self.calls.append(method)
+
+    def SetMultiAttValues(self, attr, items):
+        self._check("SetMultiAttValues")
+        for index, value in items:
+            self.data[attr][index - 1] = value
+
+    def GetMultipleAttributes(self, attrs):
+        self._check("SetMultipleAttributes")
+        n = len(self.data[attrs[0]])
+        return tuple(tuple(self.data[a][i] for a in attrs) for i in range(n))
+
+    def SetMultipleAttributes(self, attrs, rows):
+        self._check("SetMultipleAttributes")
+        for i, row in enumerate(rows):
+            for attr, value in zip(attrs, row):
+                self.data[attr][i] = value
+
+    @property
+    def GetAll(self):
+        self.calls.append("GetAll")
+        return [FakeObject(self, i) for i in range(len(self.data["TypeNo"]))]
+
+
+def fill(writer, n):
+    """Aggiornamenti con indici/valori numpy: TypeNo sugli indici dispari, un AddVal1."""
+    for index in range(1, n + 1, 2):
+        writer.set(np.int64(index), "TypeNo", np.int64(index * 10))
+    writer.set(np.int64(1), "TypeNo", np.int64(7))     # a parita' di indice vince l'ultimo
+    writer.set(3, "AddVal1", np.float64(1.5))
+
+
+def check_values(coll, n):
+    expected = [(i * 10 if i % 2 else 0) for i in range(1, n + 1)]
+    expected[0] = 7
+    assert coll.data["TypeNo"] == expected, "valori TypeNo errati"
+    assert coll.data["AddVal1"][2] == 1.5 and sum(coll.data["AddVal1"]) == 1.5
+    assert type(coll.data["TypeNo"][0]) is int, "valori numpy non convertiti"
+    assert type(coll.data["AddVal1"][2]) is float
+
+
+def test_set_multi_att_values(W):
+    coll = FakeCollection(100, methods=("SetMultiAttValues", "SetMultipleAttributes"))
+    writer = W(coll)
+    fill(writer, 100)
+    assert len(writer) == 51
+    written = writer.flush()
+    check_values(coll, 100)
+    assert written == {"TypeNo": 50, "AddVal1": 1}
+    assert coll.calls == ["SetMultiAttValues", "SetMultiAttValues"]
+    assert writer.method == "SetMultiAttValues"
+    assert writer.stats == {"bulk_calls": 2, "object_writes": 0}
+    assert len(writer) == 0 and writer.flush() == {}
+
+
+def test_set_multiple_attributes_fallback(W):
+    coll = FakeCollection(100, methods=("SetMultipleAttributes",))
+    writer = W(coll)
+    fill(writer, 100)
+    written = writer.flush()
+    check_values(coll, 100)
+    assert written == {"TypeNo": 50, "AddVal1": 1}
+    # Lettura + scrittura dell'intera colonna per attributo
+    assert coll.calls == ["SetMultipleAttributes"] * 4
+    assert writer.method == "SetMultipleAttributes"
+    assert writer.stats == {"bulk_calls": 2, "object_writes": 0}
+
+    # Flush successivo: il metodo riuscito viene provato per primo
+    coll.methods.add("SetMultiAttValues")
+    coll.calls.clear()
+    writer.set(2, "TypeNo", 5)
+    writer.flush()
+    assert coll.calls == ["SetMultipleAttributes"] * 2 and coll.data["TypeNo"][1] == 5
+
+
+def test_chunked_set_att_value_fallback(W):
+    coll = FakeCollection(100, methods=())
+    writer = W(coll, chunk_size=8)
+    fill(writer, 100)
+    written = writer.flush()
+    check_values(coll, 100)
+    assert written == {"TypeNo": 50, "AddVal1": 1}
+    # GetAll una sola volta, poi un SetAttValue per oggetto aggiornato
+    assert coll.calls.count("GetAll") == 1
+    assert coll.calls.count("SetAttValue") == 51
+    assert writer.method is None
+    assert writer.stats == {"bulk_calls": 0, "object_writes": 51}
+
+
+def test_flush_invalidates_snapshot(ns):
+    class Snapshot:
+        invalidated = []
+
+        def invalidate(self, collection=None, attrs=None):
+            self.invalidated.append((collection, attrs))
+
+    ns["_NETWORK_SNAPSHOT"] = snap = Snapshot()
+    try:
+        writer = ns["BulkAttributeWriter"](FakeCollection(10, methods=("SetMultiAttValues",)))
+        writer.set(1, "TypeNo", 3)
+        writer.flush()
+        assert snap.invalidated == [(None, ["TypeNo"])]
+    finally:
+        ns["_NETWORK_SNAPSHOT"] = None
+
+
+def main():
+    ns = load_writer_module()
+    W = ns["BulkAttributeWriter"]
+    tests = [
+        ("SetMultiAttValues", lambda: test_set_multi_att_values(W)),
+        ("fallback SetMultipleAttributes", lambda: test_set_multiple_attributes_fallback(W)),
+        ("fallback SetAttValue a blocchi", lambda: test_chunked_set_att_value_fallback(W)),
+        ("invalidazione snapshot", lambda: test_flush_invalidates_snapshot(ns)),
+    ]
+    failed = 0
+    for name, test in tests:
+        try:
+            test()
+            print("✓ {}".format(name))
+        except AssertionError as e:
+            failed += 1
+            print("✗ {}: {}".format(name, e or "asserzione fallita"))
+    print("\n{} / {} test superati".format(len(tests) - failed, len(tests)))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())